@@ -154,10 +154,12 @@ def do_aperture_photometry(image,
                            ap_size = 1.7,
                            inf_ap_size = 2.5,
                            r_in_size = 1.9,
-                           r_out_size = 2.2):
+                           r_out_size = 2.2,
+                           cog = None):
     '''
 
     Perform aperture photometry using two aperture sizes on a series of targets.
+    Both aperture sizes are measured from the curve of growth of each source.
     
     :param image: 2D image containing sources to be measured using aperture photometry
     :type image: 2D array
@@ -173,6 +175,8 @@ def do_aperture_photometry(image,
     :type r_in_size: float, optional
     :param r_out_size: Multiple of FWHM to be used as outer radius of background annulus, defaults to 2.2
     :type r_out_size: float, optional
+    :param cog: Curve of growth of the sources in *dataframe*. If None, it is found from *image*, defaults to None
+    :type cog: curve_of_growth, optional
     :return: Returns a dataframe containing original :math:`\mathit{x\_pix}` and :math:`\mathit{y\_pix}` columns as well as columns  :math:`\mathit{counts\_inf\_ap}`  and :math:`\mathit{counts\_ap}` containing counts under the apertures given by :math:`\mathit{ap\_size}` and :math:`\mathit{inf\_ap\_size}`
     :rtype: Dataframe
 
@@ -184,39 +188,27 @@ def do_aperture_photometry(image,
     import os
     import logging
 
-    from autophot.packages.aperture import measure_aperture_photometry
+    from autophot.packages.curve_of_growth import curve_of_growth
     
     logger = logging.getLogger(__name__)
 
 
     try:
 
-        ap_dict = {}
-        ap_dict['inf_ap'] = inf_ap_size * fwhm
-        ap_dict['ap']     = ap_size * fwhm
+        if cog is None:
+            cog = curve_of_growth(image,
+                                  np.array(dataframe['x_pix']),
+                                  np.array(dataframe['y_pix']),
+                                  r_max = (max(ap_size,inf_ap_size) + r_out_size) * fwhm)
 
-        positions  = list(zip(np.array(dataframe['x_pix']),np.array(dataframe['y_pix'])))
+        # Measure both aperture sizes from the same curve of growth
+        counts_ap,counts_inf_ap,_ = cog.aperture_correction(ap_size = ap_size * fwhm,
+                                                            inf_ap_size = inf_ap_size * fwhm,
+                                                            r_in_size = r_in_size * fwhm,
+                                                            r_out_size = r_out_size * fwhm)
 
-        for key,val in ap_dict.items():
-
-            try:
-
-                aperture_counts,aperture_counts_error,_,_,_ = measure_aperture_photometry(positions,
-                                                                                          image,
-                                                                                          ap_size = val,
-                                                                                          r_in = val + r_in_size   * fwhm,
-                                                                                          r_out = val + r_out_size * fwhm)
-                                                                           
-
-                dataframe['counts_'+str(key)] = aperture_counts
-
-            except Exception as e:
-
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                logger.info(exc_type, fname, exc_tb.tb_lineno,e)
-
-                break
+        dataframe['counts_inf_ap'] = counts_inf_ap
+        dataframe['counts_ap'] = counts_ap
  
     except Exception as e:
 
@@ -230,6 +222,237 @@ def do_aperture_photometry(image,
 # =============================================================================
 # Measure Aperture photometry
 # =============================================================================
+def stack_aperture_photometry(positions,
+                              image,
+                              ap_sizes,
+                              r_in,
+                              r_out,
+                              gain = 1,
+                              sigma = 3):
+    '''
+    Aperture photometry of many sources using several aperture sizes at once.
+    The pixels around each source are extracted once into a stack of cutouts,
+    and the counts (and maximum pixel value) within every aperture size are
+    found for all sources at once, rather than placing each aperture
+    separately. Pixels are weighted by the exact area which overlaps the
+    aperture, matching the *exact* method in photutils, and the background
+    is removed using the same area.
+
+    The background level under each aperture is the sigma clipped median of the
+    background annulus, found for all sources at once. If each aperture size
+    has its own annulus, *r_in* and *r_out* can be given as lists with the same
+    length as *ap_sizes*. The error on the counts is found using
+    *compute_phot_error*, with the Poisson noise of the source given by the
+    background subtracted counts.
+
+    :param positions: List of tuples containing x,y positions. For example:  :math:`positions = [(1,2),(3,4)]`
+    :type positions: List of Tuples
+    :param image: 2D image containing sources which we want to measure with aperture photometry
+    :type image: 2D array
+    :param ap_sizes: List of aperture radii in pixels
+    :type ap_sizes: list
+    :param r_in: Inner radius of background annulus in pixels, or a list of inner radii for each aperture size
+    :type r_in: float or list
+    :param r_out: Outer radius of background annulus in pixels, or a list of outer radii for each aperture size
+    :type r_out: float or list
+    :param gain: Gain of observation in :math:`e^{-}\ per\ ADU`, defaults to 1
+    :type gain: float, optional
+    :param sigma: Number of standard deviations used when sigma clipping the background annulus, defaults to 3
+    :type sigma: float, optional
+    :return: Returns arrays with shape (N sources, N aperture sizes) of the aperture sum, the error on the aperture sum, the max_pixel found within the aperture, the median value of the background and the standard deviation of the background.
+    :rtype: list
+
+    '''
+
+    import numpy as np
+
+    from autophot.packages.centroid import extract_cutouts
+
+    positions = np.asarray(list(positions),dtype = float).reshape(-1,2)
+
+    x = positions[:,0]
+    y = positions[:,1]
+
+    ap_sizes = np.atleast_1d(np.asarray(ap_sizes,dtype = float))
+
+    scale = int(np.ceil(max(np.nanmax(ap_sizes),np.nanmax(r_out)))) + 1
+
+    stack, _ = extract_cutouts(image,x,y,scale,partial = True)
+
+    # Position of each source within its cutout
+    x_cutout = x - (x - scale).astype(int)
+    y_cutout = y - (y - scale).astype(int)
+
+    return cutout_aperture_photometry(stack,
+                                      x_cutout,
+                                      y_cutout,
+                                      ap_sizes = ap_sizes,
+                                      r_in = r_in,
+                                      r_out = r_out,
+                                      gain = gain,
+                                      sigma = sigma)
+
+
+def cutout_aperture_photometry(stack,
+                               x,
+                               y,
+                               ap_sizes,
+                               r_in,
+                               r_out,
+                               gain = 1,
+                               sigma = 3,
+                               bkg_median = None,
+                               bkg_std = None):
+    '''
+    Aperture photometry on a stack of cutouts, see *stack_aperture_photometry*.
+    This is useful when the same location is measured many times with
+    different sources added to it, e.g. when injecting artificial sources, as
+    the cutouts can be built directly without adding each source to the full
+    image. If the background of each cutout is already known, it can be given
+    with *bkg_median* and *bkg_std* and the background annulus is not measured.
+
+    :param stack: Stack of cutouts with shape (N, height, width)
+    :type stack: 3D array
+    :param x: X pixel location of the source in each cutout
+    :type x: array
+    :param y: Y pixel location of the source in each cutout
+    :type y: array
+    :param ap_sizes: List of aperture radii in pixels
+    :type ap_sizes: list
+    :param r_in: Inner radius of background annulus in pixels, or a list of inner radii for each aperture size
+    :type r_in: float or list
+    :param r_out: Outer radius of background annulus in pixels, or a list of outer radii for each aperture size
+    :type r_out: float or list
+    :param gain: Gain of observation in :math:`e^{-}\ per\ ADU`, defaults to 1
+    :type gain: float, optional
+    :param sigma: Number of standard deviations used when sigma clipping the background annulus, defaults to 3
+    :type sigma: float, optional
+    :param bkg_median: Median background of each cutout, with shape (N) or (N, N aperture sizes), defaults to None
+    :type bkg_median: array, optional
+    :param bkg_std: Standard deviation of the background of each cutout, with shape (N) or (N, N aperture sizes), defaults to None
+    :type bkg_std: array, optional
+    :return: Returns arrays with shape (N sources, N aperture sizes) of the aperture sum, the error on the aperture sum, the max_pixel found within the aperture, the median value of the background and the standard deviation of the background.
+    :rtype: list
+
+    '''
+
+    import numpy as np
+
+    from autophot.packages.centroid import stack_sigma_clipped_stats
+    from autophot.packages.curve_of_growth import pixel_overlap
+
+    x = np.atleast_1d(np.asarray(x,dtype = float))
+    y = np.atleast_1d(np.asarray(y,dtype = float))
+
+    ap_sizes = np.atleast_1d(np.asarray(ap_sizes,dtype = float))
+
+    r_in = np.broadcast_to(np.asarray(r_in,dtype = float),ap_sizes.shape)
+    r_out = np.broadcast_to(np.asarray(r_out,dtype = float),ap_sizes.shape)
+
+    n_sources = len(stack)
+    n_sizes = len(ap_sizes)
+
+    # Distance from the source position to the center of each pixel
+    dx = np.arange(stack.shape[2])[None,:] - x[:,None]
+    dy = np.arange(stack.shape[1])[None,:] - y[:,None]
+
+    distance = np.sqrt(dy[:,:,None]**2 + dx[:,None,:]**2).reshape(n_sources,-1)
+
+    values = stack.reshape(n_sources,-1)
+
+    # =============================================================================
+    # Background annulus
+    # =============================================================================
+
+    if bkg_median is not None and bkg_std is not None:
+
+        bkg_median = np.asarray(bkg_median,dtype = float).reshape(n_sources,-1) * np.ones((1,n_sizes))
+        bkg_std = np.asarray(bkg_std,dtype = float).reshape(n_sources,-1) * np.ones((1,n_sizes))
+
+        annuli = []
+
+    else:
+
+        bkg_median = np.full((n_sources,n_sizes),np.nan)
+        bkg_std = np.full((n_sources,n_sizes),np.nan)
+
+        annuli = set(zip(r_in,r_out))
+
+    for annulus in annuli:
+
+        idx = (r_in == annulus[0]) & (r_out == annulus[1])
+
+        annulus_mask = (distance >= annulus[0]) & (distance < annulus[1])
+
+        annulus_values = np.where(annulus_mask,values,np.nan)
+
+        _, median_sigclip, std_sigclip = stack_sigma_clipped_stats(annulus_values,
+                                                                   sigma = sigma,
+                                                                   maxiters = 5)
+
+        bkg_median[:,idx] = median_sigclip[:,None]
+        bkg_std[:,idx] = std_sigclip[:,None]
+
+    # =============================================================================
+    # Counts under each aperture
+    # =============================================================================
+
+    finite = np.isfinite(values)
+
+    values = np.where(finite,values,0)
+
+    aperture_sum = np.full((n_sources,n_sizes),np.nan)
+    max_pixel = np.full((n_sources,n_sizes),np.nan)
+
+    # Area of each aperture covered by finite pixels
+    area = np.zeros((n_sources,n_sizes))
+
+    dx_pixels = np.broadcast_to(dx[:,None,:],stack.shape).reshape(n_sources,-1)
+    dy_pixels = np.broadcast_to(dy[:,:,None],stack.shape).reshape(n_sources,-1)
+
+    # Pixels further than this from the edge of the aperture are fully inside or outside it
+    half_diagonal = np.sqrt(2)/2
+
+    for i,r in enumerate(ap_sizes):
+
+        weights = (distance <= r - half_diagonal).astype(float)
+
+        # Pixels on the edge are weighted by the exact area which overlaps the aperture
+        edge = np.abs(distance - r) < half_diagonal
+        weights[edge] = pixel_overlap(dx_pixels[edge],dy_pixels[edge],r)
+
+        weights[~finite] = 0
+
+        area[:,i] = np.sum(weights,axis = 1)
+
+        aperture_sum[:,i] = np.sum(weights * values,axis = 1)
+
+        # Max value within aperture
+        max_pixel[:,i] = np.max(np.where(weights > 0,values,-np.inf),axis = 1)
+
+    empty = area == 0
+
+    aperture_sum[empty] = np.nan
+    max_pixel[empty] = np.nan
+
+    max_pixel = max_pixel - bkg_median
+
+    # Area of background annulus
+    area_sky_annulus = np.pi * r_out[None,:] ** 2 - np.pi * r_in[None,:] ** 2
+
+    aperture_sum = aperture_sum - bkg_median * area
+
+    aperture_sum[aperture_sum <= 0] = 0
+
+    aperture_sum_error = compute_phot_error(flux_variance = aperture_sum,
+                                            sky_std = bkg_std,
+                                            sky_annulus_area = area_sky_annulus,
+                                            ap_area = area,
+                                            gain = gain)
+
+    return aperture_sum, aperture_sum_error, max_pixel, bkg_median, bkg_std
+
+
 def measure_aperture_photometry(positions,
                                 image,
                                 gain = 1, 
@@ -249,6 +472,8 @@ def measure_aperture_photometry(positions,
 
     where :math:`F_{ap}` is the flux under an aperture, :math:`T_{exp}` is the exposure time of the observations in seconds. :math:`\sum_{ap}(counts)` defines the counts summed up under an aperture, :math:`\\langle counts_{sky} \\rangle` is the average background level assumed to be under the aperture (and the flux we want to measure) and n is the number of pixels in the aperture (:math:`n=\pi r_{ap} ^2`, where :math:`r_{ap}` is the radius of the aperture.)
 
+    The photometry is performed using *stack_aperture_photometry*.
+
     :param positions: List of tuples containing x,y positions. For example:  :math:`positions = [(1,2),(3,4)]`
     :type positions: List of Tuples
     :param image: 2D image containing sources which we want to measure with aperture photometry
@@ -259,12 +484,10 @@ def measure_aperture_photometry(positions,
     :type bkg_level: float, optional
     :param ap_size: Size of aperture to be used as standard aperture size, defaults to 1.7
     :type ap_size: float, optional
-    :param inf_ap_size:  Size of aperture to be used as larger, :math:`\mathit{infinite}` aperture size, defaults to 2.5
-    :type inf_ap_size: float, optional
-    :param r_in_size:  Size of aperture to be used as inner radius of background annulus, defaults to 1.9
-    :type r_in_size: float, optional
-    :param r_out_size:  Size of aperture to be used as outer radius of background annulus, defaults to 2.2
-    :type r_out_size: float, optional
+    :param r_in: Size of aperture to be used as inner radius of background annulus, defaults to 1.9
+    :type r_in: float, optional
+    :param r_out: Size of aperture to be used as outer radius of background annulus, defaults to 2.2
+    :type r_out: float, optional
     :return: Returns the aperture sum, the error on the aperture sum, the max_pixel found within the aperture, the median value of the background and the standard deviation of the background.
     :rtype: list
     
@@ -274,11 +497,6 @@ def measure_aperture_photometry(positions,
 
     try:
 
-        from astropy.stats import sigma_clipped_stats
-        from photutils import aperture_photometry
-        from photutils import CircularAperture, CircularAnnulus
-        import numpy as np
-        from photutils.datasets import make_noise_image
         import os,sys
 
         if r_in == None or r_out == None:
@@ -287,117 +505,18 @@ def measure_aperture_photometry(positions,
             r_in = 10
             r_out = 20
 
-        if not isinstance(positions,list):
-            positions = list(positions)
-        
-        # List of aperture for use on the image
-        apertures = CircularAperture(positions, r=ap_size)
-        
-        # Area of aperture
-        area = np.pi * ap_size ** 2
-        
-        # Create annulus to get background value with inner/outer radii
-        annulus_apertures = CircularAnnulus(positions, r_in=r_in, r_out=r_out)
-        
-        # create masks
-        annulus_masks = annulus_apertures.to_mask(method='center')
-        aperture_masks = apertures.to_mask(method='center')
-        
         # Warning for development - shouldn't pop up
         if r_out >= image.shape[0] or r_out > image.shape[1]:
             print('Error - Apphot - Annulus size greater than image size')
 
-        # list of bkg median for each aperture/source
-        bkg_median = []
-        bkg_std = []
-        max_pixel = [] 
-        
-        area_sky_annulus = np.pi*(r_out)**2 - np.pi*(r_in)**2
-        
-        # data_possion_ready = data
-        
-        if np.any(image < 0):
-            
-            error_array = None
-            
-        else:
-        
-            possion_noise = make_noise_image(image.shape,
-                                            distribution = 'poisson',
-                                            mean = image)
-      
-            error_array = possion_noise
-            
-        if not isinstance(annulus_masks,list):
-            annulus_masks = list(annulus_masks)
-            
-        if not isinstance(aperture_masks,list):
-            aperture_masks = list(aperture_masks)
-
-        # get background for each source
-        for annulus_mask,aperture_mask in zip(annulus_masks,aperture_masks):
-            
-            median_sigclip = np.nan
-            std_sigclip = np.nan
-            max_pixel_value = np.nan
-            
-            annulus_data = annulus_mask.multiply(image)
-            annulus_data_1d = annulus_data[annulus_mask.data > 0]
-            annulus_data_1d_nonan = annulus_data_1d[~np.isnan(annulus_data_1d)]
-            
-            aperture_data = aperture_mask.multiply(image)
-            aperture_data_1d = aperture_data[aperture_mask.data > 0]
-            aperture_data_1d_nonan = aperture_data_1d[~np.isnan(aperture_data_1d)]
-
-            mean_sigclip, median_sigclip, std_sigclip = sigma_clipped_stats(annulus_data_1d_nonan,
-                                                                            cenfunc = np.nanmedian,
-                                                                            stdfunc = np.nanstd,
-                                                                            sigma= 3)
-            
-            # std_sigclip = np.nanstd(annulus_data_1d_nonan)
-            max_pixel_value = np.nanmax(aperture_data_1d_nonan) - median_sigclip
-     
-            bkg_median.append(median_sigclip)
-            bkg_std.append(std_sigclip)
-            max_pixel.append(max_pixel_value)
-
-        # Background median and standard deviation of annulus
-        bkg_median = np.array(bkg_median)
-        bkg_std = np.array(bkg_std)
-        
-        # Max value within aperture
-        max_pixel = np.array(max_pixel) 
-        
-        # perform aperure photometry on image using list of apertures
-        phot = aperture_photometry(image, apertures, error = error_array)
-        phot = phot.to_pandas()
-       
-
-        phot['annulus_median'] = bkg_median
-        phot['annulus_std'] = bkg_std
-        phot['aperture_bkg'] = bkg_median * area
-
-        phot['aperture_sum_bkgsub'] = phot['aperture_sum'] - phot['aperture_bkg']
-        
-        phot.at[phot['aperture_sum_bkgsub']<=0,'aperture_sum_bkgsub'] = 0 
-        
-        aperture_sum = phot['aperture_sum_bkgsub'].values
-        
-        if error_array is None:
-            aperture_sum_error = compute_phot_error(flux_variance = aperture_sum,
-                                                    sky_std = bkg_std,
-                                                    sky_annulus_area=area_sky_annulus,
-                                                    ap_area=area,
-                                                    gain=gain)
-            
-        else:
-            aperture_sum_error = compute_phot_error(flux_variance = phot['aperture_sum_err'].values**2,
-                                                    sky_std = bkg_std,
-                                                    sky_annulus_area=area_sky_annulus,
-                                                    ap_area=area,
-                                                    gain=gain)
-       
+        output = stack_aperture_photometry(positions,
+                                           image,
+                                           ap_sizes = [ap_size],
+                                           r_in = r_in,
+                                           r_out = r_out,
+                                           gain = gain)
 
+        aperture_sum, aperture_sum_error, max_pixel, bkg_median, bkg_std = [i[:,0] for i in output]
 
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -630,7 +749,8 @@ def find_optimum_aperture_size(dataframe,
                                r_in_size = 1.9,
                                r_out_size = 2.2,
                                GAIN = 1, 
-                               RDNOISE = 0):
+                               RDNOISE = 0,
+                               cog = None):
     '''
 
       Find the optimum aperture radius for a given image. Although the
@@ -679,6 +799,8 @@ def find_optimum_aperture_size(dataframe,
     :type GAIN: float, optional
     :param RDNOISE: Read Noise of image  of image in :math:`e^{-}$ per pixel`, defaults to 0
     :type RDNOISE: float, optional
+    :param cog: Curve of growth of the sources in *dataframe*. If None, it is found from *image*, defaults to None
+    :type cog: curve_of_growth, optional
     :return: Gives the optim radius in units of FWHM.
     :rtype: Float
     '''
@@ -688,7 +810,8 @@ def find_optimum_aperture_size(dataframe,
     import os
 
     
-    from autophot.packages.functions import SNR,SNR_err
+    from autophot.packages.functions import SNR_err
+    from autophot.packages.curve_of_growth import curve_of_growth
     import matplotlib.pyplot as plt
     from autophot.packages.functions import set_size
     
@@ -701,41 +824,38 @@ def find_optimum_aperture_size(dataframe,
     search_size = np.arange(0.1,5,step_size)
     
     if 'include_fwhm' in dataframe.columns:
-        idx = dataframe['include_fwhm']
+        idx = np.array(dataframe['include_fwhm'],dtype = bool)
     else:
-        idx = [True] *len(dataframe) 
+        idx = np.array([True] *len(dataframe))
+
+    # Position of selected sources in dataframe
+    selected = np.where(idx)[0][:25]
 
-    dataframe = dataframe[idx].head(25)
+    dataframe = dataframe.iloc[selected]
     
     positions  = list(zip(np.array(dataframe.x_pix),np.array(dataframe.y_pix)))
+
+    if cog is None:
+        cog = curve_of_growth(image,
+                              np.array(dataframe.x_pix),
+                              np.array(dataframe.y_pix),
+                              r_max = max(search_size[-1],r_out_size) * fwhm)
+    else:
+        cog = cog.select(selected)
     
     output = []
+
+    # SNR from ccd equation for every aperture size, using the same curve of growth
+    SNR_all = cog.snr(radii = search_size * fwhm,
+                      r_in = r_in_size  * fwhm,
+                      r_out = r_out_size * fwhm,
+                      exp_time = exp_time,
+                      gain = GAIN,
+                      rdnoise = RDNOISE)
         
-    for s in search_size:
-
-        s_in = r_in_size
-        s_out = r_out_size
-    
-        aperture_counts,aperture_counts_error ,_, aperture_bkg_counts,_ = measure_aperture_photometry(positions,
-                                                                                        image,
-                                                                                        ap_size =  s     * fwhm,
-                                                                                        r_in =    s_in  * fwhm,
-                                                                                        r_out =   s_out * fwhm)
-        # Background flux from annulus
-        aperture_bkg_flux = aperture_bkg_counts/exp_time
-    
-        # Source flux
-        aperture_flux = aperture_counts/exp_time
-
-    
-        # SNR from ccd equation
-        SNR_val = SNR(flux_star = aperture_flux ,
-                      flux_sky = aperture_bkg_flux ,
-                      exp_t = exp_time,
-                      radius = s * fwhm,
-                      G  = GAIN,
-                      RN = RDNOISE,
-                      DC = 0 )
+    for i,s in enumerate(search_size):
+
+        SNR_val = SNR_all[:,i]
         
         SNR_val_err = SNR_err(SNR_val)
         
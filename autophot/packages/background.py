@@ -1,7 +1,7 @@
 def remove_background(image,fwhm = 7, xc=None, yc=None,
                       remove_bkg_local = True, remove_bkg_surface = False,
                       remove_bkg_poly  = False, remove_bkg_poly_degree = 1,
-                      bkg_level = 3
+                      bkg_level = 3, frame_bkg = None, origin = None
                       ):
     '''
     
@@ -71,6 +71,10 @@ def remove_background(image,fwhm = 7, xc=None, yc=None,
     :type remove_bkg_poly_degree: TYPE, optional
     :param bkg_level: The number of standard deviations, below which is assumed to be due to the background noise distribution, defaults to 3
     :type bkg_level: float, optional
+    :param frame_bkg: Background mesh of the full image which *image* was cut from. If given and *remove_bkg_surface* or *remove_bkg_poly* is True, the background surface is interpolated from this mesh rather than fitted to the cutout, defaults to None
+    :type frame_bkg: background_mesh, optional
+    :param origin: X and Y pixel location in the full image of the lower left pixel of *image*, defaults to None in which case it is taken to be (0,0)
+    :type origin: tuple, optional
     :return: Return the original image with the pre-selected background removed, the fitted background itself, the median value of this background at the position of the target (performed using crude aperture photometry) and the noise of this background surface (taken as the standard deviation)
     :rtype: Tuple
     
@@ -109,7 +113,17 @@ def remove_background(image,fwhm = 7, xc=None, yc=None,
         masks = aperture.to_mask(method='center')
         mask_array = masks.to_image(shape=image.shape).astype(bool)
      
-        if remove_bkg_surface:
+        if frame_bkg is not None and (remove_bkg_surface or (remove_bkg_poly and not remove_bkg_local)):
+            
+            # Surface taken from the background mesh of the full image
+            if origin is None:
+                origin = (0,0)
+                
+            surface = frame_bkg.surface(origin[0],origin[1],image.shape)
+            
+            image_background_free = image - surface
+            
+        elif remove_bkg_surface:
             
             # Fit surface background
             background = Background2D(image,
@@ -189,4 +203,148 @@ def remove_background(image,fwhm = 7, xc=None, yc=None,
         
         print('Could not fit background: %s' % e)
         
-        return np.nan, np.nan, np.nan, np.nan
\ No newline at end of file
+        return np.nan, np.nan, np.nan, np.nan
+
+
+class background_mesh(object):
+    '''
+    Low resolution background map of a full image, measured once and used to
+    find the background of any cutout from that image. The image is split into
+    boxes a few times larger than the FWHM and the (sigma-clipped) background of
+    each box is found using `Background2D
+    <https://photutils.readthedocs.io/en/stable/api/photutils.background.Background2D.html>`_.
+    The background of a cutout is then found by interpolating between the
+    centers of these boxes, rather than fitting a new surface to every cutout.
+    '''
+
+    def __init__(self,image,fwhm = 7,box_size = 5,bkg_level = 3):
+        '''
+        :param image: 2D image
+        :type image: 2D array
+        :param fwhm: Full Width Half Maximum (FWHM) of the image, defaults to 7
+        :type fwhm: float, optional
+        :param box_size: Size of each box in the background map, in units of FWHM, defaults to 5
+        :type box_size: float, optional
+        :param bkg_level: The number of standard deviations used when sigma clipping each box, defaults to 3
+        :type bkg_level: float, optional
+
+        '''
+
+        import numpy as np
+
+        from scipy.ndimage import median_filter
+        from astropy.stats import SigmaClip
+        from photutils import Background2D,SExtractorBackground
+
+        image = np.asarray(image,dtype = float)
+
+        self.box = max(int(np.ceil(box_size * fwhm)),3)
+        self.box = min(self.box,*image.shape)
+
+        sigma_clip = SigmaClip(sigma=bkg_level,cenfunc = 'median',stdfunc = 'std')
+
+        # Only whole boxes are used, pixels past the last box are extrapolated
+        ny = (image.shape[0] // self.box) * self.box
+        nx = (image.shape[1] // self.box) * self.box
+
+        background = Background2D(image[:ny,:nx],
+                                  box_size = self.box,
+                                  mask = ~np.isfinite(image[:ny,:nx]),
+                                  filter_size = 1,
+                                  sigma_clip = sigma_clip,
+                                  bkg_estimator = SExtractorBackground(sigma_clip=sigma_clip))
+
+        # Extra box on each side, extrapolated linearly from the outer two
+        # boxes, so the surface keeps its slope up to the edge of the image.
+        # The 3x3 median filter is applied to the padded mesh so it doesn't
+        # flatten a gradient at the edges
+        mesh = median_filter(self._pad(np.asarray(background.background_mesh,dtype = float)),size = 3)
+
+        self.mesh = mesh[1:-1,1:-1]
+        self.padded_mesh = self._pad(self.mesh)
+
+        self.shape = image.shape
+
+        # Position of the image within the frame the mesh was measured from
+        self.offset = (0,0)
+
+    def shifted(self,x0,y0):
+        '''
+        Background mesh of a cutout of the image, sharing the same map. Pixel
+        (0,0) of the cutout is pixel (*x0*, *y0*) of the image.
+
+        :param x0: X pixel location of the lower left pixel of the cutout
+        :type x0: int
+        :param y0: Y pixel location of the lower left pixel of the cutout
+        :type y0: int
+        :return: Background mesh of cutout
+        :rtype: background_mesh
+
+        '''
+
+        import copy
+
+        shifted = copy.copy(self)
+
+        shifted.offset = (self.offset[0] + int(x0),self.offset[1] + int(y0))
+
+        return shifted
+
+    @staticmethod
+    def _pad(mesh):
+        '''
+        Pad *mesh* by one box on each side, extrapolating linearly from the
+        two outer boxes. If there is only one box along an axis, the value of
+        that box is used.
+        '''
+
+        import numpy as np
+
+        for axis in [0,1]:
+
+            mesh = np.moveaxis(mesh,axis,0)
+
+            if mesh.shape[0] > 1:
+                first = 2*mesh[0] - mesh[1]
+                last = 2*mesh[-1] - mesh[-2]
+            else:
+                first = last = mesh[0]
+
+            mesh = np.moveaxis(np.concatenate([first[None],mesh,last[None]],axis = 0),0,axis)
+
+        return mesh
+
+    def _interpolate(self,mesh,x0,y0,shape):
+        '''
+        Bilinear interpolation of the padded *mesh* onto the pixels of a
+        cutout. Pixels between the centers of the outer boxes and the edge of
+        the image are extrapolated linearly.
+        '''
+
+        import numpy as np
+        from scipy.ndimage import map_coordinates
+
+        # Box centers in the padded mesh are offset by one box
+        y = (np.arange(shape[0]) + y0 + self.offset[1] + 0.5) / self.box + 0.5
+        x = (np.arange(shape[1]) + x0 + self.offset[0] + 0.5) / self.box + 0.5
+
+        yy, xx = np.meshgrid(y,x,indexing = 'ij')
+
+        return map_coordinates(mesh,[yy,xx],order = 1,mode = 'nearest')
+
+    def surface(self,x0,y0,shape):
+        '''
+        Background surface of a cutout.
+
+        :param x0: X pixel location of the lower left pixel of the cutout
+        :type x0: int
+        :param y0: Y pixel location of the lower left pixel of the cutout
+        :type y0: int
+        :param shape: Shape of the cutout
+        :type shape: tuple
+        :return: Background surface with the same shape as the cutout
+        :rtype: 2D array
+
+        '''
+
+        return self._interpolate(self.padded_mesh,x0,y0,shape)
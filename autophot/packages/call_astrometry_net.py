@@ -39,10 +39,9 @@ def AstrometryNetLOCAL(file,solve_field_exe_loc = None,pixel_scale = None,
 
     
 
-    import subprocess
     import os
     import numpy as np
-    from autophot.packages.functions import getheader,getimage
+    from autophot.packages.functions import getheader,getimage,start_process
     import signal
     import time
     import logging
@@ -154,11 +153,10 @@ def AstrometryNetLOCAL(file,solve_field_exe_loc = None,pixel_scale = None,
         with open(astrometry_log_fpath, 'w') as FNULL:
  
             logger.info('ASTROMETRY started...' )
-            pro = subprocess.Popen(args,
-                                   shell=True,
-                                   stdout=FNULL,
-                                   stderr=FNULL,
-                                   preexec_fn=os.setsid)
+            pro = start_process(args,
+                                shell=True,
+                                stdout=FNULL,
+                                stderr=FNULL)
 
             # Timeout command - will only run command for this long - ~30s works fine
             try:
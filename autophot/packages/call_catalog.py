@@ -78,7 +78,7 @@ def search(headinfo,
     :param radius: Radius in degrees around target location with which to download catalog, defaults to 0.5
     :type radius: float, optional
     :param wdir: DESCRIPTION, defaults to None
-    :type wdir: Location of directory containing catalog queries. If no matching catalog is found, downloaded catalog is saved here under the name given by *target_name*, if a matching catalog is found that catalog is returned rather than downloading a new one.
+    :type wdir: Location of directory containing catalog queries. Catalogs are saved here in a sky-tiled store (see *catalog_store*) and only the parts of the sky not already saved are downloaded, so overlapping searches for any target are returned without downloading a new catalog.
     :param catalog: Name of catalog to search, see keywords above, defaults to 'apass'
     :type catalog: str, optional
     :param target_name: Name of transient. This is used to locate the correct folder in *wdir* to download new catalog to, defaults to None
@@ -95,9 +95,7 @@ def search(headinfo,
 
     import os,sys
     import logging
-    import requests
     import pathlib
-    import shutil
     import os.path
     import warnings
 
@@ -108,11 +106,9 @@ def search(headinfo,
 
     from astropy.table import Table
     from astropy.wcs import wcs
-    from astroquery.vizier import Vizier
-    from astropy.io.votable import parse_single_table
-    from astropy.coordinates import Angle
 
     from autophot.packages.functions import border_msg
+    from autophot.packages.catalog_store import cone_search
 
     logger = logging.getLogger(__name__)
 
@@ -150,19 +146,8 @@ def search(headinfo,
 
 
 
-        # Search limitation with Pan Starrs rlimited to 0.5 deg
-        if radius > 0.5 and catalog == 'pan_starrs' :
-            logger.warning('Search Limitation with PanStarrs API -> Radius = 0.5 [deg] ')
-            radius = 0.5
-
-        # Choosen catalog for input.yml, create directory for catalog if needed
-        pathlib.Path(os.path.join(dirname ,catalog)).mkdir(parents = True, exist_ok=True)
-
-        # Folder for target, create directory if needed
+        # Filename of catalog previously fetched for this target
         target_dir =   reduce(os.path.join,[dirname,catalog,target_name.lower()])
-        pathlib.Path(target_dir).mkdir(parents = True, exist_ok=True)
-
-        # Filename of fetched catalog for this target
         fname = str(target_name) + '_r_' + str(radius)
 
         #  If catalog set to cutsom
@@ -180,90 +165,24 @@ def search(headinfo,
             chosen_catalog = pd.read_csv(fname)
             # return chosen_catalog
 
-        # if catalog is found via it's filename - use this and return chosen_catalog
+        # if catalog is found via it's filename from an older version - use this and return chosen_catalog
         elif os.path.isfile(os.path.join(target_dir,fname+'.csv')):
             logger.info('Catalog found for %s\nCatalog: %s \nFile: %s' % (target_name,str(catalog).upper(),fname))
             chosen_catalog = Table.read(os.path.join(target_dir,fname+'.csv'),format = 'csv')
             chosen_catalog = chosen_catalog.to_pandas().fillna(np.nan)
 
         else:
-            # If no previously catalog found - look for one
-            logger.info('Searching for new catalog [%s] for %s ' % ( catalog, target_name))
-
-            if catalog in ['gaia']:
-                # TODO is this needed?
-
-                import astropy.units as u
-                from astroquery.gaia import Gaia
-
-                warnings.filterwarnings('ignore')
-
-                width = u.Quantity(radius, u.deg)
-                height = u.Quantity(radius, u.deg)
-
-                chosen_catalog = Gaia.query_object_async(coordinate=target_coords, width=width, height=height)
-
-                chosen_catalog = chosen_catalog.to_pandas()
-                chosen_catalog.to_csv(fname+'.csv', sep=',',index = False)
-
-
-            if catalog in ['apass','2mass','sdss']:
-
-                # No row limit
-                Vizier.ROW_LIMIT = -1
-                catalog_search = Vizier.query_region(target_coords,
-                                                     radius = Angle(radius,'deg'),
-                                                     catalog = catalog)
-
-                # Select first catalog from list
-                chosen_catalog = catalog_search[0].to_pandas()
-
-                # Clean the chosen_catalog from sdss
-                # TODO: make sure mode 2 is correct
-                if catalog == 'sdss':
-                    chosen_catalog = chosen_catalog[chosen_catalog['mode']== 2]
-
-            # some catalogs need specific download path using 'requests'
-            if catalog in ['pan_starrs','skymapper']:
-
-                mindet=1
-
-                if catalog == 'pan_starrs':
-
-                    server=('https://archive.stsci.edu/'+'panstarrs/search.php')
-                    params = {'RA': target_coords.ra.degree, 'DEC': target_coords.dec.degree,
-                              'SR': radius, 'max_records': 10000,
-                              'outputformat': 'VOTable',
-                              'ndetections': ('>%d' % mindet)}
-
-                if catalog == 'skymapper':
-
-                    server=('http://skymapper.anu.edu.au/sm-cone/public/query?')
-                    params = {'RA': target_coords.ra.degree, 'DEC': target_coords.dec.degree,
-                              'SR': radius,
-                              'RESPONSEFORMAT': 'VOTABLE'}
-
-                with open('temp.xml', "wb") as f:
-
-                    logger.info('Downloading sequence stars from %s'  % catalog )
-                    response = requests.get(server,params = params)
-                    f.write(response.content)
-
-                # Parse local file into astropy.table object
-                chosen_catalog = parse_single_table('temp.xml')
-
-                # Delete temporary file
-                os.remove('temp.xml')
-
-                # Convert table to chosen_catalogframe
-                chosen_catalog_table = chosen_catalog.to_table(use_names_over_ids=True)
-                chosen_catalog = chosen_catalog_table.to_pandas()
-
-                # invalid entries in panstarrs are -999 - change to nans
-                if catalog == 'pan_starrs':
-                    chosen_catalog = chosen_catalog.replace(-999,np.nan)
+            # Use the local sky-tiled store, only downloading tiles that aren't found
+            logger.info('Searching for catalog [%s] for %s ' % ( catalog, target_name))
 
+            # PanSTARRS API only allows a search radius of 0.5 deg - larger searches are split into tiles
+            max_query_radius = 0.5 if catalog == 'pan_starrs' else None
 
+            chosen_catalog = cone_search(wdir,catalog,
+                                         target_ra,target_dec,radius,
+                                         ra_col = catalog_keywords['RA'],
+                                         dec_col = catalog_keywords['DEC'],
+                                         max_query_radius = max_query_radius)
 
             # No sources in field - temporary fix - will add "check different catalog"
             if len(chosen_catalog) == 0:
@@ -272,32 +191,24 @@ def search(headinfo,
 
             # If you have
             if include_IR_sequence_data and catalog != '2mass':
-                Vizier.ROW_LIMIT = -1
-                catalog_search = Vizier.query_region(target_coords,
-                                                     radius = Angle(radius,'deg'),
-                                                     catalog = '2mass')
-
-                # Select first catalog from list
-                chosen_catalog_2mass = catalog_search[0].to_pandas()
-                chosen_catalog_2mass.rename(columns={"Jmag": "J",
+
+                chosen_catalog_2mass = cone_search(wdir,'2mass',
+                                                   target_ra,target_dec,radius,
+                                                   ra_col = 'RAJ2000',
+                                                   dec_col = 'DEJ2000')
+
+                chosen_catalog_2mass = chosen_catalog_2mass.rename(columns={"Jmag": "J",
                                            "e_Jmag": "J_err",
                                            "Hmag": "H",
                                            "e_Hmag": "H_err",
                                            "Kmag": "K",
                                            "e_Kmag": "K_err",
                                            'RAJ2000':catalog_keywords['RA'],
-                                           'DEJ2000':catalog_keywords['DEC']},
-                                  inplace = True)
+                                           'DEJ2000':catalog_keywords['DEC']})
 
                 chosen_catalog = pd.concat([chosen_catalog,chosen_catalog_2mass])
 
-
-            # Save to csv and move to 'catalog_queries'
             chosen_catalog = chosen_catalog.fillna(np.nan)
-            chosen_catalog.to_csv(fname+'.csv',index = False,na_rep = np.nan)
-
-            shutil.move(os.path.join(os.getcwd(), fname+'.csv'),
-                        os.path.join(target_dir,  fname+'.csv'))
 
 
         # Add in x and y pixel locatins under wcs given by file
@@ -398,7 +309,7 @@ def match(image,headinfo,target_coords,catalog_keywords,image_filter,
     :type max_fit_fwhm: float, optional
     :param max_catalog_sources: Maximum number of catalog sources to use, defaults to 300
     :type max_catalog_sources: int, optional
-    :param fitting_method: Selected method to fit model for centroid. Select from list given `here <https://lmfit.github.io/lmfit-py/fitting.html>`_ , defaults to 'least_squares'
+    :param fitting_method: Sources are centroided together using a batched Levenberg-Marquardt fit. If this does not converge for a source, it is refit individually using this method. Select from list given `here <https://lmfit.github.io/lmfit-py/fitting.html>`_ , defaults to 'least_squares'
     :type fitting_method: str, optional
     :param matching_source_FWHM_limit: Excluded sources whose FWHM is greater than this value, defaults to np.inf
     :type matching_source_FWHM_limit: float, optional
@@ -417,39 +328,22 @@ def match(image,headinfo,target_coords,catalog_keywords,image_filter,
 
 
 
-    import lmfit
     import numpy as np
     import pandas as pd
     import logging
     import warnings
 
-    from photutils import DAOStarFinder
-    from astropy.stats import sigma_clipped_stats
-
     from autophot.packages.functions import pix_dist,border_msg
-    from autophot.packages.functions import moffat_2d,moffat_fwhm
-    from autophot.packages.functions import gauss_sigma2fwhm,gauss_2d,gauss_fwhm2sigma
+    from autophot.packages.functions import moffat_fwhm
+    from autophot.packages.functions import gauss_sigma2fwhm,gauss_fwhm2sigma
+    from autophot.packages.centroid import extract_cutouts,stack_sigma_clipped_stats
+    from autophot.packages.centroid import stack_detect,stack_moments,stack_fit,fit_cutout
 
     border_msg('Matching catalog sources to image')
 
 
     logger = logging.getLogger(__name__)
 
-    RA_list = []
-    DEC_list = []
-    x_new_source = []
-    y_new_source = []
-    x_new_cen    = []
-    y_new_cen    = []
-    cp_dist      = []
-    dist2target_list = []
-    cat_idx      = []
-
-    # list for (non) detected sources
-    non_detections = []
-    detections     = []
-    fwhm_list = []
-
     # Add all available filter information, not just the image filter
     image_filtermagnitude = {}
     image_filtermagnitude_err = {}
@@ -509,15 +403,6 @@ def match(image,headinfo,target_coords,catalog_keywords,image_filter,
                             inplace = True,
                             na_position='last')
 
-    # Grid of close-up mathcing scale of image
-    x = np.arange(0,2*scale)
-    xx,yy= np.meshgrid(x,x)
-
-    k = 0
-
-    dx = scale-1
-    dy = scale-1
-
     if use_local_stars:
 
         too_far_dist = pix_dist(chosen_catalog.x_pix,target_x_pix,chosen_catalog.y_pix,target_y_pix)
@@ -555,332 +440,235 @@ def match(image,headinfo,target_coords,catalog_keywords,image_filter,
 
         logging.info('Using Moffat Profile for fitting')
 
-        # fitting_model = moffat_2d
         fitting_model_fwhm = moffat_fwhm
 
     else:
 
         logging.info('Using Gaussian Profile for fitting')
 
-        # fitting_model = gauss_2d
         fitting_model_fwhm = gauss_sigma2fwhm
 
-    useable_sources = 0
-    # offimage_source = 0
-    not_detected = 0
-    saturated_source = 0
-    broken_cutout = 0
-    broken = 0
-    too_far = 0
-
     logging.info('Catalog Length: %d' % len(chosen_catalog))
 
     if plot_catalog_nondetections:
         logging.info('\nIncluding non detections in catalog analysis')
 
-
     try:
 
-        for i in range(len(chosen_catalog.index.values)):
-
-
-            if useable_sources >= max_catalog_sources:
-                break
-
-            idx = np.array(chosen_catalog.index.values)[i]
-
-            message = '\rMatching catalog to image: %d / %d :: Useful sources %d / %d '% (float(i)+1,
-                                                                                        len(chosen_catalog.index),
-                                                                                        useable_sources+1,
-                                                                                       len(chosen_catalog.index))
-
-            print(message,end = '')
-
-            # catalog pixel coordinates of source take as an approximate location
-            x = chosen_catalog.x_pix[idx]
-            y = chosen_catalog.y_pix[idx]
-
-            RA_list.append(chosen_catalog[catalog_keywords['RA']][idx])
-            DEC_list.append(chosen_catalog[catalog_keywords['DEC']][idx])
-
-            x_new_source.append(x)
-            y_new_source.append(y)
-
-            image_filtermagnitude[image_filter].append(chosen_catalog[catalog_keywords[image_filter]][idx])
-            image_filtermagnitude_err[image_filter+'_err'].append(chosen_catalog[catalog_keywords[image_filter+'_err']][idx])
-
-            for key,val in default_dmag.items():
-
-                if key != image_filter:
-                    try:
-                        # print(chosen_catalog[catalog_keywords[key]][idx])
-                        image_filtermagnitude[key].append(chosen_catalog[catalog_keywords[key]][idx])
-                        image_filtermagnitude_err[key+'_err'].append(chosen_catalog[catalog_keywords[key+'_err']][idx])
-
-                        # print(image_filtermagnitude[key])
-                    except:
-
-                        image_filtermagnitude[key].append(np.nan)
-                        image_filtermagnitude_err[key+'_err'].append(np.nan)
-                        pass
-
-            # Add index key for original catalog file comparision and matching
-            cat_idx.append(int(idx))
-
-            try:
-
-
-                 # Create cutout image of size (2*scale,2*scale)
-                 close_up = image[int(y-scale): int(y + scale),
-                                  int(x-scale): int(x + scale)]
-
-
-                 # Cutout not possible - too close to edge or invalue pixel chosen_catalog i.e. nans of infs
-                 if close_up.shape != (2*scale,2*scale):
-
-                     x_new_cen.append(np.nan)
-                     y_new_cen.append(np.nan)
-                     cp_dist.append(np.nan)
-                     dist2target_list.append(np.nan)
-                     fwhm_list.append(np.nan)
-
-                     broken_cutout +=1
-
-                     continue
-
-                 # Preset pixel error popup skip this source
-                 if np.nanmax(close_up) >= sat_lvl or np.isnan(np.min(close_up)):
-
-                     x_new_cen.append(np.nan)
-                     y_new_cen.append(np.nan)
-                     cp_dist.append(np.nan)
-                     dist2target_list.append(np.nan)
-                     fwhm_list.append(np.nan)
-
-                     saturated_source +=1
-
-                     continue
-
-                 # Get close up image properties
-                 mean, median, std = sigma_clipped_stats(close_up,
-                                                         sigma = bkg_level,
-                                                         maxiters = 10)
-
-                 try:
-
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("ignore")
-                        daofind = DAOStarFinder(fwhm      = fwhm,
-                                                threshold = bkg_level*std,
-                                                sharplo   =  0.2,sharphi = 1.0,
-                                                roundlo   = -1.0,roundhi = 1.0
-                                                )
-
-                        sources = daofind(close_up - median)
-
-                    # If no source is found - skip
-                    if sources is None:
-                        sources = []
-
-                    else:
-                        sources = sources.to_pandas()
-
-
-
-                 except Exception as e:
-
-
-                     x_new_cen.append(np.nan)
-                     y_new_cen.append(np.nan)
-                     cp_dist.append(np.nan)
-                     dist2target_list.append(np.nan)
-                     fwhm_list.append(np.nan)
-
-                     logger.exception(e)
-
-                     broken+=1
-
-                     continue
-
-                 if len(sources) == 0 and not plot_catalog_nondetections:
-
-                     not_detected+=1
-
-                     non_detections.append(chosen_catalog[catalog_keywords[image_filter]].loc[[idx]].values[0])
-
-                     x_new_cen.append(np.nan)
-                     y_new_cen.append(np.nan)
-                     cp_dist.append(np.nan)
-                     dist2target_list.append(np.nan)
-                     fwhm_list.append(np.nan)
-
-                     continue
-
-                 if len(sources) == 0:
-
-                     xc_guess = close_up.shape[1]/2
-                     yc_guess = close_up.shape[0]/2
-
-
-
-                 # If more than one source detected in close up
-                 # assume source closest to center is desired source
-                 elif len(sources) > 1:
+        # =============================================================================
+        # Batched centroiding - all cutouts are extracted into a single stack and
+        # fitted together. Sources are checked in batches (brightest first) until
+        # enough useable sources are found
+        # =============================================================================
 
+        n_catalog = len(chosen_catalog)
 
-                   r_vals = pix_dist(scale,np.array(sources['xcentroid']),
-                                     scale,np.array(sources['ycentroid']))
+        x_cat = chosen_catalog.x_pix.values.astype(float)
+        y_cat = chosen_catalog.y_pix.values.astype(float)
 
-                   r_idx = np.argmin(r_vals)
+        x_new_cen = np.full(n_catalog,np.nan)
+        y_new_cen = np.full(n_catalog,np.nan)
+        cp_dist = np.full(n_catalog,np.nan)
+        fwhm_list = np.full(n_catalog,np.nan)
 
-                   xc_guess = np.array(sources['xcentroid'])[r_idx]
-                   yc_guess = np.array(sources['ycentroid'])[r_idx]
+        # Outcome of each source - useable, broken cutout, saturated, not detected or error
+        status = np.full(n_catalog,'',dtype = object)
 
-                 else:
+        # Parameter bounds - following A, x0, y0, sky, alpha/sigma, [beta]
+        cutout_size = 2*int(scale)
+        dx = scale-1
+        dy = scale-1
 
-                     # Approximate location of source
-                     xc_guess = np.array(sources['xcentroid'])[0]
-                     yc_guess = np.array(sources['ycentroid'])[0]
+        lower = [1e-6,0.5*cutout_size - dx,0.5*cutout_size - dy,-np.inf]
+        upper = [np.inf,0.5*cutout_size + dx,0.5*cutout_size + dy,np.inf]
 
+        if use_moffat:
+            lower+=[1e-3]
+            upper+=[30]
+            if vary_moff_beta:
+                # Fit beta as the last parameter
+                fit_beta = None
+                lower+=[1e-3]
+                upper+=[np.inf]
+            else:
+                fit_beta = default_moff_beta
+        else:
+            lower+=[1e-3]
+            upper+=[gauss_fwhm2sigma(max_fit_fwhm)]
+            fit_beta = None
 
+        lower = np.array(lower)
+        upper = np.array(upper)
 
-                 pars = lmfit.Parameters()
-                 pars.add('A',value = np.nanmax(close_up),
-                         min = 1e-6)
+        batch_size = int(max(max_catalog_sources,1))
 
-                 pars.add('x0',value = close_up.shape[1]/2,
-                         min = 0.5*close_up.shape[1] - dx,
-                         max = 0.5*close_up.shape[1]+ dx)
+        useable_sources = 0
+        batch_start = 0
 
-                 pars.add('y0',value = close_up.shape[0]/2,
-                         min = 0.5*close_up.shape[0]- dy,
-                         max = 0.5*close_up.shape[0] + dy)
+        while batch_start < n_catalog and useable_sources < max_catalog_sources:
 
-                 pars.add('sky',value = np.nanmedian(close_up))
+            batch = np.arange(batch_start,min(batch_start + batch_size,n_catalog))
+            batch_start = batch[-1] + 1
 
-                 if use_moffat:
+            print('\rMatching catalog to image: %d / %d :: Useful sources %d / %d ' % (batch_start,n_catalog,useable_sources,n_catalog),end = '')
 
-                   pars.add('alpha',
-                            value = 7,
-                            min = 0,
-                            max = 30)
+            stack, on_image = extract_cutouts(image,x_cat[batch],y_cat[batch],scale)
 
-                   pars.add('beta',
-                            value = default_moff_beta,
-                            min = 0,
-                            vary = vary_moff_beta)
+            # Cutout not possible - too close to edge
+            status[batch[~on_image]] = 'broken_cutout'
 
-                 else:
+            # Saturated or contains invalid pixels i.e. nans or infs
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                saturated = on_image & ((np.nanmax(stack,axis = (1,2)) >= sat_lvl) | ~np.isfinite(stack).all(axis = (1,2)))
 
-                     pars.add('sigma',
-                              value = 7,
-                              min = 0,
-                              max = gauss_fwhm2sigma(max_fit_fwhm) )
+            status[batch[saturated]] = 'saturated'
 
-                 if use_moffat:
+            check = on_image & ~saturated
 
-                     def residual(p):
-                         p = p.valuesdict()
-                         return (np.sqrt(abs(close_up))*(close_up - moffat_2d((xx,yy),p['x0'],p['y0'],p['sky'],p['A'],dict(alpha=p['alpha'],beta=p['beta'])).reshape(close_up.shape))).flatten()
-                 else:
+            if not check.any():
+                continue
 
-                     def residual(p):
-                         p = p.valuesdict()
-                         return (np.sqrt(abs(close_up))*(close_up - gauss_2d((xx,yy),p['x0'],p['y0'],p['sky'],p['A'],dict(sigma=p['sigma'])).reshape(close_up.shape))).flatten()
+            stack = stack[check]
+            idx_check = batch[check]
 
+            mean, median, std = stack_sigma_clipped_stats(stack,sigma = bkg_level,maxiters = 10)
 
-                 mini = lmfit.Minimizer(residual,
-                                       pars,
-                                       nan_policy = 'omit')
+            detected, x_peak, y_peak = stack_detect(stack,median,std,fwhm,threshold = bkg_level)
 
-                 result = mini.minimize(method = fitting_method)
+            if not plot_catalog_nondetections:
 
+                status[idx_check[~detected]] = 'not_detected'
 
-                 xcen = result.params['x0'].value
-                 ycen = result.params['y0'].value
+                stack = stack[detected]
+                median = median[detected]
+                idx_check = idx_check[detected]
+                x_peak = x_peak[detected]
+                y_peak = y_peak[detected]
+                detected = detected[detected]
 
+            if len(idx_check) == 0:
+                continue
 
-                 # S    = result.params['sky'].value
-                 # H    = result.params['A'].value
+            # If nothing is detected, start at the center of the cutout
+            x_peak = np.where(detected,x_peak,0.5*cutout_size)
+            y_peak = np.where(detected,y_peak,0.5*cutout_size)
 
-                 if use_moffat:
-                     source_image_params = dict(alpha=result.params['alpha'].value,beta=result.params['beta'].value)
-                 else:
-                     source_image_params = dict(sigma=result.params['sigma'])
+            # First pass with flux weighted moments around the detection closest to the center
+            x_guess, y_guess = stack_moments(stack,median,x_peak,y_peak,radius = fwhm)
 
+            amplitude = np.nanmax(stack,axis = (1,2)) - median
 
-                 fwhm_fit = fitting_model_fwhm(source_image_params)
+            if use_moffat:
+                width_guess = fwhm / (2*np.sqrt(2**(1/default_moff_beta)-1))
+            else:
+                width_guess = gauss_fwhm2sigma(fwhm)
 
+            params = [amplitude,x_guess,y_guess,median,np.full(len(idx_check),width_guess)]
 
-                 k+=1
+            if use_moffat and vary_moff_beta:
+                params+=[np.full(len(idx_check),default_moff_beta)]
 
-                # Add new source location accounting for difference
-                # in fitted location / expected location
-                 centroid_x = xcen - scale + x
-                 centroid_y = ycen - scale + y
+            params = np.column_stack(params)
 
+            params, converged = stack_fit(stack,params,lower,upper,
+                                          use_moffat = use_moffat,
+                                          beta = fit_beta)
 
-                 dist2target = pix_dist(target_x_pix,centroid_x,
-                                       target_y_pix,centroid_y)
+            # Refit any source that didn't converge individually
+            for j in np.where(~converged)[0]:
+                try:
+                    params[j] = fit_cutout(stack[j],params[j],lower,upper,
+                                           use_moffat = use_moffat,
+                                           beta = fit_beta,
+                                           fitting_method = fitting_method)
+                except Exception as e:
+                    logger.exception(e)
+                    params[j] = np.nan
 
-                 detections.append(chosen_catalog[catalog_keywords[image_filter]].loc[[idx]].values[0])
+            failed = ~np.isfinite(params).all(axis = 1)
+            status[idx_check[failed]] = 'error'
 
-                 useable_sources +=1
+            params = params[~failed]
+            idx_check = idx_check[~failed]
 
-                 x_new_cen.append(centroid_x)
-                 y_new_cen.append(centroid_y)
+            xcen = params[:,1]
+            ycen = params[:,2]
 
-                 cp_dist.append(np.sqrt( (xcen - scale)**2 + (ycen - scale)**2) )
+            if use_moffat:
+                beta_fit = params[:,5] if vary_moff_beta else default_moff_beta
+                source_image_params = dict(alpha = params[:,4],beta = beta_fit)
+            else:
+                source_image_params = dict(sigma = params[:,4])
 
-                 dist2target_list.append(dist2target)
+            # Add new source location accounting for difference
+            # in fitted location / expected location
+            x_new_cen[idx_check] = xcen - scale + x_cat[idx_check]
+            y_new_cen[idx_check] = ycen - scale + y_cat[idx_check]
 
-                 fwhm_list.append(fwhm_fit)
+            cp_dist[idx_check] = np.sqrt( (xcen - scale)**2 + (ycen - scale)**2)
 
+            fwhm_list[idx_check] = fitting_model_fwhm(source_image_params)
 
+            status[idx_check] = 'useable'
 
-            except Exception as e:
+            useable_sources = np.sum(status == 'useable')
 
-                x_new_cen.append(np.nan)
-                y_new_cen.append(np.nan)
-                cp_dist.append(np.nan)
-                dist2target_list.append(np.nan)
-                fwhm_list.append(np.nan)
+        # Only keep sources up until the maximum number of useable sources is reached
+        n_checked = batch_start
+        if useable_sources > max_catalog_sources:
+            n_checked = np.where(np.cumsum(status == 'useable') == max_catalog_sources)[0][0] + 1
 
-                logger.exception(e)
+        useable_sources = min(useable_sources,max_catalog_sources)
 
-                continue
+        print('\rMatching catalog to image: %d / %d :: Useful sources %d / %d ' % (n_checked,n_catalog,useable_sources,n_catalog),end = '')
 
         print('  .. done')
 
-        print('\nBroken cutouts: %d' % broken_cutout )
-        print('Not in correct location: %d' % too_far)
-        print('Not detected: %d' % not_detected)
-        print('Saturated: %d' % saturated_source)
-        print('Error: %d\n' % broken )
-
-
+        status = status[:n_checked]
 
+        print('\nBroken cutouts: %d' % np.sum(status == 'broken_cutout') )
+        print('Not detected: %d' % np.sum(status == 'not_detected'))
+        print('Saturated: %d' % np.sum(status == 'saturated'))
+        print('Error: %d\n' % np.sum(status == 'error') )
 
         # =============================================================================
         # Prepare output
         # =============================================================================
 
+        checked_catalog = chosen_catalog.iloc[:n_checked]
+
+        x_new_cen = x_new_cen[:n_checked]
+        y_new_cen = y_new_cen[:n_checked]
+
+        dist2target_list = pix_dist(target_x_pix,x_new_cen,
+                                    target_y_pix,y_new_cen)
+
         frame_chosen_catalog = [
-                      np.array([int(i) for i in cat_idx]),
-                      np.array(RA_list),
-                      np.array(DEC_list),
-                      np.array(x_new_source),
-                      np.array(y_new_source),
-                      np.array(x_new_cen),
-                      np.array(y_new_cen),
-                      np.array(cp_dist),
+                      np.array([int(i) for i in checked_catalog.index.values]),
+                      checked_catalog[catalog_keywords['RA']].values,
+                      checked_catalog[catalog_keywords['DEC']].values,
+                      x_cat[:n_checked],
+                      y_cat[:n_checked],
+                      x_new_cen,
+                      y_new_cen,
+                      cp_dist[:n_checked],
                       np.array(dist2target_list),
-                      np.array(fwhm_list),
-                      np.array(image_filtermagnitude[image_filter]),
-                      np.array(image_filtermagnitude_err[image_filter+'_err'])]
+                      fwhm_list[:n_checked],
+                      checked_catalog[catalog_keywords[image_filter]].values,
+                      checked_catalog[catalog_keywords[image_filter+'_err']].values]
 
+        for key,val in default_dmag.items():
 
+            if key == image_filter:
+                continue
 
+            try:
+                image_filtermagnitude[key] = checked_catalog[catalog_keywords[key]].values
+                image_filtermagnitude_err[key+'_err'] = checked_catalog[catalog_keywords[key+'_err']].values
+            except:
+                image_filtermagnitude[key] = np.full(n_checked,np.nan)
+                image_filtermagnitude_err[key+'_err'] = np.full(n_checked,np.nan)
 
         frame_cols = ['cat_idx',
                      'ra',
@@ -899,7 +687,7 @@ def match(image,headinfo,target_coords,catalog_keywords,image_filter,
         chosen_catalog_new_frame.columns = frame_cols
 
         for f in image_filtermagnitude:
-            if  (np.isnan(image_filtermagnitude[f]).all() ) | (f == image_filter) :
+            if (f == image_filter) or np.isnan(np.array(image_filtermagnitude[f],dtype = float)).all():
                     continue
 
             chosen_catalog_new_frame['cat_'+f] = image_filtermagnitude[f]
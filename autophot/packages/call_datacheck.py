@@ -219,8 +219,8 @@ def checkteledata(autophot_input,flst,filepath = None):
     import re
     # import numpy as np
     import logging
-    from astropy.io import fits
     from autophot.packages.functions import getimage
+    from autophot.packages.fits_io import write_fits
 
     # Get header information - priporeity script
     from autophot.packages.functions import getheader
@@ -303,7 +303,7 @@ def checkteledata(autophot_input,flst,filepath = None):
 
                         if apply_inst_2_all == 'y':
                             headinfo[inst_key] = (inst_input,'added by autophot')
-                            fits.writeto(name,getimage(name),headinfo,overwrite = True,output_verify = 'silentfix+ignore')
+                            write_fits(name,getimage(name),headinfo,overwrite = True,output_verify = 'silentfix+ignore')
                             break
 
                         print('\nFile: %s' % name)
@@ -315,12 +315,12 @@ def checkteledata(autophot_input,flst,filepath = None):
                             inst_input= str(input('Name of instrument? [default: UNKNOWN]: ') or 'UNKNOWN')
                             apply_inst_2_all  = str(input('Apply to all?  y/[n]: ')or 'n')
                             headinfo[inst_key] = (inst_input,'added by autophot')
-                            fits.writeto(name,getimage(name),headinfo,overwrite = True,output_verify = 'silentfix+ignore')
+                            write_fits(name,getimage(name),headinfo,overwrite = True,output_verify = 'silentfix+ignore')
                             break
 
                         elif inst_key_tmp in headinfo:
                             headinfo[inst_key] = (headinfo[inst_key_tmp],'added by autophot')
-                            fits.writeto(name,getimage(name),headinfo,overwrite = True,output_verify = 'silentfix+ignore')
+                            write_fits(name,getimage(name),headinfo,overwrite = True,output_verify = 'silentfix+ignore')
 
                             apply_inst_2_all  = str(input('Apply to all?  y/[n]: ')or 'n')
                             break
@@ -344,7 +344,7 @@ def checkteledata(autophot_input,flst,filepath = None):
             if tele == '' or tele == None:
                 tele = 'UNKNOWN'
                 headinfo[tele_key] = (tele,'updated by autophot')
-                fits.writeto(name,getimage(name),headinfo,
+                write_fits(name,getimage(name),headinfo,
                              overwrite = True,output_verify = 'silentfix+ignore')
 
 
@@ -556,7 +556,7 @@ def checkteledata(autophot_input,flst,filepath = None):
 
                     tele = 'UNKNOWN'
                     headinfo[tele_key] = (tele,'updated by autophot')
-                    fits.writeto(name,getimage(name),headinfo,
+                    write_fits(name,getimage(name),headinfo,
                                  overwrite = True,output_verify = 'silentfix+ignore')
 
              
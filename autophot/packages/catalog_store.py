@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Local sky-tiled store of catalog data used by *call_catalog.search*.
+
+The sky is split into declination bands of width *tile_size* degrees, and
+each band is split in right ascension into cells that are roughly
+*tile_size* degrees across on the sky. Every tile is saved as a separate
+binary file in *wdir/catalog_queries/<catalog>/tiles*. A cone search works
+out which tiles overlap the cone, loads those already on disk and only
+downloads the missing ones. Once the tiles covering a field have been
+downloaded, any target in that field, with any search radius that lies
+within those tiles, is served locally without a network connection.
+'''
+
+# Default tile size in degrees - only used when a new store is created
+tile_size_default = 0.2
+
+
+def angular_separation(ra1,dec1,ra2,dec2):
+    '''
+    Angular separation between two points on the sky using the haversine
+    formula.
+
+    :param ra1: Right ascension of first point(s) in degrees
+    :type ra1: float or array
+    :param dec1: Declination of first point(s) in degrees
+    :type dec1: float or array
+    :param ra2: Right ascension of second point(s) in degrees
+    :type ra2: float or array
+    :param dec2: Declination of second point(s) in degrees
+    :type dec2: float or array
+    :return: Angular separation in degrees
+    :rtype: float or array
+
+    '''
+
+    import numpy as np
+
+    ra1,dec1,ra2,dec2 = map(np.radians,(ra1,dec1,ra2,dec2))
+
+    a = np.sin((dec2-dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2-ra1)/2)**2
+
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(a,0,1))))
+
+
+def n_ra_cells(band,tile_size):
+    '''
+    Number of right ascension cells in a declination band. This is chosen so
+    that cells are at most *tile_size* degrees across at the edge of the band
+    closest to the equator.
+
+    :param band: Index of declination band
+    :type band: int or array
+    :param tile_size: Tile size in degrees
+    :type tile_size: float
+    :return: Number of cells in band
+    :rtype: int or array
+
+    '''
+
+    import numpy as np
+
+    dec_lo = band*tile_size - 90
+    dec_hi = np.minimum(dec_lo + tile_size,90)
+
+    cos_max = np.where((dec_lo <= 0) & (dec_hi >= 0),1,
+                       np.maximum(np.cos(np.radians(dec_lo)),np.cos(np.radians(dec_hi))))
+
+    return np.maximum(1,np.ceil(360*cos_max/tile_size)).astype(int)
+
+
+def tile_index(ra,dec,tile_size):
+    '''
+    Tile name for each sky position, given as "<band>_<cell>".
+
+    :param ra: Right ascension in degrees
+    :type ra: array
+    :param dec: Declination in degrees
+    :type dec: array
+    :param tile_size: Tile size in degrees
+    :type tile_size: float
+    :return: Tile name of each position
+    :rtype: array
+
+    '''
+
+    import numpy as np
+
+    ra = np.mod(np.asarray(ra,dtype = float),360)
+    dec = np.clip(np.asarray(dec,dtype = float),-90,90)
+
+    n_bands = int(np.ceil(180/tile_size))
+
+    band = np.clip(np.floor((dec + 90)/tile_size).astype(int),0,n_bands-1)
+    n_cells = n_ra_cells(band,tile_size)
+    cell = np.floor(ra/(360/n_cells)).astype(int) % n_cells
+
+    return np.char.add(np.char.add(band.astype(str),'_'),cell.astype(str))
+
+
+def cone_tiles(ra,dec,radius,tile_size):
+    '''
+    Names of all tiles that overlap a cone on the sky.
+
+    :param ra: Right ascension of cone center in degrees
+    :type ra: float
+    :param dec: Declination of cone center in degrees
+    :type dec: float
+    :param radius: Radius of cone in degrees
+    :type radius: float
+    :param tile_size: Tile size in degrees
+    :type tile_size: float
+    :return: List of tile names
+    :rtype: list
+
+    '''
+
+    import numpy as np
+
+    n_bands = int(np.ceil(180/tile_size))
+
+    dec_lo = max(dec - radius,-90)
+    dec_hi = min(dec + radius,90)
+
+    band_lo = int(np.clip(np.floor((dec_lo + 90)/tile_size),0,n_bands-1))
+    band_hi = int(np.clip(np.floor((dec_hi + 90)/tile_size),0,n_bands-1))
+
+    # Half width of cone in right ascension - all of it if the cone includes a pole
+    if radius + abs(dec) >= 90:
+        dra = 180
+    else:
+        dra = np.degrees(np.arcsin(min(np.sin(np.radians(radius))/np.cos(np.radians(dec)),1)))
+
+    tiles = []
+
+    for band in range(band_lo,band_hi+1):
+
+        n_cells = int(n_ra_cells(band,tile_size))
+        width = 360/n_cells
+
+        if dra >= 180:
+            cells = range(n_cells)
+        else:
+            cell_lo = int(np.floor((ra - dra)/width))
+            cell_hi = int(np.floor((ra + dra)/width))
+            cells = sorted(set([i % n_cells for i in range(cell_lo,cell_hi+1)]))
+
+        tiles += ['%d_%d' % (band,cell) for cell in cells]
+
+    return tiles
+
+
+def tile_center(tile,tile_size):
+    '''
+    Center of a tile on the sky.
+
+    :param tile: Tile name given as "<band>_<cell>"
+    :type tile: str
+    :param tile_size: Tile size in degrees
+    :type tile_size: float
+    :return: Right ascension and declination of tile center in degrees
+    :rtype: tuple
+
+    '''
+
+    band,cell = [int(i) for i in tile.split('_')]
+
+    n_cells = int(n_ra_cells(band,tile_size))
+
+    ra = (cell + 0.5) * 360/n_cells
+    dec = min(band*tile_size - 90 + 0.5*tile_size,90)
+
+    return ra, dec
+
+
+def open_store(wdir,catalog):
+    '''
+    Location and tile size of the tile store for a catalog. The tile size is
+    saved when the store is first created so that it never changes for a given
+    store.
+
+    :param wdir: Working directory containing the *catalog_queries* folder
+    :type wdir: str
+    :param catalog: Name of catalog
+    :type catalog: str
+    :return: Directory containing tiles and tile size in degrees
+    :rtype: tuple
+
+    '''
+
+    import os
+    import json
+    import pathlib
+
+    store_dir = os.path.join(wdir,'catalog_queries',catalog,'tiles')
+    pathlib.Path(store_dir).mkdir(parents = True, exist_ok=True)
+
+    meta_fpath = os.path.join(store_dir,'store.json')
+
+    if os.path.isfile(meta_fpath):
+        with open(meta_fpath,'r') as f:
+            tile_size = float(json.load(f)['tile_size'])
+    else:
+        tile_size = tile_size_default
+        tmp_fpath = meta_fpath + '.%d.tmp' % os.getpid()
+        with open(tmp_fpath,'w') as f:
+            json.dump({'catalog':catalog,'tile_size':tile_size},f)
+        os.replace(tmp_fpath,meta_fpath)
+
+    return store_dir, tile_size
+
+
+def load_tiles(store_dir,tiles):
+    '''
+    Load tiles from the store.
+
+    :param store_dir: Directory containing tiles
+    :type store_dir: str
+    :param tiles: List of tile names
+    :type tiles: list
+    :return: List of DataFrames for tiles found and list of tile names that are missing
+    :rtype: tuple
+
+    '''
+
+    import os
+    import pandas as pd
+
+    found = []
+    missing = []
+
+    for tile in tiles:
+
+        tile_fpath = os.path.join(store_dir,tile + '.pkl')
+
+        if not os.path.isfile(tile_fpath):
+            missing.append(tile)
+            continue
+
+        try:
+            found.append(pd.read_pickle(tile_fpath))
+        except Exception:
+            # Partially written or corrupt tile - download again
+            missing.append(tile)
+
+    return found, missing
+
+
+def split_tiles(data,tiles,ra_col,dec_col,tile_size):
+    '''
+    Split catalog data into the given tiles.
+
+    :param data: Catalog data
+    :type data: DataFrame
+    :param tiles: List of tile names
+    :type tiles: list
+    :param ra_col: Name of right ascension column in degrees
+    :type ra_col: str
+    :param dec_col: Name of declination column in degrees
+    :type dec_col: str
+    :param tile_size: Tile size in degrees
+    :type tile_size: float
+    :return: List of DataFrames for each tile
+    :rtype: list
+
+    '''
+
+    import numpy as np
+
+    if len(data) > 0:
+        data_tiles = tile_index(data[ra_col].values,data[dec_col].values,tile_size)
+    else:
+        data_tiles = np.array([],dtype = str)
+
+    return [data[data_tiles == tile].reset_index(drop = True) for tile in tiles]
+
+
+def save_tiles(store_dir,data,tiles,ra_col,dec_col,tile_size):
+    '''
+    Split catalog data into tiles and save each of the given tiles to the store.
+    Tiles with no sources are still saved so they are not downloaded again.
+    Each tile is written to a temporary file first so a tile on disk is always
+    complete.
+
+    :param store_dir: Directory containing tiles
+    :type store_dir: str
+    :param data: Catalog data that fully covers *tiles*
+    :type data: DataFrame
+    :param tiles: List of tile names to save
+    :type tiles: list
+    :param ra_col: Name of right ascension column in degrees
+    :type ra_col: str
+    :param dec_col: Name of declination column in degrees
+    :type dec_col: str
+    :param tile_size: Tile size in degrees
+    :type tile_size: float
+    :return: List of DataFrames for each saved tile
+    :rtype: list
+
+    '''
+
+    import os
+
+    saved = []
+
+    for tile,tile_data in zip(tiles,split_tiles(data,tiles,ra_col,dec_col,tile_size)):
+
+        tile_fpath = os.path.join(store_dir,tile + '.pkl')
+        tmp_fpath = tile_fpath + '.%d.tmp' % os.getpid()
+
+        tile_data.to_pickle(tmp_fpath)
+        os.replace(tmp_fpath,tile_fpath)
+
+        saved.append(tile_data)
+
+    return saved
+
+
+def fetch_cone(catalog,ra,dec,radius,max_records = 100000,return_truncated = False):
+    '''
+    Download catalog data within a cone on the sky.
+
+    :param catalog: Name of catalog, either *apass*, *2mass*, *sdss*, *pan_starrs*, *skymapper* or *gaia*
+    :type catalog: str
+    :param ra: Right ascension of cone center in degrees
+    :type ra: float
+    :param dec: Declination of cone center in degrees
+    :type dec: float
+    :param radius: Radius of cone in degrees
+    :type radius: float
+    :param max_records: Maximum number of sources requested from Gaia, PanSTARRS and SkyMapper, defaults to 100000
+    :type max_records: int, optional
+    :param return_truncated: If True, also return whether the query hit *max_records*, or the server reported that the result was cut short, and so may be missing sources, defaults to False
+    :type return_truncated: bool, optional
+    :return: Catalog data, and whether it is truncated if *return_truncated* is True
+    :rtype: DataFrame
+
+    '''
+
+    import io
+    import logging
+    import warnings
+    import requests
+    import numpy as np
+    import pandas as pd
+    import astropy.units as u
+    from astropy.coordinates import SkyCoord,Angle
+
+    logger = logging.getLogger(__name__)
+
+    coords = SkyCoord(ra,dec,unit = (u.deg,u.deg))
+
+    truncated = False
+
+    if catalog in ['gaia']:
+
+        from astroquery.gaia import Gaia
+
+        # Default row limit is 50
+        Gaia.ROW_LIMIT = max_records
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            job = Gaia.cone_search_async(coords,radius = u.Quantity(radius,u.deg))
+            data = job.get_results().to_pandas()
+
+        truncated = len(data) >= max_records
+
+    elif catalog in ['apass','2mass','sdss']:
+
+        from astroquery.vizier import Vizier
+
+        # No row limit
+        Vizier.ROW_LIMIT = -1
+        catalog_search = Vizier.query_region(coords,
+                                             radius = Angle(radius,'deg'),
+                                             catalog = catalog)
+
+        if len(catalog_search) == 0:
+            return pd.DataFrame()
+
+        # Select first catalog from list
+        data = catalog_search[0].to_pandas()
+
+        # TODO: make sure mode 2 is correct
+        if catalog == 'sdss':
+            data = data[data['mode']== 2]
+
+    elif catalog in ['pan_starrs','skymapper']:
+
+        from astropy.io.votable import parse
+
+        mindet=1
+
+        if catalog == 'pan_starrs':
+
+            server=('https://archive.stsci.edu/'+'panstarrs/search.php')
+            params = {'RA': ra, 'DEC': dec,
+                      'SR': radius, 'max_records': max_records,
+                      'outputformat': 'VOTable',
+                      'ndetections': ('>%d' % mindet)}
+
+        else:
+
+            server=('http://skymapper.anu.edu.au/sm-cone/public/query?')
+            params = {'RA': ra, 'DEC': dec,
+                      'SR': radius, 'MAXREC': max_records,
+                      'RESPONSEFORMAT': 'VOTABLE'}
+
+        logger.info('Downloading sequence stars from %s'  % catalog )
+
+        response = requests.get(server,params = params)
+        response.raise_for_status()
+
+        votable = parse(io.BytesIO(response.content))
+        data = votable.get_first_table().to_table(use_names_over_ids=True).to_pandas()
+
+        # Servers following the VO cone search standard flag results cut short by their own limit
+        infos = list(votable.infos) + [info for resource in votable.resources for info in resource.infos]
+        overflow = any(info.name == 'QUERY_STATUS' and str(info.value).upper() == 'OVERFLOW' for info in infos)
+
+        truncated = overflow or len(data) >= max_records
+
+        # invalid entries in panstarrs are -999 - change to nans
+        if catalog == 'pan_starrs':
+            data = data.replace(-999,np.nan)
+
+    else:
+        raise Exception('Catalog %s not recognised' % catalog)
+
+    if truncated:
+        logger.warning('%s query returned the maximum number of sources [%d] - catalog may be incomplete' % (catalog,len(data)))
+
+    data = data.fillna(np.nan).reset_index(drop = True)
+
+    if return_truncated:
+        return data, truncated
+
+    return data
+
+
+def cone_search(wdir,catalog,ra,dec,radius,ra_col,dec_col,max_query_radius = None):
+    '''
+    Cone search using the local tile store. Tiles overlapping the cone that are
+    already on disk are loaded and any missing tiles are downloaded in a single
+    query covering all of them and saved for later use. If the catalog server
+    limits the search radius (*max_query_radius*), tiles not fully covered by
+    this query are downloaded individually. If a query hits the row limit of
+    the catalog server, the missing tiles are downloaded individually instead,
+    and any tile that is still incomplete is used but not saved to the store.
+    If the download fails, the tiles found locally are returned.
+
+    :param wdir: Working directory containing the *catalog_queries* folder
+    :type wdir: str
+    :param catalog: Name of catalog
+    :type catalog: str
+    :param ra: Right ascension of cone center in degrees
+    :type ra: float
+    :param dec: Declination of cone center in degrees
+    :type dec: float
+    :param radius: Radius of cone in degrees
+    :type radius: float
+    :param ra_col: Name of right ascension column in the catalog
+    :type ra_col: str
+    :param dec_col: Name of declination column in the catalog
+    :type dec_col: str
+    :param max_query_radius: Maximum radius in degrees allowed by the catalog server, defaults to None
+    :type max_query_radius: float, optional
+    :return: Catalog data within the cone
+    :rtype: DataFrame
+
+    '''
+
+    import sys,os
+    import logging
+    import numpy as np
+    import pandas as pd
+
+    logger = logging.getLogger(__name__)
+
+    store_dir, tile_size = open_store(wdir,catalog)
+
+    tiles = cone_tiles(ra,dec,radius,tile_size)
+
+    found, missing = load_tiles(store_dir,tiles)
+
+    logger.info('Catalog tiles [%s]: %d / %d found locally' % (catalog,len(tiles)-len(missing),len(tiles)))
+
+    if len(missing) > 0:
+
+        # Every point in a tile is within this distance of its center
+        tile_radius = 1.01 * np.sqrt(2) * tile_size / 2
+
+        try:
+
+            # Query around the cone that covers all missing tiles, limited by the catalog server
+            query_radius = radius + 2*tile_radius
+
+            if max_query_radius is not None:
+                query_radius = min(query_radius,max_query_radius)
+
+            data, truncated = fetch_cone(catalog,ra,dec,query_radius,return_truncated = True)
+
+            covered = []
+
+            if truncated:
+                logger.warning('Catalog query [%s] is incomplete - downloading %d tiles individually' % (catalog,len(missing)))
+            else:
+                for tile in missing:
+                    tile_ra,tile_dec = tile_center(tile,tile_size)
+                    if angular_separation(ra,dec,tile_ra,tile_dec) + tile_radius <= query_radius:
+                        covered.append(tile)
+
+                found += save_tiles(store_dir,data,covered,ra_col,dec_col,tile_size)
+
+            # Any tiles not fully covered by this query are downloaded individually
+            for tile in [i for i in missing if i not in covered]:
+                tile_ra,tile_dec = tile_center(tile,tile_size)
+                data, truncated = fetch_cone(catalog,tile_ra,tile_dec,tile_radius,return_truncated = True)
+
+                if truncated:
+                    # Don't save an incomplete tile - it would be reused as if complete
+                    logger.warning('Catalog tile %s [%s] is incomplete - not saved' % (tile,catalog))
+                    found += split_tiles(data,[tile],ra_col,dec_col,tile_size)
+                else:
+                    found += save_tiles(store_dir,data,[tile],ra_col,dec_col,tile_size)
+
+        except Exception as e:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+            logger.info('%s %s %s %s' % (exc_type, fname, exc_tb.tb_lineno,e))
+            logger.warning('Could not download catalog tiles - using %d tiles found locally' % (len(found)))
+
+    found = [i for i in found if len(i) > 0]
+
+    if len(found) == 0:
+        return pd.DataFrame()
+
+    data = pd.concat(found,axis = 0,sort = False,ignore_index = True)
+
+    # Tiles cover a larger area than the cone - only keep sources within the cone
+    within = angular_separation(ra,dec,data[ra_col].values.astype(float),data[dec_col].values.astype(float)) <= radius
+
+    return data[within].reset_index(drop = True)
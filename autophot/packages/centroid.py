@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Batched centroiding of many sources at once. Rather than looping over each
+source and fitting it individually, every cutout is extracted into a single
+3D array of shape (N, 2*scale, 2*scale) and the background statistics,
+detection and model fitting are computed across the whole stack with numpy.
+'''
+
+
+def extract_cutouts(image,x,y,scale,partial = False):
+    '''
+    Extract square cutouts of size (2*scale, 2*scale) centered on each (x,y)
+    location into a single 3D array. The cutouts match those given by
+    *image[int(y-scale):int(y+scale),int(x-scale):int(x+scale)]*. Cutouts that
+    would fall off the image are filled with nans and flagged as invalid. If
+    *partial* is True, only the pixels that fall off the image are set to nan.
+
+    :param image: Image containing sources
+    :type image: 2D array
+    :param x: X pixel locations of sources
+    :type x: array
+    :param y: Y pixel locations of sources
+    :type y: array
+    :param scale: Half width of cutouts in pixels
+    :type scale: int
+    :param partial: If True, keep the pixels of cutouts which are partially on the image, defaults to False
+    :type partial: bool, optional
+    :return: Stack of cutouts with shape (N, 2*scale, 2*scale) and boolean array which is True if the cutout is fully on the image
+    :rtype: tuple
+
+    '''
+
+    import numpy as np
+
+    scale = int(scale)
+
+    x = np.asarray(x,dtype = float)
+    y = np.asarray(y,dtype = float)
+
+    x_start = (x - scale).astype(int)
+    y_start = (y - scale).astype(int)
+
+    offsets = np.arange(2*scale)
+
+    ix = x_start[:,None] + offsets[None,:]
+    iy = y_start[:,None] + offsets[None,:]
+
+    valid = (x_start >= 0) & (y_start >= 0)
+    valid &= (x_start + 2*scale <= image.shape[1]) & (y_start + 2*scale <= image.shape[0])
+
+    ix_clip = np.clip(ix,0,image.shape[1]-1)
+    iy_clip = np.clip(iy,0,image.shape[0]-1)
+
+    stack = np.asarray(image)[iy_clip[:,:,None],ix_clip[:,None,:]].astype(float)
+
+    if partial:
+        off_image = (iy != iy_clip)[:,:,None] | (ix != ix_clip)[:,None,:]
+        stack[off_image] = np.nan
+    else:
+        stack[~valid] = np.nan
+
+    return stack, valid
+
+
+def stack_sigma_clipped_stats(stack,sigma = 3,maxiters = 10):
+    '''
+    Sigma clipped mean, median and standard deviation of each cutout in a stack.
+    This follows the default behaviour of astropy's *sigma_clipped_stats* (median
+    centered, standard deviation width) but clips every cutout at the same
+    time.
+
+    :param stack: Stack of cutouts with shape (N, height, width)
+    :type stack: 3D array
+    :param sigma: Number of standard deviations to use for both the lower and upper clipping limit, defaults to 3
+    :type sigma: float, optional
+    :param maxiters: Maximum number of clipping iterations, defaults to 10
+    :type maxiters: int, optional
+    :return: Arrays of mean, median and standard deviation of each cutout
+    :rtype: tuple
+
+    '''
+
+    import numpy as np
+    import warnings
+
+    data = stack.reshape(len(stack),-1).copy()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+
+        for i in range(maxiters):
+
+            median = np.nanmedian(data,axis = 1)
+            std = np.nanstd(data,axis = 1)
+
+            clip = abs(data - median[:,None]) > sigma * std[:,None]
+
+            if not clip.any():
+                break
+
+            data[clip] = np.nan
+
+        mean = np.nanmean(data,axis = 1)
+        median = np.nanmedian(data,axis = 1)
+        std = np.nanstd(data,axis = 1)
+
+    return mean, median, std
+
+
+def lowered_gaussian_kernel(fwhm):
+    '''
+    Lowered Gaussian kernel with the given FWHM (similar to *DAOStarFinder*).
+    The kernel is normalised so that convolving a background subtracted image
+    with it gives the amplitude of a source. *relerr* is the noise in the
+    convolved image relative to the noise in the image, so a convolved value
+    divided by *relerr* times the background standard deviation gives the
+    significance of a detection in the same units as the *DAOStarFinder*
+    threshold.
+
+    :param fwhm: Full Width Half Maximum of sources in the image
+    :type fwhm: float
+    :return: Kernel with shape (2r+1, 2r+1), the kernel radius r in pixels and *relerr*
+    :rtype: tuple
+
+    '''
+
+    import numpy as np
+    from autophot.packages.functions import gauss_fwhm2sigma
+
+    sigma = gauss_fwhm2sigma(fwhm)
+
+    # Kernel out to ~1.5 FWHM
+    r = max(int(np.ceil(0.75*fwhm)),2)
+    kx,ky = np.meshgrid(np.arange(-r,r+1),np.arange(-r,r+1))
+    kr2 = kx**2 + ky**2
+    footprint = kr2 <= r**2
+
+    gauss = np.exp(-kr2/(2*sigma**2))
+    gauss[~footprint] = 0
+
+    # Lowered kernel, normalised so the convolved image gives the source amplitude
+    kernel = np.where(footprint,gauss - gauss[footprint].mean(),0)
+    denom = np.sum(kernel*gauss)
+    kernel /= denom
+
+    relerr = 1/np.sqrt(denom)
+
+    return kernel, r, relerr
+
+
+def stack_detect(stack,median,std,fwhm,threshold = 3,sharplo = 0.2,
+                 sharphi = 1.0,roundlo = -1.0,roundhi = 1.0):
+    '''
+    Detect sources in each cutout of a stack. Each background subtracted
+    cutout is convolved with a lowered Gaussian kernel with the given FWHM
+    (similar to *DAOStarFinder*) so that the convolved image gives the
+    amplitude of a source. Local maxima above *threshold* times the noise in
+    the convolved image (the background standard deviation times *relerr*, as
+    used by *DAOStarFinder*) are taken as detections, and the detection
+    closest to the center of the cutout is returned.
+
+    Peaks are also required to have a sharpness and symmetry based roundness
+    (*roundness1* of *DAOStarFinder*) within the given limits, which removes
+    hot pixels and cosmic rays. The roundness from Gaussian fits to the
+    marginal distributions (*roundness2*) is not used.
+
+    :param stack: Stack of cutouts with shape (N, height, width)
+    :type stack: 3D array
+    :param median: Background level of each cutout
+    :type median: array
+    :param std: Background standard deviation of each cutout
+    :type std: array
+    :param fwhm: Full Width Half Maximum of sources in the image
+    :type fwhm: float
+    :param threshold: Number of standard deviations above the background needed for a detection, defaults to 3
+    :type threshold: float, optional
+    :param sharplo: Lower bound on sharpness for a detection, defaults to 0.2
+    :type sharplo: float, optional
+    :param sharphi: Upper bound on sharpness for a detection, defaults to 1.0
+    :type sharphi: float, optional
+    :param roundlo: Lower bound on roundness for a detection, defaults to -1.0
+    :type roundlo: float, optional
+    :param roundhi: Upper bound on roundness for a detection, defaults to 1.0
+    :type roundhi: float, optional
+    :return: Boolean array which is True if a source is detected, and arrays of the X and Y location of the detection closest to the center of each cutout
+    :rtype: tuple
+
+    '''
+
+    import numpy as np
+    from scipy.ndimage import convolve,correlate,maximum_filter
+
+    kernel, r, relerr = lowered_gaussian_kernel(fwhm)
+
+    data = stack - median[:,None,None]
+    data = np.where(np.isfinite(data),data,0)
+
+    convolved = convolve(data,kernel[None,:,:],mode = 'constant',cval = 0)
+
+    peaks = convolved == maximum_filter(convolved,size = (1,3,3),mode = 'constant',cval = -np.inf)
+    peaks &= convolved > threshold * relerr * std[:,None,None]
+
+    kx,ky = np.meshgrid(np.arange(-r,r+1),np.arange(-r,r+1))
+
+    # Kernel footprint without the central pixel
+    ring = (kx**2 + ky**2 <= r**2).astype(float)
+    ring[r,r] = 0
+
+    # Sharpness - peak height above the mean of the surrounding pixels, relative to the source amplitude
+    data_mean = correlate(data,ring[None,:,:] / ring.sum(),mode = 'constant',cval = 0)
+
+    # Roundness - difference between opposite quadrants of the convolved image
+    quadrants = np.zeros(kx.shape)
+    quadrants[(ky <= 0) & (kx > 0)] = -1
+    quadrants[(ky < 0) & (kx <= 0)] = 1
+    quadrants[(ky >= 0) & (kx < 0)] = -1
+    quadrants[(ky > 0) & (kx >= 0)] = 1
+
+    quadrant_sum = correlate(convolved,quadrants[None,:,:],mode = 'constant',cval = 0)
+    abs_sum = correlate(abs(convolved),(quadrants != 0)[None,:,:].astype(float),mode = 'constant',cval = 0)
+
+    with np.errstate(divide = 'ignore',invalid = 'ignore'):
+        sharpness = (data - data_mean) / convolved
+        roundness = np.where(quadrant_sum == 0,0,2 * quadrant_sum / abs_sum)
+
+    peaks &= (sharpness >= sharplo) & (sharpness <= sharphi)
+    peaks &= (roundness >= roundlo) & (roundness <= roundhi)
+
+    # Ignore the border where the kernel overhangs the cutout
+    peaks[:,:r,:] = False
+    peaks[:,-r:,:] = False
+    peaks[:,:,:r] = False
+    peaks[:,:,-r:] = False
+
+    height,width = stack.shape[1:]
+    yy,xx = np.mgrid[0:height,0:width]
+    r_center = np.hypot(xx - width/2,yy - height/2)
+
+    r_peaks = np.where(peaks,r_center[None,:,:],np.inf).reshape(len(stack),-1)
+    closest = np.argmin(r_peaks,axis = 1)
+
+    detected = np.isfinite(r_peaks[np.arange(len(stack)),closest])
+
+    y_peak,x_peak = np.unravel_index(closest,(height,width))
+
+    return detected, x_peak.astype(float), y_peak.astype(float)
+
+
+def stack_moments(stack,median,x_guess,y_guess,radius):
+    '''
+    First pass centroid of each cutout from the first moment of the background
+    subtracted flux within *radius* pixels of an initial guess.
+
+    :param stack: Stack of cutouts with shape (N, height, width)
+    :type stack: 3D array
+    :param median: Background level of each cutout
+    :type median: array
+    :param x_guess: Initial X location in each cutout
+    :type x_guess: array
+    :param y_guess: Initial Y location in each cutout
+    :type y_guess: array
+    :param radius: Radius in pixels used to compute moments
+    :type radius: float
+    :return: Arrays of the X and Y centroid
+    :rtype: tuple
+
+    '''
+
+    import numpy as np
+
+    height,width = stack.shape[1:]
+    yy,xx = np.mgrid[0:height,0:width]
+
+    dx = xx[None,:,:] - x_guess[:,None,None]
+    dy = yy[None,:,:] - y_guess[:,None,None]
+
+    weights = stack - median[:,None,None]
+    weights = np.where(np.isfinite(weights) & (weights > 0) & (dx**2 + dy**2 <= radius**2),weights,0)
+
+    total = weights.sum(axis = (1,2))
+    total = np.where(total > 0,total,np.nan)
+
+    x_cen = (weights * xx[None,:,:]).sum(axis = (1,2)) / total
+    y_cen = (weights * yy[None,:,:]).sum(axis = (1,2)) / total
+
+    x_cen = np.where(np.isfinite(x_cen),x_cen,x_guess)
+    y_cen = np.where(np.isfinite(y_cen),y_cen,y_guess)
+
+    return x_cen, y_cen
+
+
+def stack_model(xx,yy,params,use_moffat = True,beta = None,kernel = None):
+    '''
+    Moffat or Gaussian model evaluated for every cutout in a stack, along with
+    the derivative of the model with respect to each parameter, see
+    *kernels.model_kernel*.
+
+    Parameters are given as an array with shape (N, P). For a Moffat model
+    these are [A, x0, y0, sky, alpha] with [beta] appended if *beta* is None.
+    For a Gaussian model these are [A, x0, y0, sky, sigma].
+
+    :param xx: X pixel grid of a single cutout
+    :type xx: 2D array
+    :param yy: Y pixel grid of a single cutout
+    :type yy: 2D array
+    :param params: Model parameters for each cutout
+    :type params: 2D array
+    :param use_moffat: If True, use a Moffat model, else use a Gaussian model, defaults to True
+    :type use_moffat: bool, optional
+    :param beta: Fixed Moffat exponent. If None, beta is taken from *params*, defaults to None
+    :type beta: float, optional
+    :param kernel: Kernel for the pixel grid given by *xx* and *yy*, so its work arrays can be reused between calls, defaults to None
+    :type kernel: model_kernel, optional
+    :return: Model with shape (N, M) and derivatives with shape (N, M, P) where M is the number of pixels in a cutout
+    :rtype: tuple
+
+    '''
+
+    import numpy as np
+
+    from autophot.packages.kernels import model_kernel
+
+    if kernel is None:
+        kernel = model_kernel(xx,yy,use_moffat = use_moffat)
+
+    params = np.asarray(params,dtype = float)
+
+    n_sources,n_params = params.shape
+
+    if use_moffat and beta is not None:
+        params = np.column_stack([params[:,:5],np.broadcast_to(beta,(n_sources,))])
+
+    model = np.empty((n_sources,kernel.size))
+    derivs = np.empty((n_sources,kernel.size,len(kernel.names)))
+
+    kernel.evaluate_with_jacobian(params,out = model,jac_out = derivs)
+
+    return model, derivs[:,:,:n_params]
+
+
+def stack_lm(data,params,lower,upper,model,weights = None,
+             max_iter = 100,tol = 1e-8):
+    '''
+    Fit a model to many data sets at the same time using Levenberg-Marquardt.
+    Each data set has its own damping parameter and the normal equations for
+    all data sets are solved together. Parameters are clipped to lie within
+    *lower* and *upper*. Pixels which are not finite are given zero weight.
+
+    *model* is called with an array of parameters with shape (n, P) and must
+    return the model with shape (n, M) and its derivatives with respect to each
+    parameter with shape (n, M, P), see *stack_model*.
+
+    :param data: Data sets with shape (N, M)
+    :type data: 2D array
+    :param params: Initial parameters for each data set with shape (N, P)
+    :type params: 2D array
+    :param lower: Lower bound of each parameter with shape (P,) or (N, P)
+    :type lower: array
+    :param upper: Upper bound of each parameter with shape (P,) or (N, P)
+    :type upper: array
+    :param model: Function returning the model and its derivatives for a set of parameters
+    :type model: callable
+    :param weights: Weight of each pixel with shape (N, M), defaults to None in which case all pixels are weighted equally
+    :type weights: 2D array, optional
+    :param max_iter: Maximum number of iterations, defaults to 100
+    :type max_iter: int, optional
+    :param tol: Fit is converged when the relative change in chi-squared is less than this value, defaults to 1e-8
+    :type tol: float, optional
+    :return: Best fitting parameters with shape (N, P), boolean array which is True if the fit for that data set converged, chi-squared of each fit and the weighted normal matrix :math:`J^T J` at the best fitting parameters with shape (N, P, P)
+    :rtype: tuple
+
+    '''
+
+    import numpy as np
+
+    n_sources,n_params = params.shape
+
+    lower = np.broadcast_to(np.asarray(lower,dtype = float),params.shape)
+    upper = np.broadcast_to(np.asarray(upper,dtype = float),params.shape)
+
+    finite = np.isfinite(data)
+    data = np.where(finite,data,0)
+
+    if weights is None:
+        weights = np.ones(data.shape)
+    weights = np.where(finite,weights,0)
+
+    params = np.clip(params.astype(float),lower,upper)
+
+    def chi2(p,sel):
+        model_p,derivs = model(p)
+        resid = weights[sel] * (data[sel] - model_p)
+        return np.sum(resid**2,axis = 1), resid, derivs
+
+    with np.errstate(all = 'ignore'):
+        cost, resid, derivs = chi2(params,np.arange(n_sources))
+
+    damping = np.full(n_sources,1e-3)
+    converged = np.zeros(n_sources,dtype = bool)
+
+    for i in range(max_iter):
+
+        # Only sources that are still being fitted
+        active = np.where(~converged)[0]
+
+        if len(active) == 0:
+            break
+
+        J = weights[active,:,None] * derivs[active]
+        JTJ = np.einsum('nmp,nmq->npq',J,J)
+        JTr = np.einsum('nmp,nm->np',J,resid[active])
+
+        diag = np.einsum('npp->np',JTJ)
+        diag = np.where(diag > 0,diag,1e-12)
+
+        lhs = JTJ + (damping[active,None] * diag)[:,:,None] * np.eye(n_params)[None,:,:]
+
+        try:
+            step = np.linalg.solve(lhs,JTr[:,:,None])[:,:,0]
+        except np.linalg.LinAlgError:
+            step = np.stack([np.linalg.lstsq(lhs[j],JTr[j],rcond = None)[0] for j in range(len(lhs))])
+
+        trial = np.clip(params[active] + step,lower[active],upper[active])
+
+        with np.errstate(all = 'ignore'):
+            trial_cost, trial_resid, trial_derivs = chi2(trial,active)
+
+        improved = np.isfinite(trial_cost) & (trial_cost <= cost[active])
+
+        # Converged if chi-squared barely changes or the damping grows too large
+        small_change = abs(cost[active] - trial_cost) <= tol * np.maximum(cost[active],1e-30)
+        converged[active] = (improved & small_change) | (damping[active] > 1e10)
+
+        accept = active[improved]
+
+        params[accept] = trial[improved]
+        cost[accept] = trial_cost[improved]
+        resid[accept] = trial_resid[improved]
+        derivs[accept] = trial_derivs[improved]
+
+        damping[accept] /= 10
+        damping[active[~improved]] *= 10
+
+    converged &= np.isfinite(params).all(axis = 1)
+
+    J = weights[:,:,None] * derivs
+    JTJ = np.einsum('nmp,nmq->npq',J,J)
+
+    return params, converged, cost, JTJ
+
+
+def stack_fit(stack,params,lower,upper,use_moffat = True,beta = None,
+              max_iter = 100,tol = 1e-8):
+    '''
+    Fit a Moffat or Gaussian model to every cutout in a stack at the same time
+    using *stack_lm*. Following the centroiding in *call_catalog.match*,
+    residuals are weighted by the square root of the absolute pixel value.
+
+    :param stack: Stack of cutouts with shape (N, height, width)
+    :type stack: 3D array
+    :param params: Initial parameters for each cutout with shape (N, P), see *stack_model*
+    :type params: 2D array
+    :param lower: Lower bound of each parameter with shape (P,)
+    :type lower: array
+    :param upper: Upper bound of each parameter with shape (P,)
+    :type upper: array
+    :param use_moffat: If True, use a Moffat model, else use a Gaussian model, defaults to True
+    :type use_moffat: bool, optional
+    :param beta: Fixed Moffat exponent. If None, beta is fitted and must be included in *params*, defaults to None
+    :type beta: float, optional
+    :param max_iter: Maximum number of iterations, defaults to 100
+    :type max_iter: int, optional
+    :param tol: Fit is converged when the relative change in chi-squared is less than this value, defaults to 1e-8
+    :type tol: float, optional
+    :return: Best fitting parameters with shape (N, P) and boolean array which is True if the fit for that cutout converged
+    :rtype: tuple
+
+    '''
+
+    import numpy as np
+
+    from autophot.packages.kernels import model_kernel
+
+    n_sources = stack.shape[0]
+
+    height,width = stack.shape[1:]
+    yy,xx = np.mgrid[0:height,0:width]
+
+    data = stack.reshape(n_sources,-1)
+
+    kernel = model_kernel(xx,yy,use_moffat = use_moffat)
+
+    def model(p):
+        return stack_model(xx,yy,p,use_moffat = use_moffat,beta = beta,kernel = kernel)
+
+    params, converged, _, _ = stack_lm(data,params,lower,upper,model,
+                                       weights = np.sqrt(abs(data)),
+                                       max_iter = max_iter,
+                                       tol = tol)
+
+    return params, converged
+
+
+def fit_cutout(close_up,params,lower,upper,use_moffat = True,beta = None,
+               fitting_method = 'least_squares'):
+    '''
+    Fit a single cutout using *fitter.fit_kernel*. This is used when the
+    batched fit in *stack_fit* does not converge for a source.
+
+    :param close_up: Cutout of source
+    :type close_up: 2D array
+    :param params: Initial parameters, see *stack_model*
+    :type params: array
+    :param lower: Lower bound of each parameter
+    :type lower: array
+    :param upper: Upper bound of each parameter
+    :type upper: array
+    :param use_moffat: If True, use a Moffat model, else use a Gaussian model, defaults to True
+    :type use_moffat: bool, optional
+    :param beta: Fixed Moffat exponent. If None, beta is fitted and must be included in *params*, defaults to None
+    :type beta: float, optional
+    :param fitting_method: Selected method to fit model, see *fitter*, defaults to 'least_squares'
+    :type fitting_method: str, optional
+    :return: Best fitting parameters
+    :rtype: array
+
+    '''
+
+    import numpy as np
+
+    from autophot.packages.kernels import model_kernel
+    from autophot.packages.fitter import fit_parameters,fit_kernel
+
+    names = ['A','x0','y0','sky','width','beta'][:len(params)]
+
+    pars = fit_parameters()
+    for name,value,lo,hi in zip(names,params,lower,upper):
+        pars.add(name,value = value,min = lo,max = hi)
+
+    height,width = close_up.shape
+    yy,xx = np.mgrid[0:height,0:width]
+
+    weights = np.sqrt(abs(close_up))
+
+    kernel = model_kernel(xx,yy,use_moffat = use_moffat)
+
+    # Names of parameters in the order used by the kernel
+    kernel_names = ['A','x0','y0','sky','width','beta'][:len(kernel.names)]
+
+    result = fit_kernel(kernel,close_up,pars,
+                        method = fitting_method,
+                        weights = weights,
+                        names = kernel_names,
+                        fixed = {'beta':beta})
+
+    return np.array([result.params[name].value for name in names])
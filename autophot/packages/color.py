@@ -680,7 +680,8 @@ def get_colorslope_emcee(wdir,
     # load in output file - Usually names REDCUED csv
     output_fname = outcsv_name+'.csv'
     OutFile_loc = os.path.join( fits_dir + '_' +outdir_name, output_fname)
-    OutFile = pd.read_csv(OutFile_loc)
+    from autophot.packages.output_table import load_output
+    OutFile = load_output(OutFile_loc)
 
     # look in outfile for what color combinations we need
     for index, row in OutFile.iterrows():
@@ -1381,7 +1382,8 @@ def correct_zeropoint(wdir,
 
         output_fname = outcsv_name+'.csv'
         OutFile_loc = os.path.join( fits_dir + '_' +outdir_name, output_fname)
-        OutFile = pd.read_csv(OutFile_loc)
+        from autophot.packages.output_table import load_output
+        OutFile = load_output(OutFile_loc)
         
         plt.ioff()
 
@@ -1538,7 +1540,6 @@ def colorcorrect_transient(wdir,
     from autophot.packages.functions import set_size,border_msg
     # from autophot.packages.recover_output import recover
 
-    import pandas as pd
     import numpy as np
     
     
@@ -1575,7 +1576,8 @@ def colorcorrect_transient(wdir,
         output_fname = outcsv_name+'.csv'
 
     OutFile_loc = os.path.join( fits_dir + '_' +outdir_name, output_fname)
-    OutFile = pd.read_csv(OutFile_loc)
+    from autophot.packages.output_table import load_output
+    OutFile = load_output(OutFile_loc)
 
 
     mjd_span  = list(set(np.floor(OutFile.mjd.values)))
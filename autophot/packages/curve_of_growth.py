@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Curve of growth of a set of sources. The pixels around each source are
+extracted once and sorted by distance from the source, so the counts within
+any aperture radius can be found from a cumulative sum rather than by
+performing aperture photometry again. Pixels which lie completely inside the
+aperture are taken from the cumulative sum, while pixels on the edge of the
+aperture are weighted by the exact area of the pixel which overlaps the
+aperture. The optimum aperture size, the aperture correction and the signal to
+noise ratio at each radius are then all found from the same curve of growth.
+'''
+
+
+def _quadrant_area(x,y,r):
+    '''
+    Area of a circle of radius *r* centered on the origin which falls within the
+    rectangle with corners (0,0) and (x,y). The area is negative if *x* or *y*
+    is negative, so the overlap with any rectangle can be found by adding and
+    subtracting the areas of its corners.
+
+    :param x: X coordinate of corner
+    :type x: array
+    :param y: Y coordinate of corner
+    :type y: array
+    :param r: Radius of circle
+    :type r: float
+    :return: Signed area of circle within rectangle
+    :rtype: array
+
+    '''
+
+    import numpy as np
+
+    sign = np.sign(x) * np.sign(y)
+
+    x = np.minimum(abs(x),r)
+    y = np.minimum(abs(y),r)
+
+    def integral(t):
+        # Area under the circle from 0 to t
+        return 0.5 * (t * np.sqrt(np.maximum(r**2 - t**2,0)) + r**2 * np.arcsin(t/r))
+
+    # Point where the circle crosses the top of the rectangle
+    x_cross = np.minimum(x,np.sqrt(np.maximum(r**2 - y**2,0)))
+
+    return sign * (y * x_cross + integral(x) - integral(x_cross))
+
+
+def pixel_overlap(dx,dy,r):
+    '''
+    Exact fraction of a pixel which is overlapped by a circular aperture.
+
+    :param dx: X offset of the pixel center from the center of the aperture
+    :type dx: array
+    :param dy: Y offset of the pixel center from the center of the aperture
+    :type dy: array
+    :param r: Radius of aperture in pixels
+    :type r: float
+    :return: Fraction of each pixel within the aperture
+    :rtype: array
+
+    '''
+
+    x0 = dx - 0.5
+    x1 = dx + 0.5
+    y0 = dy - 0.5
+    y1 = dy + 0.5
+
+    return (_quadrant_area(x1,y1,r) - _quadrant_area(x0,y1,r)
+            - _quadrant_area(x1,y0,r) + _quadrant_area(x0,y0,r))
+
+
+class curve_of_growth(object):
+    '''
+    Curve of growth of a set of sources, found from a single extraction of the
+    pixels around each source.
+    '''
+
+    def __init__(self,image,x,y,r_max):
+        '''
+        :param image: 2D image containing sources
+        :type image: 2D array
+        :param x: X pixel locations of sources
+        :type x: array
+        :param y: Y pixel locations of sources
+        :type y: array
+        :param r_max: Largest radius (including the background annulus) which will be used, in pixels
+        :type r_max: float
+
+        '''
+
+        import numpy as np
+
+        self.image = image
+
+        self.x = np.asarray(x,dtype = float).ravel()
+        self.y = np.asarray(y,dtype = float).ravel()
+
+        self._background = {}
+
+        self._extract(r_max)
+
+    def __len__(self):
+
+        return len(self.x)
+
+    def _extract(self,r_max):
+        '''
+        Extract the pixels within *r_max* of each source and sort them by
+        distance. Pixels are sorted by the distance to their furthest corner, so
+        all pixels within the cumulative sum up to a radius lie fully inside it.
+        '''
+
+        import numpy as np
+
+        from autophot.packages.centroid import extract_cutouts
+
+        scale = int(np.ceil(r_max)) + 1
+
+        stack, _ = extract_cutouts(self.image,self.x,self.y,scale,partial = True)
+
+        n = len(self.x)
+
+        offsets = np.arange(2*scale)
+
+        dx = (self.x - scale).astype(int)[:,None] + offsets[None,:] - self.x[:,None]
+        dy = (self.y - scale).astype(int)[:,None] + offsets[None,:] - self.y[:,None]
+
+        dx = np.broadcast_to(dx[:,None,:],stack.shape).reshape(n,-1)
+        dy = np.broadcast_to(dy[:,:,None],stack.shape).reshape(n,-1)
+
+        values = stack.reshape(n,-1)
+
+        # Distance to the nearest and furthest part of each pixel
+        near = np.sqrt(np.maximum(abs(dx) - 0.5,0)**2 + np.maximum(abs(dy) - 0.5,0)**2)
+        far = np.sqrt((abs(dx) + 0.5)**2 + (abs(dy) + 0.5)**2)
+
+        order = np.argsort(far,axis = 1)
+
+        self.r_max = r_max
+
+        self.dx = np.take_along_axis(dx,order,axis = 1)
+        self.dy = np.take_along_axis(dy,order,axis = 1)
+        self.near = np.take_along_axis(near,order,axis = 1)
+        self.far = np.take_along_axis(far,order,axis = 1)
+        self.values = np.take_along_axis(values,order,axis = 1)
+
+        self.finite = np.isfinite(self.values)
+
+        self.cumulative_sum = np.hstack([np.zeros((n,1)),
+                                         np.cumsum(np.where(self.finite,self.values,0),axis = 1)])
+
+        # Number of finite pixels, so the area of an aperture only includes pixels on the image
+        self.cumulative_area = np.hstack([np.zeros((n,1)),
+                                          np.cumsum(self.finite,axis = 1)])
+
+        self._background = {}
+
+        return
+
+    def _check_radius(self,r):
+        '''
+        Extract the pixels again if a radius larger than *r_max* is needed.
+        '''
+
+        if r > self.r_max:
+            self._extract(r)
+
+        return
+
+    def background(self,r_in,r_out,sigma = 3):
+        '''
+        Sigma clipped median and standard deviation of the pixels in a
+        background annulus around each source. Pixels are included if their
+        center lies within the annulus. Results are cached for each annulus.
+
+        :param r_in: Inner radius of background annulus in pixels
+        :type r_in: float
+        :param r_out: Outer radius of background annulus in pixels
+        :type r_out: float
+        :param sigma: Number of standard deviations used when sigma clipping, defaults to 3
+        :type sigma: float, optional
+        :return: Median and standard deviation of the background of each source
+        :rtype: tuple
+
+        '''
+
+        import numpy as np
+
+        from autophot.packages.centroid import stack_sigma_clipped_stats
+
+        self._check_radius(r_out)
+
+        key = (float(r_in),float(r_out),float(sigma))
+
+        if key not in self._background:
+
+            distance = np.sqrt(self.dx**2 + self.dy**2)
+
+            annulus = (distance >= r_in) & (distance < r_out)
+
+            _, median, std = stack_sigma_clipped_stats(np.where(annulus,self.values,np.nan),
+                                                       sigma = sigma,
+                                                       maxiters = 5)
+
+            self._background[key] = (median,std)
+
+        return self._background[key]
+
+    def total_counts(self,radii,return_area = False):
+        '''
+        Counts within each aperture radius for each source, without removing the
+        background.
+
+        :param radii: List of aperture radii in pixels
+        :type radii: list
+        :param return_area: If True, also return the area of each aperture covered by finite pixels, defaults to False
+        :type return_area: bool, optional
+        :return: Array of counts with shape (N sources, N radii), and the area of each aperture if *return_area* is True
+        :rtype: array
+
+        '''
+
+        import numpy as np
+
+        radii = np.atleast_1d(np.asarray(radii,dtype = float))
+
+        self._check_radius(np.nanmax(radii))
+
+        n = len(self.x)
+
+        counts = np.full((n,len(radii)),np.nan)
+        area = np.full((n,len(radii)),np.nan)
+
+        if n == 0:
+            return (counts, area) if return_area else counts
+
+        rows = np.arange(n)
+
+        for i,r in enumerate(radii):
+
+            # Pixels which lie fully inside the aperture
+            n_inside = (self.far <= r).sum(axis = 1)
+
+            inside = self.cumulative_sum[rows,n_inside]
+
+            # Pixels on the edge of the aperture
+            edge = (self.near < r) & (self.far > r) & self.finite
+
+            overlap = np.zeros(self.values.shape)
+            overlap[edge] = pixel_overlap(self.dx[edge],self.dy[edge],r)
+
+            partial = np.sum(np.where(edge,self.values,0) * overlap,axis = 1)
+
+            # Sources with no pixels on the image within the aperture
+            has_data = ((self.near < r) & self.finite).any(axis = 1)
+
+            counts[:,i] = np.where(has_data,inside + partial,np.nan)
+            area[:,i] = self.cumulative_area[rows,n_inside] + np.sum(overlap,axis = 1)
+
+        if return_area:
+            return counts, area
+
+        return counts
+
+    def counts(self,radii,r_in,r_out,gain = 1):
+        '''
+        Background subtracted counts within each aperture radius for each
+        source, along with their error found using *compute_phot_error*. The
+        background is removed over the area of the aperture covered by finite
+        pixels, as done by *aperture.cutout_aperture_photometry*.
+
+        :param radii: List of aperture radii in pixels
+        :type radii: list
+        :param r_in: Inner radius of background annulus in pixels
+        :type r_in: float
+        :param r_out: Outer radius of background annulus in pixels
+        :type r_out: float
+        :param gain: Gain of image in :math:`e^{-}` per ADU, defaults to 1
+        :type gain: float, optional
+        :return: Arrays with shape (N sources, N radii) of the counts and the error on the counts, and arrays of the median and standard deviation of the background of each source
+        :rtype: tuple
+
+        '''
+
+        import numpy as np
+
+        from autophot.packages.aperture import compute_phot_error
+
+        radii = np.atleast_1d(np.asarray(radii,dtype = float))
+
+        bkg_median, bkg_std = self.background(r_in,r_out)
+
+        total, area = self.total_counts(radii,return_area = True)
+
+        area_sky_annulus = np.pi * r_out ** 2 - np.pi * r_in ** 2
+
+        counts = total - bkg_median[:,None] * area
+
+        counts[counts <= 0] = 0
+
+        counts_error = compute_phot_error(flux_variance = counts,
+                                          sky_std = bkg_std[:,None],
+                                          sky_annulus_area = area_sky_annulus,
+                                          ap_area = area,
+                                          gain = gain)
+
+        return counts, counts_error, bkg_median, bkg_std
+
+    def snr(self,radii,r_in,r_out,exp_time,gain = 1,rdnoise = 0):
+        '''
+        Signal to noise ratio of each source at each aperture radius, found using *SNR*.
+
+        :param radii: List of aperture radii in pixels
+        :type radii: list
+        :param r_in: Inner radius of background annulus in pixels
+        :type r_in: float
+        :param r_out: Outer radius of background annulus in pixels
+        :type r_out: float
+        :param exp_time: Exposure time in seconds of image.
+        :type exp_time: float
+        :param gain: Gain of image in :math:`e^{-}` per ADU, defaults to 1
+        :type gain: float, optional
+        :param rdnoise: Read noise of image in :math:`e^{-}` per pixel, defaults to 0
+        :type rdnoise: float, optional
+        :return: Array of signal to noise ratios with shape (N sources, N radii)
+        :rtype: array
+
+        '''
+
+        import numpy as np
+
+        from autophot.packages.functions import SNR
+
+        radii = np.atleast_1d(np.asarray(radii,dtype = float))
+
+        counts, _, bkg_median, _ = self.counts(radii,r_in,r_out,gain = gain)
+
+        return SNR(flux_star = counts / exp_time,
+                   flux_sky = bkg_median[:,None] / exp_time,
+                   exp_t = exp_time,
+                   radius = radii[None,:],
+                   G = gain,
+                   RN = rdnoise,
+                   DC = 0)
+
+    def aperture_correction(self,ap_size,inf_ap_size,r_in_size,r_out_size,gain = 1):
+        '''
+        Magnitude difference between a normal and a larger, "infinite", aperture
+        for each source. Each aperture uses its own background annulus, as in
+        *do_aperture_photometry*.
+
+        :param ap_size: Radius of normal aperture in pixels
+        :type ap_size: float
+        :param inf_ap_size: Radius of larger aperture in pixels
+        :type inf_ap_size: float
+        :param r_in_size: Distance from the edge of the aperture to the inner radius of background annulus in pixels
+        :type r_in_size: float
+        :param r_out_size: Distance from the edge of the aperture to the outer radius of background annulus in pixels
+        :type r_out_size: float
+        :param gain: Gain of image in :math:`e^{-}` per ADU, defaults to 1
+        :type gain: float, optional
+        :return: Counts under the normal aperture, counts under the larger aperture and aperture correction in magnitudes
+        :rtype: tuple
+
+        '''
+
+        import numpy as np
+
+        from autophot.packages.functions import calc_mag
+
+        counts_ap = self.counts([ap_size],ap_size + r_in_size,ap_size + r_out_size,gain = gain)[0][:,0]
+        counts_inf_ap = self.counts([inf_ap_size],inf_ap_size + r_in_size,inf_ap_size + r_out_size,gain = gain)[0][:,0]
+
+        with np.errstate(divide = 'ignore',invalid = 'ignore'):
+            correction = calc_mag(counts_inf_ap / counts_ap,1,0)
+
+        return counts_ap, counts_inf_ap, correction
+
+    def select(self,index):
+        '''
+        Curve of growth of a subset of the sources, sharing the extracted pixels.
+
+        :param index: Boolean array or list of positions of sources to select
+        :type index: array
+        :return: Curve of growth of selected sources
+        :rtype: curve_of_growth
+
+        '''
+
+        import numpy as np
+
+        subset = curve_of_growth.__new__(curve_of_growth)
+
+        index = np.asarray(index)
+
+        if index.dtype == bool:
+            index = np.where(index)[0]
+
+        subset.image = self.image
+        subset.r_max = self.r_max
+
+        for attr in ['x','y','dx','dy','near','far','values','finite','cumulative_sum']:
+            setattr(subset,attr,getattr(self,attr)[index])
+
+        subset._background = {key:(val[0][index],val[1][index]) for key,val in self._background.items()}
+
+        return subset
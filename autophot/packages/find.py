@@ -55,6 +55,106 @@ def combine(dictionaries):
     return combined_dict
     
 
+def detection_significance(image, x, y, fwhm, image_median, image_std):
+    '''
+    Significance of detected sources in the same units as the *DAOStarFinder*
+    threshold. The background subtracted image is convolved with a lowered
+    Gaussian kernel (see *centroid.lowered_gaussian_kernel*) around each source
+    and the highest value within a pixel of its centroid is divided by the
+    noise in the convolved image. A source with a significance above
+    :math:`threshold\_value` would be detected with this threshold.
+
+    :param image: Image containing sources
+    :type image: 2D array
+    :param x: X pixel locations of sources
+    :type x: array
+    :param y: Y pixel locations of sources
+    :type y: array
+    :param fwhm: Full Width Half Maximum used for source detection
+    :type fwhm: float
+    :param image_median: Background level of image
+    :type image_median: float
+    :param image_std: Background standard deviation of image
+    :type image_std: float
+    :return: Significance of each source
+    :rtype: array
+
+    '''
+
+    import numpy as np
+    from scipy.ndimage import correlate
+    from autophot.packages.centroid import extract_cutouts,lowered_gaussian_kernel
+
+    kernel, r, relerr = lowered_gaussian_kernel(fwhm)
+
+    # Cutouts large enough to convolve the 3x3 pixels around each source
+    scale = r + 2
+
+    x = np.round(np.asarray(x,dtype = float))
+    y = np.round(np.asarray(y,dtype = float))
+
+    stack, _ = extract_cutouts(image,x + 0.5,y + 0.5,scale)
+
+    stack = stack - image_median
+    stack = np.where(np.isfinite(stack),stack,0)
+
+    convolved = correlate(stack,kernel[None,:,:],mode = 'constant',cval = 0)
+
+    peak = convolved[:,scale-1:scale+2,scale-1:scale+2].reshape(len(stack),-1).max(axis = 1)
+
+    return peak / (relerr * image_std)
+
+
+def pick_threshold(significance, threshold_value, min_source_no, max_source_no,
+                   lim_threshold_value = 5):
+    '''
+    Pick a threshold value directly from the significance of detected sources,
+    rather than stepping the threshold up and down until a useful number of
+    sources is found. If *threshold_value* already gives between
+    *min_source_no* and *max_source_no* sources, it is returned unchanged.
+    Otherwise the threshold is set halfway between the significance of the
+    last source kept and the next source, such that *max_source_no* (or
+    *min_source_no*) sources are found.
+
+    :param significance: Significance of each detected source
+    :type significance: array
+    :param threshold_value: Current threshold value
+    :type threshold_value: float
+    :param min_source_no: Minimum number of sources wanted
+    :type min_source_no: int
+    :param max_source_no: Maximum number of sources wanted
+    :type max_source_no: int
+    :param lim_threshold_value: Lowest allowed threshold value, defaults to 5
+    :type lim_threshold_value: float, optional
+    :return: Threshold value
+    :rtype: float
+
+    '''
+
+    import numpy as np
+
+    significance = np.sort(np.asarray(significance,dtype = float)[np.isfinite(significance)])[::-1]
+
+    n_sources = np.sum(significance >= threshold_value)
+
+    if n_sources > max_source_no:
+        k = int(max_source_no)
+    elif n_sources < min_source_no:
+        k = int(np.ceil(min_source_no))
+    else:
+        return threshold_value
+
+    if k <= 0:
+        return max(threshold_value,significance[0] + 1) if len(significance) > 0 else threshold_value
+
+    if k >= len(significance):
+        return lim_threshold_value
+
+    threshold_value = 0.5 * (significance[k-1] + significance[k])
+
+    return round(max(threshold_value,lim_threshold_value),3)
+
+
 def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
              bkg_level = 3, max_source_lim = 1000, min_source_lim = 2, 
              int_scale = 25, fudge_factor = 5, fine_fudge_factor = 0.1,
@@ -69,7 +169,8 @@ def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
              local_radius = 1000, mask_sources_XY_R = [], 
              remove_sat = True, use_moffat = True,
              target_name = None, target_x_pix = None, target_y_pix = None, 
-             scale = None, use_catalog = None, sigma_lvl = None, fwhm = None
+             scale = None, use_catalog = None, sigma_lvl = None, fwhm = None,
+             fast_threshold = False
              ):
     '''
     
@@ -157,6 +258,8 @@ def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
     :type scale: int, optional
     :param use_catalog: If True, use a catalog containing the columns *x_pix* and *y_pix* instead of using source detection. This variable source correspond tothe filepath of the catalog *csv* file, defaults to None
     :type use_catalog: str, optional
+    :param fast_threshold: If True, detect sources once at the lowest threshold (*lim\_threshold\_value*) and find the significance of each source (see *detection_significance*). The threshold value is then picked directly from these values (see *pick_threshold*), and any further changes to the threshold select sources from this list rather than searching the image again. The image is only searched again if the FWHM guess changes, defaults to False
+    :type fast_threshold: bool, optional
     :return: Returns the image FWHM, a dataframe containing information on thefitted sources, the updated cutout scale and the :math:`image\_params` dictionary containing information on the best fitting analytical model
     :rtype: List of objects
     
@@ -178,7 +281,9 @@ def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
     
     from autophot.packages.functions import gauss_sigma2fwhm,gauss_2d,gauss_fwhm2sigma
     from autophot.packages.functions import moffat_2d,moffat_fwhm
-    from autophot.packages.functions import set_size,pix_dist,border_msg
+    from autophot.packages.functions import set_size,border_msg
+    from autophot.packages.spatial_index import nearest_distance
+    from autophot.packages.fitter import lmfit_method
 
     logger = logging.getLogger(__name__)
     
@@ -306,6 +411,11 @@ def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
         
         brightest = 25
         
+        # Sources detected at the lowest threshold, used if fast_threshold is True
+        candidates = None
+        candidates_fwhm = None
+        candidates_threshold = None
+        
         
         # =============================================================================
         #  Setup FWHM fitting model
@@ -438,23 +548,76 @@ def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
                         fudge_factor = fine_fudge_factor
 
 
-                    daofind = DAOStarFinder(fwhm      = int_fwhm,
-                                            threshold = threshold_value*image_std,
-                                            sharplo   =  0.2,sharphi = 1.0,
-                                            roundlo   = -1.0,roundhi = 1.0,
-                                            exclude_border = True,
-                                            brightest = brightest
-                                            )
-                    
-                    sources = daofind(search_image - image_median,
-                                      mask = mask.astype(bool))
+                    if fast_threshold:
+                        
+                        # Only search the image again if the FWHM guess has changed
+                        if candidates is None or candidates_fwhm != int_fwhm or threshold_value < candidates_threshold:
+                            
+                            candidates_threshold = min(lim_threshold_value,threshold_value)
+                            candidates_fwhm = int_fwhm
+                            
+                            daofind = DAOStarFinder(fwhm      = int_fwhm,
+                                                    threshold = candidates_threshold*image_std,
+                                                    sharplo   =  0.2,sharphi = 1.0,
+                                                    roundlo   = -1.0,roundhi = 1.0,
+                                                    exclude_border = True,
+                                                    brightest = None
+                                                    )
+                            
+                            candidates = daofind(search_image - image_median,
+                                                 mask = mask.astype(bool))
+                            
+                            if candidates is None:
+                                raise Exception('FWHM detection failed - no sources found above %.1f sigma' % candidates_threshold)
+                                
+                            candidates = candidates.to_pandas()
+                            
+                            candidates['significance'] = detection_significance(search_image,
+                                                                                candidates['xcentroid'].values,
+                                                                                candidates['ycentroid'].values,
+                                                                                fwhm = int_fwhm,
+                                                                                image_median = image_median,
+                                                                                image_std = image_std)
+                            
+                            if sigma_lvl is None:
+                                threshold_value = pick_threshold(candidates['significance'].values,
+                                                                 threshold_value,
+                                                                 min_source_no = min_source_no,
+                                                                 max_source_no = max_source_no,
+                                                                 lim_threshold_value = lim_threshold_value)
+                                
+                            logger.info('%d candidate sources - threshold set to %.1f sigma' % (len(candidates),threshold_value))
+                        
+                        sources = candidates[candidates['significance'] >= threshold_value]
+                        
+                        if not (brightest is None):
+                            sources = sources.sort_values(by = 'flux',ascending = False).head(brightest)
+                            
+                        sources = sources.reset_index(drop = True)
+                            
+                        if len(sources) == 0:
+                            sources = None
+                            
+                    else:
+                        
+                        daofind = DAOStarFinder(fwhm      = int_fwhm,
+                                                threshold = threshold_value*image_std,
+                                                sharplo   =  0.2,sharphi = 1.0,
+                                                roundlo   = -1.0,roundhi = 1.0,
+                                                exclude_border = True,
+                                                brightest = brightest
+                                                )
+                        
+                        sources = daofind(search_image - image_median,
+                                          mask = mask.astype(bool))
 
                     if sources is None:
                         logger.warning('Sources == None at %.1f sigma - decresing threshold' % threshold_value)
                         m = fudge_factor
                         continue
 
-                    sources = sources.to_pandas()
+                    if not fast_threshold:
+                        sources = sources.to_pandas()
                     
                 
                 logger.info('\nNumber of sources before cleaning [ %.1f sigma ]: %d ' % (threshold_value,len(sources)))
@@ -534,7 +697,7 @@ def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
                             result = fwhm_fitting_model.fit(data = close_up,
                                                             params = fwhm_fitting_pars,
                                                             x = np.ones(close_up.shape),
-                                                            method = fitting_method,
+                                                            method = lmfit_method(fitting_method),
                                                             nan_policy = 'omit')
                             
                             if use_moffat:
@@ -636,37 +799,20 @@ def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
 
                     isolated_sources = pd.DataFrame({'x_pix':x,'y_pix':y})
                     
-                not_isolated = 0
-                
-                # TODO: No need for this loop - change to generator
-                for idx in range(len(x)):
-                    
-
-                    try:
-
-                        x0 = x[idx]
-                        y0 = y[idx]
-                
-                        dist = np.sqrt((x0-np.array(x))**2+(y0-np.array(y))**2)
-
-                        dist = dist[np.where(dist>0)]
-
-                        if len(dist) == 0:
-                            dist = [0]
+                # Distance from each source to its nearest neighbour
+                nearest_dist = nearest_distance(x,y)
 
-                        if min(dist) <= init_iso_scale  and not using_catalog_sources:
+                # Sources without any neighbours are treated as crowded
+                nearest_dist[~np.isfinite(nearest_dist)] = 0
 
-                            not_isolated+=1
+                if using_catalog_sources:
+                    crowded = np.zeros(len(x),dtype = bool)
+                else:
+                    crowded = nearest_dist <= init_iso_scale
 
-                        else:
-                            
-                            df = np.array((float(x0),float(y0)))
+                not_isolated = int(np.sum(crowded))
 
-                            iso_temp.append(df)
-                            
-                    except Exception as e:
-                        logger.exception(e)
-                        pass
+                iso_temp.extend(list(np.column_stack([x,y])[~crowded].astype(float)))
 
                 logger.info('Removed %d crowded sources' % ( not_isolated))
 
@@ -769,7 +915,7 @@ def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
                             result = fwhm_fitting_model.fit(data = close_up,
                                                              params = fwhm_fitting_pars,
                                                              x = np.ones(close_up.shape),
-                                                             method = fitting_method,
+                                                             method = lmfit_method(fitting_method),
                                                              nan_policy = 'omit')
                             
                             A = result.params['A'].value
@@ -888,8 +1034,8 @@ def get_fwhm(image, wdir, base, threshold_value = 25, fwhm_guess = 5,
                 isolated_sources['median'] = medianlst
                 
                 
-                seperations = [pix_dist(i[0],isolated_sources['x_pix'],i[1],isolated_sources['y_pix']) for i in list(zip(isolated_sources['x_pix'],isolated_sources['y_pix']))]
-                isolated_sources['min_seperation'] = list([np.nanmin(i[i>0]) for i in seperations ])
+                isolated_sources['min_seperation'] = nearest_distance(isolated_sources['x_pix'].values,
+                                                                      isolated_sources['y_pix'].values)
                 isolated_sources.reset_index(inplace = True,drop = True)
                 
                     
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Access layer for reading and writing *FITS* images in AutoPhOT. Each file is
+opened once to find the extension containing the image (a *sci* extension,
+the primary HDU, or a tile compressed extension in *fits.fz* files) and to
+build a single header from all extensions. This is cached per file path, so
+repeated calls to *read_header* do not re-open and re-verify the file. The
+cache is checked against the size and modification time of the file, and is
+cleared whenever a file is written through *write_fits*. Pixel data is
+memory mapped where possible, so reading an image does not copy it into
+memory until it is used. The *image_state* class holds the image and header
+being worked on in memory during a run, so they are written out only when
+needed rather than after every change.
+'''
+
+# Cache of file information, keyed by absolute file path
+_fits_cache = {}
+
+# Number of files to keep in the cache
+_fits_cache_size = 64
+
+
+def _file_signature(fpath):
+    '''
+    Size and modification time of a file used to check if a cached entry is still valid.
+
+    :param fpath: File path
+    :type fpath: str
+    :return: Tuple of file size and modification time in nanoseconds
+    :rtype: tuple
+
+    '''
+
+    import os
+
+    stat = os.stat(fpath)
+
+    return (stat.st_size,stat.st_mtime_ns)
+
+
+def _find_image_hdu(hdul):
+    '''
+    Find the extension in a *FITS* file containing the image. An extension named
+    *sci* is used if found, otherwise the first extension (including tile
+    compressed extensions) which contains data.
+
+    :param hdul: Opened *FITS* file
+    :type hdul: HDUList
+    :return: Index of extension containing image
+    :rtype: int
+
+    '''
+
+    sci_idx = None
+    data_idx = None
+
+    for idx,hdu in enumerate(hdul):
+
+        if sci_idx is None and hdu.name.lower() == 'sci':
+            sci_idx = idx
+
+        if data_idx is None and hdu.is_image and hdu.header.get('NAXIS',0) > 0:
+            data_idx = idx
+
+        # Compressed images are stored as binary tables
+        if data_idx is None and hdu.header.get('ZIMAGE',False):
+            data_idx = idx
+
+    if sci_idx is not None:
+        return sci_idx
+
+    if data_idx is not None:
+        return data_idx
+
+    return 0
+
+
+def invalidate(fpath = None):
+    '''
+    Remove a file from the cache, or clear the cache if *fpath* is None.
+
+    :param fpath: File path, defaults to None
+    :type fpath: str, optional
+    :return: None
+    :rtype: None
+
+    '''
+
+    import os
+
+    if fpath is None:
+        _fits_cache.clear()
+    else:
+        _fits_cache.pop(os.path.abspath(fpath),None)
+
+    return
+
+
+def _file_info(fpath):
+    '''
+    Header and image extension of a *FITS* file. The file is only opened if it
+    isn't in the cache or has changed since it was cached.
+
+    :param fpath: File path of *FITS* file
+    :type fpath: str
+    :return: Dictionary containing the merged header (*header*) and index of the extension containing the image (*image_hdu*)
+    :rtype: dict
+
+    '''
+
+    import os
+    from astropy.io import fits
+
+    key = os.path.abspath(fpath)
+    signature = _file_signature(fpath)
+
+    info = _fits_cache.get(key)
+
+    if info is not None and info['signature'] == signature:
+        return info
+
+    with fits.open(fpath,ignore_missing_end = True,memmap = True) as hdul:
+
+        # Need to verify/fix or can get errors down the line
+        hdul.verify('silentfix+ignore')
+
+        image_hdu = _find_image_hdu(hdul)
+
+        # If file contains multiple headers, concat them
+        header = hdul[0].header.copy()
+        for i in range(1,len(hdul)):
+            header.update(hdul[i].header)
+
+    info = {'signature':signature,
+            'header':header,
+            'image_hdu':image_hdu}
+
+    if len(_fits_cache) >= _fits_cache_size:
+        _fits_cache.pop(next(iter(_fits_cache)))
+
+    _fits_cache[key] = info
+
+    return info
+
+
+def read_header(fpath):
+    '''
+    Header of a *FITS* file. If the file has multiple extensions, the headers of
+    all extensions are merged into a single header. A copy of the cached header
+    is returned so it can be safely changed.
+
+    :param fpath: File path of *FITS* file
+    :type fpath: str
+    :return: Header information
+    :rtype: Header
+
+    '''
+
+    return _file_info(fpath)['header'].copy()
+
+
+def read_image(fpath,memmap = True):
+    '''
+    Image from a *FITS* file. The extension containing the image is found once
+    and cached. If *memmap* is True, the pixel data is memory mapped rather than
+    read into memory (not possible for compressed or scaled images). An error is
+    raised if the image is not a 2D array.
+
+    :param fpath: File path of *FITS* file
+    :type fpath: str
+    :param memmap: If True, memory map the pixel data, defaults to True
+    :type memmap: bool, optional
+    :return: 2D image
+    :rtype: array
+
+    '''
+
+    import os
+    from astropy.io import fits
+
+    image_hdu = _file_info(fpath)['image_hdu']
+
+    with fits.open(fpath,ignore_missing_end = True,memmap = memmap) as hdul:
+        image = hdul[image_hdu].data
+
+    if image is None or len(image.shape) != 2:
+
+        base=os.path.basename(fpath)
+
+        raise Exception('Warning:: %s not 2-D array' % base)
+
+    return image
+
+
+def _is_memmap(array):
+    '''
+    Check if an array is backed by a memory mapped file.
+
+    :param array: Array
+    :type array: array
+    :return: True if array is memory mapped
+    :rtype: bool
+
+    '''
+
+    import mmap
+    import numpy as np
+
+    while array is not None:
+        if isinstance(array,(np.memmap,mmap.mmap)):
+            return True
+        array = getattr(array,'base',None)
+
+    return False
+
+
+def write_fits(fpath,image,header = None,overwrite = True,
+               output_verify = 'silentfix+ignore'):
+    '''
+    Write an image and header to a *FITS* file and remove it from the cache.
+    Memory mapped images are copied into memory first in case they are mapped
+    from the file being overwritten.
+
+    :param fpath: File path of *FITS* file
+    :type fpath: str
+    :param image: 2D image
+    :type image: array
+    :param header: Header information, defaults to None
+    :type header: Header, optional
+    :param overwrite: If True, overwrite file if it already exists, defaults to True
+    :type overwrite: bool, optional
+    :param output_verify: Verification option passed to astropy, defaults to 'silentfix+ignore'
+    :type output_verify: str, optional
+    :return: None
+    :rtype: None
+
+    '''
+
+    import numpy as np
+    from astropy.io import fits
+
+    if image is not None and _is_memmap(image):
+        image = np.array(image)
+
+    invalidate(fpath)
+
+    fits.writeto(fpath,image,header,
+                 overwrite = overwrite,
+                 output_verify = output_verify)
+
+    return
+
+
+class image_state(object):
+    '''
+    Image and header of the file being worked on, kept in memory while the
+    pipeline runs. Each step that changes the image or header (trimming, cosmic
+    ray removal, updating the WCS, etc) calls *update* rather than writing the
+    file and reading it back in. The file is only written when *flush* is
+    called, e.g. before an external program (such as *Astrometry.net*) needs to
+    read it, or once the image is finished.
+    '''
+
+    def __init__(self,fpath,image = None,header = None):
+        '''
+        :param fpath: File path of *FITS* file
+        :type fpath: str
+        :param image: 2D image, defaults to None in which case it is read from *fpath*
+        :type image: array, optional
+        :param header: Header information, defaults to None in which case it is read from *fpath*
+        :type header: Header, optional
+
+        '''
+
+        self.fpath = fpath
+
+        self.image = read_image(fpath) if image is None else image
+        self.header = read_header(fpath) if header is None else header
+
+        self.modified = False
+
+    def update(self,image = None,header = None):
+        '''
+        Update the image and/or header held in memory. If the image changes
+        shape, the *NAXIS1* and *NAXIS2* keywords in the header are updated to match.
+
+        :param image: New 2D image, defaults to None
+        :type image: array, optional
+        :param header: New header information, defaults to None
+        :type header: Header, optional
+        :return: None
+        :rtype: None
+
+        '''
+
+        if image is not None:
+            self.image = image
+
+        if header is not None:
+            self.header = header
+
+        if image is not None and self.header is not None:
+            self.header['NAXIS1'] = self.image.shape[1]
+            self.header['NAXIS2'] = self.image.shape[0]
+
+        self.modified = True
+
+        return
+
+    def wcs(self):
+        '''
+        World coordinate system of the header held in memory.
+
+        :return: World coordinate system
+        :rtype: WCS
+
+        '''
+
+        from astropy.wcs import WCS
+
+        return WCS(self.header)
+
+    def flush(self):
+        '''
+        Write the image and header to *fpath* if they have been changed since
+        the file was last written.
+
+        :return: File path of *FITS* file
+        :rtype: str
+
+        '''
+
+        if self.modified:
+
+            write_fits(self.fpath,self.image,self.header)
+
+            self.modified = False
+
+        return self.fpath
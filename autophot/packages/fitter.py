@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Fitting backends for the analytical models in *kernels*. The backend is
+chosen by the *fitting_method* given in the *fitting* section of the input
+file:
+
+* **fast_least_squares**: `scipy.optimize.least_squares
+  <https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.least_squares.html>`_
+  is called directly with arrays of parameters and bounds, and the analytic
+  Jacobian of the model.
+
+* **fast_lm**: Levenberg-Marquardt fit using *centroid.stack_lm* with the
+  analytic Jacobian of the model. Parameters are clipped to their bounds.
+
+* Any other method is passed to `lmfit <https://lmfit.github.io/lmfit-py/fitting.html>`_,
+  which is used as the reference.
+
+The fast backends avoid building *lmfit.Parameters* and *lmfit.Minimizer*
+objects for every fit, and do not transform bounded parameters. *benchmark*
+fits the same simulated sources with each backend so their results and
+timings can be compared.
+'''
+
+# Fitting methods which are not passed to lmfit, and the lmfit method used in their place
+_fast_methods = {'fast_least_squares':'least_squares',
+                 'fast_lm':'leastsq'}
+
+
+def is_fast_method(method):
+    '''
+    Check if a fitting method uses one of the fast backends.
+
+    :param method: Fitting method
+    :type method: str
+    :return: True if *method* is a fast backend
+    :rtype: bool
+
+    '''
+
+    return method in _fast_methods
+
+
+def lmfit_method(method):
+    '''
+    Fitting method to pass to *lmfit*. Fast backends are replaced by the
+    equivalent *lmfit* method, so fits which are not done with *fit_kernel*
+    can use the same *fitting_method*.
+
+    :param method: Fitting method
+    :type method: str
+    :return: Fitting method accepted by *lmfit*
+    :rtype: str
+
+    '''
+
+    return _fast_methods.get(method,method)
+
+
+class fit_parameter(object):
+    '''
+    Value, bounds and whether a parameter is varied during a fit.
+    '''
+
+    def __init__(self,name,value = 0,min = None,max = None,vary = True):
+
+        self.name = name
+        self.value = value
+        self.min = -float('inf') if min is None else min
+        self.max = float('inf') if max is None else max
+        self.vary = vary
+        self.stderr = None
+
+    def __repr__(self):
+
+        return '<fit_parameter %s = %s, bounds = [%s, %s], vary = %s>' % (self.name,self.value,self.min,self.max,self.vary)
+
+
+class fit_parameters(dict):
+    '''
+    Set of parameters for *fit_kernel*. Parameters are added in the same way
+    as *lmfit.Parameters*, but without the overhead of building *lmfit*
+    objects when a fast backend is used.
+    '''
+
+    def add(self,name,value = 0,min = None,max = None,vary = True):
+        '''
+        Add a parameter.
+
+        :param name: Name of parameter
+        :type name: str
+        :param value: Initial value, defaults to 0
+        :type value: float, optional
+        :param min: Lower bound, defaults to None
+        :type min: float, optional
+        :param max: Upper bound, defaults to None
+        :type max: float, optional
+        :param vary: If True, parameter is varied during the fit, defaults to True
+        :type vary: bool, optional
+        :return: None
+        :rtype: None
+
+        '''
+
+        self[name] = fit_parameter(name,value = value,min = min,max = max,vary = vary)
+
+        return
+
+    def valuesdict(self):
+        '''
+        Dictionary of parameter names and values.
+
+        :return: Parameter values
+        :rtype: dict
+
+        '''
+
+        return {name:par.value for name,par in self.items()}
+
+    def to_lmfit(self):
+        '''
+        Equivalent *lmfit.Parameters*.
+
+        :return: Parameters
+        :rtype: lmfit.Parameters
+
+        '''
+
+        import lmfit
+
+        pars = lmfit.Parameters()
+
+        for name,par in self.items():
+            pars.add(name,value = par.value,min = par.min,max = par.max,vary = par.vary)
+
+        return pars
+
+    def copy(self):
+
+        copied = fit_parameters()
+
+        for name,par in self.items():
+            copied.add(name,value = par.value,min = par.min,max = par.max,vary = par.vary)
+
+        return copied
+
+
+class fit_result(object):
+    '''
+    Best fitting parameters and fit statistics, with the same attribute names
+    as *lmfit.minimizer.MinimizerResult*.
+    '''
+
+    def __init__(self,params,chisqr,ndata,nvarys,success,nfev,method):
+
+        self.params = params
+        self.chisqr = chisqr
+        self.ndata = ndata
+        self.nvarys = nvarys
+        self.nfree = max(ndata - nvarys,1)
+        self.redchi = chisqr / self.nfree
+        self.success = success
+        self.nfev = nfev
+        self.method = method
+
+
+def fit_kernel(kernel,data,params,method = 'least_squares',weights = None,
+               names = None,fixed = None,max_nfev = None):
+    '''
+    Fit a *kernels.model_kernel* to an image using the backend selected by
+    *method*. Pixels which are not finite (or have a weight which is not
+    finite) are ignored.
+
+    :param kernel: Model to fit
+    :type kernel: model_kernel
+    :param data: Image with the same shape as the grid of *kernel*
+    :type data: 2D array
+    :param params: Initial parameters
+    :type params: fit_parameters
+    :param method: Fitting method, defaults to 'least_squares'
+    :type method: str, optional
+    :param weights: Weight of each pixel, defaults to None
+    :type weights: 2D array, optional
+    :param names: Names of the parameters in the order used by the kernel, defaults to None in which case *names* of the kernel is used
+    :type names: list, optional
+    :param fixed: Values of kernel parameters which are not included in *params*, defaults to None in which case they are set to zero
+    :type fixed: dict, optional
+    :param max_nfev: Maximum number of function evaluations, defaults to None
+    :type max_nfev: int, optional
+    :return: Result of the fit, with the best fitting parameters in *params*
+    :rtype: fit_result
+
+    '''
+
+    import numpy as np
+
+    names = kernel.names if names is None else names
+    fixed = {} if fixed is None else fixed
+
+    data = np.asarray(data,dtype = float).ravel()
+
+    if weights is not None:
+        weights = np.asarray(weights,dtype = float).ravel()
+
+    if not is_fast_method(method):
+        return _fit_lmfit(kernel,data,params,method,weights,names,fixed,max_nfev)
+
+    # Parameters with equal bounds are held fixed
+    var_names = [name for name,par in params.items() if par.vary and par.min < par.max]
+    columns = [names.index(name) for name in var_names]
+
+    base = kernel.parameter_vector(params.valuesdict(),names,fixed)
+
+    lower = np.array([params[name].min for name in var_names],dtype = float)
+    upper = np.array([params[name].max for name in var_names],dtype = float)
+
+    x0 = np.clip(np.array([params[name].value for name in var_names],dtype = float),lower,upper)
+
+    good = np.isfinite(data)
+    if weights is not None:
+        good &= np.isfinite(weights)
+
+    data_good = data[good]
+    weights_good = None if weights is None else weights[good]
+
+    def vector(x):
+        full = base.copy()
+        full[columns] = x
+        return full
+
+    def model_and_jacobian(x):
+        model, jac = kernel.evaluate_with_jacobian(vector(x))
+        model = model[good]
+        jac = jac[good][:,columns]
+        if weights_good is not None:
+            model = model * weights_good
+            jac = jac * weights_good[:,None]
+        return model, jac
+
+    weighted_data = data_good if weights_good is None else data_good * weights_good
+
+    if method == 'fast_least_squares':
+
+        from scipy.optimize import least_squares
+
+        def residual(x):
+            model = kernel.evaluate(vector(x))[good]
+            if weights_good is not None:
+                model = model * weights_good
+            return weighted_data - model
+
+        def jacobian(x):
+            return -model_and_jacobian(x)[1]
+
+        if len(var_names) > 0:
+            result = least_squares(residual,x0,
+                                   jac = jacobian,
+                                   bounds = (lower,upper),
+                                   method = 'trf',
+                                   max_nfev = max_nfev)
+            best = result.x
+            chisqr = 2 * result.cost
+            success = result.success
+            nfev = result.nfev
+            jac_best = result.jac
+        else:
+            best = x0
+            chisqr = np.sum(residual(x0)**2)
+            success = True
+            nfev = 1
+            jac_best = None
+
+    else:
+
+        from autophot.packages.centroid import stack_lm
+
+        def model(p):
+            model, jac = model_and_jacobian(p[0])
+            return model[None,:], jac[None,:,:]
+
+        if len(var_names) > 0:
+            best, converged, cost, JTJ = stack_lm(weighted_data[None,:],x0[None,:],
+                                                  lower,upper,model,
+                                                  max_iter = 100 if max_nfev is None else max_nfev)
+            best = best[0]
+            chisqr = cost[0]
+            success = bool(converged[0])
+            jac_best = model_and_jacobian(best)[1]
+        else:
+            best = x0
+            chisqr = np.sum((weighted_data - model_and_jacobian(x0)[0])**2)
+            success = True
+            jac_best = None
+        nfev = None
+
+    best_params = params.copy()
+
+    for name,value in zip(var_names,best):
+        best_params[name].value = value
+
+    fitted = fit_result(best_params,chisqr,len(data_good),len(var_names),success,nfev,method)
+
+    # Parameter errors from the covariance matrix, scaled by the reduced chi-squared
+    if jac_best is not None:
+        try:
+            covar = np.linalg.inv(np.dot(jac_best.T,jac_best)) * fitted.redchi
+            for name,var in zip(var_names,np.diag(covar)):
+                best_params[name].stderr = np.sqrt(var) if var >= 0 else np.nan
+        except np.linalg.LinAlgError:
+            pass
+
+    return fitted
+
+
+def _fit_lmfit(kernel,data,params,method,weights,names,fixed,max_nfev):
+    '''
+    Fit a kernel using *lmfit* with the analytic Jacobian where possible.
+    '''
+
+    import lmfit
+    import numpy as np
+
+    pars = params.to_lmfit()
+
+    residual = kernel.lmfit_residual(data,weights = weights,names = names,fixed = fixed)
+
+    jacobian_kws = kernel.lmfit_jacobian_kws(pars,data,method,
+                                             weights = weights,
+                                             names = names,
+                                             fixed = fixed)
+
+    mini = lmfit.Minimizer(residual,pars,nan_policy = 'omit',max_nfev = max_nfev)
+
+    result = mini.minimize(method = method,**jacobian_kws)
+
+    best_params = params.copy()
+
+    for name in best_params:
+        best_params[name].value = result.params[name].value
+        best_params[name].stderr = result.params[name].stderr
+
+    ndata = getattr(result,'ndata',np.sum(np.isfinite(data)))
+
+    return fit_result(best_params,result.chisqr,ndata,result.nvarys,
+                      result.success,result.nfev,method)
+
+
+def benchmark(n_sources = 200,size = 21,use_moffat = True,noise = 10,
+              methods = ('least_squares','fast_least_squares','fast_lm'),
+              reference = 'least_squares',seed = 0,position_tol = 1e-3,
+              amplitude_tol = 1e-3,print_results = True):
+    '''
+    Fit the same simulated sources with each fitting backend and compare them
+    to the *reference* backend. Each source has a random amplitude, position
+    and sky level, and Gaussian noise is added. The amplitude, position and sky
+    are fitted with the width (and beta) fixed, as done for the target in
+    *main*.
+
+    :param n_sources: Number of simulated sources, defaults to 200
+    :type n_sources: int, optional
+    :param size: Width of each cutout in pixels, defaults to 21
+    :type size: int, optional
+    :param use_moffat: If True, use a Moffat model, else use a Gaussian model, defaults to True
+    :type use_moffat: bool, optional
+    :param noise: Standard deviation of the noise added to each pixel, defaults to 10
+    :type noise: float, optional
+    :param methods: Fitting methods to compare, defaults to ('least_squares','fast_least_squares','fast_lm')
+    :type methods: list, optional
+    :param reference: Fitting method which the others are compared to, defaults to 'least_squares'
+    :type reference: str, optional
+    :param seed: Seed for the random number generator, defaults to 0
+    :type seed: int, optional
+    :param position_tol: Largest difference in position from the reference, in pixels, for a backend to agree, defaults to 1e-3
+    :type position_tol: float, optional
+    :param amplitude_tol: Largest fractional difference in amplitude from the reference for a backend to agree, defaults to 1e-3
+    :type amplitude_tol: float, optional
+    :param print_results: If True, print a summary of the benchmark, defaults to True
+    :type print_results: bool, optional
+    :return: Dataframe with the time taken per fit, the largest differences from the reference and whether each backend agrees with the reference
+    :rtype: DataFrame
+
+    '''
+
+    import time
+    import numpy as np
+    import pandas as pd
+
+    from autophot.packages.kernels import model_kernel
+
+    rng = np.random.default_rng(seed)
+
+    yy,xx = np.mgrid[0:size,0:size]
+
+    kernel = model_kernel(xx,yy,use_moffat = use_moffat)
+
+    if use_moffat:
+        width = {'alpha':3.0,'beta':4.765}
+    else:
+        width = {'sigma':2.0}
+
+    truth = np.column_stack([rng.uniform(100,10000,n_sources),
+                             size/2 + rng.uniform(-1,1,n_sources),
+                             size/2 + rng.uniform(-1,1,n_sources),
+                             rng.uniform(0,100,n_sources)]
+                            + [np.full(n_sources,value) for value in width.values()])
+
+    images = kernel.evaluate(truth).copy() + rng.normal(0,noise,(n_sources,kernel.size))
+    images = images.reshape((n_sources,) + kernel.shape)
+
+    if reference not in methods:
+        methods = [reference] + list(methods)
+
+    fitted = {}
+    timing = {}
+
+    for method in methods:
+
+        best = np.empty((n_sources,4))
+
+        start = time.perf_counter()
+
+        for i in range(n_sources):
+
+            pars = fit_parameters()
+            pars.add('A',value = np.nanmax(images[i]) * 0.5,min = 1e-6)
+            pars.add('x0',value = size/2,min = size/2 - 3,max = size/2 + 3)
+            pars.add('y0',value = size/2,min = size/2 - 3,max = size/2 + 3)
+            pars.add('sky',value = np.nanmedian(images[i]))
+
+            for name,value in width.items():
+                pars.add(name,value = value,min = 0,vary = False)
+
+            result = fit_kernel(kernel,images[i],pars,method = method)
+
+            best[i] = [result.params[name].value for name in ['A','x0','y0','sky']]
+
+        timing[method] = (time.perf_counter() - start) / n_sources
+
+        fitted[method] = best
+
+    ref = fitted[reference]
+
+    rows = []
+
+    for method in methods:
+
+        best = fitted[method]
+
+        position_diff = np.nanmax(np.hypot(best[:,1] - ref[:,1],best[:,2] - ref[:,2]))
+        amplitude_diff = np.nanmax(abs(best[:,0] - ref[:,0]) / ref[:,0])
+
+        rows.append([method,
+                     timing[method] * 1e3,
+                     timing[reference] / timing[method],
+                     position_diff,
+                     amplitude_diff,
+                     np.nanmax(np.hypot(best[:,1] - truth[:,1],best[:,2] - truth[:,2])),
+                     (position_diff <= position_tol) and (amplitude_diff <= amplitude_tol)])
+
+    results = pd.DataFrame(rows,columns = ['method','time_per_fit_ms','speedup',
+                                           'max_position_diff','max_amplitude_diff',
+                                           'max_position_error','agrees'])
+
+    if print_results:
+        print(results.to_string(index = False))
+
+    return results
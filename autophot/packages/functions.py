@@ -258,7 +258,7 @@ def getheader(fpath):
 
     """
     
-    Robust function to get header from :math:`FITS` image for use in AutoPHOT. Due to a :math:`FITS` image typically having multiple headers, which may have useful important information spread across multiples heres, this function returns (if appropriate) a single header file containing all needed header files. This function aims to find correct telescope header info based on "Telescop" header key.
+    Robust function to get header from :math:`FITS` image for use in AutoPHOT. Due to a :math:`FITS` image typically having multiple headers, which may have useful important information spread across multiples heres, this function returns (if appropriate) a single header file containing all needed header files. The file is opened once and the header is cached until the file changes, see *fits_io.read_header*.
 
     :param fpath: Location of fits image which contains a header file
     :type fpath: str
@@ -267,45 +267,9 @@ def getheader(fpath):
     
     """
 
-    # Need to rename this function
-    from astropy.io.fits import getheader
-    from astropy.io import fits
+    from autophot.packages.fits_io import read_header
 
-    try:
-        try:
-            with fits.open(fpath,ignore_missing_end=True) as hdul:
-                # Need to verify/fix or can get errors down the line
-                hdul.verify('silentfix+ignore')
-                headinfo = hdul
-            try:
-                # try for Telescop keyword
-                headinfo['Telescop']
-            except:
-                raise Exception
-        except:
-            # try to find 'sci' extension
-            headinfo = getheader(fpath,'sci')
-            raise Exception
-    except:
-        with fits.open(fpath) as hdul:
-            hdul.verify('silentfix+ignore')
-            headinfo = hdul
-
-    try:
-        # If header is a list
-        if isinstance(headinfo,list):
-            # If list length contains multiple headers, concat them
-            if len(headinfo)>1:
-                headinfo_list = headinfo[0].header
-                for i in range(1,len(headinfo)):
-                    headinfo_list.update(headinfo[i].header)
-                    
-                headinfo = headinfo_list
-            else:
-                # is length of list choose this a header
-                headinfo = headinfo[0].header
-    except Exception as e:
-        print(e)
+    headinfo = read_header(fpath)
 
     return headinfo
 
@@ -386,7 +350,7 @@ def arcmins2pixel(value,pixel_scale):
 def getimage(fpath):
     
     '''
-    For a given :math:`\mathit{FITS}` file, search through header a look for 2D image using the ":math:`\mathit{sci}`" attribute. A error is raise if the image found is not a 2D array e.g. if a :math:`\mathit{FITS\ cube}` is given,
+    For a given :math:`\mathit{FITS}` file, search through header a look for 2D image using the ":math:`\mathit{sci}`" attribute. If not found, the first extension containing data is used (including tile compressed images). The pixel data is memory mapped where possible, see *fits_io.read_image*. A error is raise if the image found is not a 2D array e.g. if a :math:`\mathit{FITS\ cube}` is given,
     
     :param fpath: File path towards :math:`\mathit{FITS}` file.
     :type fpath: str
@@ -395,26 +359,9 @@ def getimage(fpath):
 
     '''
 
-    import os
-    from astropy.io import fits
-    try:
-
-        try:
-            image = fits.getdata(fpath,'sci')
-        except:
-            image = fits.getdata(fpath)
-
-    except:
-        with fits.open(fpath,ignore_missing_end=True) as hdul:
-            hdul.verify('silentfix+ignore')
-            image = hdul[0].data
-
-
-    if len(image.shape) != 2:
-
-        base=os.path.basename(fpath)
+    from autophot.packages.fits_io import read_image
 
-        raise Exception('Warning:: %s not 2-D array' % base)
+    image = read_image(fpath)
 
     return image
 
@@ -941,6 +888,282 @@ def scale_roll(x,xc,m):
     return shift
 
 
+# External programs (e.g. solve-field, HOTPANTS) started by this process, so
+# they can be stopped if the image they belong to is abandoned
+_child_processes = []
+
+
+def start_process(args,**kwargs):
+
+    '''
+    Start an external program in its own process group and keep track of it so it can be stopped by *kill_processes*.
+
+    :param args: Command to run, passed to *subprocess.Popen*
+    :type args: str or list
+    :param kwargs: Keywords passed to *subprocess.Popen*
+    :return: Running process
+    :rtype: subprocess.Popen
+
+    '''
+
+    import subprocess
+
+    pro = subprocess.Popen(args,start_new_session = True,**kwargs)
+
+    # Forget programs that have already finished
+    _child_processes[:] = [i for i in _child_processes if i.poll() is None]
+    _child_processes.append(pro)
+
+    return pro
+
+
+def kill_processes(sig = None):
+
+    '''
+    Stop every external program started by *start_process* that is still running, along with any programs they have started.
+
+    :param sig: Signal sent to each process group, defaults to None in which case SIGTERM is used
+    :type sig: int, optional
+    :return: Number of process groups signalled
+    :rtype: int
+
+    '''
+
+    import os
+    import signal
+
+    if sig is None:
+        sig = signal.SIGTERM
+
+    n = 0
+
+    for pro in _child_processes:
+
+        if pro.poll() is not None:
+            continue
+
+        try:
+            os.killpg(os.getpgid(pro.pid),sig)
+            n+=1
+        except Exception:
+            pass
+
+    del _child_processes[:]
+
+    return n
+
+
+def peak_memory():
+
+    '''
+    Peak resident set size (RSS) of the current process in megabytes. This is the high-water mark of memory usage since the process started, so it can only increase. Uses the :math:`resource` module, which is only available on unix systems, returns nan otherwise.
+
+    :return: Peak memory usage in MB
+    :rtype: float
+
+    '''
+
+    import sys
+    import numpy as np
+
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is given in bytes on macOS and kilobytes on linux
+    if sys.platform == 'darwin':
+        return peak / 1024**2
+
+    return peak / 1024
+
+
+def current_memory():
+
+    '''
+    Current resident set size (RSS) of the current process in megabytes. Read from */proc/self/statm*, which is only available on linux, returns nan otherwise.
+
+    :return: Memory usage in MB
+    :rtype: float
+
+    '''
+
+    import os
+    import numpy as np
+
+    try:
+        with open('/proc/self/statm','r') as f:
+            rss_pages = int(f.read().split()[1])
+    except Exception:
+        return np.nan
+
+    return rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024**2
+
+
+def reset_peak_memory():
+
+    '''
+    Reset the peak resident set size (*VmHWM*) of the current process to its current RSS by writing 5 to */proc/self/clear_refs*. This is only available on linux (kernel 4.0 or later).
+
+    :return: True if the peak was reset, else False
+    :rtype: bool
+
+    '''
+
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except Exception:
+        return False
+
+    return True
+
+
+def peak_memory_since_reset():
+
+    '''
+    Peak resident set size (*VmHWM*) of the current process in megabytes since it was last reset by *reset_peak_memory*. Read from */proc/self/status*, which is only available on linux, returns nan otherwise.
+
+    :return: Peak memory usage in MB
+    :rtype: float
+
+    '''
+
+    import numpy as np
+
+    try:
+        with open('/proc/self/status','r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except Exception:
+        pass
+
+    return np.nan
+
+
+class stage_timer(object):
+
+    '''
+    Record the wall-clock time and peak memory usage for each stage of the photometric reduction. Stages are recorded lap-style, calling *stage* with a new name ends the current stage and starts the next one. If a stage name is given more than once, the times are summed. For example:
+
+    .. code-block :: python
+
+       timer = stage_timer()
+       timer.stage('fwhm')
+       ...
+       timer.stage('psf_build')
+       ...
+       timer.stop()
+       output.update(timer.output())
+
+    will return the columns *t_fwhm*, *t_psf_build*, *mem_fwhm*, *mem_psf_build* and *mem_peak*, where time is given in seconds, *mem_<stage>* is the peak RSS in MB during that stage and *mem_peak* is the peak RSS in MB of the process so far. The peak is reset at the start of each stage using *reset_peak_memory*, where this is not possible (i.e. not on linux) *mem_<stage>* is nan. When running with multiprocessing, *mem_peak* includes earlier images handled by the same worker.
+
+    '''
+
+    def __init__(self):
+
+        import collections
+
+        self.times = collections.OrderedDict({})
+        self.memory = collections.OrderedDict({})
+        self.current = None
+        self.start = None
+        self.peak_reset = False
+        self.max_memory = current_memory()
+
+    def stage(self,name = None):
+
+        '''
+        End the current stage (if any) and begin timing the stage given by *name*. If *name* is None, timing is stopped.
+
+        :param name: Name of the next stage, defaults to None
+        :type name: str, optional
+        :return: None
+        :rtype: None
+
+        '''
+
+        import time
+        import numpy as np
+
+        now = time.perf_counter()
+
+        if self.current is not None:
+            stage_peak = peak_memory_since_reset() if self.peak_reset else np.nan
+
+            self.times[self.current] = self.times.get(self.current,0) + (now - self.start)
+            self.memory[self.current] = np.nanmax([self.memory.get(self.current,np.nan),stage_peak])
+            self.max_memory = np.nanmax([self.max_memory,stage_peak])
+
+        self.current = name
+        self.start = now
+
+        # Peak memory of the next stage only
+        self.peak_reset = reset_peak_memory() if name is not None else False
+
+        return
+
+    def stop(self):
+
+        '''
+        Stop timing the current stage.
+
+        '''
+
+        self.stage(None)
+
+        return
+
+    def output(self):
+
+        '''
+        Return recorded times and memory usage as a dictionary ready to be added to the output file.
+
+        :return: Dictionary with keys *t_<stage>* [s], *mem_<stage>* [MB] and *mem_peak* [MB]
+        :rtype: dict
+
+        '''
+
+        import collections
+        import numpy as np
+
+        out = collections.OrderedDict({})
+
+        for key,value in self.times.items():
+            out['t_'+key] = round(value,3)
+
+        for key,value in self.memory.items():
+            out['mem_'+key] = round(float(value),1)
+
+        # Resetting the peak for each stage also lowers ru_maxrss, so include the peaks seen by each stage
+        out['mem_peak'] = round(float(np.nanmax([peak_memory(),self.max_memory])),1)
+
+        return out
+
+    def summary(self):
+
+        '''
+        Return a printable table of time spent on each stage
+
+        :return: Multi-line string with one stage per row
+        :rtype: str
+
+        '''
+
+        total = sum(self.times.values())
+
+        lines = ['%-24s %10s %8s %14s' % ('Stage','Time [s]','[ % ]','Peak RSS [MB]')]
+
+        for key,value in self.times.items():
+            percent = 100 * value / total if total > 0 else 0
+            lines.append('%-24s %10.2f %8.1f %14.1f' % (key,value,percent,self.memory[key]))
+
+        return '\n'.join(lines)
+
+
 def round_half(number):
     
     '''
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Moffat and Gaussian models with analytic derivatives. The pixel grid and the
+arrays used while evaluating a model are set up once for a given cutout shape
+and reused for every evaluation, and any number of sources can be evaluated at
+the same time. The derivatives of the model with respect to each parameter can
+be given to *lmfit* (as *Dfun* when using *leastsq* or *jac* when using
+*least_squares*) so the Jacobian is not estimated by finite differences.
+
+Parameters are ordered as [A, x0, y0, sky, alpha, beta] for a Moffat model and
+[A, x0, y0, sky, sigma] for a Gaussian model, following *functions.moffat_2d*
+and *functions.gauss_2d*.
+'''
+
+
+class model_kernel(object):
+    '''
+    Moffat or Gaussian model evaluated on a fixed pixel grid, along with its
+    derivatives with respect to each parameter.
+
+    Arrays returned by *evaluate* and *evaluate_with_jacobian* are reused by
+    the next call with the same number of sources unless *out* and *jac_out*
+    are given.
+    '''
+
+    def __init__(self,xx,yy,use_moffat = True):
+        '''
+        :param xx: X pixel grid
+        :type xx: 2D array
+        :param yy: Y pixel grid
+        :type yy: 2D array
+        :param use_moffat: If True, use a Moffat model, else use a Gaussian model, defaults to True
+        :type use_moffat: bool, optional
+
+        '''
+
+        import numpy as np
+
+        self.x = np.asarray(xx,dtype = float).ravel()
+        self.y = np.asarray(yy,dtype = float).ravel()
+
+        self.shape = np.shape(xx)
+        self.size = len(self.x)
+
+        self.use_moffat = use_moffat
+
+        if use_moffat:
+            self.names = ['A','x0','y0','sky','alpha','beta']
+        else:
+            self.names = ['A','x0','y0','sky','sigma']
+
+        self._buffers = {}
+
+    def _buffer(self,n):
+        '''
+        Work arrays for *n* sources, allocated the first time they are needed.
+        '''
+
+        import numpy as np
+
+        if n not in self._buffers:
+
+            shape = (n,self.size)
+
+            self._buffers[n] = {'dx':np.empty(shape),
+                                'dy':np.empty(shape),
+                                'r2':np.empty(shape),
+                                'u':np.empty(shape),
+                                'f':np.empty(shape),
+                                'g':np.empty(shape),
+                                'model':np.empty(shape),
+                                'jac':np.empty(shape + (len(self.names),))}
+
+        return self._buffers[n]
+
+    def _evaluate(self,params,jacobian,out,jac_out):
+
+        import numpy as np
+
+        params = np.asarray(params,dtype = float)
+
+        single = params.ndim == 1
+        params = np.atleast_2d(params)
+
+        n = len(params)
+
+        buffer = self._buffer(n)
+
+        A = params[:,0:1]
+        x0 = params[:,1:2]
+        y0 = params[:,2:3]
+        sky = params[:,3:4]
+        width = params[:,4:5]
+
+        dx = buffer['dx']
+        dy = buffer['dy']
+        r2 = buffer['r2']
+        u = buffer['u']
+        f = buffer['f']
+        g = buffer['g']
+
+        np.subtract(self.x[None,:],x0,out = dx)
+        np.subtract(self.y[None,:],y0,out = dy)
+
+        np.multiply(dx,dx,out = r2)
+        np.multiply(dy,dy,out = f)
+        np.add(r2,f,out = r2)
+
+        width2 = width**2
+
+        if self.use_moffat:
+
+            beta = params[:,5:6]
+
+            np.divide(r2,width2,out = u)
+            np.add(u,1,out = u)
+
+            np.power(u,-beta,out = f)
+
+        else:
+
+            np.divide(r2,-2*width2,out = f)
+            np.exp(f,out = f)
+
+        model = buffer['model'] if out is None else out.reshape(n,self.size)
+
+        np.multiply(A,f,out = model)
+        np.add(model,sky,out = model)
+
+        if not jacobian:
+            return model[0] if single else model
+
+        jac = buffer['jac'] if jac_out is None else jac_out.reshape(n,self.size,len(self.names))
+
+        if self.use_moffat:
+            np.divide(f,u,out = g)
+            np.multiply(g,2*A*beta/width2,out = g)
+        else:
+            np.multiply(f,A/width2,out = g)
+
+        jac[:,:,0] = f
+
+        np.multiply(g,dx,out = jac[:,:,1])
+        np.multiply(g,dy,out = jac[:,:,2])
+
+        jac[:,:,3] = 1
+
+        np.multiply(g,r2,out = jac[:,:,4])
+        np.divide(jac[:,:,4],width,out = jac[:,:,4])
+
+        if self.use_moffat:
+            np.log(u,out = jac[:,:,5])
+            np.multiply(jac[:,:,5],f,out = jac[:,:,5])
+            np.multiply(jac[:,:,5],-A,out = jac[:,:,5])
+
+        if single:
+            return model[0], jac[0]
+
+        return model, jac
+
+    def evaluate(self,params,out = None):
+        '''
+        Model for one or more sets of parameters.
+
+        :param params: Parameters with shape (P,) for a single source or (N, P) for many sources
+        :type params: array
+        :param out: Array with shape (N, M) to write the model to, defaults to None
+        :type out: array, optional
+        :return: Model with shape (M,) or (N, M), where M is the number of pixels in the grid
+        :rtype: array
+
+        '''
+
+        return self._evaluate(params,False,out,None)
+
+    def evaluate_with_jacobian(self,params,out = None,jac_out = None):
+        '''
+        Model and its derivatives with respect to each parameter for one or more sets of parameters.
+
+        :param params: Parameters with shape (P,) for a single source or (N, P) for many sources
+        :type params: array
+        :param out: Array with shape (N, M) to write the model to, defaults to None
+        :type out: array, optional
+        :param jac_out: Array with shape (N, M, P) to write the derivatives to, defaults to None
+        :type jac_out: array, optional
+        :return: Model with shape (M,) or (N, M) and derivatives with shape (M, P) or (N, M, P)
+        :rtype: tuple
+
+        '''
+
+        return self._evaluate(params,True,out,jac_out)
+
+    def parameter_vector(self,values,names = None,fixed = None):
+        '''
+        Parameters in the order used by the kernel from a dictionary of parameter values.
+
+        :param values: Dictionary of parameter names and values
+        :type values: dict
+        :param names: Names of the parameters in the order used by the kernel, defaults to None in which case *names* of the kernel is used
+        :type names: list, optional
+        :param fixed: Values of parameters which are not included in *values*, defaults to None in which case they are set to zero
+        :type fixed: dict, optional
+        :return: Parameters in the order used by the kernel
+        :rtype: array
+
+        '''
+
+        import numpy as np
+
+        names = self.names if names is None else names
+        fixed = {} if fixed is None else fixed
+
+        vector = np.empty(len(self.names))
+
+        for i,(kernel_name,name) in enumerate(zip(self.names,names)):
+
+            if name in values:
+                vector[i] = values[name]
+            elif kernel_name in fixed:
+                vector[i] = fixed[kernel_name]
+            else:
+                vector[i] = 0
+
+        return vector
+
+    def lmfit_residual(self,data,weights = None,names = None,fixed = None):
+        '''
+        Residual function which can be given to *lmfit.Minimizer*, returning
+        the (weighted) difference between *data* and the model.
+
+        :param data: Image to fit, with the same shape as the grid
+        :type data: 2D array
+        :param weights: Weight of each pixel, defaults to None
+        :type weights: 2D array, optional
+        :param names: Names of the *lmfit* parameters in the order used by the kernel, defaults to None in which case *names* of the kernel is used
+        :type names: list, optional
+        :param fixed: Values of parameters which are not included in the *lmfit* parameters, defaults to None in which case they are set to zero
+        :type fixed: dict, optional
+        :return: Residual function
+        :rtype: callable
+
+        '''
+
+        import numpy as np
+
+        names = self.names if names is None else names
+        fixed = {} if fixed is None else fixed
+
+        data = np.asarray(data,dtype = float).ravel()
+
+        if weights is not None:
+            weights = np.asarray(weights,dtype = float).ravel()
+
+        def residual(p):
+
+            model = self.evaluate(self.parameter_vector(p.valuesdict(),names,fixed))
+
+            resid = data - model
+
+            if weights is not None:
+                resid *= weights
+
+            return resid
+
+        return residual
+
+    def lmfit_jacobian_kws(self,params,data,method,weights = None,names = None,
+                           fixed = None):
+        '''
+        Keywords to pass to *lmfit.Minimizer.minimize* so the derivatives of
+        the residual returned by *lmfit_residual* are calculated analytically.
+        Pixels where the residual is not finite are removed, following
+        *nan_policy = 'omit'*. If *method* does not accept a Jacobian, or a
+        parameter which is varied is not part of the model, an empty dictionary
+        is returned and *lmfit* estimates the derivatives itself.
+
+        :param params: Parameters which will be fitted
+        :type params: lmfit.Parameters
+        :param data: Image to fit, with the same shape as the grid
+        :type data: 2D array
+        :param method: Fitting method used by *lmfit*
+        :type method: str
+        :param weights: Weight of each pixel, defaults to None
+        :type weights: 2D array, optional
+        :param names: Names of the *lmfit* parameters in the order used by the kernel, defaults to None in which case *names* of the kernel is used
+        :type names: list, optional
+        :param fixed: Values of parameters which are not included in the *lmfit* parameters, defaults to None in which case they are set to zero
+        :type fixed: dict, optional
+        :return: Keywords for *lmfit.Minimizer.minimize*
+        :rtype: dict
+
+        '''
+
+        import numpy as np
+
+        names = self.names if names is None else names
+        fixed = {} if fixed is None else fixed
+
+        if method not in ['leastsq','least_squares']:
+            return {}
+
+        var_names = [name for name,par in params.items() if par.vary and not par.expr]
+
+        if any(name not in names for name in var_names) or any(par.expr for par in params.values()):
+            return {}
+
+        columns = [names.index(name) for name in var_names]
+
+        data = np.asarray(data,dtype = float).ravel()
+
+        if weights is not None:
+            weights = np.asarray(weights,dtype = float).ravel()
+
+        def jacobian(vector):
+
+            model, jac = self.evaluate_with_jacobian(vector)
+
+            resid = data - model
+
+            # Derivative of the residual rather than the model
+            jac = -jac[:,columns]
+
+            if weights is not None:
+                resid = resid * weights
+                jac = jac * weights[:,None]
+
+            return jac[np.isfinite(resid)]
+
+        if method == 'leastsq':
+
+            def Dfun(p,*args,**kws):
+                return jacobian(self.parameter_vector(p.valuesdict(),names,fixed))
+
+            return {'Dfun':Dfun,'col_deriv':False}
+
+        fixed_values = params.valuesdict()
+
+        def jac(x,*args,**kws):
+
+            # lmfit >= 1.2 passes Parameters, older versions pass the array of varied values
+            if hasattr(x,'valuesdict'):
+                return jacobian(self.parameter_vector(x.valuesdict(),names,fixed))
+
+            values = dict(fixed_values)
+            values.update(zip(var_names,x))
+            return jacobian(self.parameter_vector(values,names,fixed))
+
+        return {'jac':jac}
@@ -17,12 +17,12 @@ def plot_lightcurve(fits_dir,
   
 
     import numpy as np
-    import pandas as pd
     import os
     import matplotlib.pyplot as plt
     from autophot.packages.functions import set_size
     
     from autophot.packages.functions import border_msg
+    from autophot.packages.output_table import load_output
     
     border_msg('Plotting multiband light curve')
     
@@ -59,7 +59,7 @@ def plot_lightcurve(fits_dir,
         # print('Found it')
         pass
 
-    data  = pd.read_csv(output_file_loc)
+    data  = load_output(output_file_loc)
 
 
     markers = ['o','s','v','^','<','>','p',
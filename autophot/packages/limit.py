@@ -59,6 +59,453 @@ def PointsInCircum(r,shape,n=8):
     return [(np.cos(2*np.pi/n*x)*r + shape[1]/2 ,np.sin(2*np.pi/n*x)*r + shape[0]/2) for x in range(0,n)]
     
 
+def magnitude_search(evaluate,start_mag,dmag,fine_dmag,batch_size = 8,
+                     max_trials = 100,print_progress = True):
+    '''
+    Find the faintest magnitude at which artificial sources are recovered.
+    Rather than stepping the magnitude one step at a time, a batch of trial
+    magnitudes is evaluated together. The search first steps through batches
+    spaced by *dmag* until it finds a recovered magnitude next to a magnitude
+    where the sources are lost. The gap between the two is then split into a
+    batch of evenly spaced trial magnitudes, and the search repeats until the
+    gap is smaller than *fine_dmag*.
+
+    The limit is taken as the faintest recovered magnitude before the first
+    magnitude (going from bright to faint) where the sources are lost.
+
+    :param evaluate: Function which accepts an array of magnitudes and returns a boolean array which is True if sources injected at that magnitude are recovered
+    :type evaluate: callable function
+    :param start_mag: Initial guess of the limiting magnitude
+    :type start_mag: float
+    :param dmag: Large magnitude step size used when searching for the limit
+    :type dmag: float
+    :param fine_dmag: Precision of the limiting magnitude
+    :type fine_dmag: float
+    :param batch_size: Number of trial magnitudes evaluated at once, defaults to 8
+    :type batch_size: int, optional
+    :param max_trials: Maximum number of trial magnitudes to evaluate before the limit is found to within *dmag*, defaults to 100
+    :type max_trials: int, optional
+    :param print_progress: If True, print the status of the search, defaults to True
+    :type print_progress: bool, optional
+    :return: Limiting magnitude, or nan if it can't be found
+    :rtype: float
+
+    '''
+
+    import numpy as np
+
+    batch_size = max(int(batch_size),2)
+
+    tested_mags = np.array([])
+    tested_recovered = np.array([],dtype = bool)
+
+    def bracket():
+        # Faintest recovered magnitude and the first lost magnitude after it
+        order = np.argsort(tested_mags)
+        mags = tested_mags[order]
+        lost = np.where(~tested_recovered[order])[0]
+
+        if len(lost) == 0:
+            return mags[-1], None
+        if lost[0] == 0:
+            return None, mags[0]
+
+        return mags[lost[0]-1], mags[lost[0]]
+
+    # Centre the first batch on the initial guess
+    trial_mags = start_mag + dmag * (np.arange(batch_size) - batch_size//2)
+
+    n_trials = 0
+
+    while True:
+
+        recovered = np.asarray(evaluate(trial_mags),dtype = bool)
+
+        tested_mags = np.concatenate([tested_mags,trial_mags])
+        tested_recovered = np.concatenate([tested_recovered,recovered])
+
+        n_trials += len(trial_mags)
+
+        bright, faint = bracket()
+
+        if bright is not None and faint is not None:
+
+            if faint - bright <= fine_dmag:
+                break
+
+            trial_mags = np.linspace(bright,faint,batch_size+2)[1:-1]
+
+            if print_progress:
+                print('Limiting magnitude between %.3f and %.3f' % (bright,faint))
+
+            continue
+
+        if n_trials >= max_trials:
+
+            if print_progress:
+                print('Limiting magnitude not found after %d trial magnitudes' % n_trials)
+
+            return np.nan
+
+        if faint is None:
+            # All sources recovered - try fainter sources
+            trial_mags = bright + dmag * np.arange(1,batch_size+1)
+        else:
+            # No sources recovered - try brighter sources
+            trial_mags = faint - dmag * np.arange(1,batch_size+1)
+
+    return bright
+
+
+class injection_sites(object):
+    '''
+    Cache of the locations used for artificial source injection. The image
+    around each location, its background and the model of a source with unit
+    amplitude placed at the location are found once. Injecting a source of any
+    amplitude is then a matter of scaling the cached model and adding it to the
+    cached cutout, rather than adding the source to the full image and
+    measuring it from scratch.
+
+    The random numbers used to add Poisson noise to the injected sources are
+    also drawn once for each location and repeat. The same random numbers are
+    then used for every magnitude, so brighter sources are always measured as
+    brighter and the fraction of sources recovered changes smoothly with
+    magnitude.
+    '''
+
+    def __init__(self,image,x,y,fwhm,input_model,ap_size = 1.7,
+                 r_in_size = 2,r_out_size = 3,redo = 1,add_noise = False,
+                 seed = None,use_psf = False,residual_table = None,
+                 image_params = None,use_moffat = True,fitting_radius = 1.3,
+                 regrid_size = 10,unity_PSF_counts = None,
+                 remove_bkg_local = True,remove_bkg_surface = False,
+                 remove_bkg_poly = False,remove_bkg_poly_degree = 1,
+                 bkg_level = 3,frame_bkg = None,fitting_method = 'least_sqaure',
+                 fpath = None):
+        '''
+        :param image: 2D image with the injection locations
+        :type image: 2D array
+        :param x: X pixel locations of injection sites
+        :type x: array
+        :param y: Y pixel locations of injection sites
+        :type y: array
+        :param fwhm: Full Width Half Maximum of image
+        :type fwhm: float
+        :param input_model: Function which returns an image of a source with a given amplitude at a given location, i.e. *input_model(x,y,amplitude)*
+        :type input_model: callable function
+        :param ap_size: Multiple of FWHM to be used as standard aperture size, defaults to 1.7
+        :type ap_size: float, optional
+        :param r_in_size: Multiple of FWHM to be used as inner radius of background annulus, defaults to 2
+        :type r_in_size: float, optional
+        :param r_out_size: Multiple of FWHM to be used as outer radius of background annulus, defaults to 3
+        :type r_out_size: float, optional
+        :param redo: Number of times a source is injected at each location, defaults to 1
+        :type redo: int, optional
+        :param add_noise: If True, add Poisson noise to the injected sources, defaults to False
+        :type add_noise: bool, optional
+        :param seed: Seed for the random numbers used for the Poisson noise, defaults to None
+        :type seed: int, optional
+        :param use_psf: If True, recover sources by fitting the PSF model, else use aperture photometry, defaults to False
+        :type use_psf: bool, optional
+        :param residual_table: Residual table of the PSF model, needed if *use_psf* is True, defaults to None
+        :type residual_table: 2D array, optional
+        :param image_params: Dictionary containing analytical model params, needed if *use_psf* is True, defaults to None
+        :type image_params: dict, optional
+        :param use_moffat: If True, the PSF model uses a moffat function, else a gaussian, defaults to True
+        :type use_moffat: bool, optional
+        :param fitting_radius: Multiple of FWHM used as the half width of the area fitted by the PSF model, defaults to 1.3
+        :type fitting_radius: float, optional
+        :param regrid_size: Zoom scale of the residual table, defaults to 10
+        :type regrid_size: int, optional
+        :param unity_PSF_counts: Number of counts under a PSF with amlpitude equal to 1, defaults to None
+        :type unity_PSF_counts: float, optional
+        :param remove_bkg_local: If True, use the local median of the image as the background, defaults to True
+        :type remove_bkg_local: bool, optional
+        :param remove_bkg_surface: If True, use a fitted background surface, defaults to False
+        :type remove_bkg_surface: bool, optional
+        :param remove_bkg_poly: If True, use a fitted polynomial surface, defaults to False
+        :type remove_bkg_poly: bool, optional
+        :param remove_bkg_poly_degree: Degree of the polynomial surface, defaults to 1
+        :type remove_bkg_poly_degree: int, optional
+        :param bkg_level: The number of standard deviations, below which is assumed to be due to the background noise distribution, defaults to 3
+        :type bkg_level: float, optional
+        :param frame_bkg: Background mesh of *image*, see *remove_background*, defaults to None
+        :type frame_bkg: background_mesh, optional
+        :param fitting_method: Fitting method used when a source is fitted individually with *psf.fit*, defaults to 'least_square'
+        :type fitting_method: str, optional
+        :param fpath: File path of image, passed to *psf.fit*, defaults to None
+        :type fpath: str, optional
+
+        '''
+
+        import numpy as np
+
+        from autophot.packages.centroid import extract_cutouts
+        from autophot.packages.aperture import cutout_aperture_photometry
+        from autophot.packages.background import remove_background
+
+        self.x = np.asarray(x,dtype = float)
+        self.y = np.asarray(y,dtype = float)
+
+        self.fwhm = fwhm
+        self.ap_size = ap_size
+        self.r_in_size = r_in_size
+        self.r_out_size = r_out_size
+        self.redo = int(redo)
+        self.add_noise = add_noise
+
+        self.use_psf = use_psf
+        self.residual_table = residual_table
+        self.image_params = image_params
+        self.use_moffat = use_moffat
+        self.regrid_size = regrid_size
+        self.unity_PSF_counts = unity_PSF_counts
+        self.fitting_method = fitting_method
+        self.fitting_radius_fwhm = fitting_radius
+        self.fpath = fpath
+
+        n = len(self.x)
+
+        if not use_psf:
+
+            scale = int(np.ceil(max(ap_size,r_out_size)*fwhm)) + 1
+
+            self.cutouts, _ = extract_cutouts(image,self.x,self.y,scale,partial = True)
+
+            # Position of each location within its cutout
+            self.x_cutout = self.x - (self.x - scale).astype(int)
+            self.y_cutout = self.y - (self.y - scale).astype(int)
+
+            self.unit_cutouts = np.array([extract_cutouts(input_model(self.x[k],self.y[k],1),self.x[[k]],self.y[[k]],scale,partial = True)[0][0] for k in range(n)])
+
+            # Background of each location before any source is injected
+            _, _, _, self.bkg_median, self.bkg_std = cutout_aperture_photometry(self.cutouts,
+                                                                                self.x_cutout,
+                                                                                self.y_cutout,
+                                                                                ap_sizes = [ap_size * fwhm],
+                                                                                r_in = r_in_size * fwhm,
+                                                                                r_out = r_out_size * fwhm)
+            self.bkg_median = self.bkg_median[:,0]
+            self.bkg_std = self.bkg_std[:,0]
+
+        else:
+
+            # Same cutouts and fitting area as used in psf.fit
+            self.fitting_radius = int(fitting_radius * fwhm)
+
+            scale = int(residual_table.shape[0]/2)
+
+            if residual_table.shape[0]%2 != 0:
+                scale+=0.5
+
+            cutouts = []
+            unit_cutouts = []
+            bkg_median = []
+            bkg_std = []
+
+            for k in range(n):
+
+                region = (slice(int(self.y[k]-scale),int(self.y[k]+scale)),
+                          slice(int(self.x[k]-scale),int(self.x[k]+scale)))
+
+                source_base = np.array(image[region],dtype = float)
+                unit_base = np.array(input_model(self.x[k],self.y[k],1)[region],dtype = float)
+
+                if source_base.shape != residual_table.shape:
+                    source_base = np.full(residual_table.shape,np.nan)
+                    unit_base = np.zeros(residual_table.shape)
+
+                source_bkg_free, _, median, noise = remove_background(source_base,
+                                                                      remove_bkg_local = remove_bkg_local,
+                                                                      remove_bkg_surface = remove_bkg_surface,
+                                                                      remove_bkg_poly   = remove_bkg_poly,
+                                                                      remove_bkg_poly_degree = remove_bkg_poly_degree,
+                                                                      bkg_level = bkg_level,
+                                                                      frame_bkg = frame_bkg,
+                                                                      origin = (int(self.x[k]-scale),int(self.y[k]-scale)))
+
+                if np.ndim(source_bkg_free) != 2:
+                    source_bkg_free = np.full(residual_table.shape,np.nan)
+
+                cutouts.append(source_bkg_free)
+                unit_cutouts.append(unit_base)
+                bkg_median.append(median)
+                bkg_std.append(noise)
+
+            self.cutouts = np.array(cutouts)
+            self.unit_cutouts = np.array(unit_cutouts)
+            self.bkg_median = np.array(bkg_median,dtype = float)
+            self.bkg_std = np.array(bkg_std,dtype = float)
+
+            shape = residual_table.shape
+
+            self.fitting_area = (slice(int(0.5*shape[1] - self.fitting_radius),int(0.5*shape[1] + self.fitting_radius)),
+                                 slice(int(0.5*shape[0] - self.fitting_radius),int(0.5*shape[0] + self.fitting_radius)))
+
+        self.unit_cutouts = np.nan_to_num(self.unit_cutouts)
+
+        # Uniform random numbers for the Poisson noise of each injected source
+        if add_noise:
+            rng = np.random.default_rng(seed)
+            self.noise_draws = rng.random((n,self.redo) + self.unit_cutouts.shape[1:])
+
+    def __len__(self):
+
+        return len(self.x)
+
+    def inject(self,amplitudes):
+        '''
+        Cutouts of each location with a source of each amplitude injected.
+
+        :param amplitudes: Amplitudes of injected sources
+        :type amplitudes: array
+        :return: Injected sources and cutouts with injected sources, both with shape (N amplitudes, N locations, redo, height, width)
+        :rtype: tuple
+
+        '''
+
+        import numpy as np
+        from scipy.stats import poisson
+
+        amplitudes = np.atleast_1d(np.asarray(amplitudes,dtype = float))
+
+        shape = (len(amplitudes),len(self.x),self.redo) + self.unit_cutouts.shape[1:]
+
+        fake_sources = amplitudes[:,None,None,None,None] * self.unit_cutouts[None,:,None]
+        fake_sources = np.broadcast_to(fake_sources,shape)
+
+        if self.add_noise:
+            # Poisson noise from the cached random numbers
+            fake_sources = np.maximum(poisson.ppf(self.noise_draws[None],np.clip(fake_sources,0,None)),0)
+
+        return fake_sources, self.cutouts[None,:,None] + fake_sources
+
+    def measure(self,amplitudes,workers = 1):
+        '''
+        Inject sources of each amplitude at every location and measure them.
+        Every injected source is measured at once, either by aperture photometry
+        using the cached background of each location, or by fitting the PSF
+        model using *psf.fit_batch*. If *workers* is greater than 1, the PSF
+        fitting is split between several threads. As in *psf.fit*, sources
+        where the fit together does not converge are fitted again individually
+        using *fitting_method*, and are not recovered if this also fails.
+
+        :param amplitudes: Amplitudes of injected sources
+        :type amplitudes: array
+        :param workers: Number of threads used when fitting the PSF model, defaults to 1
+        :type workers: int, optional
+        :return: Arrays with shape (N amplitudes, N locations, redo) of the counts, the error on the counts, the maximum pixel, the background median, the background standard deviation and the peak of the injected source
+        :rtype: tuple
+
+        '''
+
+        import numpy as np
+        import pandas as pd
+        from concurrent.futures import ThreadPoolExecutor
+
+        from autophot.packages.psf import fit_batch
+        from autophot.packages.aperture import cutout_aperture_photometry
+
+        amplitudes = np.atleast_1d(np.asarray(amplitudes,dtype = float))
+
+        shape = (len(amplitudes),len(self.x),self.redo)
+
+        fake_sources, injected = self.inject(amplitudes)
+
+        injected_peak = np.nanmax(fake_sources,axis = (-2,-1))
+
+        bkg_median = np.broadcast_to(self.bkg_median[None,:,None],shape)
+        bkg_std = np.broadcast_to(self.bkg_std[None,:,None],shape)
+
+        if not self.use_psf:
+
+            output = cutout_aperture_photometry(injected.reshape((-1,) + injected.shape[-2:]),
+                                                np.broadcast_to(self.x_cutout[None,:,None],shape).ravel(),
+                                                np.broadcast_to(self.y_cutout[None,:,None],shape).ravel(),
+                                                ap_sizes = [self.ap_size * self.fwhm],
+                                                r_in = self.r_in_size * self.fwhm,
+                                                r_out = self.r_out_size * self.fwhm,
+                                                bkg_median = bkg_median.ravel(),
+                                                bkg_std = bkg_std.ravel())
+
+            counts, counts_err, max_pixel, _, _ = [i[:,0].reshape(shape) for i in output]
+
+        else:
+
+            source = injected[...,self.fitting_area[0],self.fitting_area[1]]
+
+            max_pixel = np.nanmax(source,axis = (-2,-1))
+            A_max = 1.5 * np.nanmax(injected,axis = (-2,-1))
+
+            stack = source.reshape((-1,) + source.shape[-2:])
+
+            def fit_chunk(idx):
+                return fit_batch(stack[idx],
+                                 residual_table = self.residual_table,
+                                 fwhm = self.fwhm,
+                                 image_params = self.image_params,
+                                 A_init = 0.75 * max_pixel.ravel()[idx],
+                                 A_max = A_max.ravel()[idx],
+                                 use_moffat = self.use_moffat,
+                                 fitting_radius = self.fitting_radius,
+                                 regrid_size = self.regrid_size,
+                                 dx = 3 * self.fwhm)
+
+            chunks = np.array_split(np.arange(len(stack)),max(1,min(int(workers),len(stack))))
+
+            with ThreadPoolExecutor(max_workers = len(chunks)) as pool:
+                fitted = pd.concat(list(pool.map(fit_chunk,chunks)),ignore_index = True)
+
+            # Fits which did not converge are tried again individually
+            cutouts = injected.reshape((-1,) + injected.shape[-2:])
+
+            for i in np.flatnonzero(~fitted['converged'].values.astype(bool)):
+                fitted.loc[i,['A','A_err']] = self.fit_single(cutouts[i])
+
+            counts = fitted['A'].values.reshape(shape) * self.unity_PSF_counts
+            counts_err = np.nan_to_num(fitted['A_err'].values.reshape(shape)) * self.unity_PSF_counts
+
+        return counts, counts_err, max_pixel, bkg_median, bkg_std, injected_peak
+
+    def fit_single(self,cutout):
+        '''
+        Fit the PSF model to a single cutout using *psf.fit* with
+        *fitting_method*.
+
+        :param cutout: Background subtracted cutout centered on the injected source, with the same shape as the residual table
+        :type cutout: 2D array
+        :return: Amplitude of the PSF model and its error, both nan if the fit fails
+        :rtype: tuple
+
+        '''
+
+        import numpy as np
+        import pandas as pd
+        from autophot.packages.psf import fit
+
+        center = self.residual_table.shape[0]/2
+
+        try:
+
+            fitted = fit(image = cutout,
+                         sources = pd.DataFrame({'x_pix':[center],'y_pix':[center]}),
+                         residual_table = self.residual_table,
+                         fwhm = self.fwhm,
+                         fpath = self.fpath,
+                         fitting_radius = self.fitting_radius_fwhm,
+                         regrid_size = self.regrid_size,
+                         use_moffat = self.use_moffat,
+                         image_params = self.image_params,
+                         fitting_method = self.fitting_method,
+                         return_fwhm = True)
+
+            return fitted['H_psf'].values[0], fitted['H_psf_err'].values[0]
+
+        except Exception:
+
+            return np.nan, np.nan
+
+
 def flatten_dict(d):
     '''
     
@@ -92,7 +539,9 @@ def limiting_magnitude_prob(image,fpath, detection_limit=3, bkg_level=3, fwhm =
                             print_progress = True , remove_bkg_local = True,
                             remove_bkg_surface = False, remove_bkg_poly = False,
                             remove_bkg_poly_degree = 1, subtraction_ready = False,
-                            injected_sources_use_beta = True, plot_probable_limit = True):
+                            injected_sources_use_beta = True, plot_probable_limit = True,
+                            probable_limit_draws = 2000, probable_limit_seed = None,
+                            frame_bkg = None):
     '''
         
     Package to employ the same error technique as in the `SNOOPY
@@ -148,6 +597,12 @@ def limiting_magnitude_prob(image,fpath, detection_limit=3, bkg_level=3, fwhm =
     :param remove_bkg_poly_degree: If remove_bkg_poly is True, this is the degree of the polynomial fitted to the image, 1 = flat surface, 2 = 2nd order polynomial etc, defaults to 1
     :param bkg_level: The number of standard deviations, below which is assumed to be due to the background noise distribution, defaults to 3
     :type bkg_level: float, optional
+    :param probable_limit_draws: Number of random apertures to draw from the background when building the distribution of pseudo-counts, defaults to 2000
+    :type probable_limit_draws: int, optional
+    :param probable_limit_seed: Seed for the random number generator used to place the random apertures. If None, a different seed is used each time, defaults to None
+    :type probable_limit_seed: int, optional
+    :param frame_bkg: Background mesh of *image*. If given, the background surface is interpolated from this mesh rather than fitted to the image, see *remove_background*, defaults to None
+    :type frame_bkg: background_mesh, optional
     :return: Returns the standard deviation of the recovered magnitudes of the artifically injection pseudo-transient PSFs
     :rtype: float
 
@@ -155,7 +610,6 @@ def limiting_magnitude_prob(image,fpath, detection_limit=3, bkg_level=3, fwhm =
                        
     
     import os
-    import random
     import logging
     import warnings
     import numpy as np
@@ -198,7 +652,8 @@ def limiting_magnitude_prob(image,fpath, detection_limit=3, bkg_level=3, fwhm =
                                                                          remove_bkg_surface = remove_bkg_surface,
                                                                          remove_bkg_poly   = remove_bkg_poly,
                                                                          remove_bkg_poly_degree = remove_bkg_poly_degree,
-                                                                         bkg_level = bkg_level
+                                                                         bkg_level = bkg_level,
+                                                                         frame_bkg = frame_bkg
                                                                          )
 
 
@@ -266,64 +721,43 @@ def limiting_magnitude_prob(image,fpath, detection_limit=3, bkg_level=3, fwhm =
         exclud_x = excluded_points[1]
         exclud_y = excluded_points[0]
 
-        exclud_zip = list(zip(exclud_x,exclud_y))
-
-        included_points = np.where(mask_image != 0)
-
-        includ_x = list(included_points[1])
-        includ_y = list(included_points[0])
-
-        includ_zip = list(zip(includ_x,includ_y))
-
-        number_of_points = 150
-
-        fake_points = {}
+        included_points = mask_image != 0
 
         # Failsafe - if there isn't enough pixels just use everything
-        if len(includ_zip) < aperture_area:
-
-            includ_zip=includ_zip+exclud_zip
-
-        # get random sample of pixels and sum them up
-        for i in range(number_of_points):
-
-            fake_points[i] = []
-
-            random_pixels = random.sample(includ_zip,aperture_area)
-
-            xp_ran = [i[0] for i in random_pixels]
-            yp_ran = [i[1] for i in random_pixels]
-
-            fake_points[i].append([xp_ran,yp_ran])
+        if included_points.sum() < aperture_area:
+            included_points = np.ones(image_no_surface.shape,dtype = bool)
 
-        fake_sum = {}
+        included_values = np.asarray(image_no_surface)[included_points].astype(float)
 
-        for i in range(number_of_points):
+        rng = np.random.default_rng(probable_limit_seed)
 
-            fake_sum[i] = []
+        number_of_points = int(probable_limit_draws)
 
-            for j in fake_points[i]:
+        fake_mags = np.zeros(number_of_points)
 
-                for k in range(len(j[0])):
+        # Draw pixels for each random aperture - drawn with replacement as the
+        # aperture is much smaller than the image, so the cost only depends on
+        # the aperture area. Done in chunks to limit memory use
+        chunk_size = max(1,int(4e6 // max(aperture_area,1)))
 
-                    fake_sum[i].append(image_no_surface[j[0][k]][j[1][k]])
+        for i in range(0,number_of_points,chunk_size):
 
+            n_draws = min(chunk_size,number_of_points - i)
 
-        fake_mags = {}
+            random_pixels = rng.integers(0,len(included_values),size = (n_draws,aperture_area))
 
-        for f in fake_sum.keys():
-
-            fake_mags[f] = np.sum(fake_sum[f])
+            # get random sample of pixels and sum them up
+            fake_mags[i:i+n_draws] = included_values[random_pixels].sum(axis = 1)
 
         # Fit histogram and get mean and std of distribution
-        hist, bins = np.histogram(list(fake_mags.values()),
-                                  bins = len(list(fake_mags.values())),
+        hist, bins = np.histogram(fake_mags,
+                                  bins = 'auto',
                                   density = True)
 
         center = (bins[:-1] + bins[1:]) / 2
 
-        sigma_guess = np.nanstd(list(fake_mags.values()))
-        mean_guess = np.nanmean(list(fake_mags.values()))
+        sigma_guess = np.nanstd(fake_mags)
+        mean_guess = np.nanmean(fake_mags)
         A_guess = np.nanmax(hist)
 
         popt,pcov = curve_fit(gauss_1d,center,hist,
@@ -389,7 +823,7 @@ def limiting_magnitude_prob(image,fpath, detection_limit=3, bkg_level=3, fwhm =
                         zorder = 2)
     
             # the histogram of the data
-            n, bins, patches = ax0.hist(list(fake_mags.values()),
+            n, bins, patches = ax0.hist(fake_mags,
                                         density=True,
                                         bins = 'auto',
                                         facecolor='blue',
@@ -681,7 +1115,9 @@ def inject_sources(image, fwhm, fpath, exp_time, ap_size = 1.7, scale = 25,
                    lmag_guess= None, print_progress = True, save_plot = True,
                    save_plot_to_folder = False,fitting_method = 'least_sqaure',
                    remove_bkg_local = True, remove_bkg_surface = False, 
-                   remove_bkg_poly = False, remove_bkg_poly_degree = 1):
+                   remove_bkg_poly = False, remove_bkg_poly_degree = 1,
+                   inject_source_batch_search = True, inject_source_batch_size = 8,
+                   inject_source_workers = 1, frame_bkg = None):
     '''
     
     Package to find limiting magnitude using artifical source injection. This is
@@ -716,6 +1152,13 @@ def inject_sources(image, fwhm, fpath, exp_time, ap_size = 1.7, scale = 25,
     
     #. The penultimate injected magnitude is set at the limiting magnitude.
     
+    If *inject_source_batch_search* is True, the magnitude steps above are
+    replaced by *magnitude_search*, which evaluates a batch of trial magnitudes
+    at a time and splits the gap around the limit until it is smaller than
+    *inject_source_recover_fine_dmag*. The cutout, background and source model
+    at each location are cached using *injection_sites*, and every injected
+    source in a batch is measured at once.
+    
     This can be a very robust function that can fully sample the surrounding
     location of a suspected transient. *However* if the transient has significant
     flux, i.e. it is severly present in the image or the location is severly
@@ -808,6 +1251,14 @@ def inject_sources(image, fwhm, fpath, exp_time, ap_size = 1.7, scale = 25,
     :type remove_bkg_surface: Boolean, optional
     :type remove_bkg_poly: If True, use the background polynomial surface of the image and subtract this to produce a background free image, see above, optional
     :param remove_bkg_poly_degree: If remove_bkg_poly is True, this is the degree of the polynomial fitted to the image, 1 = flat surface, 2 = 2nd order polynomial etc, defaults to 1
+    :param inject_source_batch_search: If True, search for the limiting magnitude using batches of trial magnitudes, else step through magnitudes one at a time, defaults to True
+    :type inject_source_batch_search: bool, optional
+    :param inject_source_batch_size: Number of trial magnitudes evaluated at once if *inject_source_batch_search* is True, defaults to 8
+    :type inject_source_batch_size: int, optional
+    :param inject_source_workers: Number of threads used to fit the PSF model to injected sources when using PSF photometry, defaults to 1
+    :type inject_source_workers: int, optional
+    :param frame_bkg: Background mesh of *image*. If given, the background surface around each injected source is interpolated from this mesh rather than fitted to each cutout, see *remove_background*, defaults to None
+    :type frame_bkg: background_mesh, optional
     :return: Returns the limiting magnitude found via artifical sour injection
     :rtype: float
     '''
@@ -1053,7 +1504,8 @@ def inject_sources(image, fwhm, fpath, exp_time, ap_size = 1.7, scale = 25,
                         remove_bkg_surface = remove_bkg_surface,
                         remove_bkg_poly   = remove_bkg_poly,
                         remove_bkg_poly_degree = remove_bkg_poly_degree,
-                        bkg_level = bkg_level)
+                        bkg_level = bkg_level,
+                        frame_bkg = frame_bkg)
        
         
   
@@ -1219,7 +1671,121 @@ def inject_sources(image, fwhm, fpath, exp_time, ap_size = 1.7, scale = 25,
     # Initial detection for display purposes
     detect_percentage = 100
 
-    while True:
+    if inject_source_batch_search:
+
+        use_psf_recovery = not inject_lmag_use_ap_phot and PSF_available
+
+        # Cutouts, backgrounds and source models at each location are found once
+        sites = injection_sites(image,
+                                injection_df['x_pix'].values,
+                                injection_df['y_pix'].values,
+                                fwhm = fwhm,
+                                input_model = input_model,
+                                ap_size = ap_size,
+                                r_in_size = r_in_size,
+                                r_out_size = r_out_size,
+                                redo = redo,
+                                add_noise = inject_source_add_noise,
+                                use_psf = use_psf_recovery,
+                                residual_table = r_table,
+                                image_params = image_params,
+                                use_moffat = use_moffat,
+                                fitting_radius = fitting_radius,
+                                regrid_size = regrid_size,
+                                unity_PSF_counts = unity_PSF_counts,
+                                remove_bkg_local = remove_bkg_local,
+                                remove_bkg_surface = remove_bkg_surface,
+                                remove_bkg_poly = remove_bkg_poly,
+                                remove_bkg_poly_degree = remove_bkg_poly_degree,
+                                bkg_level = bkg_level,
+                                frame_bkg = frame_bkg,
+                                fitting_method = fitting_method,
+                                fpath = fpath)
+
+        n_locations = len(sites)
+
+        def recover_trials(trial_mags):
+            '''
+            Inject and recover sources at every location for a batch of trial
+            magnitudes. Returns True for each magnitude where enough sources are
+            recovered.
+            '''
+
+            trial_mags = np.atleast_1d(np.asarray(trial_mags,dtype = float))
+
+            shape = (len(trial_mags),n_locations,redo)
+
+            psf_counts, psf_counts_err, psf_height, psf_bkg_counts, psf_bkg_std, injected_peak = sites.measure(mag2image(trial_mags),
+                                                                                                               workers = inject_source_workers)
+
+            psf_flux = psf_counts/exp_time
+            psf_flux_err = psf_counts_err/exp_time
+            psf_bkg_flux = psf_bkg_counts/exp_time
+            psf_bkg_std_flux = psf_bkg_std/exp_time
+            psf_height_flux = psf_height/exp_time
+
+            fake_target_beta = beta_value(n=detection_limit,
+                                          sigma = psf_bkg_std_flux,
+                                          f_ul = psf_height_flux)
+
+            with np.errstate(divide = 'ignore',invalid = 'ignore'):
+                SNR_trials = np.where(psf_bkg_flux > 0,
+                                      SNR(flux_star = psf_flux,
+                                          flux_sky = psf_bkg_flux,
+                                          exp_t = exp_time,
+                                          radius = ap_size*fwhm ,
+                                          G  = gain,
+                                          RN =  rdnoise,
+                                          DC = 0 ),
+                                      psf_height_flux/psf_bkg_std_flux)
+
+            mag_recovered = calc_mag(psf_flux.ravel()).reshape(shape)
+            mag_recovered_error = mag_recovered - calc_mag((psf_flux+psf_flux_err).ravel()).reshape(shape)
+
+            if subtraction_ready or injected_sources_use_beta:
+                recovered_sources = psf_height_flux >= injection_df['f_ul'].values[None,:,None]
+            else:
+                recovered_sources = SNR_trials >= injection_df['limit_SNR'].values[None,:,None]
+
+            recovered_fraction = recovered_sources.reshape(len(trial_mags),-1).mean(axis = 1)
+
+            for i in range(len(trial_mags)):
+
+                # step labels to keep track of everything
+                step_name = round(trial_mags[i]+zeropoint,3)
+
+                for k in range(n_locations):
+
+                    inserted_magnitude[k][step_name] = [float(trial_mags[i])] * redo
+                    recovered_magnitude[k][step_name] = list(mag_recovered[i,k])
+                    recovered_magnitude_e[k][step_name] = list(mag_recovered_error[i,k])
+                    recovered_fwhm[k][step_name] = []
+                    recovered_fwhm_e[k][step_name] = []
+                    location_noise[k][step_name] = list(psf_bkg_std_flux[i,k])
+                    injected_f_source[k][step_name] = list(injected_peak[i,k]/exp_time)
+                    recovered_f_source[k][step_name] = list(psf_height_flux[i,k])
+                    recovered_max_flux[k][step_name] = list(psf_height_flux[i,k])
+                    recovered_SNR[k][step_name] = [[j] for j in SNR_trials[i,k]]
+                    beta_probability[k][step_name] = list(1-fake_target_beta[i,k])
+
+                if print_progress:
+                    print('Mag %.3f :: Sources detected: %d%%' % (trial_mags[i]+zeropoint,100*recovered_fraction[i]))
+
+            return recovered_fraction >= 1 - detection_cutout
+
+        inject_lmag = magnitude_search(recover_trials,
+                                       start_mag = start_mag,
+                                       dmag = dmag,
+                                       fine_dmag = fine_dmag,
+                                       batch_size = inject_source_batch_size,
+                                       max_trials = nsteps,
+                                       print_progress = print_progress)
+
+        if print_progress and not np.isnan(inject_lmag):
+            print('\nLimiting magnitude: %.3f \n' % ( inject_lmag+zeropoint ))
+
+    # Step through magnitudes one at a time if not using the batch search
+    while not inject_source_batch_search:
         try:
         
             if use_dmag_fine and not explore:
@@ -1297,7 +1863,8 @@ def inject_sources(image, fwhm, fpath, exp_time, ap_size = 1.7, scale = 25,
                                         remove_bkg_surface = remove_bkg_surface,
                                         remove_bkg_poly   = remove_bkg_poly,
                                         remove_bkg_poly_degree = remove_bkg_poly_degree,
-                                        bkg_level = bkg_level)
+                                        bkg_level = bkg_level,
+                                        frame_bkg = frame_bkg)
                        
                         
                   
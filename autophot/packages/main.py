@@ -27,7 +27,6 @@ def main(object_info,autophot_input,fpath):
     import pandas as pd
     import pathlib
     import collections
-    import lmfit
     import time
     import logging
     import datetime
@@ -45,13 +44,11 @@ def main(object_info,autophot_input,fpath):
     import astropy.wcs as wcs
     from astropy.stats import sigma_clipped_stats
     from astropy.time import Time
-    from functools import reduce
     from astropy.coordinates import Angle
     from matplotlib.ticker import MultipleLocator
     from astropy.table import Table
     from scipy.stats import binned_statistic
     from astroquery.skyview import SkyView
-    from reproject import reproject_interp
     from astropy.wcs import WCS
 
     from astropy.visualization import  ZScaleInterval
@@ -59,6 +56,8 @@ def main(object_info,autophot_input,fpath):
 
     # Proprietary modules developed for AUTOPHOT
     from autophot.packages.functions import  getheader,getimage,calc_mag,set_size,pix_dist
+    from autophot.packages.fits_io import write_fits,image_state
+    from autophot.packages.spatial_index import nearest_distance
     from autophot.packages.functions import gauss_2d,gauss_fwhm2sigma,gauss_sigma2fwhm
     from autophot.packages.functions import moffat_2d,moffat_fwhm,border_msg
     from autophot.packages.check_wcs import updatewcs,removewcs
@@ -72,7 +71,13 @@ def main(object_info,autophot_input,fpath):
     from autophot.packages.functions import arcmins2pixel,pixel2arcsec
     from autophot.packages.find import get_fwhm
     from autophot.packages.aperture import measure_aperture_photometry,find_aperture_correction,do_aperture_photometry,find_optimum_aperture_size
+    from autophot.packages.curve_of_growth import curve_of_growth
+    from autophot.packages.background import background_mesh
+    from autophot.packages.kernels import model_kernel
+    from autophot.packages.spatial_psf import spatial_psf
+    from autophot.packages.fitter import fit_parameters,fit_kernel
     import autophot.packages.psf as psf
+    import autophot.packages.psf_store as psf_store
     import autophot.packages.call_catalog as call_catalog
     from autophot.packages.psf import compute_multilocation_err
 
@@ -82,11 +87,13 @@ def main(object_info,autophot_input,fpath):
     from autophot.packages.zeropoint import get_zeropoint
     from autophot.packages.template_subtraction import prepare_templates
     from autophot.packages.template_subtraction import get_pstars
+    from autophot.packages.template_subtraction import align_template
 
 
     from astropy.nddata.utils import Cutout2D
 
     from autophot.packages.functions import trim_zeros_slices
+    from autophot.packages.functions import stage_timer
     from matplotlib.gridspec import  GridSpec
 
 
@@ -94,6 +101,10 @@ def main(object_info,autophot_input,fpath):
 
     # Start time of this image
     start_time = time.time()
+
+    # Wall-clock time and peak memory for each stage of the reduction
+    timer = stage_timer()
+    timer.stage('setup')
     try:
         # Preparing output dictionary
         output = collections.OrderedDict({})
@@ -189,6 +200,8 @@ def main(object_info,autophot_input,fpath):
         # Get image and header from function library
         image    = getimage(fpath)
         headinfo = getheader(fpath)
+        # Image and header are kept in memory and only written when needed
+        state = image_state(fpath,image,headinfo)
         if object_info == None:
             sys.exit('No Target Info')
         if autophot_input == None:
@@ -348,6 +361,9 @@ def main(object_info,autophot_input,fpath):
         autophot_input['tele'] = telescope
         autophot_input['inst'] = inst
 
+        # Longitude of the telescope site, if given in telescope.yml
+        autophot_input['site_lon'] = (tele_autophot_input[telescope].get('location') or {}).get('lon')
+
         if 'NAXIS1' in headinfo and 'NAXIS' in headinfo:
             autophot_input['NAXIS1'] = headinfo['NAXIS1']
             autophot_input['NAXIS2'] = headinfo['NAXIS2']
@@ -371,10 +387,7 @@ def main(object_info,autophot_input,fpath):
 
             headinfo['TRIMMED'] = True
 
-            fits.writeto(fpath,image_trim,
-                         headinfo,
-                         overwrite = True,
-                         output_verify = 'silentfix+ignore')
+            state.update(image = image_trim,header = headinfo)
 
             image = image_trim
 
@@ -473,33 +486,41 @@ def main(object_info,autophot_input,fpath):
 
                 autophot_input['pixel_scale'] = tele_autophot_input[telescope][inst_key][inst]['pixel_scale']
 
-            prepare_templates(fpath,
-                              tele_autophot_input=tele_autophot_input ,
-                              get_fwhm = True,
-                              build_psf = True,
-                              clean_cosmic = True,
-
-                              solve_field_exe_loc = autophot_input['wcs']['solve_field_exe_loc'],
-                              use_lacosmic = False,
-                              use_filter = use_filter,
-                              redo_wcs = True,
-                              target_ra = autophot_input['target_ra'],
-                              target_dec =  autophot_input['target_dec'],
-                              search_radius = 0.5,
-                              cpu_limit= 180,
-                              downsample = 2,
-                              threshold_value = 25,
-                              ap_size =  autophot_input['photometry']['ap_size'],
-                              inf_ap_size = autophot_input['photometry']['inf_ap_size'],
-                              r_in_size = autophot_input['photometry']['r_in_size'],
-                              r_out_size = autophot_input['photometry']['r_out_size'],
-                              use_moffat = autophot_input['fitting']['use_moffat'],
-                              psf_source_no = autophot_input['psf']['psf_source_no'],
-                              fitting_method = autophot_input['fitting']['fitting_method'],
-                              regrid_size  = autophot_input['psf']['regrid_size'],
-                              fitting_radius =autophot_input['fitting']['fitting_radius'])
-
-            return
+            # Template preparation works from the file on disk
+            state.flush()
+
+            prepared = prepare_templates(fpath,
+                                         tele_autophot_input=tele_autophot_input ,
+                                         get_fwhm = True,
+                                         build_psf = True,
+                                         clean_cosmic = True,
+
+                                         solve_field_exe_loc = autophot_input['wcs']['solve_field_exe_loc'],
+                                         use_lacosmic = False,
+                                         use_filter = use_filter,
+                                         redo_wcs = True,
+                                         target_ra = autophot_input['target_ra'],
+                                         target_dec =  autophot_input['target_dec'],
+                                         search_radius = 0.5,
+                                         cpu_limit= 180,
+                                         downsample = 2,
+                                         threshold_value = 25,
+                                         ap_size =  autophot_input['photometry']['ap_size'],
+                                         inf_ap_size = autophot_input['photometry']['inf_ap_size'],
+                                         r_in_size = autophot_input['photometry']['r_in_size'],
+                                         r_out_size = autophot_input['photometry']['r_out_size'],
+                                         use_moffat = autophot_input['fitting']['use_moffat'],
+                                         psf_source_no = autophot_input['psf']['psf_source_no'],
+                                         fitting_method = autophot_input['fitting']['fitting_method'],
+                                         regrid_size  = autophot_input['psf']['regrid_size'],
+                                         fitting_radius =autophot_input['fitting']['fitting_radius'])
+
+            # Prepared template is recorded in the template manifest by run_autophot
+            if not prepared:
+                logging.warning('Template not prepared: %s' % os.path.basename(fpath))
+                return None,fpath
+
+            return {'fname':fpath},fpath
         # ============================================================================
         # Begin photometric reductions
         # ============================================================================
@@ -516,15 +537,6 @@ def main(object_info,autophot_input,fpath):
         # =============================================================================
 
         try:
-            try:
-
-                fpath = reduce(fpath,use_filter,autophot_input)
-                image    = fits.getdata(fpath)
-                headinfo = getheader(fpath)
-
-            except:
-
-                pass
 
             if fpath == None:
                 raise Exception
@@ -636,11 +648,11 @@ def main(object_info,autophot_input,fpath):
             # Cosmic ray removal usign astroscrappy
             # =============================================================================
 
+            timer.stage('cosmic_rays')
             if autophot_input['cosmic_rays']['remove_cmrays']:
                 try:
                 # if cosmic rays have no already been removed
                         if 'CRAY_RMD'  not in headinfo:
-                            headinfo = getheader(fpath)
                             # image with cosmic rays
                             image_old = fits.PrimaryHDU(image)
                             image = remove_cosmic_rays(image_old,
@@ -648,13 +660,9 @@ def main(object_info,autophot_input,fpath):
 
                                                      use_lacosmic = autophot_input['cosmic_rays']['use_lacosmic'])
 
-                            # Update header and write to new file
+                            # Update header and image
                             headinfo['CRAY_RMD'] = ('T', 'Comsic rays wautophot')
-                            fits.writeto(fpath,
-                                         image,
-                                         headinfo,
-                                         overwrite = True,
-                                         output_verify = 'silentfix+ignore')
+                            state.update(image = image,header = headinfo)
                             logging.info('Cosmic rays removed - image updated')
 
                         else:
@@ -666,6 +674,8 @@ def main(object_info,autophot_input,fpath):
             # =============================================================================
             # WCS Check and target
             # =============================================================================
+            timer.stage('wcs')
+
             # -- Various instances of when/if to query using astrometry.net --
             # if any instance of wcs_keywords are not found in the header infomation it
             # if succesful, it will add the UPWCS = T header/value to the header
@@ -682,14 +692,9 @@ def main(object_info,autophot_input,fpath):
                 existing_WCS = False
             if autophot_input['wcs']['remove_wcs']  or not existing_WCS and 'UPWCS' not in headinfo:
                 logging.info('\nPerforming Astrometry.net')
-                new_header = removewcs(headinfo,delete_keys = True)
-
-                fits.writeto(fpath,image,
-                             new_header,
-                             overwrite = True,
-                             output_verify = 'silentfix+ignore')
+                headinfo = removewcs(headinfo,delete_keys = True)
 
-                headinfo = getheader(fpath)
+                state.update(header = headinfo)
             # search keywords for wcs validation
             wcs_keywords = ['CD1_1','CD1_2','CD2_1','CD2_2',
                             'CRVAL1','CRVAL2','CRPIX1','CRPIX2',
@@ -752,7 +757,8 @@ def main(object_info,autophot_input,fpath):
                                         # vary_moff_beta = autophot_input['fitting']['vary_moff_beta'],
                                         max_fit_fwhm = autophot_input['source_detection']['max_fit_fwhm'],
                                         fitting_method = autophot_input['fitting']['fitting_method'],
-                                        use_catalog = autophot_input['source_detection']['use_catalog'] )
+                                        use_catalog = autophot_input['source_detection']['use_catalog'],
+                                        fast_threshold = autophot_input['source_detection']['fast_threshold'])
 
                     # df = df[(df['include_fwhm']) & (df['include_median'])]
                     n = np.vstack([df['x_pix'],df['y_pix']]).T
@@ -762,7 +768,8 @@ def main(object_info,autophot_input,fpath):
                     bintab.writeto(fpath_BINTABLE,overwrite=True)
                     fpath_astrometry  = fpath_BINTABLE
                 else:
-                    fpath_astrometry  = fpath
+                    # Astrometry.net reads the image from disk
+                    fpath_astrometry  = state.flush()
 
 
                 # Run local instance of Astrometry.net - returns filepath of wcs file
@@ -780,7 +787,7 @@ def main(object_info,autophot_input,fpath):
                                                )
 
 
-                old_headinfo = getheader(fpath)
+                old_headinfo = headinfo.copy()
                 try:
                     # Open wcs fits file with wcs values
                     new_wcs  = fits.open(astro_check,ignore_missing_end = True)
@@ -804,13 +811,10 @@ def main(object_info,autophot_input,fpath):
                     # update header to show wcs has been checked
                     headinfo_updated['UPWCS'] = ('F', 'NOT WCS by APT')
                     updated_wcs = False
-                # Write new header
-                fits.writeto(fpath,image,
-                             headinfo_updated,
-                             overwrite = True,
-                             output_verify = 'silentfix+ignore')
-                headinfo = getheader(fpath)
-                logging.info('WCS saved to new file')
+                # Update header with new WCS
+                headinfo = headinfo_updated
+                state.update(header = headinfo)
+                logging.info('WCS updated')
 
                 if autophot_input['wcs']['update_wcs_scale'] and updated_wcs == True:
                     'Update image scale params from '
@@ -830,7 +834,7 @@ def main(object_info,autophot_input,fpath):
             #==============================================================================
             # Load target information from TNS query if needed
             #==============================================================================
-            w1 = wcs.WCS(headinfo)# WCS values
+            w1 = state.wcs()# WCS values
 
             if autophot_input['target_name'] == None:
 
@@ -942,6 +946,8 @@ def main(object_info,autophot_input,fpath):
             #==============================================================================
             # FWHM - Using total image source detection
             #==============================================================================
+            timer.stage('fwhm')
+
 
             if not (autophot_input['source_detection']['use_catalog'] is None):
                 fwhm_source_catalog = pd.read_csv(autophot_input['source_detection']['use_catalog'])
@@ -992,7 +998,8 @@ def main(object_info,autophot_input,fpath):
                                                    # vary_moff_beta = autophot_input['fitting']['vary_moff_beta'],
                                                    max_fit_fwhm = autophot_input['source_detection']['max_fit_fwhm'],
                                                    fitting_method = autophot_input['fitting']['fitting_method'],
-                                                   use_catalog = autophot_input['source_detection']['use_catalog'])
+                                                   use_catalog = autophot_input['source_detection']['use_catalog'],
+                                                   fast_threshold = autophot_input['source_detection']['fast_threshold'])
             image_fwhm_err = np.nanstd(df['FWHM'])
 
 
@@ -1035,6 +1042,15 @@ def main(object_info,autophot_input,fpath):
             # =============================================================================
             # Find optimum radius for best SNR
             # =============================================================================
+            timer.stage('aperture')
+
+            # Curve of growth of sources, shared by the optimum radius search
+            # and the aperture correction
+            cog = curve_of_growth(image,
+                                  np.array(df['x_pix']),
+                                  np.array(df['y_pix']),
+                                  r_max = max(5,autophot_input['photometry']['inf_ap_size'] + autophot_input['photometry']['r_out_size']) * autophot_input['fwhm'])
+
 
             if autophot_input['photometry']['find_optimum_radius']:
 
@@ -1050,6 +1066,7 @@ def main(object_info,autophot_input,fpath):
                                                                r_out_size = autophot_input['photometry']['r_out_size'],
                                                                GAIN =  autophot_input['gain'],
                                                                # rdnoise =  autophot_input['rdnoise']
+                                                               cog = cog
                                                                )
 
                 autophot_input['photometry']['ap_size'] = optimum_ap_size
@@ -1069,7 +1086,8 @@ def main(object_info,autophot_input,fpath):
                                         ap_size = autophot_input['photometry']['ap_size'],
                                         inf_ap_size = autophot_input['photometry']['inf_ap_size'],
                                         r_in_size = autophot_input['photometry']['r_in_size'],
-                                        r_out_size = autophot_input['photometry']['r_out_size'])
+                                        r_out_size = autophot_input['photometry']['r_out_size'],
+                                        cog = cog)
 
 
             ap_corr_base, ap_corr_base_err = find_aperture_correction(dataframe = df,
@@ -1083,6 +1101,8 @@ def main(object_info,autophot_input,fpath):
             #==============================================================================
             # Catalog source detecion
             #==============================================================================
+            timer.stage('catalog_search')
+
 
             # Search for sources in images that have corrospondong magnityide entry in given catalog
             specified_catalog = call_catalog.search(headinfo,
@@ -1104,6 +1124,7 @@ def main(object_info,autophot_input,fpath):
             # TODO: fix limt -> limit in input parameters
             WCS_checked = False
 
+            timer.stage('catalog_match')
             # While loop to see if WCS needs to be redone
             while True:
                 # Re-aligns catalog sources with source detection and centroid
@@ -1157,43 +1178,36 @@ def main(object_info,autophot_input,fpath):
                     break
 
                 logging.info('Inconsistent Matching - Removing and rechecking WCS')
-                # remove wcs values and update -  will delete keys from header file
-                fit_open = fits.open(fpath,ignore_missing_end = True)
-                fit_header_wcs_clean = removewcs(fit_open,delete_keys = True)
-                fit_open.close()
-
-                fit_header_wcs_clean.writeto(fpath,
-                                             overwrite = True,
-                                             output_verify = 'silentfix+ignore')
+                # remove wcs values and update -  will delete keys from header
+                headinfo = removewcs(headinfo,delete_keys = True)
+                state.update(header = headinfo)
 
                 # Run astromety - return filepath of wcs file
-                astro_check = AstrometryNetLOCAL(fpath,autophot_input = autophot_input)
+                astro_check = AstrometryNetLOCAL(state.flush(),
+                                                 NAXIS1 = autophot_input['NAXIS1'],
+                                                 NAXIS2 = autophot_input['NAXIS2'],
+                                                 solve_field_exe_loc = autophot_input['wcs']['solve_field_exe_loc'],
+                                                 pixel_scale = autophot_input['pixel_scale'],
+                                                 target_ra = autophot_input['target_ra'],
+                                                 target_dec = autophot_input['target_dec'],
+                                                 search_radius = autophot_input['wcs']['search_radius'],
+                                                 downsample = autophot_input['wcs']['downsample'],
+                                                 cpulimit = autophot_input['wcs']['cpulimit']
+                                                 )
                 new_wcs  = fits.open(astro_check,ignore_missing_end = True)
-                fit_open = updatewcs(fit_open,new_wcs)
+                headinfo = updatewcs(headinfo,new_wcs[0].header)
                 new_wcs.close()
-                fit_open.writeto(fpath , overwrite = True,output_verify = 'silentfix+ignore')
-                fit_open = fits.open(fpath,ignore_missing_end = True)
-                headinfo = getheader(fpath)
                 headinfo['UPWCS'] = ('T', 'CROSS CHECKED WITH ASTROMETRY.NET')
-                fit_open.writeto(fpath , overwrite = True,output_verify = 'silentfix+ignore')
-                fit_open.close()
+                state.update(header = headinfo)
 
                 WCS_checked = True
             #==============================================================================
             # Isolate catalog sources
             #=============================================================================
             c_temp_dict = {}
-            dist_list = []
-            # Go through each matched catalog source and get its distance to every other source
-            # TODO: remove this and replace with index
-            for i in c.index:
-                try:
-                    dist = np.sqrt((c.x_pix[i]-np.array(c.x_pix))**2 +( c.y_pix[i]-np.array(c.y_pix))**2)
-                    dist = dist[np.where(dist!=0)]
-                    # add minimum - used to find isolated sources
-                    dist_list.append(np.nanmin(dist))
-                except:
-                    dist_list.append(np.nan)
+            # Distance from each matched catalog source to its nearest neighbour - used to find isolated sources
+            dist_list = nearest_distance(c.x_pix.values,c.y_pix.values)
+            dist_list[np.isinf(dist_list)] = np.nan
             # =============================================================================
             # Perform Photometry
             # =============================================================================
@@ -1206,6 +1220,32 @@ def main(object_info,autophot_input,fpath):
 
                 do_ap = False
 
+            timer.stage('psf_build')
+
+            def get_frame_bkg(image):
+                # Background map of the whole image, used for every cutout unless
+                # surfaces are fitted to each cutout
+                fitting_input = autophot_input['fitting']
+                if fitting_input['remove_bkg_cutout']:
+                    return None
+                if not (fitting_input['remove_bkg_surface'] or (fitting_input['remove_bkg_poly'] and not fitting_input['remove_bkg_local'])):
+                    return None
+                try:
+                    return background_mesh(image,
+                                           fwhm = autophot_input['fwhm'],
+                                           box_size = fitting_input['remove_bkg_box_size'],
+                                           bkg_level = fitting_input['bkg_level'])
+                except Exception as e:
+                    logging.warning('Could not measure background map of image - fitting background of each cutout: %s' % e)
+                    return None
+
+            frame_bkg = get_frame_bkg(image)
+
+            # Spatially varying residual table, if used
+            psf_field = None
+
+            PSF_available = False
+
             # First try to build PSF model in case it is needed later
             try:
 
@@ -1230,40 +1270,140 @@ def main(object_info,autophot_input,fpath):
                     dist = pix_dist(target_x_pix,df_PSF['x_pix'],target_y_pix,df_PSF['y_pix'])
                     df_PSF['dist'] = dist
 
-                r_table, fwhm_fit, psf_MODEL_sources = psf.build_r_table(base_image = image,
-                                                                            selected_sources = df_PSF,
-                                                                            fwhm = autophot_input['fwhm'],
-                                                                            exp_time = autophot_input['exp_time'],
-                                                                            image_params = autophot_input['image_params'],
-                                                                            fpath = autophot_input['fpath'],
-                                                                            GAIN = autophot_input['gain'],
-                                                                            rdnoise = autophot_input['rdnoise'],
-                                                                            use_moffat = autophot_input['fitting']['use_moffat'],
+                # Look for a PSF model from an earlier image taken on the same night
+                stored_psf = None
+                psf_store_dir = None
 
-                                                                            fitting_radius = autophot_input['fitting']['fitting_radius'],
-                                                                            regrid_size = autophot_input['psf']['regrid_size'],
-                                                                            use_PSF_starlist = autophot_input['psf']['use_PSF_starlist'],
-                                                                            use_local_stars_for_PSF = autophot_input['photometry']['use_local_stars_for_PSF'],
-                                                                            prepare_templates = autophot_input['template_subtraction']['prepare_templates'],
-                                                                            scale = autophot_input['scale'],
-                                                                            ap_size = autophot_input['photometry']['ap_size'],
-                                                                            r_in_size = autophot_input['photometry']['r_in_size'],
-                                                                            r_out_size = autophot_input['photometry']['r_out_size'],
-                                                                            local_radius = autophot_input['photometry']['local_radius'],
-                                                                            bkg_level = autophot_input['fitting']['bkg_level'],
-                                                                            psf_source_no = autophot_input['psf']['psf_source_no'],
-                                                                            min_psf_source_no = autophot_input['psf']['min_psf_source_no'],
-                                                                            construction_SNR = autophot_input['psf']['construction_SNR'],
-                                                                            remove_bkg_local = autophot_input['fitting']['remove_bkg_local'],
-                                                                            remove_bkg_surface = autophot_input['fitting']['remove_bkg_surface'],
-                                                                            remove_bkg_poly = autophot_input['fitting']['remove_bkg_poly'],
-                                                                            remove_bkg_poly_degree = autophot_input['fitting']['remove_bkg_poly_degree'],
+                if autophot_input['psf']['use_psf_store'] and not autophot_input['template_subtraction']['prepare_templates']:
+                    try:
+                        psf_store_dir = psf_store.open_store(new_output_dir,autophot_input['psf']['psf_store_dir'])
 
+                        stored_psf = psf_store.find_model(psf_store_dir,
+                                                          fwhm = autophot_input['fwhm'],
+                                                          tele = autophot_input['tele'],
+                                                          inst = autophot_input['inst'],
+                                                          image_filter = use_filter,
+                                                          mjd = autophot_input['mjd'],
+                                                          shape = (int(2*autophot_input['scale']),int(2*autophot_input['scale'])),
+                                                          use_moffat = autophot_input['fitting']['use_moffat'],
+                                                          fwhm_tol = autophot_input['psf']['psf_store_fwhm_tol'],
+                                                          longitude = autophot_input['site_lon'])
+
+                        if stored_psf is not None:
+
+                            stored_psf_valid, stored_psf_sources = psf_store.check_model(image,df_PSF,stored_psf,
+                                                                                         fwhm = autophot_input['fwhm'],
+                                                                                         fpath = autophot_input['fpath'],
+                                                                                         n_sources = autophot_input['psf']['psf_source_no'],
+                                                                                         min_sources = autophot_input['psf']['min_psf_source_no'],
+                                                                                         residual_tol = autophot_input['psf']['psf_store_residual_tol'],
+                                                                                         fitting_radius = autophot_input['fitting']['fitting_radius'],
+                                                                                         regrid_size = autophot_input['psf']['regrid_size'],
+                                                                                         sat_lvl = autophot_input['sat_lvl'],
+                                                                                         fitting_method = autophot_input['fitting']['fitting_method'],
+                                                                                         bkg_level = autophot_input['fitting']['bkg_level'],
+                                                                                         remove_bkg_local = autophot_input['fitting']['remove_bkg_local'],
+                                                                                         remove_bkg_surface = autophot_input['fitting']['remove_bkg_surface'],
+                                                                                         remove_bkg_poly = autophot_input['fitting']['remove_bkg_poly'],
+                                                                                         remove_bkg_poly_degree = autophot_input['fitting']['remove_bkg_poly_degree'],
+                                                                                         batch_fit = autophot_input['psf']['batch_fit'],
+                                                                                         frame_bkg = frame_bkg)
+                            if not stored_psf_valid:
+                                logging.info('Stored PSF model does not match this image - building new PSF model')
+                                stored_psf = None
+
+                    except Exception as e:
+                        logging.warning('Could not use PSF store: %s' % e)
+                        stored_psf = None
+
+                if stored_psf is not None:
+
+                    logging.info('Using stored PSF model from %s' % stored_psf['fpath'])
+
+                    r_table = stored_psf['r_table']
+                    fwhm_fit = stored_psf['fwhm']
+                    psf_MODEL_sources = stored_psf_sources
 
-                                                                            fitting_method = autophot_input['fitting']['fitting_method'],
-                                                                            save_PSF_stars = autophot_input['psf']['save_PSF_stars'],
-                                                                            # plot_PSF_model_residuals = autophot_input['psf']['plot_PSF_model_residuals'],
-                                                                            save_PSF_models_fits = autophot_input['psf']['save_PSF_models_fits'])
+                    # The residual table is measured relative to the analytical model it was built with
+                    autophot_input['image_params'] = stored_psf['image_params']
+
+                    if autophot_input['psf']['save_PSF_models_fits']:
+                        psf.save_PSF_model(r_table,autophot_input['image_params'],autophot_input['fpath'],
+                                           use_moffat = autophot_input['fitting']['use_moffat'])
+
+                else:
+
+                    use_spatial_psf = autophot_input['psf']['psf_spatial_degree'] > 0
+
+                    build_output = psf.build_r_table(base_image = image,
+                                                     selected_sources = df_PSF,
+                                                     fwhm = autophot_input['fwhm'],
+                                                     exp_time = autophot_input['exp_time'],
+                                                     image_params = autophot_input['image_params'],
+                                                     fpath = autophot_input['fpath'],
+                                                     GAIN = autophot_input['gain'],
+                                                     rdnoise = autophot_input['rdnoise'],
+                                                     use_moffat = autophot_input['fitting']['use_moffat'],
+
+                                                     fitting_radius = autophot_input['fitting']['fitting_radius'],
+                                                     regrid_size = autophot_input['psf']['regrid_size'],
+                                                     use_PSF_starlist = autophot_input['psf']['use_PSF_starlist'],
+                                                     use_local_stars_for_PSF = autophot_input['photometry']['use_local_stars_for_PSF'],
+                                                     prepare_templates = autophot_input['template_subtraction']['prepare_templates'],
+                                                     scale = autophot_input['scale'],
+                                                     ap_size = autophot_input['photometry']['ap_size'],
+                                                     r_in_size = autophot_input['photometry']['r_in_size'],
+                                                     r_out_size = autophot_input['photometry']['r_out_size'],
+                                                     local_radius = autophot_input['photometry']['local_radius'],
+                                                     bkg_level = autophot_input['fitting']['bkg_level'],
+                                                     psf_source_no = autophot_input['psf']['psf_source_no'],
+                                                     min_psf_source_no = autophot_input['psf']['min_psf_source_no'],
+                                                     construction_SNR = autophot_input['psf']['construction_SNR'],
+                                                     remove_bkg_local = autophot_input['fitting']['remove_bkg_local'],
+                                                     remove_bkg_surface = autophot_input['fitting']['remove_bkg_surface'],
+                                                     remove_bkg_poly = autophot_input['fitting']['remove_bkg_poly'],
+                                                     remove_bkg_poly_degree = autophot_input['fitting']['remove_bkg_poly_degree'],
+
+
+                                                     fitting_method = autophot_input['fitting']['fitting_method'],
+                                                     save_PSF_stars = autophot_input['psf']['save_PSF_stars'],
+                                                     # plot_PSF_model_residuals = autophot_input['psf']['plot_PSF_model_residuals'],
+                                                     save_PSF_models_fits = autophot_input['psf']['save_PSF_models_fits'],
+                                                     frame_bkg = frame_bkg,
+                                                     return_residuals = use_spatial_psf)
+
+                    r_table, fwhm_fit, psf_MODEL_sources = build_output[:3]
+
+                    if use_spatial_psf and fwhm_fit is not None and not np.any(r_table == None):
+                        try:
+                            psf_field = spatial_psf(build_output[3],
+                                                    x = psf_MODEL_sources.x_pix.values,
+                                                    y = psf_MODEL_sources.y_pix.values,
+                                                    image_shape = image.shape,
+                                                    image_params = autophot_input['image_params'],
+                                                    use_moffat = autophot_input['fitting']['use_moffat'],
+                                                    degree = autophot_input['psf']['psf_spatial_degree'],
+                                                    cell_size = autophot_input['psf']['psf_spatial_cell_size'],
+                                                    norm_radius = autophot_input['photometry']['ap_size'] * autophot_input['fwhm'])
+                        except Exception as e:
+                            logging.warning('Could not build spatially varying PSF model - using the same PSF model across the image: %s' % e)
+                            psf_field = None
+
+                    if psf_store_dir is not None and fwhm_fit is not None and not np.any(r_table == None):
+                        try:
+                            psf_store.save_model(psf_store_dir,autophot_input['fpath'],r_table,
+                                                 image_params = autophot_input['image_params'],
+                                                 fwhm = autophot_input['fwhm'],
+                                                 tele = autophot_input['tele'],
+                                                 inst = autophot_input['inst'],
+                                                 image_filter = use_filter,
+                                                 mjd = autophot_input['mjd'],
+                                                 use_moffat = autophot_input['fitting']['use_moffat'],
+                                                 n_sources = len(psf_MODEL_sources),
+                                                 fwhm_tol = autophot_input['psf']['psf_store_fwhm_tol'],
+                                                 longitude = autophot_input['site_lon'])
+                        except Exception as e:
+                            logging.warning('Could not save PSF model to store: %s' % e)
 
 
                 # Need to check if PSF model if build, inital assume it is not
@@ -1311,9 +1451,10 @@ def main(object_info,autophot_input,fpath):
 
                     logging.info('Approx PSF mag %.3f mag' % approx_psf_mag)
 
+                    timer.stage('psf_fit')
                     c_psf = psf.fit(image = image,
                                     sources = c,
-                                    residual_table = r_table,
+                                    residual_table = r_table if psf_field is None else psf_field,
                                     fwhm = autophot_input['fwhm'],
                                     fpath = autophot_input['fpath'],
                                     fitting_radius = autophot_input['fitting']['fitting_radius'],
@@ -1338,7 +1479,10 @@ def main(object_info,autophot_input,fpath):
                                     remove_bkg_surface = autophot_input['fitting']['remove_bkg_surface'],
                                     remove_bkg_poly = autophot_input['fitting']['remove_bkg_poly'],
                                     remove_bkg_poly_degree = autophot_input['fitting']['remove_bkg_poly_degree'],
-                                    plot_PSF_residuals = autophot_input['psf']['plot_PSF_residuals'])
+                                    plot_PSF_residuals = autophot_input['psf']['plot_PSF_residuals'],
+                                    batch_fit = autophot_input['psf']['batch_fit'],
+                                    blend_fallback = autophot_input['psf']['blend_fallback'],
+                                    frame_bkg = frame_bkg)
 
 
                     c_psf = psf.do(df = c_psf,
@@ -1378,6 +1522,7 @@ def main(object_info,autophot_input,fpath):
             # Perform aperture photoometry if pre-selected or psf fitting wasn't viable
             if autophot_input['photometry']['do_ap_phot'] or do_ap == True:
 
+                timer.stage('sequence_aperture')
                 logging.info('Using Aperture Photometry on sequence Stars ' )
                 # list of tuples of pix coordinates of sources
                 positions  = list(zip(np.array(c.x_pix),np.array(c.y_pix)))
@@ -1488,6 +1633,8 @@ def main(object_info,autophot_input,fpath):
             # =============================================================================
             # Find Zeropoint
             # =============================================================================
+            timer.stage('zeropoint')
+
 
             zp_measurement, c = get_zeropoint(c,image=image,headinfo=headinfo,
                                           fpath = autophot_input['fpath'],
@@ -1504,12 +1651,18 @@ def main(object_info,autophot_input,fpath):
                                           zp_use_WA = autophot_input['zeropoint']['zp_use_WA'],
                                            plot_ZP_image_analysis = autophot_input['zeropoint']['plot_ZP_image_analysis'],
                                           # plot_ZP_image_analysis = False,
-                                          plot_ZP_vs_SNR = autophot_input['zeropoint']['plot_ZP_vs_SNR'])
+                                          plot_ZP_vs_SNR = autophot_input['zeropoint']['plot_ZP_vs_SNR'],
+                                          write_image = False)
+
+            # fwhm and zeropoint are added to the header by get_zeropoint
+            state.update(image = image.astype(np.single),header = headinfo)
 
 
             # =============================================================================
             # Plot of image with sources used and target
             # =============================================================================
+            timer.stage('plots')
+
 
             if autophot_input['plot_source_selection']:
                 plt.ioff()
@@ -1834,12 +1987,20 @@ def main(object_info,autophot_input,fpath):
             # if np.isnan(catalog_mag_limit):
             #     mag_limit = 20
 
+            if psf_field is not None:
+                # Residual table of the spatially varying PSF model at the target
+                # location, found before the image is cropped to match a template
+                r_table = psf_field.table(target_x_pix,target_y_pix)
+
             # =============================================================================
             # Get Template
             # =============================================================================
+            timer.stage('template')
+
             # Initally assume subtraction is not ready
             subtraction_ready = False
             template_found = False
+            image_sub = None
 
             if autophot_input['template_subtraction']['do_subtraction']:
                 try:
@@ -1895,7 +2056,7 @@ def main(object_info,autophot_input,fpath):
 
                                 # https://astroquery.readthedocs.io/en/latest/skyview/skyview.html
                                 hdu  = SkyView.get_images(target_coords,survey = ['2MASS-'+use_filter_template.upper()],coordinates = 'ICRS',radius = size * u.arcsec)
-                                fits.writeto(fpath.replace(fname_ext,'_template')+'no_rot'+fname_ext,
+                                write_fits(fpath.replace(fname_ext,'_template')+'no_rot'+fname_ext,
                                  hdu[0][0].data,
                                   headinfo, overwrite=True,
                                   output_verify = 'silentfix+ignore')
@@ -1928,7 +2089,7 @@ def main(object_info,autophot_input,fpath):
                                         template_found  = True
                                         # save templates into original folder under the name template
                                         pathlib.Path(expected_template_folder).mkdir(parents = True, exist_ok=True)
-                                        fits.writeto(expected_filter_template_file,
+                                        write_fits(expected_filter_template_file,
                                                      hdu[0].data,
                                                      headinfo_template,
                                                      overwrite=True,
@@ -1944,6 +2105,9 @@ def main(object_info,autophot_input,fpath):
                     if not template_found:
                         logging.info('Template not found - cannot perform image subtraction')
                     else:
+                        # The PSF model of the template is saved under the name of the original file
+                        template_original = fpath_template
+
                         with fits.open(fpath_template,ignore_missing_end = True,lazy_load_hdus = True) as hdu:
                             headinfo_template = hdu[0].header
                             try:
@@ -1967,59 +2131,70 @@ def main(object_info,autophot_input,fpath):
                                     try:
                                         logging.info('Aligning via WCS with reproject_interp')
 
-                                        aligned_template, footprint = reproject_interp(hdu[0], headinfo, order = 1)
-                                        aligned_template[~footprint.astype(bool)] = 0
+                                        if autophot_input['template_subtraction']['cache_template_alignment']:
+                                            align_cache_dir = os.path.join(new_output_dir,'template_alignment')
+                                        else:
+                                            align_cache_dir = None
+
+                                        # Only the cutout of the image around the target covered by the template is reprojected
+                                        aligned_template, image_template_size, footprint = align_template(fpath_template,image,w1,
+                                                                                                          target_x_pix,target_y_pix,
+                                                                                                          cache_dir = align_cache_dir)
 
                                     except Exception as e:
                                         logging.info('Could not align images: %s' % e)
                                         # TODO: make this not crash everything
                                         raise Exception
 
-                                # cutout template around transient and match image size
+                                else:
 
-                                aligned_template_no_zeroes,good_templates_slices = trim_zeros_slices(aligned_template)
+                                    # cutout template around transient and match image size
 
-                                # Lets see where the target location is in relation to the template cutout
-                                ny, nx = aligned_template.shape
-                                x = np.arange(nx) # x an y so they are distance from center, assuming array is "nx" long (as opposed to 1. which is the other common choice)
-                                y = np.arange(ny)
-                                Y, X = np.meshgrid(x, y)
+                                    aligned_template_no_zeroes,good_templates_slices = trim_zeros_slices(aligned_template)
 
-                                distance_grid = pix_dist(X,target_x_pix,Y,target_y_pix)
-                                distance_grid[good_templates_slices] = 0
+                                    # Lets see where the target location is in relation to the template cutout
+                                    ny, nx = aligned_template.shape
+                                    x = np.arange(nx) # x an y so they are distance from center, assuming array is "nx" long (as opposed to 1. which is the other common choice)
+                                    y = np.arange(ny)
+                                    Y, X = np.meshgrid(x, y)
 
-                                distance_to_zero = distance_grid[distance_grid>0]
+                                    distance_grid = pix_dist(X,target_x_pix,Y,target_y_pix)
+                                    distance_grid[good_templates_slices] = 0
 
-                                if len(distance_to_zero) ==0:
-                                    distance_to_zero  = [np.nan]
+                                    distance_to_zero = distance_grid[distance_grid>0]
 
-                                if np.isnan(np.nanmin(distance_to_zero)):
+                                    if len(distance_to_zero) ==0:
+                                        distance_to_zero  = [np.nan]
 
-                                    logging.info('Template larger than image, cropping')
+                                    if np.isnan(np.nanmin(distance_to_zero)):
 
-                                    crop_size_y = np.floor(aligned_template.shape[0])
-                                    crop_size_x = np.floor(aligned_template.shape[1])
+                                        logging.info('Template larger than image, cropping')
 
-                                else:
+                                        crop_size_y = np.floor(aligned_template.shape[0])
+                                        crop_size_x = np.floor(aligned_template.shape[1])
 
-                                    logging.info('Template smaller than image, cropping to exlcude zeros')
-                                    crop_size_x = 2*abs(np.nanmin(distance_to_zero))
-                                    crop_size_y = 2*abs(np.nanmin(distance_to_zero))
+                                    else:
 
-                                aligned_template = Cutout2D(aligned_template,
-                                                            (np.floor(target_x_pix),np.floor(target_y_pix)),
-                                                            (int(crop_size_y),int(crop_size_x)),
-                                                            # mode = 'strict'
-                                                            )
+                                        logging.info('Template smaller than image, cropping to exlcude zeros')
+                                        crop_size_x = 2*abs(np.nanmin(distance_to_zero))
+                                        crop_size_y = 2*abs(np.nanmin(distance_to_zero))
 
-                                image_template_size =  Cutout2D(image,
+                                    aligned_template = Cutout2D(aligned_template,
                                                                 (np.floor(target_x_pix),np.floor(target_y_pix)),
                                                                 (int(crop_size_y),int(crop_size_x)),
-                                                                wcs=w1,
                                                                 # mode = 'strict'
                                                                 )
 
-                                logging.info('Trimmed template shape:(%d %d)' %  (aligned_template.data.shape[0],aligned_template.data.shape[1]))
+                                    image_template_size =  Cutout2D(image,
+                                                                    (np.floor(target_x_pix),np.floor(target_y_pix)),
+                                                                    (int(crop_size_y),int(crop_size_x)),
+                                                                    wcs=w1,
+                                                                    # mode = 'strict'
+                                                                    )
+
+                                    aligned_template = aligned_template.data
+
+                                logging.info('Trimmed template shape:(%d %d)' %  (aligned_template.shape[0],aligned_template.shape[1]))
                                 logging.info('Trimmed image shape:(%d %d)' %  (image_template_size.data.shape[0],image_template_size.data.shape[1]))
 
                                 if image_template_size.data.shape[0]!=aligned_template.shape[0] or image_template_size.data.shape[1]!=aligned_template.shape[1]:
@@ -2040,14 +2215,14 @@ def main(object_info,autophot_input,fpath):
                                 fpath = fpath.replace(fname_ext,'_image_cutout')+fname_ext
 
                                 # Write aligned image with cutout to file
-                                fits.writeto(fpath_template,
-                                             aligned_template.data,
+                                write_fits(fpath_template,
+                                             aligned_template,
                                              headinfo_template,
                                              overwrite=True,
                                              output_verify = 'silentfix+ignore')
 
                                 # Write aligned template to file
-                                fits.writeto(fpath,
+                                write_fits(fpath,
                                              image_template_size.data,
                                              image_template_size.wcs.to_header(),
                                              overwrite=True,
@@ -2070,6 +2245,8 @@ def main(object_info,autophot_input,fpath):
             # =============================================================================
             # Image subtraction using HOTPANTS
             # =============================================================================
+            timer.stage('subtraction')
+
             autophot_input['subtraction_ready'] = subtraction_ready
 
             if autophot_input['template_subtraction']['do_subtraction'] and not subtraction_ready:
@@ -2088,19 +2265,40 @@ def main(object_info,autophot_input,fpath):
                 #  This is where the template files are found
                 autophot_input['template_dir'] = os.path.join(autophot_input['fits_dir'],'templates/'+ use_filter_template + '_template')
 
-                fpath_sub = subtract(file = fpath,
-                                     template = fpath_template,
-                                     image_fwhm = image_fwhm,
-                                     footprint = footprint,
-                                     use_zogy = autophot_input['template_subtraction']['use_zogy'],
-                                     hotpants_exe_loc = autophot_input['template_subtraction']['hotpants_exe_loc'],
-                                     hotpants_timeout = autophot_input['template_subtraction']['hotpants_timeout'],
-                                     template_dir = autophot_input['template_dir'],
-                                     # psf = PSF_MODEL,
-                                     # mask_border = False,
-                                     # pix_bound = autophot_input['source_detection']['pix_bound'],
-                                     remove_sat = autophot_input['source_detection']['remove_sat'],
-                                     zogy_use_pixel = autophot_input['template_subtraction']['zogy_use_pixel'])
+                # PSF model of the image, so it doesn't need to be read from file
+                if PSF_available:
+                    image_psf = psf.psf_model_array(r_table,autophot_input['image_params'],
+                                                    use_moffat = autophot_input['fitting']['use_moffat'])
+                else:
+                    image_psf = None
+
+                # WCS of the template the PSF model was built from, used to resample it onto the image
+                template_wcs = WCS(headinfo_template)
+                if not template_wcs.has_celestial:
+                    template_wcs = None
+
+                fpath_sub, image_sub = subtract(file = fpath,
+                                                template = fpath_template,
+                                                image_fwhm = image_fwhm,
+                                                footprint = footprint,
+                                                use_zogy = autophot_input['template_subtraction']['use_zogy'],
+                                                hotpants_exe_loc = autophot_input['template_subtraction']['hotpants_exe_loc'],
+                                                hotpants_timeout = autophot_input['template_subtraction']['hotpants_timeout'],
+                                                template_dir = autophot_input['template_dir'],
+                                                # psf = PSF_MODEL,
+                                                # mask_border = False,
+                                                # pix_bound = autophot_input['source_detection']['pix_bound'],
+                                                remove_sat = autophot_input['source_detection']['remove_sat'],
+                                                zogy_use_pixel = autophot_input['template_subtraction']['zogy_use_pixel'],
+                                                use_native_zogy = autophot_input['template_subtraction']['use_native_zogy'],
+                                                image_psf = image_psf,
+                                                image_data = image_template_size.data if subtraction_ready else None,
+                                                template_data = aligned_template if subtraction_ready else None,
+                                                fft_threads = autophot_input['template_subtraction']['fft_threads'],
+                                                bkg_level = autophot_input['fitting']['bkg_level'],
+                                                return_image = True,
+                                                template_original = template_original,
+                                                template_wcs = template_wcs)
 
 
             if autophot_input['template_subtraction']['do_ap_on_sub'] and subtraction_ready:
@@ -2115,13 +2313,22 @@ def main(object_info,autophot_input,fpath):
             # =============================================================================
             # Perform photometry on target
             # =============================================================================
+            timer.stage('target')
+
 
             if subtraction_ready:
-                image    = getimage(fpath_sub)
+                if image_sub is not None:
+                    image = image_sub
+                else:
+                    image    = getimage(fpath_sub)
                 logging.info('Target photometry on subtracted image')
             else:
                 logging.info('Target photometry on original image')
             image_copy  = image.copy()
+
+            if subtraction_ready:
+                frame_bkg = get_frame_bkg(image)
+
             target_x_pix_TNS, target_y_pix_TNS = w1.all_world2pix(autophot_input['target_ra'],
                                                                   autophot_input['target_dec'],
                                                                   1)
@@ -2143,7 +2350,7 @@ def main(object_info,autophot_input,fpath):
 
                 ax2 = fig_sub.add_subplot(122)
                 plt.subplots_adjust(hspace=0.0,wspace=0.3)
-                image_sub_tmp = fits.getdata(fpath_sub)
+                image_sub_tmp = image_sub if image_sub is not None else fits.getdata(fpath_sub)
 
                 vmin,vmax = (ZScaleInterval(nsamples = 600)).get_limits(image_sub_tmp)
                 ax1.imshow(image_sub_tmp,
@@ -2187,7 +2394,7 @@ def main(object_info,autophot_input,fpath):
             dx = autophot_input['dx']
             dy = autophot_input['dy']
             
-            pars = lmfit.Parameters()
+            pars = fit_parameters()
             pars.add('A',
                      value = np.nanmax(target_close_up)*0.5,
                      min = 1e-6)
@@ -2213,19 +2420,10 @@ def main(object_info,autophot_input,fpath):
                          min = 0,
                          max = gauss_fwhm2sigma(autophot_input['source_detection']['max_fit_fwhm']),
                          vary = False)
-            if autophot_input['fitting']['use_moffat']:
-                def residual(p):
-                    p = p.valuesdict()
-                    return (target_close_up - moffat_2d((xx,yy),p['x0'],p['y0'],p['sky'],p['A'],dict(alpha=p['alpha'],beta=p['beta'])).reshape(target_close_up.shape)).flatten()
-            else:
-                def residual(p):
-                    p = p.valuesdict()
-                    return (target_close_up - gauss_2d((xx,yy),p['x0'],p['y0'],p['sky'],p['A'],dict(sigma=p['sigma'])).reshape(target_close_up.shape)).flatten()
-            mini = lmfit.Minimizer(residual,
-                                   pars,
-                                   nan_policy = 'omit')
+            analytic_kernel = model_kernel(xx,yy,use_moffat = autophot_input['fitting']['use_moffat'])
 
-            result = mini.minimize(method = autophot_input['fitting']['fitting_method'])
+            result = fit_kernel(analytic_kernel,target_close_up,pars,
+                                method = autophot_input['fitting']['fitting_method'])
 
             if autophot_input['fitting']['use_moffat']:
                 fitting_model = moffat_2d
@@ -2235,9 +2433,9 @@ def main(object_info,autophot_input,fpath):
                 fitting_model_fwhm = gauss_sigma2fwhm
 
             if autophot_input['fitting']['use_moffat']:
-                target_fwhm = fitting_model_fwhm(dict(alpha=result.params['alpha'],beta=result.params['beta']))
+                target_fwhm = fitting_model_fwhm(dict(alpha=result.params['alpha'].value,beta=result.params['beta'].value))
             else:
-                target_fwhm = fitting_model_fwhm(dict(sigma=result.params['sigma']))
+                target_fwhm = fitting_model_fwhm(dict(sigma=result.params['sigma'].value))
 
             target_x_pix_corr =  result.params['x0'].value
             target_y_pix_corr =  result.params['y0'].value
@@ -2328,7 +2526,8 @@ def main(object_info,autophot_input,fpath):
                                                         remove_bkg_poly = autophot_input['fitting']['remove_bkg_poly'],
                                                         remove_bkg_poly_degree = autophot_input['fitting']['remove_bkg_poly_degree'],
 
-                                                        plot_PSF_residuals = autophot_input['psf']['plot_PSF_residuals'])
+                                                        plot_PSF_residuals = autophot_input['psf']['plot_PSF_residuals'],
+                                                        frame_bkg = frame_bkg)
                 c_psf_target =psf.do(df = c_psf_target,
                                         residual_image = r_table,
                                         ap_size = autophot_input['photometry']['ap_size'],
@@ -2388,6 +2587,8 @@ def main(object_info,autophot_input,fpath):
             # =============================================================================
             # Limiting Magnitude
             # =============================================================================
+            timer.stage('limit')
+
 
 
             lmag_check = True
@@ -2395,6 +2596,10 @@ def main(object_info,autophot_input,fpath):
             close_up_expand = image_copy[int(target_y_pix - expand_scale): int(target_y_pix + expand_scale),
                                          int(target_x_pix - expand_scale): int(target_x_pix + expand_scale)]
 
+            close_up_expand_bkg = None
+            if frame_bkg is not None:
+                close_up_expand_bkg = frame_bkg.shifted(int(target_x_pix - expand_scale),int(target_y_pix - expand_scale))
+
             model = PSF_MODEL
 
             if autophot_input['limiting_magnitude']['skip_lmag']:
@@ -2440,6 +2645,9 @@ def main(object_info,autophot_input,fpath):
                                                                             remove_bkg_poly = autophot_input['fitting']['remove_bkg_poly'],
                                                                             remove_bkg_poly_degree = autophot_input['fitting']['remove_bkg_poly_degree'],
                                                                             subtraction_ready = autophot_input['subtraction_ready'],
+                                                                            probable_limit_draws = autophot_input['limiting_magnitude']['probable_limit_draws'],
+                                                                            probable_limit_seed = autophot_input['limiting_magnitude']['probable_limit_seed'],
+                                                                            frame_bkg = close_up_expand_bkg,
                                                                            )
 
                     lmag_prob = lmag_prob_inst + zp_measurement[0]
@@ -2454,6 +2662,7 @@ def main(object_info,autophot_input,fpath):
                         lmag_guess = None
 
 
+                    timer.stage('inject_sources')
                     lmag_inject_inst = inject_sources(image = close_up_expand,
                                                                     fwhm = autophot_input['fwhm'],
                                                                     fpath = autophot_input['fpath'],
@@ -2479,6 +2688,10 @@ def main(object_info,autophot_input,fpath):
                                                                     inject_source_mag = autophot_input['limiting_magnitude']['inject_source_mag'],
                                                                     inject_source_recover_nsteps = autophot_input['limiting_magnitude']['inject_source_recover_nsteps'],
                                                                     inject_source_recover_dmag_redo = autophot_input['limiting_magnitude']['inject_source_recover_dmag_redo'],
+                                                                    inject_source_batch_search = autophot_input['limiting_magnitude']['inject_source_batch_search'],
+                                                                    inject_source_batch_size = autophot_input['limiting_magnitude']['inject_source_batch_size'],
+                                                                    inject_source_workers = autophot_input['limiting_magnitude']['inject_source_workers'],
+                                                                    frame_bkg = close_up_expand_bkg,
                                                                     inject_source_sources_no = autophot_input['limiting_magnitude']['inject_source_sources_no'],
                                                                     inject_source_cutoff_limit = autophot_input['limiting_magnitude']['inject_source_cutoff_limit'],
                                                                     subtraction_ready = autophot_input['subtraction_ready'],
@@ -2515,6 +2728,8 @@ def main(object_info,autophot_input,fpath):
         # Check limiting magnitudes of catalog nondetections
         # =============================================================================
 
+            timer.stage('catalog_nondetections')
+
             if autophot_input['limiting_magnitude']['check_catalog_nondetections']:
                 border_msg('Performing catalog non detections analysis')
 
@@ -2531,6 +2746,10 @@ def main(object_info,autophot_input,fpath):
                         catalog_close_up_expand = image_copy[int(catalog_y_pix - expand_scale): int(catalog_y_pix + expand_scale),
                                                      int(catalog_x_pix - expand_scale): int(catalog_x_pix + expand_scale)]
 
+                        catalog_close_up_expand_bkg = None
+                        if frame_bkg is not None:
+                            catalog_close_up_expand_bkg = frame_bkg.shifted(int(catalog_x_pix - expand_scale),int(catalog_y_pix - expand_scale))
+
                         catalog_lmag_prob_inst = limiting_magnitude_prob(image = catalog_close_up_expand,
                                                                          model = model,
                                                                          r_table = r_table,
@@ -2556,7 +2775,10 @@ def main(object_info,autophot_input,fpath):
                                                                          remove_bkg_surface = autophot_input['fitting']['remove_bkg_surface'],
                                                                          remove_bkg_poly = autophot_input['fitting']['remove_bkg_poly'],
                                                                          remove_bkg_poly_degree = autophot_input['fitting']['remove_bkg_poly_degree'],
-                                                                         subtraction_ready = autophot_input['subtraction_ready'])
+                                                                         subtraction_ready = autophot_input['subtraction_ready'],
+                                                                         probable_limit_draws = autophot_input['limiting_magnitude']['probable_limit_draws'],
+                                                                         probable_limit_seed = autophot_input['limiting_magnitude']['probable_limit_seed'],
+                                                                         frame_bkg = catalog_close_up_expand_bkg)
 
                         catalog_lmag_prob = catalog_lmag_prob_inst + zp_measurement[0]
 
@@ -2586,6 +2808,10 @@ def main(object_info,autophot_input,fpath):
                                                         inject_source_mag = autophot_input['limiting_magnitude']['inject_source_mag'],
                                                         inject_source_recover_nsteps = autophot_input['limiting_magnitude']['inject_source_recover_nsteps'],
                                                         inject_source_recover_dmag_redo = autophot_input['limiting_magnitude']['inject_source_recover_dmag_redo'],
+                                                        inject_source_batch_search = autophot_input['limiting_magnitude']['inject_source_batch_search'],
+                                                        inject_source_batch_size = autophot_input['limiting_magnitude']['inject_source_batch_size'],
+                                                        inject_source_workers = autophot_input['limiting_magnitude']['inject_source_workers'],
+                                                        frame_bkg = catalog_close_up_expand_bkg,
                                                         inject_source_sources_no = autophot_input['limiting_magnitude']['inject_source_sources_no'],
                                                         inject_source_cutoff_limit = autophot_input['limiting_magnitude']['inject_source_cutoff_limit'],
                                                         subtraction_ready = autophot_input['subtraction_ready'],
@@ -2634,6 +2860,7 @@ def main(object_info,autophot_input,fpath):
 
             if autophot_input['extinction']['apply_airmass_extinction']:
 
+                timer.stage('extinction')
 
                 if 'extinction' not in tele_autophot_input[telescope]:
                     airmass_correction = np.nan
@@ -2649,6 +2876,8 @@ def main(object_info,autophot_input,fpath):
             # =============================================================================
             # Error on target magnitude
             # =============================================================================
+            timer.stage('error')
+
 
             # Error due to SNR of target
             SNR_error = SNR_err(SNR_target)
@@ -2771,6 +3000,11 @@ def main(object_info,autophot_input,fpath):
             output.update(ap_corr_err_out)
             output.update({'time_taken':round(time.time() - start_time,1)})
 
+            # Add time and memory usage of each stage
+            timer.stop()
+            output.update(timer.output())
+            logging.info('\n'+timer.summary())
+
             # =============================================================================
             # Print message to tell about source detection
             # =============================================================================
@@ -2896,6 +3130,10 @@ def main(object_info,autophot_input,fpath):
             #                 return_subtraction_image = True)
             logging.info('Time Taken [ %s ]: %ss' % (str(os.getpid()),round(time.time() - start)))
             logging.info('Sucess: %s :: PID %s \n'%(str(base),str(os.getpid())))
+
+            # Write any changes to the image/header held in memory
+            state.flush()
+
             console.close()
 
             gc.collect()
@@ -2904,6 +3142,11 @@ def main(object_info,autophot_input,fpath):
         except Exception as e:
             logging.exception(e)
             logging.critical('Failure: '+ str(base) + ' - PID: '+str(os.getpid()))
+            try:
+                # Keep any changes made before failure
+                state.flush()
+            except Exception as e:
+                logging.exception(e)
             # # console.close()
             # logging.info(cur_dir)
             # fail_dir = os.path.join(cur_dir,'fail')
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Resume manifest used when *restart* is True. Each time an image finishes in
+AutoPhOT, a single line is appended to the manifest recording the input file,
+a signature of its contents, a hash of the input commands and whether the
+reduction was successful. On restart, the manifest is loaded once into a
+dictionary keyed by the input file path, so checking if an image has already
+been done does not depend on the layout of the output directory.
+'''
+
+# Commands that control how AutoPhOT is run, rather than the photometry itself.
+# Changing these will not cause an image to be redone.
+run_keys = ['restart','restart_use_hash','method','nCPU','mp_timeout',
+            'outcsv_name','output_columnar','select_filter','do_filter',
+            'ignore_no_telescop','ignore_no_filter']
+
+
+def manifest_fpath(output_dir,fname = 'autophot_manifest.jsonl'):
+    '''
+    Location of the resume manifest for a given output directory.
+
+    :param output_dir: Output directory e.g. *fits_dir* with *outdir_name* appended
+    :type output_dir: str
+    :param fname: Name of manifest file, defaults to 'autophot_manifest.jsonl'
+    :type fname: str, optional
+    :return: File path of manifest
+    :rtype: str
+
+    '''
+
+    import os
+
+    return os.path.join(output_dir,fname)
+
+
+def config_hash(autophot_input):
+    '''
+    Hash of the AutoPhOT input dictionary, ignoring commands that only control how
+    the script is run (given by *run_keys*). If any other command is changed, the
+    hash will change and previously completed images will be redone on restart.
+
+    :param autophot_input: AutoPHOT input dictionary
+    :type autophot_input: dict
+    :return: sha1 hex digest of input commands
+    :rtype: str
+
+    '''
+
+    import json
+    import hashlib
+
+    relevant_input = {key:value for key,value in autophot_input.items() if key not in run_keys}
+
+    encoded = json.dumps(relevant_input,sort_keys = True,default = str).encode('utf-8')
+
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def file_signature(fpath,use_hash = False):
+    '''
+    Signature of an input file used to check whether it has changed since it was
+    last reduced. By default this is the file size and modification time, which
+    only needs a single *stat* call. If *use_hash* is True, the sha1 hash of the
+    file contents is used instead, which is robust against files being copied or
+    touched, but requires reading the whole file.
+
+    :param fpath: File path of image
+    :type fpath: str
+    :param use_hash: If True, use a hash of the file contents, defaults to False
+    :type use_hash: bool, optional
+    :return: Signature of file
+    :rtype: str
+
+    '''
+
+    import os
+    import hashlib
+
+    if use_hash:
+
+        sha1 = hashlib.sha1()
+
+        with open(fpath,'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha1.update(chunk)
+
+        return 'sha1:%s' % sha1.hexdigest()
+
+    stat = os.stat(fpath)
+
+    return 'stat:%d:%d' % (stat.st_size,stat.st_mtime_ns)
+
+
+def load_manifest(fpath):
+    '''
+    Load resume manifest into a dictionary keyed by the absolute file path of each
+    input image. If an image appears multiple times, the most recent entry is
+    kept. Lines that cannot be read (e.g. if the script was killed while writing)
+    are ignored.
+
+    :param fpath: File path of manifest
+    :type fpath: str
+    :return: Dictionary of manifest entries
+    :rtype: dict
+
+    '''
+
+    import os
+    import json
+
+    manifest = {}
+
+    if not os.path.isfile(fpath):
+        return manifest
+
+    with open(fpath,'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                manifest[entry['fpath']] = entry
+            except Exception:
+                continue
+
+    return manifest
+
+
+def update_manifest(fpath,image_fpath,signature,config,status,output_fpath = None):
+    '''
+    Append the outcome of a single image to the resume manifest. Each entry is
+    written as a single line and flushed to disk before returning, so a run that
+    is stopped part way through will only lose the image currently being
+    worked on.
+
+    :param fpath: File path of manifest
+    :type fpath: str
+    :param image_fpath: File path of input image
+    :type image_fpath: str
+    :param signature: Signature of input image given by *file_signature*
+    :type signature: str
+    :param config: Hash of input commands given by *config_hash*
+    :type config: str
+    :param status: Outcome of reduction, either *done* or *failed*
+    :type status: str
+    :param output_fpath: File path of working image in output directory, defaults to None
+    :type output_fpath: str, optional
+    :return: None
+    :rtype: None
+
+    '''
+
+    import os
+    import json
+    import datetime
+
+    entry = {'fpath':os.path.abspath(image_fpath),
+             'signature':signature,
+             'config':config,
+             'status':status,
+             'output':output_fpath,
+             'time':str(datetime.datetime.now())}
+
+    with open(fpath,'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+    return
+
+
+def is_complete(manifest,image_fpath,signature,config):
+    '''
+    Check if an image has already been successfully reduced with the current input
+    commands and has not changed since.
+
+    :param manifest: Dictionary of manifest entries given by *load_manifest*
+    :type manifest: dict
+    :param image_fpath: File path of input image
+    :type image_fpath: str
+    :param signature: Signature of input image given by *file_signature*
+    :type signature: str
+    :param config: Hash of input commands given by *config_hash*
+    :type config: str
+    :return: Tuple of whether the image is complete and the reason if not. Reason is one of *new*, *failed*, *modified* or *config*
+    :rtype: tuple
+
+    '''
+
+    import os
+
+    entry = manifest.get(os.path.abspath(image_fpath))
+
+    if entry is None:
+        return False, 'new'
+
+    if entry['status'] != 'done':
+        return False, 'failed'
+
+    if entry['signature'] != signature:
+        return False, 'modified'
+
+    if entry['config'] != config:
+        return False, 'config'
+
+    return True, None
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Functions to write the output of AutoPhOT as each image finishes, rather than
+all at once at the end of a run. Rows are appended to the output csv file
+(given by *outcsv_name*) under a file lock, so several instances of AutoPhOT
+can safely write to the same file. If an image returns columns not seen
+before (e.g. the first image in a new filter), the file is rewritten once with
+the new columns added.
+'''
+
+
+def lock_file(fpath):
+    '''
+    Context manager that holds an exclusive lock on *fpath* with ".lock" appended.
+    This uses *fcntl* and is only available on unix systems - otherwise no lock
+    is taken.
+
+    :param fpath: File path to lock
+    :type fpath: str
+    :return: Context manager
+    :rtype: contextmanager
+
+    '''
+
+    import contextlib
+
+    @contextlib.contextmanager
+    def _lock():
+
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+
+        with open(fpath + '.lock','a') as lock:
+            fcntl.flock(lock.fileno(),fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(),fcntl.LOCK_UN)
+
+    return _lock()
+
+
+def read_columns(fpath):
+    '''
+    Read the column names from the first line of a csv file without reading the rest of the file.
+
+    :param fpath: File path of csv file
+    :type fpath: str
+    :return: List of column names, empty if file is empty or not found
+    :rtype: list
+
+    '''
+
+    import os
+    import csv
+
+    if not os.path.isfile(fpath):
+        return []
+
+    with open(fpath,'r',newline = '') as f:
+        header = next(csv.reader(f),[])
+
+    return header
+
+
+def append_output(fpath,output):
+    '''
+    Append the output of a single image to the output csv file. If the file is
+    empty, the header is written first. If the output contains columns that are
+    not already in the file, the file is rewritten with these columns added to
+    the end, and previous rows are left blank for these columns.
+
+    :param fpath: File path of output csv file
+    :type fpath: str
+    :param output: Dictionary of outputs from a single image, as returned by *main*
+    :type output: dict
+    :return: None
+    :rtype: None
+
+    '''
+
+    import os
+    import pandas as pd
+
+    new_entry = pd.DataFrame([output])
+
+    with lock_file(fpath):
+
+        columns = read_columns(fpath)
+
+        if len(columns) == 0:
+
+            new_entry.to_csv(fpath,index = False)
+
+            return
+
+        new_columns = [col for col in new_entry.columns if col not in columns]
+
+        if len(new_columns) == 0:
+
+            # Same columns - simply add to the end of the file
+            new_entry = new_entry.reindex(columns = columns)
+            new_entry.to_csv(fpath,index = False,header = False,mode = 'a')
+
+        else:
+
+            # New columns - rewrite file to a temporary file and swap
+            data = pd.read_csv(fpath)
+            update_data = pd.concat([data,new_entry],axis = 0,sort = False,ignore_index = True)
+
+            tmp_fpath = fpath + '.tmp'
+            update_data.to_csv(tmp_fpath,index = False)
+            os.replace(tmp_fpath,fpath)
+
+    return
+
+
+def columnar_fpath(fpath,columnar):
+    '''
+    File path of columnar copy of an output csv file
+
+    :param fpath: File path of output csv file
+    :type fpath: str
+    :param columnar: Columnar format, either *parquet* or *feather*
+    :type columnar: str
+    :return: File path of columnar file
+    :rtype: str
+
+    '''
+
+    import os
+
+    return os.path.splitext(fpath)[0] + '.' + columnar
+
+
+def write_columnar(fpath,columnar = 'parquet'):
+    '''
+    Write a columnar (`Parquet <https://parquet.apache.org/>`_ or `Feather <https://arrow.apache.org/docs/python/feather.html>`_) copy of an output csv file next to it. This requires *pyarrow* to be installed. These files are much faster to load than a large csv file and are used by *load_output* if they are up to date.
+
+    :param fpath: File path of output csv file
+    :type fpath: str
+    :param columnar: Columnar format, either *parquet* or *feather*, defaults to 'parquet'
+    :type columnar: str, optional
+    :return: File path of columnar file, None if it could not be written
+    :rtype: str
+
+    '''
+
+    import os
+    import sys
+    import pandas as pd
+
+    if columnar not in ['parquet','feather']:
+        print('Columnar format %s not recognised - please use parquet or feather' % columnar)
+        return None
+
+    out_fpath = columnar_fpath(fpath,columnar)
+    tmp_fpath = out_fpath + '.tmp'
+
+    try:
+
+        with lock_file(fpath):
+            data = pd.read_csv(fpath)
+
+        # Mixed type columns can't be written to columnar files - keep missing values as nulls
+        for col in data.columns:
+            if data[col].dtype == object:
+                data[col] = data[col].where(data[col].isna(),data[col].astype(str))
+
+        if columnar == 'parquet':
+            data.to_parquet(tmp_fpath,index = False)
+        else:
+            data.reset_index(drop = True).to_feather(tmp_fpath)
+
+        os.replace(tmp_fpath,out_fpath)
+
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        print(exc_type, fname, exc_tb.tb_lineno,e)
+        print('Could not write %s file - is pyarrow installed?' % columnar)
+        return None
+
+    return out_fpath
+
+
+def load_output(fpath):
+    '''
+    Load an output csv file. If a columnar copy of this file (written by
+    *write_columnar*) exists and is newer than the csv file, this is loaded
+    instead.
+
+    :param fpath: File path of output csv file
+    :type fpath: str
+    :return: Output data
+    :rtype: DataFrame
+
+    '''
+
+    import os
+    import pandas as pd
+
+    for columnar in ['parquet','feather']:
+
+        columnar_loc = columnar_fpath(fpath,columnar)
+
+        if not os.path.isfile(columnar_loc):
+            continue
+
+        if os.path.isfile(fpath) and os.path.getmtime(columnar_loc) < os.path.getmtime(fpath):
+            continue
+
+        try:
+            if columnar == 'parquet':
+                return pd.read_parquet(columnar_loc)
+            else:
+                return pd.read_feather(columnar_loc)
+        except Exception:
+            # Fall back to csv file
+            continue
+
+    return pd.read_csv(fpath)
@@ -12,7 +12,8 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
                   remove_bkg_poly_degree = 1,
                   fitting_method = 'least_sqaure', 
                   save_PSF_stars = False, plot_PSF_model_residual = False, 
-                  save_PSF_models_fits = False
+                  save_PSF_models_fits = False, frame_bkg = None,
+                  return_residuals = False
                   ):
     r'''
     
@@ -88,8 +89,12 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
     :type save_PSF_stars: bool, optional
     :param save_PSF_models_fits: If True, save a *FITS* image of the PSF model, normalised to unity, defaults to False
     :type save_PSF_models_fits: bool, optional
-    :return: DESCRIPTION
-    :rtype: TYPE
+    :param frame_bkg: Background mesh of *base_image*. If given, the background surface around each PSF star is interpolated from this mesh rather than fitted to each cutout, see *remove_background*, defaults to None
+    :type frame_bkg: background_mesh, optional
+    :param return_residuals: If True, also return the residual table of each source used, in the same order as the returned sources. These can be used to build a spatially varying PSF model using *spatial_psf*, defaults to False
+    :type return_residuals: bool, optional
+    :return: Residual table normalised to unity, FWHM of each source used and dataframe of sources used. If *return_residuals* is True, an array of the residual table of each source is also returned
+    :rtype: tuple
 
     '''
     
@@ -105,8 +110,10 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
     
     from autophot.packages.functions import scale_roll
     from autophot.packages.functions import rebin
-    from autophot.packages.functions import pix_dist
+    from autophot.packages.spatial_index import source_index
     from autophot.packages.functions import SNR,border_msg
+    from autophot.packages.kernels import model_kernel
+    from autophot.packages.fitter import fit_parameters,fit_kernel,lmfit_method
     from autophot.packages.aperture  import measure_aperture_photometry
     from autophot.packages.functions import gauss_2d,gauss_sigma2fwhm
     from autophot.packages.functions import moffat_2d,moffat_fwhm
@@ -262,10 +269,11 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
                 if len(sources)>1:
                     
                     # More than one source found! Might be detecting the same source - check if all points are withint one fwhm
-                    dist = [max(pix_dist(x,sources['xcentroid'].values,y,sources['ycentroid'].values)) for x, y in zip(sources['xcentroid'], sources['ycentroid'])]
+                    n_close = source_index(sources['xcentroid'].values,
+                                           sources['ycentroid'].values).count_within(2*fwhm)
 
-
-                    if all(x >  2*fwhm for x in dist) and not use_PSF_starlist:
+                    # Every source has another source further than 2 fwhm away
+                    if all(n_close < len(sources) - 1) and not use_PSF_starlist:
 
                         logger.info('Found faint soures near PSF star at %d sigma - skipping '%bkg_level)
                         
@@ -287,13 +295,15 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
                                                                                       remove_bkg_surface = remove_bkg_surface,
                                                                                       remove_bkg_poly   = remove_bkg_poly,
                                                                                       remove_bkg_poly_degree = remove_bkg_poly_degree,
-                                                                                      bkg_level = bkg_level)
+                                                                                      bkg_level = bkg_level,
+                                                                                      frame_bkg = frame_bkg,
+                                                                                      origin = (int(selected_sources.x_pix[idx]-scale),int(selected_sources.y_pix[idx]-scale)))
                                                                                       
 
                 x = np.arange(0,2*scale)
                 xx,yy= np.meshgrid(x,x)
 
-                pars = lmfit.Parameters()
+                pars = fit_parameters()
                 pars.add('A',value = 0.75*np.nanmax(psf_image_bkg_free),
                          min=0,
                          max = 1.5 * np.nanmax(psf_image_bkg_free))
@@ -320,27 +330,14 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
                              vary = False)
                              
 
-                if use_moffat:
-                    def residual(p):
-                        p = p.valuesdict()
-                        return (psf_image_bkg_free - moffat_2d((xx,yy),p['x0'],p['y0'],0,p['A'],dict(alpha=p['alpha'],beta=p['beta'])).reshape(psf_image_bkg_free.shape)).flatten()
-                else:
-                    def residual(p):
-                      p = p.valuesdict()
-                      return (psf_image_bkg_free - gauss_2d((xx,yy),p['x0'],p['y0'],0,p['A'],dict(sigma=p['sigma'])).reshape(psf_image_bkg_free.shape)).flatten()
-
-                    
+                analytic_kernel = model_kernel(xx,yy,use_moffat = use_moffat)
 
                 with warnings.catch_warnings():
                     
                     warnings.simplefilter("ignore")
                     
-                    mini = lmfit.Minimizer(residual,
-                                       pars,
-                                       nan_policy = 'omit',
-                                       scale_covar=True)
-                    
-                    result = mini.minimize(method = fitting_method)
+                    result = fit_kernel(analytic_kernel,psf_image_bkg_free,pars,
+                                        method = fitting_method)
                     
                 xc = result.params['x0'].value
                 yc = result.params['y0'].value
@@ -359,7 +356,9 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
                                                                           remove_bkg_surface = remove_bkg_surface,
                                                                           remove_bkg_poly   = remove_bkg_poly,
                                                                           remove_bkg_poly_degree =   remove_bkg_poly_degree,
-                                                                          bkg_level =bkg_level)
+                                                                          bkg_level =bkg_level,
+                                                                          frame_bkg = frame_bkg,
+                                                                          origin = (int(xc_global-scale),int(yc_global-scale)))
                                                                         
 
                 psf_image_slice = psf_image_bkg_free[int(psf_image_bkg_free.shape[1]/2 - fitting_radius):int(psf_image_bkg_free.shape[1]/2 + fitting_radius) ,
@@ -416,7 +415,7 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
                                        nan_policy = 'omit',
                                        scale_covar=True)
                     
-                    result = mini.minimize(method = fitting_method)
+                    result = mini.minimize(method = lmfit_method(fitting_method))
 
                 positions  = list(zip([xc_global],[yc_global]))
 
@@ -546,8 +545,12 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
 
         if sources_used < min_psf_source_no:
             logger.info('BUILDING PSF: Not enough useable sources found')
+            if return_residuals:
+                return None,None,construction_sources.append([np.nan]*5),None
             return None,None,construction_sources.append([np.nan]*5)
         
+        residual_table_sources = residual_table
+
         # Get the mean of the residual tavles
         residual_table = sum(residual_table)/sources_used
 
@@ -570,39 +573,94 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
 
         if save_PSF_models_fits:
 
-            from astropy.io import fits
-            import os
+            save_PSF_model(r_table,image_params,fpath,use_moffat = use_moffat)
 
-            if use_moffat:
-                
-                
+    except Exception as e:
+        logger.exception('BUILDING PSF: ',e)
+        raise Exception
 
-                PSF_model_array = r_table+ moffat_2d((xx,yy),r_table.shape[1]/2,r_table.shape[0]/2,
-                                                          0,1,
-                                                          dict(alpha=image_params['alpha'],
-                                                               beta=image_params['beta'])).reshape(r_table.shape)
+    if return_residuals:
 
-            else:
-                
-                PSF_model_array = r_table + gauss_2d((xx,yy),r_table.shape[1]/2,r_table.shape[0]/2,
-                                                         0,1,
-                                                         dict(sigma=image_params['sigma'])).reshape(r_table.shape)
+        # Residual table of each source at the same scale as r_table
+        source_residuals = np.array([rebin(i, (int(2*scale),int(2*scale))) for i in residual_table_sources])
 
-            hdu = fits.PrimaryHDU(PSF_model_array/np.sum(PSF_model_array))
-            hdul = fits.HDUList([hdu])
-            psf_model_savepath = os.path.join(write_dir,'PSF_model_'+base+'.fits')
-            hdul.writeto(psf_model_savepath,
-                         overwrite = True)
-        
+        return r_table,fwhm_fit,construction_sources,source_residuals
 
+    return r_table,fwhm_fit,construction_sources
 
-            print('PSF model saved as: %s' % psf_model_savepath)
 
-    except Exception as e:
-        logger.exception('BUILDING PSF: ',e)
-        raise Exception
+def psf_model_array(r_table,image_params,use_moffat = True):
+    '''
+    PSF model, given by the analytical model plus the residual table, with the
+    same shape as the residual table and normalised so it sums to 1.
 
-    return r_table,fwhm_fit,construction_sources
+    :param r_table: Residual table, normalised to unity
+    :type r_table: 2D array
+    :param image_params: Dictionary containing analytical model params. If a moffat is used, this dictionary should containing *alpha* and *beta* and their respective values, else if a gaussian is used, this dictionary should include *sigma* and its value.
+    :type image_params: dict
+    :param use_moffat: If True, use a moffat function as the analytical function, else use a gaussian, defaults to True
+    :type use_moffat: bool, optional
+    :return: PSF model
+    :rtype: 2D array
+
+    '''
+
+    import numpy as np
+    from autophot.packages.functions import gauss_2d,moffat_2d
+
+    x = np.arange(0,r_table.shape[1])
+    y = np.arange(0,r_table.shape[0])
+    xx,yy= np.meshgrid(x,y)
+
+    if use_moffat:
+
+        PSF_model_array = r_table+ moffat_2d((xx,yy),r_table.shape[1]/2,r_table.shape[0]/2,
+                                                  0,1,
+                                                  dict(alpha=image_params['alpha'],
+                                                       beta=image_params['beta'])).reshape(r_table.shape)
+
+    else:
+
+        PSF_model_array = r_table + gauss_2d((xx,yy),r_table.shape[1]/2,r_table.shape[0]/2,
+                                                 0,1,
+                                                 dict(sigma=image_params['sigma'])).reshape(r_table.shape)
+
+    return PSF_model_array/np.sum(PSF_model_array)
+
+
+def save_PSF_model(r_table,image_params,fpath,use_moffat = True):
+    '''
+    Save the PSF model, normalised to unity, as *PSF_model_<base>.fits* in the
+    same folder as *fpath*.
+
+    :param r_table: Residual table, normalised to unity
+    :type r_table: 2D array
+    :param image_params: Dictionary containing analytical model params. If a moffat is used, this dictionary should containing *alpha* and *beta* and their respective values, else if a gaussian is used, this dictionary should include *sigma* and its value.
+    :type image_params: dict
+    :param fpath: File path of image
+    :type fpath: str
+    :param use_moffat: If True, use a moffat function as the analytical function, else use a gaussian, defaults to True
+    :type use_moffat: bool, optional
+    :return: File path of PSF model
+    :rtype: str
+
+    '''
+
+    import os
+    from astropy.io import fits
+
+    base = os.path.splitext(os.path.basename(fpath))[0]
+    write_dir = os.path.dirname(fpath)
+
+    hdu = fits.PrimaryHDU(psf_model_array(r_table,image_params,use_moffat = use_moffat))
+    hdul = fits.HDUList([hdu])
+    psf_model_savepath = os.path.join(write_dir,'PSF_model_'+base+'.fits')
+    hdul.writeto(psf_model_savepath,
+                 overwrite = True)
+
+    print('PSF model saved as: %s' % psf_model_savepath)
+
+    return psf_model_savepath
 
 
 
@@ -610,6 +668,163 @@ def build_r_table(base_image, selected_sources, fwhm, exp_time, image_params,
 # =============================================================================
 # Fitting of PSF
 # =============================================================================
+# Cache of padded residual tables, coordinate grids and shifted residuals used
+# by PSF_MODEL, keyed by the id of the residual table and the padded shape
+_psf_cache = {}
+
+# Number of residual tables to keep in the cache
+_psf_cache_size = 16
+
+# Number of shifted residuals kept for each residual table
+_psf_shift_cache_size = 512
+
+
+def clear_psf_cache():
+    '''
+    Clear the cache used by *PSF_MODEL*. This is only needed if a residual table
+    is changed in place after it has been used to evaluate a PSF model.
+
+    :return: None
+    :rtype: None
+
+    '''
+
+    _psf_cache.clear()
+
+    return
+
+
+def _residual_entry(r_table,pad_shape = None):
+    '''
+    Cached information for a residual table used by *PSF_MODEL*. The residual
+    table is padded to *pad_shape* (if given) and the coordinate grid for this
+    shape is built once. A reference to the residual table is kept so its id is
+    not reused while it is in the cache.
+
+    :param r_table: Residual table
+    :type r_table: 2D array
+    :param pad_shape: Shape to pad the residual table to, defaults to None
+    :type pad_shape: tuple, optional
+    :return: Dictionary containing the padded residual table (*residual*), coordinate grid (*grid*) and cache of shifted residuals (*shifts*)
+    :rtype: dict
+
+    '''
+
+    import numpy as np
+
+    if not (pad_shape is None):
+        pad_shape = tuple(int(i) for i in pad_shape)
+
+    key = (id(r_table),pad_shape)
+
+    entry = _psf_cache.get(key)
+
+    if entry is not None and entry['r_table'] is r_table:
+        return entry
+
+    residual = r_table
+
+    if not (pad_shape is None) and pad_shape != r_table.shape:
+
+        #  Need to make PSF fitting bigger
+        top =    int((pad_shape[0] - r_table.shape[0])/2)
+        bottom = int((pad_shape[0] - r_table.shape[0])/2)
+        left =   int((pad_shape[1] - r_table.shape[1])/2)
+        right =  int((pad_shape[1] - r_table.shape[1])/2)
+
+        residual = np.pad(r_table, [(top, bottom), (left, right)], mode='constant', constant_values=0)
+
+    x_rebin = np.arange(0,residual.shape[1])
+    y_rebin = np.arange(0,residual.shape[0])
+
+    entry = {'r_table':r_table,
+             'residual':residual,
+             'grid':np.meshgrid(x_rebin,y_rebin),
+             'shifts':{}}
+
+    if len(_psf_cache) >= _psf_cache_size:
+        _psf_cache.pop(next(iter(_psf_cache)))
+
+    _psf_cache[key] = entry
+
+    return entry
+
+
+def shift_residual(residual,y_roll,x_roll,regrid_size):
+    '''
+    Shift a residual table by a sub-pixel amount. This gives the same result as
+    blowing up the residual table by *regrid_size*, rolling it by *y_roll* and
+    *x_roll* pixels on this finer grid and rebinning it to its original shape,
+    without creating the larger array. Writing each roll as :math:`q \\times
+    regrid\\_size + p`, each pixel is a weighted sum of the pixels rolled by
+    :math:`q` and :math:`q+1`, with weights :math:`(regrid\\_size - p)/regrid\\_size`
+    and :math:`p/regrid\\_size`.
+
+    :param residual: Residual table
+    :type residual: 2D array
+    :param y_roll: Shift in y direction in units of the finer grid
+    :type y_roll: int
+    :param x_roll: Shift in x direction in units of the finer grid
+    :type x_roll: int
+    :param regrid_size: Zoom scale of finer grid
+    :type regrid_size: int
+    :return: Shifted residual table
+    :rtype: 2D array
+
+    '''
+
+    import numpy as np
+
+    qy,py = divmod(int(y_roll),int(regrid_size))
+    qx,px = divmod(int(x_roll),int(regrid_size))
+
+    # Shift in y direction
+    shifted = np.roll(residual,qy,axis = 0)
+    if py != 0:
+        shifted = ((regrid_size - py) * shifted + py * np.roll(shifted,1,axis = 0)) / regrid_size
+
+    # Shift in x direction
+    shifted = np.roll(shifted,qx,axis = 1)
+    if px != 0:
+        shifted = ((regrid_size - px) * shifted + px * np.roll(shifted,1,axis = 1)) / regrid_size
+
+    return shifted
+
+
+def _cached_shift(entry,y_roll,x_roll,regrid_size):
+    '''
+    Shifted residual table from the cache in *entry* (see *_residual_entry*),
+    computed with *shift_residual* if it isn't already cached.
+
+    :param entry: Cached information for a residual table
+    :type entry: dict
+    :param y_roll: Shift in y direction in units of the finer grid
+    :type y_roll: int
+    :param x_roll: Shift in x direction in units of the finer grid
+    :type x_roll: int
+    :param regrid_size: Zoom scale of finer grid
+    :type regrid_size: int
+    :return: Shifted residual table
+    :rtype: 2D array
+
+    '''
+
+    shift_key = (y_roll,x_roll,regrid_size)
+
+    residual_shifted = entry['shifts'].get(shift_key)
+
+    if residual_shifted is None:
+
+        residual_shifted = shift_residual(entry['residual'],y_roll,x_roll,regrid_size)
+
+        if len(entry['shifts']) >= _psf_shift_cache_size:
+            entry['shifts'].clear()
+
+        entry['shifts'][shift_key] = residual_shifted
+
+    return residual_shifted
+
+
 def PSF_MODEL(xc, yc, sky, H, r_table, fwhm,image_params,use_moffat = True,
               fitting_radius = 1.3,regrid_size =10 ,slice_scale = None,
               pad_shape = None):
@@ -654,50 +869,36 @@ def PSF_MODEL(xc, yc, sky, H, r_table, fwhm,image_params,use_moffat = True,
 
     import numpy as np
     from autophot.packages.functions import gauss_2d,moffat_2d
-    from autophot.packages.functions import scale_roll,rebin
-    
-    
-    fitting_radius = int(np.ceil(fitting_radius* fwhm))
-
-    try:
+    from autophot.packages.functions import scale_roll
 
-        psf_shape = r_table.shape
 
-        if not (pad_shape is None) and pad_shape != psf_shape:
-            
-            #  Need to make PSF fitting bigger
-            top =    int((pad_shape[0] - r_table.shape[0])/2)
-            bottom = int((pad_shape[0] - r_table.shape[0])/2)
-            left =   int((pad_shape[1] - r_table.shape[1])/2)
-            right =  int((pad_shape[1] - r_table.shape[1])/2)
+    fitting_radius = int(np.ceil(fitting_radius* fwhm))
 
-            psf_shape = pad_shape
+    try:
 
-            r_table = np.pad(r_table, [(top, bottom), (left, right)], mode='constant', constant_values=0)
+        # Padded residual table and coordinate grid are only built once per residual table
+        entry = _residual_entry(r_table,pad_shape)
 
-        x_rebin = np.arange(0,psf_shape[1])
-        y_rebin = np.arange(0,psf_shape[0])
+        r_table = entry['residual']
+        psf_shape = r_table.shape
 
-        xx_rebin,yy_rebin = np.meshgrid(x_rebin,y_rebin)
+        xx_rebin,yy_rebin = entry['grid']
 
         if use_moffat:
             core = moffat_2d((xx_rebin,yy_rebin),xc,yc,sky,H,image_params).reshape(psf_shape)
 
         else:
             core = gauss_2d((xx_rebin,yy_rebin),xc,yc,sky,H,image_params).reshape(psf_shape)
-        
-        # Blow up residual table to larger size
-        residual_rebinned = np.repeat(np.repeat(r_table, regrid_size, axis=0), regrid_size, axis=1)
 
         # scale roll = where you wana go,where you are
         x_roll = scale_roll(xc,r_table.shape[1]/2,regrid_size)
         y_roll = scale_roll(yc,r_table.shape[0]/2,regrid_size)
-        
-        # Roll in y direction then in x direction
-        residual_roll = np.roll(np.roll(residual_rebinned,y_roll,axis=0),x_roll,axis = 1)
 
-        # rebin and scale to high to PSF (fitted by analytical funcrion)
-        residual = H * rebin(residual_roll,psf_shape)
+        # Shifted residual table is cached for each sub-pixel shift
+        residual_shifted = _cached_shift(entry,y_roll,x_roll,regrid_size)
+
+        # scale to high to PSF (fitted by analytical funcrion)
+        residual = H * residual_shifted
 
         # add it all together
         psf =  sky  + (core + residual)
@@ -720,6 +921,186 @@ def PSF_MODEL(xc, yc, sky, H, r_table, fwhm,image_params,use_moffat = True,
     return psf
     
 
+# =============================================================================
+# Fit the PSF model to many sources at once
+# =============================================================================
+
+def fit_batch(stack, residual_table, fwhm, image_params, A_init, A_max,
+              use_moffat = True, fitting_radius = 7, regrid_size = 10,
+              hold_pos = False, dx = 1, max_iter = 100):
+    r'''
+    Fit the PSF model to a stack of background subtracted cutouts at the same
+    time. This gives the same fit as *fit* without needing a separate
+    minimization for each source.
+
+    If *hold_pos* is True, the model only has to be scaled and the amplitude of
+    every source is found by linear least squares. Otherwise the amplitude and
+    position of every source is found using *centroid.stack_lm*. The derivatives
+    of the analytical function are known exactly, while the derivative of the
+    residual table with respect to position is found from its shift by one
+    pixel on the finer grid in each direction.
+
+    :param stack: Stack of background subtracted cutouts with shape (N, 2*fitting_radius, 2*fitting_radius), centered on the residual table
+    :type stack: 3D array
+    :param residual_table: Residual image normalised to unity.
+    :type residual_table: 2D array
+    :param fwhm: Full Width Half Maximum of image
+    :type fwhm: float
+    :param image_params: Dictionary containing analytical model params. If a moffat is used, this dictionary should containing *alpha* and *beta* and their respective values, else if a gaussian is used, this dictionary should include *sigma* and its value.
+    :type image_params: dict
+    :param A_init: Initial amplitude of each source
+    :type A_init: array
+    :param A_max: Maximum amplitude of each source
+    :type A_max: array
+    :param use_moffat: If True, use a moffat function as the analytical function, else use a gaussian, defaults to True
+    :type use_moffat: bool, optional
+    :param fitting_radius: Half width of cutouts in pixels, defaults to 7
+    :type fitting_radius: int, optional
+    :param regrid_size: Zoom scale of increased pesudo-resoloution grid, defaults to 10
+    :type regrid_size: int, optional
+    :param hold_pos: If True, don't let the PSF model adjust its position, only it's amplitude, defaults to False
+    :type hold_pos: bool, optional
+    :param dx: Maximum distance in pixels the PSF model can move from the center of the cutout, defaults to 1
+    :type dx: float, optional
+    :param max_iter: Maximum number of iterations, defaults to 100
+    :type max_iter: int, optional
+    :return: Dataframe containing the fitted position (*x0*, *y0*) and amplitude (*A*) of each source in the coordinates of the residual table, the error on the amplitude (*A_err*), *chi2*, *redchi2* and *converged*
+    :rtype: Dataframe
+
+    '''
+
+    import numpy as np
+    import pandas as pd
+    from autophot.packages.functions import scale_roll
+    from autophot.packages.centroid import stack_model,stack_lm
+    from autophot.packages.kernels import model_kernel
+
+    n_sources = stack.shape[0]
+
+    entry = _residual_entry(residual_table)
+    r_table = entry['residual']
+
+    # Same slice as used by PSF_MODEL with slice_scale = fitting_radius
+    rows = slice(int(0.5*r_table.shape[1] - fitting_radius),int(0.5*r_table.shape[1] + fitting_radius))
+    cols = slice(int(0.5*r_table.shape[0] - fitting_radius),int(0.5*r_table.shape[0] + fitting_radius))
+
+    xx_sl,yy_sl = entry['grid']
+    xx_sl = xx_sl[rows,cols]
+    yy_sl = yy_sl[rows,cols]
+
+    kernel = model_kernel(xx_sl,yy_sl,use_moffat = use_moffat)
+
+    data = stack.reshape(n_sources,-1)
+    n_pixels = np.sum(np.isfinite(data),axis = 1)
+
+    if use_moffat:
+        width = image_params['alpha']
+        beta = image_params['beta']
+    else:
+        width = image_params['sigma']
+        beta = None
+
+    def residual_shifts(x0,y0):
+
+        shifted = np.empty(data.shape)
+        d_dx = np.empty(data.shape)
+        d_dy = np.empty(data.shape)
+
+        for i in range(len(x0)):
+
+            x_roll = scale_roll(x0[i],r_table.shape[1]/2,regrid_size)
+            y_roll = scale_roll(y0[i],r_table.shape[0]/2,regrid_size)
+
+            shifted[i] = _cached_shift(entry,y_roll,x_roll,regrid_size)[rows,cols].ravel()
+
+            # Central difference over one pixel on the finer grid
+            d_dx[i] = (_cached_shift(entry,y_roll,x_roll+1,regrid_size) - _cached_shift(entry,y_roll,x_roll-1,regrid_size))[rows,cols].ravel()
+            d_dy[i] = (_cached_shift(entry,y_roll+1,x_roll,regrid_size) - _cached_shift(entry,y_roll-1,x_roll,regrid_size))[rows,cols].ravel()
+
+        return shifted, 0.5 * regrid_size * d_dx, 0.5 * regrid_size * d_dy
+
+    def model(p):
+
+        core_params = np.column_stack([p[:,0],p[:,1],p[:,2],
+                                       np.zeros(len(p)),np.full(len(p),width)])
+
+        core,derivs = stack_model(xx_sl,yy_sl,core_params,
+                                  use_moffat = use_moffat,
+                                  beta = beta,
+                                  kernel = kernel)
+
+        shifted,d_dx,d_dy = residual_shifts(p[:,1],p[:,2])
+
+        A = p[:,0:1]
+
+        derivs = derivs[:,:,:3]
+        derivs[:,:,0] += shifted
+        derivs[:,:,1] += A * d_dx
+        derivs[:,:,2] += A * d_dy
+
+        return core + A * shifted, derivs
+
+    center = np.array([r_table.shape[1]/2,r_table.shape[0]/2])
+
+    params = np.column_stack([A_init,
+                              np.full(n_sources,center[0]),
+                              np.full(n_sources,center[1])])
+
+    lower = np.column_stack([np.full(n_sources,1e-9),
+                             np.full(n_sources,center[0] - dx),
+                             np.full(n_sources,center[1] - dx)])
+
+    upper = np.column_stack([A_max,
+                             np.full(n_sources,center[0] + dx),
+                             np.full(n_sources,center[1] + dx)])
+
+    if hold_pos:
+
+        # Amplitude only - linear least squares
+        unit = model(np.column_stack([np.ones(n_sources),params[:,1:]]))[0]
+
+        finite = np.isfinite(data)
+        unit = np.where(finite,unit,0)
+
+        UU = np.sum(unit**2,axis = 1)
+        UD = np.sum(unit*np.where(finite,data,0),axis = 1)
+
+        params[:,0] = np.clip(UD/UU,lower[:,0],upper[:,0])
+
+        cost = np.nansum((data - params[:,0:1]*unit)**2,axis = 1)
+        JTJ = UU[:,None,None]
+        converged = np.isfinite(params[:,0])
+        n_vary = 1
+
+    else:
+
+        params, converged, cost, JTJ = stack_lm(data,params,lower,upper,model,
+                                                max_iter = max_iter)
+        n_vary = 3
+
+    redchi2 = cost / np.maximum(n_pixels - n_vary,1)
+
+    # Error on amplitude from the covariance matrix, scaled by the reduced chi-squared
+    A_err = np.full(n_sources,np.nan)
+
+    good = np.isfinite(JTJ).all(axis = (1,2))
+
+    with np.errstate(all = 'ignore'):
+        try:
+            covar = np.linalg.pinv(JTJ[good])
+            A_err[good] = np.sqrt(covar[:,0,0] * redchi2[good])
+        except np.linalg.LinAlgError:
+            pass
+
+    return pd.DataFrame({'A':params[:,0],
+                         'A_err':A_err,
+                         'x0':params[:,1],
+                         'y0':params[:,2],
+                         'chi2':cost,
+                         'redchi2':redchi2,
+                         'converged':converged})
+
+
 # =============================================================================
 # Fit the PSF model
 # =============================================================================
@@ -732,17 +1113,22 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
         no_print = True, return_closeup = False, remove_bkg_local = True, 
         remove_bkg_surface = False, remove_bkg_poly = False,
         remove_bkg_poly_degree = 1, plot_PSF_residuals = False,
+        batch_fit = False, blend_fallback = True, frame_bkg = None,
         ):
     r'''
         
     Function to fit a given Point Spread Function (PSF) model to a point source located in an image.
     
+    If *batch_fit* is True, sources are fitted together using *fit_batch* rather than one at a time. Sources which can't be fitted this way (e.g. near the edge of the image, or if the fit does not converge) are fitted individually. Plots and subtraction images are made source by source, so if any of these are requested, every source is fitted individually.
+    
+    If *residual_table* is a *spatial_psf*, sources are grouped by the cell they fall in and each group is fitted with the residual table of that cell.
+    
     :param image: 2D array containing point sources
     :type image: 2D array
     :param sources: Dataframe containg *x_pix* and *y_pix* columns corrospsondong the the XY pixel location in an image
     :type sources: Dataframe
-    :param residual_table: Residual image normalised to unity.
-    :type residual_table: 2D array
+    :param residual_table: Residual image normalised to unity, or a spatially varying residual table
+    :type residual_table: 2D array or spatial_psf
     :param fwhm: Full Width Half Maximum of image
     :type fwhm: float
     :param fpath: Filepath of image. This is used to save plots and figures.
@@ -779,6 +1165,12 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
     :param remove_bkg_poly_degree: If remove_bkg_poly is True, this is the degree of the polynomial fitted to the image, 1 = flat surface, 2 = 2nd order polynomial etc, defaults to 1
     :param plot_PSF_residuals: If True, plot the residual images from the PSF fitting and subtraction and save them to a directory in *file\_path* called *psf\_subtractions*, defaults to False
     :type plot_PSF_residuals: Bool, optional
+    :param batch_fit: If True, fit all sources together using *fit_batch*. The FWHM is not fitted for these sources, so if *return_fwhm* is True, *target_fwhm* is nan unless some sources are fitted individually, defaults to False
+    :type batch_fit: bool, optional
+    :param blend_fallback: If True and *batch_fit* is True, sources which have another source within their fitting area are fitted individually, defaults to True
+    :type blend_fallback: bool, optional
+    :param frame_bkg: Background mesh of *image*. If given, the background surface of each source is interpolated from this mesh rather than fitted to each cutout, see *remove_background*, defaults to None
+    :type frame_bkg: background_mesh, optional
     :return: Return a dataframe containing information in the PSF fittings
     :rtype: Dataframe
     '''
@@ -788,7 +1180,6 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
     import numpy as np
     import pandas as pd
     import pathlib
-    import lmfit
     import logging
        
 
@@ -799,11 +1190,15 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
 
     import matplotlib.pyplot as plt
 
-    from autophot.packages.functions import gauss_2d,moffat_2d,moffat_fwhm,gauss_sigma2fwhm
+    from autophot.packages.functions import moffat_fwhm,gauss_sigma2fwhm
     from autophot.packages.functions import set_size,order_shift,border_msg
     from matplotlib.gridspec import  GridSpec
     
     from autophot.packages.background import remove_background
+    from autophot.packages.spatial_index import nearest_distance
+    from autophot.packages.kernels import model_kernel
+    from autophot.packages.fitter import fit_parameters,fit_kernel,lmfit_method
+    from autophot.packages.spatial_psf import spatial_psf
     
     import os
 
@@ -820,6 +1215,58 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
 
     logger = logging.getLogger(__name__)
     
+    if isinstance(residual_table,spatial_psf):
+        
+        # Fit the sources in each cell using the residual table of that cell
+        cells = residual_table.cell(sources.x_pix.values,sources.y_pix.values)
+        
+        cell_fits = []
+        
+        for cell in np.unique(cells):
+            
+            cell_fit = fit(image = image,
+                           sources = sources[cells == cell],
+                           residual_table = residual_table.cell_table(cell),
+                           fwhm = fwhm,
+                           fpath = fpath,
+                           fitting_radius = fitting_radius,
+                           regrid_size = regrid_size,
+                           bkg_level = bkg_level,
+                           sat_lvl = sat_lvl,
+                           use_moffat = use_moffat,
+                           image_params = image_params,
+                           fitting_method = fitting_method,
+                           save_plot = save_plot,
+                           show_plot = show_plot,
+                           remove_background_val = remove_background_val,
+                           hold_pos = hold_pos,
+                           return_fwhm = return_fwhm,
+                           return_subtraction_image = return_subtraction_image,
+                           no_print = no_print,
+                           return_closeup = return_closeup,
+                           remove_bkg_local = remove_bkg_local,
+                           remove_bkg_surface = remove_bkg_surface,
+                           remove_bkg_poly = remove_bkg_poly,
+                           remove_bkg_poly_degree = remove_bkg_poly_degree,
+                           plot_PSF_residuals = plot_PSF_residuals,
+                           batch_fit = batch_fit,
+                           blend_fallback = blend_fallback,
+                           frame_bkg = frame_bkg)
+            
+            if return_closeup:
+                cell_fit,source_base = cell_fit
+                
+            cell_fits.append(cell_fit)
+            
+        PSF_sources = pd.concat(cell_fits,axis = 0).loc[sources.index]
+        
+        if not return_closeup:
+            
+            return PSF_sources
+        
+        else:
+            
+            return PSF_sources,source_base
     
     fitting_radius = int(fitting_radius * fwhm)
 
@@ -905,10 +1352,123 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
     x_slice = np.arange(0,2*fitting_radius)
     
     xx_sl,yy_sl= np.meshgrid(x_slice,x_slice)
-
+    
+    # =============================================================================
+    # Fit sources together
+    # =============================================================================
+    
+    batch_params = []
+    batch_done = set()
+    
+    if batch_fit and not (return_subtraction_image or plot_PSF_residuals or save_plot or return_closeup):
+        
+        if not no_print:
+            print('Fitting PSF to %d sources together' % len(sources.index))
+        
+        x_all = sources.x_pix.values.astype(float)
+        y_all = sources.y_pix.values.astype(float)
+        
+        # Sources with a neighbour within their fitting area are fitted individually
+        if blend_fallback and len(x_all) > 1:
+            blended = nearest_distance(x_all,y_all) < 2 * fitting_radius
+        else:
+            blended = np.zeros(len(x_all),dtype = bool)
+                
+        batch_stack = []
+        batch_info = []
+        
+        for n,idx in enumerate(sources.index):
+            
+            if blended[n]:
+                continue
+            
+            xc_global = x_all[n]
+            yc_global = y_all[n]
+            
+            source_base = image[int(yc_global-lower_y_bound): int(yc_global + upper_y_bound),
+                                int(xc_global-lower_x_bound): int(xc_global + upper_x_bound)]
+            
+            if source_base.shape != residual_table.shape:
+                continue
+            
+            try:
+                
+                source_bkg_free, bkg_surface, bkg_median, noise = remove_background(source_base,
+                                                                                   remove_bkg_local = remove_bkg_local, 
+                                                                                   remove_bkg_surface = remove_bkg_surface,
+                                                                                   remove_bkg_poly   = remove_bkg_poly,
+                                                                                   remove_bkg_poly_degree = remove_bkg_poly_degree,
+                                                                                   bkg_level = bkg_level,
+                                                                                   frame_bkg = frame_bkg,
+                                                                                   origin = (int(xc_global-lower_x_bound),int(yc_global-lower_y_bound))
+                                                                                   )
+            except Exception:
+                continue
+            
+            source = source_bkg_free[int(0.5*source_bkg_free.shape[1] - fitting_radius):int(0.5*source_bkg_free.shape[1] + fitting_radius) ,
+                                     int(0.5*source_bkg_free.shape[0] - fitting_radius):int(0.5*source_bkg_free.shape[0] + fitting_radius) ]
+            
+            if source.shape != (int(2*fitting_radius),int(2*fitting_radius)) or np.sum(np.isnan(source)) == len(source):
+                continue
+            
+            batch_stack.append(source)
+            batch_info.append((n,idx,xc_global,yc_global,bkg_median,noise,
+                               np.nanmax(source),1.5*np.nanmax(source_bkg_free)))
+            
+        if len(batch_stack) > 0:
+            
+            max_pixels = np.array([i[6] for i in batch_info])
+            
+            batch_fitted = fit_batch(np.array(batch_stack),
+                                     residual_table = residual_table,
+                                     fwhm = fwhm,
+                                     image_params = image_params,
+                                     A_init = 0.75 * max_pixels,
+                                     A_max = np.array([i[7] for i in batch_info]),
+                                     use_moffat = use_moffat,
+                                     fitting_radius = fitting_radius,
+                                     regrid_size = regrid_size,
+                                     hold_pos = hold_pos,
+                                     dx = dx)
+            
+            for j,(n,idx,xc_global,yc_global,bkg_median,noise,max_pixel,_) in enumerate(batch_info):
+                
+                # Fits which did not converge are tried again individually
+                if not batch_fitted['converged'].values[j]:
+                    continue
+                
+                xc = batch_fitted['x0'].values[j]
+                yc = batch_fitted['y0'].values[j]
+                H_psf = batch_fitted['A'].values[j]
+                
+                x_fitted = xc - residual_table.shape[1]/2 + xc_global
+                y_fitted = yc - residual_table.shape[0]/2 + yc_global
+                
+                if not return_fwhm and H_psf+bkg_median >= sat_lvl:
+                    
+                    batch_params.append((idx,x_fitted,y_fitted) + (np.nan,)*9)
+                    
+                else:
+                    
+                    batch_params.append((idx,x_fitted,y_fitted,xc,yc,bkg_median,noise,H_psf,
+                                         batch_fitted['A_err'].values[j],max_pixel,
+                                         batch_fitted['chi2'].values[j],
+                                         batch_fitted['redchi2'].values[j]))
+                
+                batch_done.add(n)
+                
+        if return_fwhm:
+            # The FWHM is not fitted for sources fitted together
+            target_PSF_FWHM = np.nan
+                
+        if not no_print:
+            print('%d / %d sources fitted together' % (len(batch_done),len(sources.index)))
     
     for n  in range(len(sources.index)):
         
+        if n in batch_done:
+            continue
+        
         bkg_median = np.nan
         H = np.nan
         H_psf_err = np.nan
@@ -949,7 +1509,9 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
                                                                                    remove_bkg_surface = remove_bkg_surface,
                                                                                    remove_bkg_poly   = remove_bkg_poly,
                                                                                    remove_bkg_poly_degree = remove_bkg_poly_degree,
-                                                                                   bkg_level = bkg_level
+                                                                                   bkg_level = bkg_level,
+                                                                                   frame_bkg = frame_bkg,
+                                                                                   origin = (int(xc_global-lower_x_bound),int(yc_global-lower_y_bound))
                                                                                    )
                                                                                     
                 
@@ -997,7 +1559,7 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
                     result = psf_residual_model.fit(data = source,
                                                     params = psf_pars,
                                                     x = np.ones(source.shape),
-                                                    method = fitting_method,
+                                                    method = lmfit_method(fitting_method),
                                                     nan_policy = 'omit',
                                                     # weights = np.sqrt(abs(source))
                                                     )
@@ -1033,7 +1595,7 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
                 if return_fwhm:
 
                         
-                    pars = lmfit.Parameters()
+                    pars = fit_parameters()
                     pars.add('A',
                              value = H_psf,
                              max = 1.25*H_psf,
@@ -1071,16 +1633,11 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
                         
                         fitting_model_fwhm = moffat_fwhm
                         
-                        def residual(p):
-                            p = p.valuesdict()
-                            return (source  - moffat_2d((xx_sl,yy_sl),p['x0'],p['y0'],0,p['A'],dict(alpha=p['alpha'],beta=p['beta'])).reshape(source.shape)).flatten()
                     else:
                         
                         fitting_model_fwhm = gauss_sigma2fwhm
                         
-                        def residual(p):
-                            p = p.valuesdict()
-                            return (source - gauss_2d((xx_sl,yy_sl),p['x0'],p['y0'],0,p['A'],dict(sigma=p['sigma'])).reshape(source.shape)).flatten()
+                    analytic_kernel = model_kernel(xx_sl,yy_sl,use_moffat = use_moffat)
     
                                     
                     import warnings
@@ -1088,13 +1645,8 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
                         
                         warnings.simplefilter("ignore")
                         
-                        mini = lmfit.Minimizer(residual,
-                                               pars,
-                                               nan_policy = 'omit',
-                                               scale_covar=True)
-                        
-           
-                        result = mini.minimize(method = fitting_method )
+                        result = fit_kernel(analytic_kernel,source,pars,
+                                            method = fitting_method)
                         
 
                     # This needs to be in the scale of the closeup image and not the overall image
@@ -1102,9 +1654,9 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
                     FWHM_fitted_yc = result.params['y0'].value - fitting_radius + lower_y_bound
 
                     if use_moffat:
-                        target_PSF_FWHM = fitting_model_fwhm(dict(alpha=result.params['alpha'],beta=result.params['beta']))
+                        target_PSF_FWHM = fitting_model_fwhm(dict(alpha=result.params['alpha'].value,beta=result.params['beta'].value))
                     else:
-                        target_PSF_FWHM = fitting_model_fwhm(dict(sigma=result.params['sigma']))
+                        target_PSF_FWHM = fitting_model_fwhm(dict(sigma=result.params['sigma'].value))
     
                     # if not no_print:
                     #     logger.info('Target FWHM: %.3f [ pixels ]\n' % target_PSF_FWHM)
@@ -1462,6 +2014,12 @@ def fit(image, sources, residual_table, fwhm, fpath, fitting_radius = 1.3,
              continue
 
 
+    if len(batch_params) > 0:
+        
+        # Put sources back in their original order
+        position = {idx:n for n,idx in enumerate(sources.index)}
+        psf_params = sorted(psf_params + batch_params,key = lambda row: position[row[0]])
+
     new_df =  pd.DataFrame(psf_params,
                            columns = ('idx','x_fitted','y_fitted','x_closeup_fitted','y_closeup_fitted','bkg','noise','H_psf','H_psf_err','max_pixel','chi2','redchi2'),
                            index = sources.index)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Store of PSF models shared between images taken with the same telescope,
+instrument and filter on the same night.
+
+When a PSF model is built by *psf.build_r_table*, the residual table is saved
+as *PSF_residual_<base>.fits* in the same folder as the *PSF_model_<base>.fits*
+file, with the analytical model parameters and where the model came from
+written to the header. A small *json* entry pointing to this file is then
+written to the store directory, named by the telescope, instrument, filter,
+night and FWHM bin of the image. The night starts at local midday at the
+telescope site, so a night of observations from a single site has the same
+key. If the longitude of the site is not known, midday UTC is used.
+
+A later image with the same key looks up the closest entry in FWHM and checks
+the stored model by fitting it to a few bright sources in the image. If the
+model describes these sources well, it is used instead of building a new
+model, otherwise a new model is built and replaces the entry in the store.
+'''
+
+
+def night_of(mjd,longitude = None):
+    '''
+    Night of an observation, given as the integer MJD at the start of the
+    night. Nights run from local midday to midday at the telescope site, using
+    the mean solar time at *longitude*.
+
+    :param mjd: Modified Julian date of observation
+    :type mjd: float
+    :param longitude: Longitude of the telescope site in degrees, positive to the east, defaults to None in which case nights run from midday to midday UTC
+    :type longitude: float, optional
+    :return: Night of observation
+    :rtype: int
+
+    '''
+
+    import numpy as np
+
+    offset = 0 if longitude is None else float(longitude)/360
+
+    return int(np.floor(float(mjd) + offset - 0.5))
+
+
+def fwhm_bin(fwhm,fwhm_tol = 0.1):
+    '''
+    Logarithmic bin of the FWHM, where each bin has a fractional width of *fwhm_tol*.
+
+    :param fwhm: Full Width Half Maximum of image
+    :type fwhm: float
+    :param fwhm_tol: Fractional width of each bin, defaults to 0.1
+    :type fwhm_tol: float, optional
+    :return: Index of FWHM bin
+    :rtype: int
+
+    '''
+
+    import numpy as np
+
+    return int(np.round(np.log(fwhm)/np.log(1 + fwhm_tol)))
+
+
+def store_key(tele,inst,image_filter,mjd,longitude = None):
+    '''
+    Name shared by store entries of images taken with the same telescope,
+    instrument and filter on the same night. Characters that can't be used in a
+    file name are replaced with dashes.
+
+    :param tele: Name of telescope
+    :type tele: str
+    :param inst: Name of instrument
+    :type inst: str
+    :param image_filter: Name of filter
+    :type image_filter: str
+    :param mjd: Modified Julian date of observation
+    :type mjd: float
+    :param longitude: Longitude of the telescope site in degrees, positive to the east, defaults to None
+    :type longitude: float, optional
+    :return: Store key
+    :rtype: str
+
+    '''
+
+    import re
+
+    clean = [re.sub(r'[^A-Za-z0-9.+-]+','-',str(i)) for i in (tele,inst,image_filter)]
+
+    return '_'.join(clean + ['%d' % night_of(mjd,longitude)])
+
+
+def open_store(output_dir,store_dir = None):
+    '''
+    Location of the PSF store, created if it doesn't exist.
+
+    :param output_dir: Output directory e.g. *fits_dir* with *outdir_name* appended
+    :type output_dir: str
+    :param store_dir: Directory of the store, defaults to None in which case the folder *PSF_store* in *output_dir* is used
+    :type store_dir: str, optional
+    :return: Directory of the store
+    :rtype: str
+
+    '''
+
+    import os
+    import pathlib
+
+    if store_dir is None:
+        store_dir = os.path.join(output_dir,'PSF_store')
+
+    pathlib.Path(store_dir).mkdir(parents = True, exist_ok=True)
+
+    return store_dir
+
+
+def save_model(store_dir,fpath,r_table,image_params,fwhm,tele,inst,
+               image_filter,mjd,use_moffat = True,n_sources = None,
+               fwhm_tol = 0.1,longitude = None):
+    '''
+    Save a residual table to the folder containing *fpath* and add it to the
+    store. The entry is written to a temporary file first so an entry in the
+    store is always complete.
+
+    :param store_dir: Directory of the store
+    :type store_dir: str
+    :param fpath: File path of image the PSF model was built from
+    :type fpath: str
+    :param r_table: Residual table, normalised to unity
+    :type r_table: 2D array
+    :param image_params: Dictionary containing analytical model params
+    :type image_params: dict
+    :param fwhm: Full Width Half Maximum of image
+    :type fwhm: float
+    :param tele: Name of telescope
+    :type tele: str
+    :param inst: Name of instrument
+    :type inst: str
+    :param image_filter: Name of filter
+    :type image_filter: str
+    :param mjd: Modified Julian date of observation
+    :type mjd: float
+    :param use_moffat: If True, the analytical model is a moffat function, else it is a gaussian, defaults to True
+    :type use_moffat: bool, optional
+    :param n_sources: Number of sources used to build the PSF model, defaults to None
+    :type n_sources: int, optional
+    :param fwhm_tol: Fractional width of each FWHM bin, defaults to 0.1
+    :type fwhm_tol: float, optional
+    :param longitude: Longitude of the telescope site in degrees, positive to the east, used to find the night of observation, defaults to None
+    :type longitude: float, optional
+    :return: File path of saved residual table
+    :rtype: str
+
+    '''
+
+    import os
+    import json
+    import numpy as np
+    from astropy.io import fits
+    from autophot.packages.fits_io import write_fits
+
+    base = os.path.splitext(os.path.basename(fpath))[0]
+    table_fpath = os.path.join(os.path.dirname(fpath),'PSF_residual_'+base+'.fits')
+
+    image_params = {key:float(value) for key,value in image_params.items()}
+
+    header = fits.Header()
+    header['TELESCOP'] = str(tele)
+    header['INSTRUME'] = str(inst)
+    header['FILTER'] = str(image_filter)
+    header['MJD'] = float(mjd)
+    header['FWHM'] = (float(fwhm),'FWHM of image [pixels]')
+    header['USEMOFF'] = (bool(use_moffat),'Analytical model is a moffat function')
+    for key,value in image_params.items():
+        header[key.upper()[:8]] = (value,'Analytical model parameter')
+    if n_sources is not None:
+        header['NSOURCES'] = (int(n_sources),'Number of sources used in PSF model')
+
+    write_fits(table_fpath,np.asarray(r_table,dtype = float),header)
+
+    entry = {'tele':str(tele),
+             'inst':str(inst),
+             'filter':str(image_filter),
+             'mjd':float(mjd),
+             'fwhm':float(fwhm),
+             'use_moffat':bool(use_moffat),
+             'shape':list(np.shape(r_table)),
+             'image_params':image_params,
+             'n_sources':None if n_sources is None else int(n_sources),
+             'fpath':table_fpath}
+
+    entry_fpath = os.path.join(store_dir,'%s_%d.json' % (store_key(tele,inst,image_filter,mjd,longitude),fwhm_bin(fwhm,fwhm_tol)))
+    tmp_fpath = entry_fpath + '.%d.tmp' % os.getpid()
+
+    with open(tmp_fpath,'w') as f:
+        json.dump(entry,f)
+    os.replace(tmp_fpath,entry_fpath)
+
+    return table_fpath
+
+
+def find_model(store_dir,fwhm,tele,inst,image_filter,mjd,shape,
+               use_moffat = True,fwhm_tol = 0.1,longitude = None):
+    '''
+    Find the stored PSF model closest in FWHM to the current image. Only models
+    with the same key, the same analytical model and residual table shape and
+    a FWHM within *fwhm_tol* of the current image are considered.
+
+    :param store_dir: Directory of the store
+    :type store_dir: str
+    :param fwhm: Full Width Half Maximum of image
+    :type fwhm: float
+    :param tele: Name of telescope
+    :type tele: str
+    :param inst: Name of instrument
+    :type inst: str
+    :param image_filter: Name of filter
+    :type image_filter: str
+    :param mjd: Modified Julian date of observation
+    :type mjd: float
+    :param shape: Shape of the residual table needed
+    :type shape: tuple
+    :param use_moffat: If True, the analytical model is a moffat function, else it is a gaussian, defaults to True
+    :type use_moffat: bool, optional
+    :param fwhm_tol: Largest fractional difference in FWHM allowed, defaults to 0.1
+    :type fwhm_tol: float, optional
+    :param longitude: Longitude of the telescope site in degrees, positive to the east, used to find the night of observation, defaults to None
+    :type longitude: float, optional
+    :return: Store entry with the residual table given by *r_table*, or None if no model is found
+    :rtype: dict
+
+    '''
+
+    import os
+    import json
+    import logging
+    import numpy as np
+    from astropy.io import fits
+
+    logger = logging.getLogger(__name__)
+
+    key = store_key(tele,inst,image_filter,mjd,longitude)
+    fwhm_idx = fwhm_bin(fwhm,fwhm_tol)
+
+    best = None
+
+    # Neighbouring bins may contain models within the tolerance
+    for idx in [fwhm_idx,fwhm_idx-1,fwhm_idx+1]:
+
+        entry_fpath = os.path.join(store_dir,'%s_%d.json' % (key,idx))
+
+        if not os.path.isfile(entry_fpath):
+            continue
+
+        try:
+            with open(entry_fpath,'r') as f:
+                entry = json.load(f)
+        except Exception:
+            continue
+
+        if entry['use_moffat'] != use_moffat or tuple(entry['shape']) != tuple(shape):
+            continue
+
+        diff = abs(entry['fwhm'] - fwhm)/fwhm
+
+        if diff > fwhm_tol:
+            continue
+
+        if best is None or diff < best[0] or (diff == best[0] and abs(entry['mjd']-mjd) < abs(best[1]['mjd']-mjd)):
+            best = (diff,entry)
+
+    if best is None:
+        return None
+
+    entry = best[1]
+
+    try:
+        entry['r_table'] = np.asarray(fits.getdata(entry['fpath']),dtype = float)
+    except Exception as e:
+        logger.info('Could not load stored PSF model %s: %s' % (entry['fpath'],e))
+        return None
+
+    return entry
+
+
+def check_model(image,sources,entry,fwhm,fpath,n_sources = 10,min_sources = 3,
+                residual_tol = 0.05,**fit_kwargs):
+    '''
+    Check a stored PSF model by fitting it to the brightest sources in the
+    image using *psf.fit*. The residual of each fit is given by the root mean
+    square difference between the source and the fitted model, relative to the
+    fitted amplitude. The model is accepted if at least *min_sources* sources
+    are fitted and their median residual is less than *residual_tol*.
+
+    :param image: 2D array containing sources
+    :type image: 2D array
+    :param sources: Dataframe containing *x_pix*, *y_pix* and *counts_ap* columns of sources that may be used for the PSF model
+    :type sources: Dataframe
+    :param entry: Store entry returned by *find_model*
+    :type entry: dict
+    :param fwhm: Full Width Half Maximum of image
+    :type fwhm: float
+    :param fpath: File path of image
+    :type fpath: str
+    :param n_sources: Number of sources to fit, defaults to 10
+    :type n_sources: int, optional
+    :param min_sources: Minimum number of sources that must be fitted, defaults to 3
+    :type min_sources: int, optional
+    :param residual_tol: Largest median residual allowed, defaults to 0.05
+    :type residual_tol: float, optional
+    :param fit_kwargs: Keywords passed to *psf.fit*
+    :return: True if the model is accepted, and the fitted sources, which can be given to *psf.do*
+    :rtype: tuple
+
+    '''
+
+    import logging
+    import numpy as np
+    from autophot.packages.psf import fit
+
+    logger = logging.getLogger(__name__)
+
+    if 'FWHM' in sources:
+        sources = sources[np.isfinite(sources['FWHM'])]
+
+    for col in ['include_fwhm','include_median']:
+        if col in sources and np.sum(sources[col]) > 10:
+            sources = sources[sources[col].astype(bool)]
+
+    if 'counts_ap' in sources:
+        sources = sources.sort_values(by = 'counts_ap',ascending = False)
+
+    sources = sources.head(n_sources)
+
+    if len(sources) < min_sources:
+        return False, None
+
+    fitted_sources = fit(image = image,
+                         sources = sources,
+                         residual_table = entry['r_table'],
+                         fwhm = fwhm,
+                         fpath = fpath,
+                         image_params = entry['image_params'],
+                         use_moffat = entry['use_moffat'],
+                         **fit_kwargs)
+
+    with np.errstate(all = 'ignore'):
+        residual = np.sqrt(fitted_sources['redchi2'].values.astype(float))/fitted_sources['H_psf'].values.astype(float)
+
+    good = np.isfinite(residual) & (fitted_sources['H_psf'].values > 0)
+
+    if np.sum(good) < min_sources:
+        logger.info('Stored PSF model: only %d sources fitted' % np.sum(good))
+        return False, None
+
+    median_residual = np.nanmedian(residual[good])
+
+    logger.info('Stored PSF model: median residual %.3f from %d sources' % (median_residual,np.sum(good)))
+
+    if median_residual > residual_tol:
+        return False, None
+
+    return True, fitted_sources[good]
@@ -59,10 +59,15 @@ def run_autophot(autophot_input):
     import sys
     import pathlib
     import pandas as pd
-    import numpy as np
     from functools import reduce
     import logging
     from autophot.packages.functions import border_msg
+    from autophot.packages.manifest import manifest_fpath,config_hash,file_signature
+    from autophot.packages.manifest import load_manifest,update_manifest,is_complete
+    from autophot.packages.output_table import append_output,write_columnar
+    from autophot.packages.template_manifest import template_manifest_fpath,template_config_hash
+    from autophot.packages.template_manifest import template_groups,template_status,print_template_status
+    from autophot.packages.template_manifest import psf_model_fpath
 
 
     logger = logging.getLogger(__name__)
@@ -88,6 +93,9 @@ def run_autophot(autophot_input):
         base_dir = os.path.basename(autophot_input['fits_dir']).replace(new_dir,'')
         work_loc = base_dir + new_dir
 
+        # Output directory e.g. fits_dir_REDUCED
+        new_output_dir = os.path.join(os.path.dirname(autophot_input['fits_dir']),work_loc)
+
         work_fpath = os.path.join(autophot_input['fits_dir'],work_loc)
         pathlib.Path(os.path.dirname(work_fpath)).mkdir(parents = True, exist_ok=True)
         os.chdir(os.path.dirname(work_fpath))
@@ -121,73 +129,116 @@ def run_autophot(autophot_input):
 
     files_completed = False
 
-    if autophot_input['restart'] and not autophot_input['template_subtraction']['prepare_templates']:
-
-        # Pick up where left out in output folder
-        flist_before = []
-
-        for i in flist:
-
-            path, file = os.path.split(i)
-
-            file_nodots,file_ext = os.path.splitext(file)
-
-            # remove dots and replace with underscores while ignoring extension
-            file_nodots = file_nodots.replace('.','_')
+    if not autophot_input['template_subtraction']['prepare_templates']:
 
-            file = file_nodots + file_ext
+        # Resume manifest - each image is recorded here once it has finished
+        pathlib.Path(new_output_dir).mkdir(parents = True, exist_ok=True)
+        manifest_loc = manifest_fpath(new_output_dir)
+        input_config = config_hash(autophot_input)
 
-            clean_path = os.path.join(path, file).replace('_APT','').replace(' ','_').replace('_'+autophot_input['outdir_name'],'')
+        # Signature of each input file, filled in as they are needed
+        flist_signatures = {}
 
-            clean_path_split = list(clean_path.split('/'))
+        def get_signature(fpath):
+            if fpath not in flist_signatures:
+                flist_signatures[fpath] = file_signature(fpath,use_hash = autophot_input['restart_use_hash'])
+            return flist_signatures[fpath]
 
-            sub_dirs = list(dict.fromkeys([i.replace(file_ext,'') for i in clean_path_split]))
-            clean_path = '/'.join(sub_dirs)
-            clean_fpath = os.path.join(clean_path,file.replace('_APT',''))
+        # Output csv file - each image is appended as soon as it finishes
+        outcsv_loc = os.path.join(new_output_dir,str(autophot_input['outcsv_name'])+'.csv')
 
-            flist_before.append(clean_fpath)
+        def record_output(fpath,out):
+            if out[0] is not None:
+                try:
+                    append_output(outcsv_loc,out[0])
+                except Exception as e:
+                    exc_type, exc_obj, exc_tb = sys.exc_info()
+                    fname1 = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    print(exc_type, fname1, exc_tb.tb_lineno,e)
+                    print('Could not write output of %s to %s' % (fpath,outcsv_loc))
+                    out = (None,fpath)
+            record_manifest(fpath,out)
+
+        def record_manifest(fpath,out):
+            try:
+                if out[0] is None:
+                    update_manifest(manifest_loc,fpath,get_signature(fpath),input_config,'failed')
+                else:
+                    update_manifest(manifest_loc,fpath,get_signature(fpath),input_config,'done',
+                                    output_fpath = out[0]['fname'])
+            except Exception as e:
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                fname1 = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                print(exc_type, fname1, exc_tb.tb_lineno,e)
+                print('Could not update restart manifest for %s' % fpath)
 
+    if autophot_input['template_subtraction']['prepare_templates']:
 
-        len_before = len(flist)
+        # Template manifest - each template is recorded here once it has been prepared
+        template_manifest_loc = template_manifest_fpath(template_loc)
+        template_config = template_config_hash(autophot_input)
 
-        print('\nRestarting - checking for files already completed in:\n%s' % (autophot_input['fits_dir']+'_'+autophot_input['outdir_name']).replace(' ',''))
+        def record_template(fpath,out):
+            try:
+                # Templates are overwritten when prepared - record the signature of the prepared file
+                if out is None or out[0] is None:
+                    update_manifest(template_manifest_loc,fpath,
+                                    file_signature(fpath,use_hash = autophot_input['restart_use_hash']),
+                                    template_config,'failed')
+                else:
+                    update_manifest(template_manifest_loc,fpath,
+                                    file_signature(fpath,use_hash = autophot_input['restart_use_hash']),
+                                    template_config,'done',
+                                    output_fpath = psf_model_fpath(fpath))
+            except Exception as e:
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                fname1 = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                print(exc_type, fname1, exc_tb.tb_lineno,e)
+                print('Could not update template manifest for %s' % fpath)
 
-        flist_restart = []
+        status = template_status(flist,load_manifest(template_manifest_loc),template_config,
+                                 use_hash = autophot_input['restart_use_hash'])
 
-        ending = '_'+autophot_input['outdir_name']
+        print_template_status(status)
 
-        output_folder = autophot_input['fits_dir']+ending
+        if not autophot_input['template_subtraction']['prepare_templates_redo']:
 
-         #Look in output directory e..g REDUCED folder
-        for root, dirs, files in os.walk(output_folder.replace(' ','')):
+            len_before = len(flist)
 
-            for fname in files:
+            # Only prepare templates that are new, changed or failed last time
+            flist = list(status['fpath'][status['status'] != 'done'])
 
-                if '_APT.f' in fname:
+            files_completed = len_before - len(flist)
 
-                    if os.path.isfile(os.path.join(root, fname)) and os.path.isfile(os.path.join(root,'out.csv')):
+            files_removed += files_completed
 
+    if autophot_input['restart'] and not autophot_input['template_subtraction']['prepare_templates']:
 
-                        dirpath_clean_up = os.path.join(root, fname).replace(ending,'')
+        # Pick up where left out using the manifest in the output folder
+        print('\nRestarting - checking for files already completed in:\n%s' % manifest_loc)
 
-                        path,file = os.path.split(dirpath_clean_up)
+        manifest = load_manifest(manifest_loc)
 
-                        clean_path = path.split('/')
+        if len(manifest) == 0:
 
-                        clean_path_new = '/'.join(clean_path) + '/'+file
+            print('No ouput files found - skipping ')
 
+        else:
 
-                        flist_restart.append(clean_path_new.replace('_APT','').replace(' ','_').replace('_'+autophot_input['outdir_name'],''))
+            len_before = len(flist)
 
-        if len(flist_before) == 0:
+            flist_redo = []
+            redo_reason = {'new':0,'failed':0,'modified':0,'config':0}
 
-            print('No ouput files found - skipping ')
+            for i in flist:
 
-        else:
+                complete, reason = is_complete(manifest,i,get_signature(i),input_config)
 
-            flist_bool = [False if f in flist_restart else True for f in flist_before]
+                if not complete:
+                    flist_redo.append(i)
+                    redo_reason[reason]+=1
 
-            flist = list(np.array(flist)[np.array(flist_bool)])
+            flist = flist_redo
 
             len_after = len(flist)
 
@@ -197,6 +248,13 @@ def run_autophot(autophot_input):
 
             print('\nFiles already done: %d' %  files_completed)
 
+            if redo_reason['failed']:
+                print('Files previously failed - redoing: %d' % redo_reason['failed'])
+            if redo_reason['modified']:
+                print('Files modified since last run - redoing: %d' % redo_reason['modified'])
+            if redo_reason['config']:
+                print('Files with updated input commands - redoing: %d' % redo_reason['config'])
+
             files_removed += len_before - len_after
 
     # Go through files, check if I have their details
@@ -466,7 +524,8 @@ def run_autophot(autophot_input):
         print('Preparing Template Files')
         print('------------------------')
 
-
+    if autophot_input['method'] not in ['sp','mp']:
+        raise Exception('Unknown method: %s - please use sp or mp' % autophot_input['method'])
 
     if autophot_input['method'] == 'sp':
         import gc
@@ -484,160 +543,254 @@ def run_autophot(autophot_input):
             out = main(TNS_response,autophot_input,i)
             gc.collect()
 
+            if not autophot_input['template_subtraction']['prepare_templates']:
+                record_output(i,out)
+            else:
+                record_template(i,out)
+
             # Append to output list
             sp_output.append(out)
 
-        if not autophot_input['template_subtraction']['prepare_templates']:
-            # Create new output csv file
-            with open(str(autophot_input['outcsv_name'])+'.csv', 'a'): pass
-
-            # Successful files
-            sp_output_data = [x[0] for x in sp_output if x[0] is not None]
+    # =============================================================================
+    #  Parallelism execution - each file is sent to a worker process
+    # =============================================================================
 
-            # Files that failed
-            output_total_fail = [x[1] for x in sp_output if x[0] is None]
+    if autophot_input['method'] == 'mp':
 
-            print('\n---')
-            print('\nFiles that failed :',output_total_fail)
+        import multiprocessing
+        import signal
+        from functools import partial
+        from tqdm import tqdm
 
-            # failurefile = os.path.join(autophot_input['write_dir'],)
+        nCPU = autophot_input['nCPU']
+        if nCPU is None:
+            nCPU = multiprocessing.cpu_count()
 
-            if len(output_total_fail)!=0:
-                with open('FailedFiles.dat', 'w') as f:
-                    for fail in output_total_fail:
-                        f.write('> %s\n' % fail)
+        if autophot_input['template_subtraction']['prepare_templates']:
 
-            '''
-            Dataframe of output parameters from recent instance of AutoPhOT
+            # Templates in the same folder write to the same files - each
+            # worker prepares every template in a single folder (filter)
+            tasks = template_groups(flist)
 
-            - will be concatinated with any previous excuted output files
-            '''
-            new_entry = pd.DataFrame(sp_output_data)
-            new_entry = new_entry.applymap(lambda x: x if isinstance(x, list) else x )
+            func = partial(run_templates_mp,
+                           object_info = TNS_response,
+                           autophot_input = autophot_input,
+                           timeout = autophot_input['mp_timeout'])
 
         else:
 
-            print('\n------------------------------------------------------------')
-            print('Templates ready - Please check to make sure they are correct')
-            print("set 'prepare_templates' to False and execute")
-            print('------------------------------------------------------------')
+            tasks = flist
 
-        if not autophot_input['template_subtraction']['prepare_templates']:
-            # Try to open an pre-existing data, if not make a new one
-            try:
-                data = pd.read_csv(str(autophot_input['outcsv_name']+'.csv'))
-                update_data = pd.concat([data,new_entry],axis = 0,sort = False,ignore_index = True)
-            except:
-                update_data = new_entry
+            func = partial(run_main_mp,
+                           object_info = TNS_response,
+                           autophot_input = autophot_input,
+                           timeout = autophot_input['mp_timeout'])
 
+        # Don't spin up more workers than there are tasks
+        nCPU = int(max(1,min(nCPU,multiprocessing.cpu_count(),len(tasks))))
 
-            update_data.to_csv(autophot_input['outcsv_name']+'.csv',index = False)
+        print('\nRunning on %d files with %d worker(s)' % (len(flist),nCPU))
+        if autophot_input['mp_timeout'] is not None:
+            print('Timeout per file: %.1f [s]' % autophot_input['mp_timeout'])
 
+        # Workers ignore keyboard interrupts - only the parent process handles them
+        original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-        print('\nDONE')
+        pool = multiprocessing.Pool(processes = nCPU)
 
-        return
+        signal.signal(signal.SIGINT, original_sigint_handler)
 
-    # =============================================================================
-    #  Parallelism execution - work in progress - doesn't work right now
-    # =============================================================================
+        sp_output = []
 
-    if autophot_input['method'] == 'mp':
-        raise Exception('This is untested - please using method == sp for the time ebing')
+        try:
 
-        import multiprocessing
+            # imap keeps the output in the same order as flist, chunksize of 1
+            # as each file is a long task and we want the workload balanced
+            for n,out in enumerate(tqdm(pool.imap(func, tasks, chunksize = 1), total=len(tasks))):
 
-        import os
-        import signal
-        from functools import partial
-        from tqdm import tqdm
+                if autophot_input['template_subtraction']['prepare_templates']:
+                    for fpath,template_out in zip(tasks[n],out):
+                        record_template(fpath,template_out)
+                    sp_output+=out
+                    continue
 
-        def main_mp():
+                sp_output.append(out)
 
+                record_output(flist[n],out)
 
+            pool.close()
 
-            original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        except KeyboardInterrupt:
+            print('Early Termination')
+            pool.terminate()
 
-            pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+        except Exception as e:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            fname1 = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+            print(exc_type, fname1, exc_tb.tb_lineno,e)
+            pool.terminate()
 
-            signal.signal(signal.SIGINT, original_sigint_handler)
+        pool.join()
 
-            func = partial(main, TNS_response, autophot_input)
+    if not autophot_input['template_subtraction']['prepare_templates']:
 
-            chunksize, extra = divmod(len(flist) , 4 * multiprocessing.cpu_count())
-            if extra:
-                chunksize += 1
+        # Workers change their own working directory - write the output to the
+        # output directory rather than whereever the last file left us
+        pathlib.Path(new_output_dir).mkdir(parents = True, exist_ok=True)
+        os.chdir(new_output_dir)
 
-            print('\n'+'Chunksize:' ,chunksize)
+        # Files that failed
+        output_total_fail = [x[1] for x in sp_output if x[0] is None]
 
-            mp_output = []
-            try:
-                try:
-                    for n in tqdm(pool.imap_unordered(func, flist,chunksize = chunksize), total=len(flist)):
-                        mp_output.append(n)
-                        pass
-
-                except KeyboardInterrupt:
-                    print('Early Termination')
-                    print(pool._pool)
-                    pool.terminate()
-
-                    for p in pool._pool:
-                       if p.exitcode is None:
-                           p.terminate()
-            except Exception as e:
+        print('\n---')
+        print('\nFiles that failed :',output_total_fail)
 
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname1 = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                print(exc_type, fname1, exc_tb.tb_lineno,e)
+        if len(output_total_fail)!=0:
+            with open('FailedFiles.dat', 'w') as f:
+                for fail in output_total_fail:
+                    f.write('> %s\n' % fail)
 
-            pool.close()
-            pool.join()
+        # Output of each image has already been appended to the output csv file
+        # as it finished - optionally write a columnar copy for faster loading
+        if autophot_input['output_columnar'] is not None and os.path.isfile(outcsv_loc):
+            columnar_loc = write_columnar(outcsv_loc,autophot_input['output_columnar'])
+            if columnar_loc is not None:
+                print('\nColumnar output file:\n%s' % columnar_loc)
 
-            for p in pool._pool:
-               if p.exitcode is None:
-                   p.terminate()
+    else:
 
-            with open(str(autophot_input['outcsv_name'])+'.csv', 'a'):
-                    pass
+        status = template_status(list(status['fpath']),load_manifest(template_manifest_loc),template_config,
+                                 use_hash = autophot_input['restart_use_hash'])
 
-            mp_output_data = [x[0] for x in mp_output if x[0] is not None]
+        print_template_status(status)
 
-            output_total_fail = [[x[1] for x in mp_output if x[0] is None]]
+        status.to_csv(os.path.join(template_loc,'template_status.csv'),index = False)
 
-            print('\nTotal failure :',output_total_fail)
+        print('\n------------------------------------------------------------')
+        print('Templates ready - Please check to make sure they are correct')
+        print("set 'prepare_templates' to False and execute")
+        print('------------------------------------------------------------')
 
-            new_entry = pd.DataFrame(mp_output_data)
-            new_entry = new_entry.applymap(lambda x: x if isinstance(x, list) else x )
 
-            try:
-                data = pd.read_csv(str(autophot_input['outcsv_name']+'.csv'),error_bad_lines=False)
-                update_data = pd.concat([data,new_entry],axis = 0,sort = False,ignore_index = True)
-            except pd.io.common.EmptyDataError:
-                update_data = new_entry
-                pass
+    print('\nDONE')
 
+    return
 
-            try:
-                update_data.to_csv(str(autophot_input['outcsv_name']+'.csv'),index = False)
-            except Exception as e:
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname1 = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                print(exc_type, fname1, exc_tb.tb_lineno,e)
-                print('CANNOT UPDATE OUTPUT CSV')
 
-            print()
-            print('DONE')
-            return
-        main_mp()
+class MainTimeoutError(BaseException):
+    '''
+    Raised inside a worker process when a single file exceeds *mp_timeout*.
+    This inherits from BaseException so it is not swallowed by the
+    *except Exception* blocks found throughout *main*.
+    '''
+    pass
+
+
+def run_main_mp(fpath,object_info,autophot_input,timeout = None):
+    '''
+    Wrapper around *main* used by the worker processes when *method* is set to
+    *mp*. Each call works on a copy of the input dictionary, so the
+    *write_dir*, *fpath* and working directory set by *main* are local to that
+    worker. If a *timeout* is given, the file is abandoned once this time has
+    passed, any external programs still running for it are stopped, and it is
+    returned as a failed file. Any other error is also returned as a failed
+    file so the remaining files are still reduced.
+
+    :param fpath: File path for *FITS* image
+    :type fpath: str
+    :param object_info: Dictionary containing transient coordinates
+    :type object_info: dict
+    :param autophot_input: Main AutoPHOT command dictionary
+    :type autophot_input: dict
+    :param timeout: Maximum time in seconds allowed for this file, defaults to None
+    :type timeout: float, optional
+    :return: Tuple of output dictionary (or None if failed) and file path, the same as *main*
+    :rtype: tuple
+
+    '''
+
+    import os
+    import copy
+    import signal
+    import logging
+    from autophot.packages.main import main
+    from autophot.packages.functions import kill_processes
+
+    # Timeouts rely on SIGALRM which is only available on unix systems
+    use_alarm = timeout is not None and hasattr(signal,'SIGALRM')
+
+    def timeout_handler(signum, frame):
+        # Keep firing until we are out of any bare except statements in main
+        signal.alarm(1)
+        raise MainTimeoutError('%s exceeded timeout of %.1f [s]' % (os.path.basename(fpath),timeout))
+
+    if use_alarm:
+        signal.signal(signal.SIGALRM, timeout_handler)
+        signal.alarm(max(1,int(round(timeout))))
+
+    try:
+
+        out = main(object_info,copy.deepcopy(autophot_input),fpath)
+
+    except MainTimeoutError as e:
+
+        signal.alarm(0)
+        logging.critical('Failure: %s' % e)
+        out = (None,fpath)
+
+        # Stop solve-field/HOTPANTS if they were still running for this file
+        if kill_processes():
+            logging.info('Stopped external programs still running for %s' % os.path.basename(fpath))
+
+    except Exception as e:
 
+        # Don't let one file end the pool - record it as failed and move on
+        logging.exception(e)
+        logging.critical('Failure: %s' % os.path.basename(fpath))
+        out = (None,fpath)
 
+        kill_processes()
 
+    finally:
+
+        if use_alarm:
+            signal.alarm(0)
+
+    # main can return None when preparing templates
+    if out is None:
+        out = (None,fpath)
+
+    return out
+
+
+
+def run_templates_mp(fpaths,object_info,autophot_input,timeout = None):
+    '''
+    Wrapper around *run_main_mp* used by the worker processes when preparing
+    templates with *method* set to *mp*. Templates in the same folder write to
+    the same files, so each worker is given every template in a single folder
+    and prepares them one after the other.
+
+    :param fpaths: File paths of templates in a single folder
+    :type fpaths: list
+    :param object_info: Dictionary containing transient coordinates
+    :type object_info: dict
+    :param autophot_input: Main AutoPHOT command dictionary
+    :type autophot_input: dict
+    :param timeout: Maximum time in seconds allowed for each template, defaults to None
+    :type timeout: float, optional
+    :return: List of tuples given by *run_main_mp*, one for each template
+    :rtype: list
+
+    '''
+
+    return [run_main_mp(fpath,object_info,autophot_input,timeout = timeout) for fpath in fpaths]
 
 
 
 def recover(fits_dir,outdir_name='REDUCED',outcsv_name='REDUCED',
-            infile_name = 'out.csv',update_fpath = True,print_msg = True):
+            infile_name = 'out.csv',update_fpath = True,print_msg = True,
+            timing_summary = True,output_columnar = None):
     '''
     
             Iterate through output folder given by *fits_dir* and *outdir_name*, search for files corresponding to *outfile_name* and concatenate into a single file named *outcsv_name*
@@ -654,6 +807,10 @@ def recover(fits_dir,outdir_name='REDUCED',outcsv_name='REDUCED',
     :type update_fpath: bool, optional
     :param print_msg: If True print a message saying that the script is working, defaults to True
     :type print_msg: bool, optional
+    :param timing_summary: If True, summarise the time (*t_* columns) and peak memory (*mem_* columns) of each stage across all images and save this to a file named *outcsv_name* with *_timing* appended, defaults to True
+    :type timing_summary: bool, optional
+    :param output_columnar: If set to *parquet* or *feather*, also write a columnar copy of *outcsv_name* for faster loading, defaults to None
+    :type output_columnar: str, optional
     :return: Produces an output csv file with the name given by *outcsv_name* in the directory given by *fits_dir* with *outdir_name* appended onto it.
     :rtype: TYPE
     
@@ -665,7 +822,8 @@ def recover(fits_dir,outdir_name='REDUCED',outcsv_name='REDUCED',
     import pandas as pd
     import os,sys
     from autophot.packages.functions import border_msg
-    
+    from autophot.packages.output_table import write_columnar
+
     if print_msg:
         border_msg('Recovering output files')
 
@@ -688,25 +846,25 @@ def recover(fits_dir,outdir_name='REDUCED',outcsv_name='REDUCED',
         print('Recovering Output from %s...' % recover_dir)
     
     for root, dirs, files in os.walk(recover_dir):
-        for fname in files:
-            if fname.endswith((".fits",'.fit','.fts','fits.fz')):
-
-
-                if os.path.isfile(os.path.join(root, infile_name)):
-                    csv = pd.read_csv(os.path.join(root, infile_name))
-                    
-                    if update_fpath:
-                        old_fpath = csv['fname'].values[0]
-                        image_fname = os.path.basename(old_fpath)
-                        new_fpath = os.path.join(root,image_fname)
-                        csv['fname'] = new_fpath
-                        
-                    csv_recover.append(csv)
-                
 
-                else:
-                    # print('No output found for: %s' % fname)
-                    pass
+        # Each output folder has a single output file - only read it once
+        # regardless of how many images are in the folder
+        if infile_name not in files:
+            continue
+
+        if not any(fname.endswith((".fits",'.fit','.fts','fits.fz')) for fname in files):
+            continue
+
+        csv = pd.read_csv(os.path.join(root, infile_name))
+
+        if update_fpath:
+            old_fpath = csv['fname'].values[0]
+            image_fname = os.path.basename(old_fpath)
+            new_fpath = os.path.join(root,image_fname)
+            csv['fname'] = new_fpath
+
+        csv_recover.append(csv)
+
     try:
 
         data = pd.concat(csv_recover,axis = 0,sort = False,ignore_index = True)
@@ -723,6 +881,31 @@ def recover(fits_dir,outdir_name='REDUCED',outcsv_name='REDUCED',
 
         print('\nData recovered :: Output File:\n%s' % output_file)
 
+        if output_columnar is not None:
+            columnar_file = write_columnar(output_file,output_columnar)
+            if columnar_file is not None:
+                print('\nColumnar Output File:\n%s' % columnar_file)
+
+        if timing_summary:
+
+            stage_cols = [col for col in data.columns if col.startswith('t_') or col.startswith('mem_')]
+
+            if len(stage_cols) > 0:
+
+                stages = data[stage_cols].apply(pd.to_numeric,errors = 'coerce')
+
+                timing = stages.agg(['count','median','mean','max','sum']).T
+                timing.index.name = 'stage'
+
+                timing_file = os.path.join(recover_dir, str(outcsv_name) + '_timing.csv')
+
+                timing.round(3).to_csv(timing_file)
+
+                if print_msg:
+                    print('\nTime spent per stage [s]:\n%s' % timing.loc[[i for i in timing.index if i.startswith('t_')]].round(2).sort_values(by = 'sum',ascending = False).to_string())
+
+                print('\nTiming summary :: Output File:\n%s' % timing_file)
+
 
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
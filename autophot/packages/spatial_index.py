@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Spatial index of source positions used for isolation and nearest neighbour
+queries. Rather than computing the distance from every source to every other
+source, the positions are stored in a KD-tree (`scipy.spatial.cKDTree
+<https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.cKDTree.html>`_)
+so all sources can be queried at once without building an N x N array of
+distances. Following the isolation checks used throughout AutoPhOT, sources
+at exactly the same position as a source (including itself) are not counted
+as neighbours.
+'''
+
+
+class source_index(object):
+    '''
+    KD-tree of source positions. Sources with a position that is not finite
+    are not included in the tree, and return nan for all queries.
+    '''
+
+    def __init__(self,x,y):
+        '''
+        :param x: X pixel locations of sources
+        :type x: array
+        :param y: Y pixel locations of sources
+        :type y: array
+
+        '''
+
+        import numpy as np
+        from scipy.spatial import cKDTree
+
+        self.x = np.asarray(x,dtype = float).ravel()
+        self.y = np.asarray(y,dtype = float).ravel()
+
+        self.finite = np.isfinite(self.x) & np.isfinite(self.y)
+
+        self.xy = np.column_stack([self.x[self.finite],self.y[self.finite]])
+
+        self.tree = cKDTree(self.xy) if len(self.xy) > 0 else None
+
+    def __len__(self):
+
+        return len(self.x)
+
+    def nearest_distance(self):
+        '''
+        Distance from each source to its nearest neighbour. If a source has no
+        neighbours (i.e. there is only one source position), the distance is
+        inf.
+
+        :return: Distance to nearest neighbour for each source
+        :rtype: array
+
+        '''
+
+        import numpy as np
+
+        distance = np.full(len(self.x),np.nan)
+
+        n = len(self.xy)
+
+        if n == 0:
+            return distance
+
+        nearest = np.full(n,np.inf)
+
+        # Look further out only for sources with coincident neighbours
+        todo = np.arange(n)
+        k = 2
+
+        while len(todo) > 0:
+
+            k_query = min(k,n)
+
+            dist, _ = self.tree.query(self.xy[todo],k = k_query)
+
+            dist = np.asarray(dist).reshape(len(todo),-1)
+            dist = np.where(dist > 0,dist,np.inf)
+
+            nearest[todo] = dist.min(axis = 1)
+
+            if k_query >= n:
+                break
+
+            todo = todo[~np.isfinite(nearest[todo])]
+            k *= 4
+
+        distance[self.finite] = nearest
+
+        return distance
+
+    def isolated(self,radius):
+        '''
+        Check if sources have no neighbours within *radius* pixels.
+
+        :param radius: Isolation radius in pixels
+        :type radius: float
+        :return: Boolean array which is True if a source is isolated
+        :rtype: array
+
+        '''
+
+        return self.nearest_distance() > radius
+
+    def count_within(self,radius,x = None,y = None):
+        '''
+        Number of sources within *radius* pixels of each source, not including
+        any sources at the same position. If *x* and *y* are given, the number
+        of sources within *radius* of these positions is returned instead.
+
+        :param radius: Search radius in pixels
+        :type radius: float
+        :param x: X pixel locations to search around, defaults to None
+        :type x: array, optional
+        :param y: Y pixel locations to search around, defaults to None
+        :type y: array, optional
+        :return: Number of sources within *radius*
+        :rtype: array
+
+        '''
+
+        import numpy as np
+
+        if x is None or y is None:
+            points = self.xy
+            exclude_same = True
+        else:
+            points = np.column_stack([np.asarray(x,dtype = float).ravel(),
+                                      np.asarray(y,dtype = float).ravel()])
+            exclude_same = False
+
+        counts = np.zeros(len(points),dtype = int)
+
+        if self.tree is None or len(points) == 0:
+            return counts if not exclude_same else self._expand(counts)
+
+        counts = np.asarray(self.tree.query_ball_point(points,r = radius,return_length = True),dtype = int)
+
+        if exclude_same:
+            counts = counts - np.asarray(self.tree.query_ball_point(points,r = 0,return_length = True),dtype = int)
+            return self._expand(counts)
+
+        return counts
+
+    def within(self,x,y,radius):
+        '''
+        Indices of sources within *radius* pixels of each of the given positions.
+
+        :param x: X pixel locations to search around
+        :type x: array
+        :param y: Y pixel locations to search around
+        :type y: array
+        :param radius: Search radius in pixels
+        :type radius: float
+        :return: List containing an array of source indices for each position
+        :rtype: list
+
+        '''
+
+        import numpy as np
+
+        points = np.column_stack([np.asarray(x,dtype = float).ravel(),
+                                  np.asarray(y,dtype = float).ravel()])
+
+        if self.tree is None:
+            return [np.array([],dtype = int) for i in range(len(points))]
+
+        # Map tree indices back to input indices
+        index = np.where(self.finite)[0]
+
+        return [index[np.asarray(i,dtype = int)] for i in self.tree.query_ball_point(points,r = radius)]
+
+    def _expand(self,values):
+        '''
+        Expand an array of values for sources in the tree to all sources, filling
+        sources with non-finite positions with zero.
+        '''
+
+        import numpy as np
+
+        expanded = np.zeros(len(self.x),dtype = values.dtype)
+        expanded[self.finite] = values
+
+        return expanded
+
+
+def nearest_distance(x,y):
+    '''
+    Distance from each source to its nearest neighbour, see *source_index.nearest_distance*.
+
+    :param x: X pixel locations of sources
+    :type x: array
+    :param y: Y pixel locations of sources
+    :type y: array
+    :return: Distance to nearest neighbour for each source
+    :rtype: array
+
+    '''
+
+    return source_index(x,y).nearest_distance()
+
+
+def isolated(x,y,radius):
+    '''
+    Check if sources have no neighbours within *radius* pixels, see *source_index.isolated*.
+
+    :param x: X pixel locations of sources
+    :type x: array
+    :param y: Y pixel locations of sources
+    :type y: array
+    :param radius: Isolation radius in pixels
+    :type radius: float
+    :return: Boolean array which is True if a source is isolated
+    :rtype: array
+
+    '''
+
+    return source_index(x,y).isolated(radius)
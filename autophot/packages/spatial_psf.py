@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Spatially varying PSF model. Each pixel of the residual table is fitted with
+a low order polynomial in the position of the sources used to build the PSF
+model, using the residual table of every source found by
+*psf.build_r_table*. The analytical part of the model is the same across the
+image.
+
+The image is split into square cells of *cell_size* pixels, and the residual
+table at the center of each cell is found the first time it is needed and
+reused for every source in that cell. Each table is adjusted so the counts
+under the PSF model within *norm_radius* are the same as for the mean residual
+table, so the counts found by *psf.do* for a PSF model with an amplitude of 1
+are valid anywhere in the image.
+'''
+
+
+def n_terms(degree):
+    '''
+    Number of terms in a 2D polynomial.
+
+    :param degree: Degree of polynomial
+    :type degree: int
+    :return: Number of terms
+    :rtype: int
+
+    '''
+
+    return int((degree + 1)*(degree + 2)/2)
+
+
+class spatial_psf(object):
+    '''
+    Residual table that varies across the image, which can be given to
+    *psf.fit* in place of a single residual table.
+    '''
+
+    def __init__(self,residuals,x,y,image_shape,image_params,use_moffat = True,
+                 degree = 1,cell_size = 128,norm_radius = None):
+        '''
+        :param residuals: Residual table of each source used to build the PSF model, normalised to unity, with shape (N, M, M)
+        :type residuals: 3D array
+        :param x: X pixel location of each source
+        :type x: array
+        :param y: Y pixel location of each source
+        :type y: array
+        :param image_shape: Shape of the image
+        :type image_shape: tuple
+        :param image_params: Dictionary containing analytical model params. If a moffat is used, this dictionary should containing *alpha* and *beta* and their respective values, else if a gaussian is used, this dictionary should include *sigma* and its value.
+        :type image_params: dict
+        :param use_moffat: If True, use a moffat function as the analytical function, else use a gaussian, defaults to True
+        :type use_moffat: bool, optional
+        :param degree: Degree of polynomial fitted to each pixel of the residual table. This is lowered if there are too few sources to constrain it, defaults to 1
+        :type degree: int, optional
+        :param cell_size: Size of each cell in pixels, defaults to 128
+        :type cell_size: int, optional
+        :param norm_radius: Radius in pixels within which the counts under the PSF model are kept the same across the image, defaults to None in which case the whole residual table is used
+        :type norm_radius: float, optional
+
+        '''
+
+        import logging
+        import numpy as np
+        from autophot.packages.functions import gauss_2d,moffat_2d
+
+        logger = logging.getLogger(__name__)
+
+        residuals = np.asarray(residuals,dtype = float)
+        x = np.asarray(x,dtype = float)
+        y = np.asarray(y,dtype = float)
+
+        self.shape = residuals.shape[1:]
+        self.image_shape = tuple(image_shape[:2])
+        self.cell_size = int(cell_size)
+
+        self.n_cells_x = int(np.ceil(self.image_shape[1]/self.cell_size))
+        self.n_cells_y = int(np.ceil(self.image_shape[0]/self.cell_size))
+
+        # Need at least one more source than the number of terms
+        while degree > 0 and len(residuals) <= n_terms(degree):
+            degree -= 1
+
+        if degree < 1:
+            logger.info('Too few sources for spatially varying PSF model - using the same residual table across the image')
+
+        self.degree = degree
+
+        self.mean = residuals.mean(axis = 0)
+
+        A = self._terms(x,y)
+
+        coeffs,_,_,_ = np.linalg.lstsq(A,residuals.reshape(len(residuals),-1),rcond = None)
+
+        self.coeffs = coeffs
+
+        # Unity analytical model centered on the residual table
+        xx,yy = np.meshgrid(np.arange(0,self.shape[1]),np.arange(0,self.shape[0]))
+
+        if use_moffat:
+            core = moffat_2d((xx,yy),self.shape[1]/2,self.shape[0]/2,0,1,image_params)
+        else:
+            core = gauss_2d((xx,yy),self.shape[1]/2,self.shape[0]/2,0,1,image_params)
+
+        self.core = np.asarray(core,dtype = float).reshape(self.shape)
+
+        if norm_radius is None:
+            self.norm_mask = np.ones(self.shape,dtype = bool)
+        else:
+            self.norm_mask = (xx - self.shape[1]/2)**2 + (yy - self.shape[0]/2)**2 <= norm_radius**2
+
+        self._tables = {}
+
+    def _terms(self,x,y):
+        '''
+        Polynomial terms for each position, with the position scaled to lie
+        between -1 and 1 across the image.
+        '''
+
+        import numpy as np
+
+        u = (np.atleast_1d(x) - 0.5*self.image_shape[1])/(0.5*self.image_shape[1])
+        v = (np.atleast_1d(y) - 0.5*self.image_shape[0])/(0.5*self.image_shape[0])
+
+        terms = [u**i * v**(d - i) for d in range(self.degree + 1) for i in range(d + 1)]
+
+        return np.column_stack(terms)
+
+    def evaluate(self,x,y):
+        '''
+        Residual table at a given position, adjusted so the counts under the
+        PSF model are the same as for the mean residual table.
+
+        :param x: X pixel location
+        :type x: float
+        :param y: Y pixel location
+        :type y: float
+        :return: Residual table, normalised to unity
+        :rtype: 2D array
+
+        '''
+
+        import numpy as np
+
+        table = (self._terms(x,y) @ self.coeffs).reshape(self.shape)
+
+        mask = self.norm_mask
+
+        table += self.core * (np.sum(self.mean[mask]) - np.sum(table[mask]))/np.sum(self.core[mask])
+
+        return table
+
+    def cell(self,x,y):
+        '''
+        Cell containing each position.
+
+        :param x: X pixel location
+        :type x: float or array
+        :param y: Y pixel location
+        :type y: float or array
+        :return: Index of cell
+        :rtype: int or array
+
+        '''
+
+        import numpy as np
+
+        ix = np.clip(np.nan_to_num(np.floor(np.asarray(x,dtype = float)/self.cell_size)),0,self.n_cells_x - 1).astype(int)
+        iy = np.clip(np.nan_to_num(np.floor(np.asarray(y,dtype = float)/self.cell_size)),0,self.n_cells_y - 1).astype(int)
+
+        return iy*self.n_cells_x + ix
+
+    def cell_table(self,cell):
+        '''
+        Residual table at the center of a cell. The same array is returned each
+        time so the padded and shifted tables cached by *psf.PSF_MODEL* are
+        also reused.
+
+        :param cell: Index of cell
+        :type cell: int
+        :return: Residual table, normalised to unity
+        :rtype: 2D array
+
+        '''
+
+        cell = int(cell)
+
+        if cell not in self._tables:
+
+            if self.degree < 1:
+                table = self.mean
+            else:
+                ix = cell % self.n_cells_x
+                iy = cell // self.n_cells_x
+
+                xc = min((ix + 0.5)*self.cell_size,self.image_shape[1])
+                yc = min((iy + 0.5)*self.cell_size,self.image_shape[0])
+
+                table = self.evaluate(xc,yc)
+
+            self._tables[cell] = table
+
+        return self._tables[cell]
+
+    def table(self,x,y):
+        '''
+        Residual table of the cell containing a given position.
+
+        :param x: X pixel location
+        :type x: float
+        :param y: Y pixel location
+        :type y: float
+        :return: Residual table, normalised to unity
+        :rtype: 2D array
+
+        '''
+
+        import numpy as np
+
+        return self.cell_table(self.cell(float(np.ravel(x)[0]),float(np.ravel(y)[0])))
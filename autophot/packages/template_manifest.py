@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Manifest of prepared templates, used when *prepare_templates* is True. Each
+time a template is prepared, a line is appended to *template_manifest.jsonl* in
+the *templates* folder recording the template, a signature of the file after
+it was prepared and a hash of the input commands used to prepare it.
+
+As templates are overwritten when they are prepared, the signature is taken
+after preparation. If a template is replaced, or the commands used to prepare
+templates are changed, it no longer matches the manifest and is prepared
+again. Templates in the same folder (i.e. the same filter) share output files
+and are prepared one after the other, while different folders can be prepared
+at the same time.
+'''
+
+# Commands used when preparing templates. Only changes to these will cause a
+# template to be prepared again.
+template_keys = {'photometry':['ap_size','inf_ap_size','r_in_size','r_out_size'],
+                 'fitting':['use_moffat','fitting_method','fitting_radius'],
+                 'psf':['psf_source_no','regrid_size'],
+                 'wcs':['solve_field_exe_loc']}
+
+
+def template_manifest_fpath(template_dir,fname = 'template_manifest.jsonl'):
+    '''
+    Location of the template manifest for a given *templates* folder.
+
+    :param template_dir: Location of *templates* folder e.g. *fits_dir* with */templates* appended
+    :type template_dir: str
+    :param fname: Name of manifest file, defaults to 'template_manifest.jsonl'
+    :type fname: str, optional
+    :return: File path of manifest
+    :rtype: str
+
+    '''
+
+    from autophot.packages.manifest import manifest_fpath
+
+    return manifest_fpath(template_dir,fname = fname)
+
+
+def template_config_hash(autophot_input):
+    '''
+    Hash of the input commands used when preparing templates, given by
+    *template_keys*, along with the target coordinates used to help solve for
+    astrometry.
+
+    :param autophot_input: AutoPHOT input dictionary
+    :type autophot_input: dict
+    :return: sha1 hex digest of input commands
+    :rtype: str
+
+    '''
+
+    import json
+    import hashlib
+
+    relevant_input = {'target_ra':autophot_input.get('target_ra'),
+                      'target_dec':autophot_input.get('target_dec')}
+
+    for section,keys in template_keys.items():
+        relevant_input[section] = {key:autophot_input.get(section,{}).get(key) for key in keys}
+
+    encoded = json.dumps(relevant_input,sort_keys = True,default = str).encode('utf-8')
+
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def psf_model_fpath(fpath):
+    '''
+    Location of the PSF model saved when a template is prepared.
+
+    :param fpath: File path of template
+    :type fpath: str
+    :return: File path of PSF model
+    :rtype: str
+
+    '''
+
+    import os
+
+    base = os.path.splitext(os.path.basename(fpath))[0]
+
+    return os.path.join(os.path.dirname(fpath),'PSF_model_'+base+'.fits')
+
+
+def template_groups(flist):
+    '''
+    Group templates by the folder they are in. Templates in the same folder
+    write to the same files and must be prepared one after the other.
+
+    :param flist: File paths of templates
+    :type flist: list
+    :return: Lists of file paths, one for each folder, sorted by folder name
+    :rtype: list
+
+    '''
+
+    import os
+
+    groups = {}
+
+    for fpath in flist:
+        groups.setdefault(os.path.dirname(fpath),[]).append(fpath)
+
+    return [sorted(groups[key]) for key in sorted(groups)]
+
+
+def template_status(flist,manifest,config,use_hash = False):
+    '''
+    Status of each template. A template is *done* if it has been prepared with
+    the current input commands, has not changed since and its PSF model can be
+    found. Otherwise the status is one of *new*, *failed*, *modified*, *config*
+    or *no_psf_model*.
+
+    :param flist: File paths of templates
+    :type flist: list
+    :param manifest: Dictionary of manifest entries given by *manifest.load_manifest*
+    :type manifest: dict
+    :param config: Hash of input commands given by *template_config_hash*
+    :type config: str
+    :param use_hash: If True, use a hash of the file contents as the signature of each template, defaults to False
+    :type use_hash: bool, optional
+    :return: Dataframe with the *fpath*, *folder*, *status* and *time* of each template
+    :rtype: Dataframe
+
+    '''
+
+    import os
+    import pandas as pd
+    from autophot.packages.manifest import file_signature,is_complete
+
+    rows = []
+
+    for fpath in flist:
+
+        complete, reason = is_complete(manifest,fpath,file_signature(fpath,use_hash = use_hash),config)
+
+        if complete and not os.path.isfile(psf_model_fpath(fpath)):
+            complete, reason = False, 'no_psf_model'
+
+        entry = manifest.get(os.path.abspath(fpath),{})
+
+        rows.append({'fpath':fpath,
+                     'folder':os.path.basename(os.path.dirname(fpath)),
+                     'status':'done' if complete else reason,
+                     'time':entry.get('time')})
+
+    return pd.DataFrame(rows,columns = ['fpath','folder','status','time'])
+
+
+def print_template_status(status):
+    '''
+    Print the number of templates with each status in each folder.
+
+    :param status: Dataframe given by *template_status*
+    :type status: Dataframe
+    :return: Table of the number of templates with each status, with one row per folder
+    :rtype: Dataframe
+
+    '''
+
+    import pandas as pd
+
+    if len(status) == 0:
+        print('\nNo template files found')
+        return pd.DataFrame()
+
+    summary = pd.crosstab(status['folder'],status['status'])
+
+    print('\nTemplate status:\n')
+    print(summary.to_string())
+    print('\nTemplates ready: %d / %d' % ((status['status'] == 'done').sum(),len(status)))
+
+    return summary
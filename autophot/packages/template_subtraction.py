@@ -70,19 +70,22 @@ def prepare_templates(fpath, tele_autophot_input ,
     :type regrid_size: int, optional
     :param fitting_radius: zoomed region around location of best fit to focus fitting. This allows for the fitting to be concentrated on high S/N areas and not fit the low S/N wings of the PSF, defaults to 1.3
     :type fitting_radius: float, optional
-    :return: This function *OVERWRITES* the given template files and cleans/calibrates this files and saves the for use on science data.
+    :return: This function *OVERWRITES* the given template files and cleans/calibrates this files and saves the for use on science data. Returns True if the template was prepared, or False if the WCS could not be updated, the PSF model could not be built or an error occured.
+    :rtype: bool
     '''
 
     import os
     import logging
     from astropy.io import fits
     from autophot.packages.functions import getheader,getimage
+    from autophot.packages.fits_io import write_fits
     from autophot.packages import psf
     from autophot.packages.aperture import do_aperture_photometry
     from autophot.packages.call_astrometry_net import AstrometryNetLOCAL
     from autophot.packages.check_wcs import updatewcs,removewcs
     from autophot.packages.find import get_fwhm
     from autophot.packages.functions import border_msg
+    from autophot.packages.template_manifest import psf_model_fpath
 
     base = os.path.basename(fpath)
     write_dir = os.path.dirname(fpath)
@@ -96,7 +99,9 @@ def prepare_templates(fpath, tele_autophot_input ,
 
     if base.startswith('PSF_model'):
         logger.info('ignoring PSF_MODEL in file: %s' % base)
-        return
+        return False
+
+    success = True
 
     dirpath = os.path.dirname(fpath)
 
@@ -190,7 +195,7 @@ def prepare_templates(fpath, tele_autophot_input ,
     updated_header['GAIN'] = GAIN
     updated_header['RDNOISE'] = rdnoise
 
-    fits.writeto(fpath,
+    write_fits(fpath,
                  image,
                  updated_header,
                  overwrite = True,
@@ -217,7 +222,7 @@ def prepare_templates(fpath, tele_autophot_input ,
 
             # Update header and write to new file
             updated_header['CRAY_RM'] = ('T', 'Comsic rays w/astroscrappy ')
-            fits.writeto(fpath,
+            write_fits(fpath,
                          image,
                          updated_header,
                          overwrite = True,
@@ -261,7 +266,7 @@ def prepare_templates(fpath, tele_autophot_input ,
             os.remove(astro_check)
 
             # Write new header
-            fits.writeto(fpath,image,
+            write_fits(fpath,image,
                          header_updated,
                          overwrite = True,
                          output_verify = 'silentfix+ignore')
@@ -269,6 +274,7 @@ def prepare_templates(fpath, tele_autophot_input ,
         except Exception as e:
 
             logger.info('Error with template WCS: %s' % e)
+            success = False
 
 
 
@@ -377,11 +383,256 @@ def prepare_templates(fpath, tele_autophot_input ,
                             # plot_PSF_model_residuals = autophot_input['psf']['plot_PSF_model_residuals'],
                             save_PSF_models_fits = True)
 
+        if not os.path.isfile(psf_model_fpath(fpath)):
+            logger.info('PSF model of template not found: %s' % os.path.basename(psf_model_fpath(fpath)))
+            success = False
+
+
+    return success
+
+
+# =============================================================================
+# Align template to science image
+# =============================================================================
+# Aligned templates and footprints keyed by the template, the pointing and
+# shape of the science image and the target location
+_align_cache = {}
+
+# Number of aligned templates to keep in the cache
+_align_cache_size = 8
+
+# Hash of each template file, keyed by its file path, size and modification time
+_template_hash_cache = {}
+
+
+def _template_hash(fpath):
+    '''
+    sha1 hash of a template file. The hash is only found again if the size or
+    modification time of the file changes.
+
+    :param fpath: File path of template
+    :type fpath: str
+    :return: Hash of template
+    :rtype: str
+
+    '''
+
+    import os
+    from autophot.packages.manifest import file_signature
+
+    key = (os.path.abspath(fpath),file_signature(fpath))
+
+    if key not in _template_hash_cache:
+        _template_hash_cache[key] = file_signature(fpath,use_hash = True)
+
+    return _template_hash_cache[key]
+
+
+def template_cutout_size(template_wcs,template_shape,image_wcs,image_shape,
+                         target_x_pix,target_y_pix,step = 16):
+    '''
+    Size of the square cutout around the target that is covered by the template.
+    The science image is sampled every *step* pixels and each sample is
+    projected onto the template, so the template does not need to be
+    reprojected to find this. If the template covers the whole image, the
+    shape of the image is returned.
+
+    :param template_wcs: WCS of template
+    :type template_wcs: WCS
+    :param template_shape: Shape of template
+    :type template_shape: tuple
+    :param image_wcs: WCS of science image
+    :type image_wcs: WCS
+    :param image_shape: Shape of science image
+    :type image_shape: tuple
+    :param target_x_pix: X pixel location of target in the science image
+    :type target_x_pix: float
+    :param target_y_pix: Y pixel location of target in the science image
+    :type target_y_pix: float
+    :param step: Spacing in pixels between samples of the science image, defaults to 16
+    :type step: int, optional
+    :return: Size of cutout in pixels given as (ny, nx)
+    :rtype: tuple
+
+    '''
+
+    import numpy as np
+
+    ny,nx = image_shape
+
+    xs = np.unique(np.append(np.arange(0,nx,step),nx-1))
+    ys = np.unique(np.append(np.arange(0,ny,step),ny-1))
+
+    XX,YY = np.meshgrid(xs,ys)
+
+    ra,dec = image_wcs.all_pix2world(XX,YY,0)
+    tx,ty = template_wcs.all_world2pix(ra,dec,0,quiet = True)
+
+    with np.errstate(invalid = 'ignore'):
+        covered = (tx >= -0.5) & (tx <= template_shape[1] - 0.5) & (ty >= -0.5) & (ty <= template_shape[0] - 0.5)
+
+    if not np.any(covered):
+        raise Exception('Template does not overlap image')
+
+    if np.all(covered):
+        return (ny,nx)
+
+    # Bounding box of samples covered by the template
+    cols = xs[np.any(covered,axis = 0)]
+    rows = ys[np.any(covered,axis = 1)]
+
+    distances = []
+
+    if cols.min() > 0:
+        distances.append(target_x_pix - cols.min())
+    if cols.max() < nx - 1:
+        distances.append(cols.max() - target_x_pix)
+    if rows.min() > 0:
+        distances.append(target_y_pix - rows.min())
+    if rows.max() < ny - 1:
+        distances.append(rows.max() - target_y_pix)
+
+    if len(distances) == 0:
+        return (ny,nx)
+
+    distance = float(np.min(distances))
+
+    if distance <= 0:
+        raise Exception('Target is not covered by template')
+
+    return (int(2*distance),int(2*distance))
+
+
+def align_template(fpath_template,image,image_wcs,target_x_pix,target_y_pix,
+                   step = 16,cache_dir = None,wcs_tol = 0.1):
+    '''
+    Align a template to a cutout of the science image around the target using
+    their WCS. The size of the cutout is found using *template_cutout_size*,
+    and the template is only reprojected onto this cutout rather than the
+    whole image.
+
+    The aligned template and its footprint are cached, keyed by the hash of
+    the template file, the shape of the science image, the target location and
+    the pointing of the science image. The pointing is given by the sky
+    position of the target pixel and the pixel scale matrix, rounded so that
+    images whose WCS differ by less than about *wcs_tol* pixels across the
+    image share a key. Images with the same pointing therefore reuse the same
+    alignment even if their WCS headers differ slightly. If *cache_dir* is
+    given, they are also saved to this directory so they can be used by later
+    runs.
+
+    :param fpath_template: File path of template
+    :type fpath_template: str
+    :param image: Science image
+    :type image: 2D array
+    :param image_wcs: WCS of science image
+    :type image_wcs: WCS
+    :param target_x_pix: X pixel location of target in the science image
+    :type target_x_pix: float
+    :param target_y_pix: Y pixel location of target in the science image
+    :type target_y_pix: float
+    :param step: Spacing in pixels between samples of the science image used to find the area covered by the template, defaults to 16
+    :type step: int, optional
+    :param cache_dir: Directory to save aligned templates to, defaults to None
+    :type cache_dir: str, optional
+    :param wcs_tol: Tolerance in pixels used to decide if two images have the same pointing, defaults to 0.1
+    :type wcs_tol: float, optional
+    :return: Aligned template, cutout of the science image and footprint of the aligned template, where 1 is a pixel covered by the template
+    :rtype: tuple
+
+    '''
+
+    import os
+    import pathlib
+    import hashlib
+    import logging
+    import numpy as np
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    from astropy.nddata.utils import Cutout2D
+    from reproject import reproject_interp
+
+    logger = logging.getLogger(__name__)
+
+    position = (np.floor(float(np.ravel(target_x_pix)[0])),np.floor(float(np.ravel(target_y_pix)[0])))
+
+    # Pointing of the image, rounded to a fraction of a pixel
+    pixel_scale_matrix = image_wcs.celestial.pixel_scale_matrix
+    pixel_scale = np.sqrt(abs(np.linalg.det(pixel_scale_matrix)))
+
+    ra,dec = image_wcs.all_pix2world(position[0],position[1],0)
+
+    sky_step = wcs_tol * pixel_scale
+    matrix_step = wcs_tol * pixel_scale / max(image.shape[:2])
+
+    pointing = [np.round(float(ra) * np.cos(np.radians(float(dec))) / sky_step),
+                np.round(float(dec) / sky_step)] + list(np.round(pixel_scale_matrix.ravel() / matrix_step))
+
+    key = '|'.join([_template_hash(fpath_template),
+                    ','.join('%d' % i for i in pointing),
+                    '%dx%d' % image.shape[:2],
+                    '%d,%d' % position])
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    entry = _align_cache.get(key)
+
+    if cache_dir is not None:
+        cache_fpath = os.path.join(cache_dir,'aligned_template_%s.npz' % key)
+
+    if entry is None and cache_dir is not None and os.path.isfile(cache_fpath):
+        try:
+            with np.load(cache_fpath) as data:
+                entry = {'template':data['template'],
+                         'footprint':data['footprint'],
+                         'size':tuple(int(i) for i in data['size'])}
+        except Exception:
+            entry = None
+
+    if entry is None:
 
-        pass
+        with fits.open(fpath_template,ignore_missing_end = True) as hdul:
 
+            template_hdu = hdul[0]
 
-    return
+            size = template_cutout_size(WCS(template_hdu.header),template_hdu.data.shape,
+                                        image_wcs,image.shape,
+                                        position[0],position[1],
+                                        step = step)
+
+            image_cutout = Cutout2D(image,position,size,wcs = image_wcs)
+
+            aligned_template, footprint = reproject_interp(template_hdu,image_cutout.wcs,
+                                                           shape_out = image_cutout.data.shape,
+                                                           order = 1)
+
+        footprint = footprint.astype(bool)
+        aligned_template[~footprint] = 0
+
+        entry = {'template':aligned_template.astype(np.float32),
+                 'footprint':footprint,
+                 'size':size}
+
+        if cache_dir is not None:
+            try:
+                pathlib.Path(cache_dir).mkdir(parents = True, exist_ok=True)
+                tmp_fpath = cache_fpath + '.%d.tmp.npz' % os.getpid()
+                np.savez_compressed(tmp_fpath,template = entry['template'],footprint = footprint,size = np.array(size))
+                os.replace(tmp_fpath,cache_fpath)
+            except Exception as e:
+                logger.info('Could not save aligned template: %s' % e)
+
+    else:
+
+        logger.info('Using cached template alignment')
+
+        image_cutout = Cutout2D(image,position,entry['size'],wcs = image_wcs)
+
+    if key not in _align_cache:
+        if len(_align_cache) >= _align_cache_size:
+            _align_cache.pop(next(iter(_align_cache)))
+        _align_cache[key] = entry
+
+    return entry['template'].astype(float), image_cutout, entry['footprint'].copy()
 
 
 # =============================================================================
@@ -469,13 +720,106 @@ def get_pstars(ra, dec, size, filters="grizy"):
 # =============================================================================
 # Perform image subtraction
 # =============================================================================
+def find_template_psf(template_dir,template_fpath = None):
+    '''
+    File path of the PSF model of a template. The PSF model saved when
+    *template_fpath* was prepared is used if it exists, otherwise the most
+    recently modified *PSF_model* file in *template_dir* is used.
+
+    :param template_dir: Directory containing the PSF model files
+    :type template_dir: str
+    :param template_fpath: File path of the template before it was aligned, defaults to None
+    :type template_fpath: str, optional
+    :return: File path of PSF model
+    :rtype: str
+
+    '''
+
+    import os
+    from glob import glob
+    from autophot.packages.template_manifest import psf_model_fpath
+
+    if template_fpath is not None:
+        expected_fpath = psf_model_fpath(template_fpath)
+        if os.path.isfile(expected_fpath):
+            return expected_fpath
+
+    flist = glob(os.path.join(template_dir,'PSF_model_*'))
+
+    if len(flist) == 0:
+        raise Exception('No PSF model found in %s' % template_dir)
+
+    return max(sorted(flist),key = os.path.getmtime)
+
+
+def resample_psf(psf,psf_wcs,image_wcs):
+    '''
+    Resample a PSF model onto the pixel grid of another image, accounting for
+    the different pixel scale and rotation given by the WCS of each image. The
+    center of the PSF is kept at (shape[1]/2, shape[0]/2) and the output is
+    normalised to sum to 1.
+
+    :param psf: PSF model with its center at (shape[1]/2, shape[0]/2)
+    :type psf: 2D array
+    :param psf_wcs: WCS of the image the PSF model was built from
+    :type psf_wcs: WCS
+    :param image_wcs: WCS of the image whose pixel grid the PSF model is resampled onto
+    :type image_wcs: WCS
+    :return: Resampled PSF model
+    :rtype: 2D array
+
+    '''
+
+    import numpy as np
+    from scipy.ndimage import affine_transform
+
+    psf = np.nan_to_num(np.asarray(psf,dtype = float))
+
+    # Pixel offsets in the image to pixel offsets in the PSF model, in (x, y)
+    matrix = np.dot(np.linalg.inv(psf_wcs.celestial.pixel_scale_matrix),
+                    image_wcs.celestial.pixel_scale_matrix)
+
+    if np.allclose(matrix,np.eye(2),atol = 1e-3):
+        return psf/np.sum(psf)
+
+    # Make sure the output is large enough to hold the PSF model
+    stretch = np.linalg.norm(np.linalg.inv(matrix),2)
+    shape = tuple(2*int(np.ceil(n*stretch/2)) for n in psf.shape)
+
+    # affine_transform works in (y, x)
+    matrix = matrix[::-1,::-1]
+
+    center_in = np.array(psf.shape)/2
+    center_out = np.array(shape)/2
+
+    resampled = affine_transform(psf,matrix,
+                                 offset = center_in - np.dot(matrix,center_out),
+                                 output_shape = shape,
+                                 order = 3,
+                                 mode = 'constant',
+                                 cval = 0)
+
+    return resampled/np.sum(resampled)
+
+
 def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
              hotpants_timeout=45, template_dir = None,footprint = None, remove_sat = False,
-             zogy_use_pixel = False):
+             zogy_use_pixel = False, use_native_zogy = False, image_psf = None,
+             image_data = None, template_data = None, fft_threads = -1,
+             bkg_level = 3, return_image = False, template_original = None,
+             template_wcs = None):
     '''
 
     Perform image subtraction using either Hotpants or Zogy
 
+    If *use_native_zogy* is True, the subtraction is done in memory using
+    *zogy.subtract_zogy*, with the PSF model of the image (given by
+    *image_psf*, or the *PSF_model* file of the image) and of the template
+    (the *PSF_model* file in *template_dir*, given by *find_template_psf*). If
+    this fails, PyZOGY or HOTPANTS is used as before. If *template_wcs* is
+    given, the PSF model of the template is resampled onto the pixel grid of
+    the science image with *resample_psf* before it is used by ZOGY.
+
     :param file: Filepath of science image containing suspected transient flux
     :type file: str
     :param template: Filepath of science image without any transient flux
@@ -496,19 +840,37 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
     :type remove_sat: bool, optional
     :param zogy_use_pixel: If True, use pixel values for gain matching when using zogy, else source matching is used for image matching, defaults to False
     :type zogy_use_pixel: bool, optional
-    :return: Retruns filepath of image after template subtraction
+    :param use_native_zogy: If True, perform the subtraction in memory using *zogy.subtract_zogy*, defaults to False
+    :type use_native_zogy: bool, optional
+    :param image_psf: PSF model of the science image. If None, the *PSF_model* file of the image is used, defaults to None
+    :type image_psf: 2D array, optional
+    :param image_data: Science image, if already in memory, defaults to None
+    :type image_data: 2D array, optional
+    :param template_data: Template aligned to the science image, if already in memory, defaults to None
+    :type template_data: 2D array, optional
+    :param fft_threads: Number of threads used to find Fourier transforms when *use_native_zogy* is True, -1 uses all available threads, defaults to -1
+    :type fft_threads: int, optional
+    :param bkg_level: The number of standard deviations, below which is assumed to be due to the background noise distribution, defaults to 3
+    :type bkg_level: float, optional
+    :param return_image: If True, also return the subtracted image so it doesn't need to be read from file, defaults to False
+    :type return_image: bool, optional
+    :param template_original: File path of the template before it was aligned, used to find its PSF model, defaults to None
+    :type template_original: str, optional
+    :param template_wcs: WCS of the template the PSF model was built from, defaults to None
+    :type template_wcs: WCS, optional
+    :return: Retruns filepath of image after template subtraction, and the subtracted image if *return_image* is True
     :rtype: str
 
     '''
 
-    import subprocess
     import os
     import sys
     import numpy as np
     from pathlib import Path
     import signal
     import time
-    from autophot.packages.functions import getimage,getheader
+    from autophot.packages.functions import getimage,getheader,start_process
+    from autophot.packages.fits_io import write_fits
     from astropy.io import fits
     import logging
     import warnings
@@ -537,9 +899,9 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
             logger.info('PyZogy selected but not installed: %s' % e)
             use_zogy = False
 
-    if use_zogy and not hotpants_exe_loc:
+    if use_zogy and not hotpants_exe_loc and not use_native_zogy:
         warnings.warn('No suitable template subtraction package found/nPlease check installation instructions!,/n returning original image')
-        return np.nan
+        return (np.nan, None) if return_image else np.nan
 
 
     try:
@@ -551,14 +913,20 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
         fname_ext = Path(file).suffix
 
         # Open image and template
-        file_image     = getimage(file)
+        if image_data is None:
+            file_image     = getimage(file)
+        else:
+            file_image     = np.asarray(image_data,dtype = float)
 
         image_header = getheader(file)
 
         original_wcs = WCS(image_header)
 
         # header = getheader(file)
-        template_image = getimage(template)
+        if template_data is None:
+            template_image = getimage(template)
+        else:
+            template_image = np.asarray(template_data,dtype = float)
 
         if template_dir is None:
             template_dir = os.path.dirname(template)
@@ -574,16 +942,6 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
 
         footprint[ ( np.isnan(file_image)) | np.isnan(template_image) ] = 1
 
-
-        hdu = fits.PrimaryHDU(footprint.astype(int))
-        hdul = fits.HDUList([hdu])
-
-        footprint_loc = os.path.join(write_dir,'footprint_'+base+fname_ext)
-
-        hdul.writeto(footprint_loc,
-                      overwrite=True,
-                      output_verify = 'silentfix+ignore')
-
         check_values_image = file_image[~footprint]
 
         check_values_template = template_image[~footprint]
@@ -601,7 +959,52 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
             template_max = np.nanmax(np.nanmax(check_values_template))
 
 
+        if use_native_zogy or use_zogy:
+            try:
+                template_psf_fpath = find_template_psf(template_dir,template_original)
+            except Exception as e:
+                logger.info('Template PSF model not found [%s]' % e)
+                template_psf_fpath = None
 
+        if use_native_zogy:
+            try:
+
+                from autophot.packages.zogy import subtract_zogy
+
+                logger.info('Performing image subtraction using ZOGY')
+
+                start = time.time()
+
+                if image_psf is None:
+                    image_psf = getimage(os.path.join(write_dir,'PSF_model_'+base.replace('_image_cutout','')+'.fits'))
+
+                template_psf = getimage(template_psf_fpath)
+
+                if template_wcs is not None:
+                    template_psf = resample_psf(template_psf,template_wcs,original_wcs)
+
+                diff, flux_ratio = subtract_zogy(file_image,template_image,
+                                                 science_psf = image_psf,
+                                                 reference_psf = template_psf,
+                                                 mask = footprint,
+                                                 science_saturation = 10+image_max,
+                                                 reference_saturation = 10+template_max,
+                                                 bkg_level = bkg_level,
+                                                 n_threads = fft_threads)
+
+                write_fits(output_fpath,
+                           diff,
+                           original_wcs.to_header(),
+                           overwrite = True,
+                           output_verify = 'silentfix+ignore')
+
+                logger.info('ZOGY finished: %.1fs' % (time.time() - start))
+                logger.info('Subtraction saved as %s' % os.path.splitext(os.path.basename(output_fpath))[0])
+
+                return (output_fpath, diff) if return_image else output_fpath
+
+            except Exception as e:
+                logger.info('ZOGY Failed [%s] - trying PyZOGY/HOTPANTS' % e)
 
 
         if use_zogy:
@@ -618,8 +1021,14 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
 
                 image_psf = os.path.join(write_dir,'PSF_model_'+base.replace('_image_cutout','')+'.fits')
 
-                from glob import glob
-                template_psf = glob(os.path.join(template_dir,'PSF_model_*'))[0]
+                template_psf = template_psf_fpath
+
+                if template_wcs is not None:
+                    template_psf = os.path.join(write_dir,'PSF_model_template_'+base+fname_ext)
+                    write_fits(template_psf,
+                               resample_psf(getimage(template_psf_fpath),template_wcs,original_wcs),
+                               overwrite = True,
+                               output_verify = 'silentfix+ignore')
 
                 logger.info('Using Image : %s' % file)
                 logger.info('Using Image PSF: %s' % image_psf)
@@ -665,6 +1074,15 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
             # Get filename for saving
             base = os.path.splitext(os.path.basename(file))[0]
 
+            hdu = fits.PrimaryHDU(footprint.astype(int))
+            hdul = fits.HDUList([hdu])
+
+            footprint_loc = os.path.join(write_dir,'footprint_'+base+fname_ext)
+
+            hdul.writeto(footprint_loc,
+                          overwrite=True,
+                          output_verify = 'silentfix+ignore')
+
             # Location of executable for hotpants
             exe = hotpants_exe_loc
 
@@ -738,7 +1156,7 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
 
             with  open(HOTPANTS_log, 'w')  as FNULL:
 
-                pro = subprocess.Popen(args,shell=True, stdout=FNULL, stderr=FNULL)
+                pro = start_process(args,shell=True, stdout=FNULL, stderr=FNULL)
                 print('ARGUMENTS:', args, file=FNULL)
 
                 # Timeout
@@ -765,7 +1183,7 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
 
                 logger.info('File was created but nothing written')
 
-                return np.nan
+                return (np.nan, None) if return_image else np.nan
 
             else:
 
@@ -777,20 +1195,20 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
                 template_image = getimage(output_fpath)
                 template_header.update(original_wcs.to_header())
 
-                fits.writeto(output_fpath,
+                write_fits(output_fpath,
                             template_image,
                             template_header,
                             overwrite = True,
                              output_verify = 'silentfix+ignore')
 
 
-                return output_fpath
+                return (output_fpath, template_image) if return_image else output_fpath
 
         if not os.path.isfile(output_fpath):
 
             logger.info('File was not created')
 
-            return np.nan
+            return (np.nan, None) if return_image else np.nan
 
     except Exception as e:
 
@@ -805,4 +1223,4 @@ def subtract(file,template,image_fwhm,use_zogy = False,hotpants_exe_loc = None,
         except:
             pass
 
-        return np.nan
+        return (np.nan, None) if return_image else np.nan
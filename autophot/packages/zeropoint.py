@@ -4,7 +4,8 @@ def get_zeropoint(c,image = None,headinfo = None, fpath = None, use_filter = Non
                   zp_use_mean = False, zp_use_max_bin = False, 
                   zp_use_median = False, zp_use_WA = False,
                   plot_ZP_image_analysis = False,
-                  plot_ZP_vs_SNR = False
+                  plot_ZP_vs_SNR = False,
+                  write_image = True
                   ):
     '''
     
@@ -70,6 +71,8 @@ def get_zeropoint(c,image = None,headinfo = None, fpath = None, use_filter = Non
     :type plot_ZP_image_analysis: bool, optional
     :param plot_ZP_vs_SNR: If True, produce a plot of the zeropoint  versus S/N, defaults to False
     :type plot_ZP_vs_SNR: TYPE, optional
+    :param write_image: If True, write the image with the updated header to *fpath*. If False, *headinfo* is only updated in place, defaults to True
+    :type write_image: bool, optional
     :return: Returns a tuple containing the zeropoint and the error on the zeropoint as well as the original dataframe with updated columns.
     :rtype: Tuple and dataframe
 
@@ -78,6 +81,7 @@ def get_zeropoint(c,image = None,headinfo = None, fpath = None, use_filter = Non
     
     from autophot.packages.functions import SNR_err
     from autophot.packages.functions import calc_mag,border_msg
+    from autophot.packages.fits_io import write_fits
     from autophot.packages.functions import weighted_avg_and_std,set_size
 
     import os
@@ -85,7 +89,6 @@ def get_zeropoint(c,image = None,headinfo = None, fpath = None, use_filter = Non
     import pandas as pd
     import matplotlib.pyplot as plt
 
-    from astropy.io import fits
     from astropy.stats import sigma_clip, mad_std
 
     import logging
@@ -270,10 +273,11 @@ def get_zeropoint(c,image = None,headinfo = None, fpath = None, use_filter = Non
             headinfo['fwhm'] = (round(fwhm,3), 'fwhm w/ autophot')
             headinfo['zp']   = (round(zp[0],3), 'zp w/ autophot')
             
-            fits.writeto(fpath,image.astype(np.single),
-                         headinfo,
-                         overwrite = True,
-                         output_verify = 'silentfix+ignore')
+            if write_image:
+                write_fits(fpath,image.astype(np.single),
+                             headinfo,
+                             overwrite = True,
+                             output_verify = 'silentfix+ignore')
 
         # autophot_input['zeropoint'] = zp
         # autophot_input['zeropoint_err'] = zp_err
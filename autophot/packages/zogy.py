@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Image subtraction following Zackay, Ofek & Gal-Yam (2016, ApJ, 830, 27),
+working on images held in memory. The matching kernel is found directly from
+the PSF of the science image and template, so no kernel needs to be fitted to
+the pixel data and no external program is called.
+
+Both images are padded to a size with fast Fourier transforms, large enough
+that sources near one edge do not wrap around onto the other. Transforms are
+found using *scipy.fft*, which can split the work over several threads.
+
+The difference image is normalised to the photometric scale of the science
+image. When the template is much deeper than the science image, the PSF of
+the difference image is the PSF of the science image, so the PSF model built
+for the science image can be used to measure sources in the difference image.
+'''
+
+
+def psf_fft(psf,shape,n_threads = -1):
+    '''
+    Fourier transform of a PSF model, normalised to sum to 1, padded to *shape*
+    with the center of the PSF moved to the first pixel.
+
+    :param psf: PSF model with its center at (shape[1]/2, shape[0]/2)
+    :type psf: 2D array
+    :param shape: Shape of the padded image
+    :type shape: tuple
+    :param n_threads: Number of threads used to find the Fourier transform, -1 uses all available threads, defaults to -1
+    :type n_threads: int, optional
+    :return: Real Fourier transform of PSF model
+    :rtype: 2D array
+
+    '''
+
+    import numpy as np
+    from scipy import fft
+
+    psf = np.nan_to_num(np.asarray(psf,dtype = float))
+    psf = psf/np.sum(psf)
+
+    padded = np.zeros(shape)
+    padded[:psf.shape[0],:psf.shape[1]] = psf
+
+    padded = np.roll(padded,(-(psf.shape[0]//2),-(psf.shape[1]//2)),axis = (0,1))
+
+    return fft.rfft2(padded,workers = n_threads)
+
+
+def match_flux(science_conv,reference_conv,use,science_noise,reference_noise,
+               snr_limit = 5,sigma = 3,maxiters = 10,min_pixels = 10):
+    '''
+    Flux ratio between the science image and template, found from pixels
+    detected in both images after each has been convolved with the PSF of the
+    other so they have the same PSF. The ratio is found by least squares and
+    pixels which don't follow it (e.g. variable sources or cosmic rays) are
+    removed by sigma clipping.
+
+    :param science_conv: Science image convolved with the PSF of the template
+    :type science_conv: 2D array
+    :param reference_conv: Template convolved with the PSF of the science image
+    :type reference_conv: 2D array
+    :param use: Pixels that can be used
+    :type use: 2D array
+    :param science_noise: Noise of *science_conv*
+    :type science_noise: float
+    :param reference_noise: Noise of *reference_conv*
+    :type reference_noise: float
+    :param snr_limit: Minimum signal to noise ratio of pixels used in both images, defaults to 5
+    :type snr_limit: float, optional
+    :param sigma: Number of standard deviations used when clipping pixels, defaults to 3
+    :type sigma: float, optional
+    :param maxiters: Maximum number of clipping iterations, defaults to 10
+    :type maxiters: int, optional
+    :param min_pixels: Minimum number of pixels needed, defaults to 10
+    :type min_pixels: int, optional
+    :return: Flux of science image divided by flux of template
+    :rtype: float
+
+    '''
+
+    import numpy as np
+
+    use = use & (science_conv > snr_limit * science_noise) & (reference_conv > snr_limit * reference_noise)
+
+    n = science_conv[use]
+    r = reference_conv[use]
+
+    if len(n) < min_pixels:
+        raise Exception('Too few pixels [%d] to match flux of image and template' % len(n))
+
+    for i in range(maxiters):
+
+        ratio = np.sum(n*r)/np.sum(r*r)
+
+        resid = n - ratio*r
+        std = 1.4826*np.median(np.abs(resid - np.median(resid)))
+
+        keep = np.abs(resid) <= sigma * std
+
+        if np.all(keep) or np.sum(keep) < min_pixels:
+            break
+
+        n = n[keep]
+        r = r[keep]
+
+    return ratio
+
+
+def subtract_zogy(science,reference,science_psf,reference_psf,mask = None,
+                  science_saturation = None,reference_saturation = None,
+                  flux_ratio = None,bkg_level = 3,n_threads = -1):
+    '''
+    Subtract a template from a science image. The images must already be
+    aligned and have the same shape. The background of each image is removed
+    using its sigma clipped median and the noise of each image is given by its
+    sigma clipped standard deviation.
+
+    :param science: Science image
+    :type science: 2D array
+    :param reference: Template aligned to the science image
+    :type reference: 2D array
+    :param science_psf: PSF model of the science image
+    :type science_psf: 2D array
+    :param reference_psf: PSF model of the template
+    :type reference_psf: 2D array
+    :param mask: Pixels to ignore in either image, defaults to None
+    :type mask: 2D array, optional
+    :param science_saturation: Pixels in the science image above this level are not used to find the flux ratio, defaults to None
+    :type science_saturation: float, optional
+    :param reference_saturation: Pixels in the template above this level are not used to find the flux ratio, defaults to None
+    :type reference_saturation: float, optional
+    :param flux_ratio: Flux of science image divided by flux of template. If None, this is found using *match_flux*, defaults to None
+    :type flux_ratio: float, optional
+    :param bkg_level: The number of standard deviations, below which is assumed to be due to the background noise distribution, defaults to 3
+    :type bkg_level: float, optional
+    :param n_threads: Number of threads used to find Fourier transforms, -1 uses all available threads, defaults to -1
+    :type n_threads: int, optional
+    :return: Difference image, with masked pixels set to nan, and the flux ratio used
+    :rtype: tuple
+
+    '''
+
+    import logging
+    import numpy as np
+    from scipy import fft
+    from astropy.stats import sigma_clipped_stats
+
+    logger = logging.getLogger(__name__)
+
+    science = np.asarray(science,dtype = float)
+    reference = np.asarray(reference,dtype = float)
+
+    if science.shape != reference.shape:
+        raise Exception('Image and template must have the same shape')
+
+    bad = ~np.isfinite(science) | ~np.isfinite(reference)
+
+    if mask is not None:
+        bad |= np.asarray(mask).astype(bool)
+
+    _, science_bkg, science_sigma = sigma_clipped_stats(science[~bad],sigma = bkg_level,maxiters = 10)
+    _, reference_bkg, reference_sigma = sigma_clipped_stats(reference[~bad],sigma = bkg_level,maxiters = 10)
+
+    science_psf = np.nan_to_num(np.asarray(science_psf,dtype = float))
+    science_psf = science_psf/np.sum(science_psf)
+
+    reference_psf = np.nan_to_num(np.asarray(reference_psf,dtype = float))
+    reference_psf = reference_psf/np.sum(reference_psf)
+
+    N = np.where(bad,0,science - science_bkg)
+    R = np.where(bad,0,reference - reference_bkg)
+
+    # Pad by the size of the PSF so sources don't wrap around the edges
+    pad = max(science_psf.shape + reference_psf.shape)
+    shape = tuple(fft.next_fast_len(int(i + pad),real = True) for i in N.shape)
+
+    N_hat = fft.rfft2(N,s = shape,workers = n_threads)
+    R_hat = fft.rfft2(R,s = shape,workers = n_threads)
+
+    Pn_hat = psf_fft(science_psf,shape,n_threads = n_threads)
+    Pr_hat = psf_fft(reference_psf,shape,n_threads = n_threads)
+
+    ny,nx = N.shape
+
+    if flux_ratio is None:
+
+        # Both images convolved with the PSF of the other have the same PSF
+        N_conv = fft.irfft2(N_hat*Pr_hat,s = shape,workers = n_threads)[:ny,:nx]
+        R_conv = fft.irfft2(R_hat*Pn_hat,s = shape,workers = n_threads)[:ny,:nx]
+
+        use = ~bad
+
+        if science_saturation is not None:
+            use &= ~(science >= science_saturation)
+        if reference_saturation is not None:
+            use &= ~(reference >= reference_saturation)
+
+        flux_ratio = match_flux(N_conv,R_conv,use,
+                                science_noise = science_sigma*np.sqrt(np.sum(reference_psf**2)),
+                                reference_noise = reference_sigma*np.sqrt(np.sum(science_psf**2)))
+
+        del N_conv,R_conv
+
+    logger.info('Image / template flux ratio: %.3f' % flux_ratio)
+
+    # Zero points normalised to the science image
+    Fn = 1
+    Fr = 1/flux_ratio
+
+    denominator = np.sqrt(science_sigma**2 * Fr**2 * np.abs(Pr_hat)**2 + reference_sigma**2 * Fn**2 * np.abs(Pn_hat)**2)
+    denominator[denominator == 0] = np.finfo(float).tiny
+
+    D_hat = Fr*Pr_hat*N_hat
+    D_hat -= Fn*Pn_hat*R_hat
+    D_hat /= denominator
+
+    del N_hat,R_hat,denominator
+
+    # Zero point of the difference image
+    Fd = Fr*Fn/np.sqrt(science_sigma**2 * Fr**2 + reference_sigma**2 * Fn**2)
+
+    diff = fft.irfft2(D_hat,s = shape,workers = n_threads)[:ny,:nx] / Fd
+
+    diff[bad] = np.nan
+
+    return diff, flux_ratio
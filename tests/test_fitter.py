@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from autophot.packages.fitter import benchmark, fit_kernel, fit_parameters
+from autophot.packages.kernels import model_kernel
+
+
+def simulated_source(size = 21,seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    yy,xx = np.mgrid[0:size,0:size]
+
+    kernel = model_kernel(xx,yy,use_moffat = True)
+
+    truth = {'A':5000,'x0':10.3,'y0':9.8,'sky':50,'alpha':3.0,'beta':4.765}
+
+    image = kernel.evaluate(np.array([list(truth.values())])).reshape(kernel.shape)
+    image = image + rng.normal(0,10,kernel.shape)
+
+    return kernel, image, truth
+
+
+@pytest.mark.parametrize('method',['least_squares','leastsq'])
+def test_lmfit_analytic_jacobian(method):
+
+    kernel, image, truth = simulated_source()
+
+    pars = fit_parameters()
+    pars.add('A',value = np.nanmax(image) * 0.5,min = 1e-6)
+    pars.add('x0',value = 10.5,min = 7.5,max = 13.5)
+    pars.add('y0',value = 10.5,min = 7.5,max = 13.5)
+    pars.add('sky',value = np.nanmedian(image))
+    pars.add('alpha',value = truth['alpha'],min = 0,vary = False)
+    pars.add('beta',value = truth['beta'],min = 0,vary = False)
+
+    result = fit_kernel(kernel,image,pars,method = method)
+
+    assert result.success
+    assert abs(result.params['x0'].value - truth['x0']) < 0.05
+    assert abs(result.params['y0'].value - truth['y0']) < 0.05
+    assert abs(result.params['A'].value - truth['A']) / truth['A'] < 0.05
+
+
+
+def test_benchmark_backends_agree():
+
+    results = benchmark(n_sources = 10,print_results = False)
+
+    assert set(results['method']) == {'least_squares','fast_least_squares','fast_lm'}
+    assert results['agrees'].all()